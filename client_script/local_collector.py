@@ -3,90 +3,709 @@
 
 import sys
 import os
-import psutil
-import argparse
-import datetime
+import marshal
+import mmap
+import struct
 import time
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
+# Each collection starts a new interpreter: modules which are slow to import (psutil, cryptography,
+# argparse, subprocess) are only imported by the code paths using them, see get_psutil and
+# envelope.load_public_key.
+_psutil = None
 
 
 OUTPUT_DATA_FILEPATH = '/tmp/data_output.txt'
-# test
+# Used when the script runs from a checkout rather than from the collector bundle
+SERVER_LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server_script',
+                              'lib')
+FRAME_HEADER_FORMAT = '>I'
 
-#ETRICS_MAPPING = {proc: ''}
+AGENT_DIR = '/tmp/fleet_health'
+RING_FILEPATH = os.path.join(AGENT_DIR, 'samples.ring')
+AGENT_PID_FILEPATH = os.path.join(AGENT_DIR, 'agent.pid')
+# One day of samples at the default rate
+DEFAULT_RING_CAPACITY = 8640
+DEFAULT_SAMPLING_RATE = 10
+# The agent stops itself when its samples weren't drained for that long
+DEFAULT_AGENT_IDLE_EXIT = 3600
+RING_MAGIC = b'FHRB'
+RING_VERSION = 1
+# magic, version, record_size, capacity, ring_id, next_seq, last_drain, acked_seq (acked_seq lives
+# in what used to be padding, rings of older agents read as nothing acknowledged)
+RING_HEADER_FORMAT = '<4sHHIQQdQ'
+RING_HEADER_SIZE = 64
+# Offsets of the header fields updated after the creation. Each one has a single writer which only
+# writes its own field: next_seq the sampling process, last_drain and acked_seq the drains.
+RING_NEXT_SEQ_OFFSET = struct.calcsize('<4sHHIQ')
+RING_LAST_DRAIN_OFFSET = struct.calcsize('<4sHHIQQ')
+RING_ACKED_SEQ_OFFSET = struct.calcsize('<4sHHIQQd')
+# seq, timestamp, cpu_usage, mem_usage, uptime
+RING_RECORD_FORMAT = '<Qdffd'
+# Counters of the previous collection: cpu usage and rates are computed from their deltas rather
+# than by sampling over a blocking interval
+STATE_FILEPATH = os.path.join(AGENT_DIR, 'counters.state')
+DEFAULT_TOP_PROCESSES = 5
+# Characters separating the extra metrics (key=value;key=value) and the fields of the stats line
+EXTRA_METRICS_TABLE = str.maketrans(dict((c, '_') for c in ',;=:| \t\n\r\x0b\x0c'))
 
-def collect_cpu_usage(max_from_individual=False):
-	# max_from_individual if true returns the percent of the max used CPU core
-	# otherise it returns the total usage
-	# To be implemented using percpu parameter
-	return psutil.cpu_percent(interval=1)
+# Extra metrics collected along cpu, mem and uptime: {name: function(snapshot) returning a list
+# of (key, value)}. See register_metric.
+METRICS = {}
+
+# On Linux the stats are read from /proc directly (same values and accounting as psutil, which
+# takes longer to import than a whole collection). Other platforms, or --psutil, go through psutil.
+PROC_DIR = '/proc'
+USE_PROC = sys.platform.startswith('linux') and os.access(os.path.join(PROC_DIR, 'stat'), os.R_OK)
+# Sector size of the /proc/diskstats counters, whatever the device
+DISKSTATS_SECTOR_SIZE = 512
+
+def get_psutil():
+  """Return the psutil module, imported on first use.
+
+  Raises:
+    ImportError: if psutil isn't installed, metrics needing it are then skipped.
+  """
+  global _psutil
+  if _psutil is None:
+    import psutil
+    _psutil = psutil
+  return _psutil
+
+def is_psutil_error(e):
+  # psutil errors (access denied, process gone...) can only be raised once it was imported
+  return _psutil is not None and isinstance(e, _psutil.Error)
+
+def read_proc_file(name):
+  with open(os.path.join(PROC_DIR, name)) as f:
+    return f.read()
+
+def read_meminfo():
+  """Return /proc/meminfo as {key: bytes}."""
+  meminfo = {}
+  for line in read_proc_file('meminfo').splitlines():
+    fields = line.split()
+    if len(fields) >= 2:
+      meminfo[fields[0].rstrip(':')] = int(fields[1]) * (1024 if fields[-1] == 'kB' else 1)
+  return meminfo
+
+def read_boot_time():
+  for line in read_proc_file('stat').splitlines():
+    if line.startswith('btime '):
+      return float(line.split()[1])
+  raise OSError('No btime in %s/stat' % PROC_DIR)
+
+def collect_cpu_usage(max_from_individual=False, interval=1):
+  # max_from_individual if true returns the percent of the max used CPU core
+  # otherise it returns the total usage
+  # interval=None doesn't block: usage is computed since the previous call
+  psutil = get_psutil()
+  if max_from_individual:
+    return max(psutil.cpu_percent(interval=interval, percpu=True))
+  return psutil.cpu_percent(interval=interval)
 
 def collect_mem_usage():
   # According to psutil documentation the best way to get th memory usage
   # is by calulating the 100% - avaiable/total rather than using directly
   # used / total
   # Documentation ref: https://pythonhosted.org/psutil/
-  # interval needs to be checked
-  memory = psutil.virtual_memory()
+  if USE_PROC:
+    meminfo = read_meminfo()
+    # Kernels older than 3.14 don't report MemAvailable
+    available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0) +
+                            meminfo.get('Buffers', 0) + meminfo.get('Cached', 0))
+    return '%2.2f' % (100 - available / meminfo['MemTotal'] * 100)
+  memory = get_psutil().virtual_memory()
   if memory:
-    return '%2.2f' % (memory.available / memory.total * 100)
+    return '%2.2f' % (100 - memory.available / memory.total * 100)
   else:
   	return -1
 
+def get_cpu_times(times):
+  # Same accounting as psutil.cpu_percent: guest time is already part of user time and iowait is
+  # idle time. Returns (busy, total)
+  total = sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+  return total - times.idle - getattr(times, 'iowait', 0), total
+
+def read_cpu_times():
+  """Return the (busy, total) seconds of each core, see get_cpu_times."""
+  if not USE_PROC:
+    return [get_cpu_times(t) for t in get_psutil().cpu_times(percpu=True)]
+  ticks = float(os.sysconf('SC_CLK_TCK'))
+  cores = []
+  for line in read_proc_file('stat').splitlines():
+    if not line.startswith('cpu'):
+      break
+    if line[3].isdigit():
+      # user nice system idle iowait irq softirq steal guest guest_nice
+      times = [int(v) / ticks for v in line.split()[1:11]]
+      total = sum(times[:8])
+      cores.append((total - times[3] - (times[4] if len(times) > 4 else 0), total))
+  return cores
+
+class Snapshot(object):
+  """Readings of a single collection, shared by the metrics.
+
+  Counters recorded with get_delta are saved for the next collection (see save_state), deltas
+  and rates are computed against the values of the previous one.
+  """
+
+  def __init__(self, previous=None, now=None):
+    self.now = now or time.time()
+    self.previous = previous or {}
+    self.counters = {'time': self.now}
+    previous_time = self.previous.get('time')
+    self.elapsed = self.now - previous_time if previous_time else None
+    self._cpu_usages = None
+
+  def get_delta(self, key, value):
+    """Record counter key, return its increase since the previous collection (None if unknown)."""
+    self.counters[key] = value
+    previous = self.previous.get(key)
+    # Counters are reset on reboot
+    if previous is None or not self.elapsed or self.elapsed <= 0 or value < previous:
+      return None
+    return value - previous
+
+  def get_rate(self, key, value):
+    delta = self.get_delta(key, value)
+    return None if delta is None else delta / self.elapsed
+
+  def get_cpu_usages(self):
+    """Return (total usage, list of usage per core) since the previous collection.
+
+    The first collection (or the first after a reboot) reports the usage since boot.
+    """
+    if self._cpu_usages is None:
+      cores = read_cpu_times()
+      previous = self.previous.get('cpu_times')
+      self.counters['cpu_times'] = cores
+      if (not previous or len(previous) != len(cores) or
+          any(c[1] < p[1] for c, p in zip(cores, previous))):
+        previous = [(0, 0)] * len(cores)
+      usages = []
+      busy = total = 0
+      for (core_busy, core_total), (previous_busy, previous_total) in zip(cores, previous):
+        busy += max(0, core_busy - previous_busy)
+        total += core_total - previous_total
+        usages.append(100.0 * max(0, core_busy - previous_busy) / (core_total - previous_total)
+                      if core_total > previous_total else 0.0)
+      self._cpu_usages = (100.0 * busy / total if total > 0 else 0.0, usages)
+    return self._cpu_usages
+
+def load_state(state_filepath=STATE_FILEPATH):
+  # marshal rather than json: it's built in the interpreter and much faster to import
+  try:
+    with open(state_filepath, 'rb') as f:
+      state = marshal.load(f)
+  except (IOError, OSError, EOFError, ValueError, TypeError):
+    return {}
+  return state if isinstance(state, dict) else {}
+
+def save_state(snapshot, state_filepath=STATE_FILEPATH):
+  # Losing the counters only costs the rates of the next collection
+  try:
+    directory = os.path.dirname(state_filepath)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory, mode=0o700)
+    tmp_filepath = '%s.%d.tmp' % (state_filepath, os.getpid())
+    with open(tmp_filepath, 'wb') as f:
+      marshal.dump(snapshot.counters, f)
+    os.rename(tmp_filepath, state_filepath)
+  except (IOError, OSError):
+    pass
+
+def register_metric(name):
+  """Decorator adding a metric function to METRICS.
+
+  The function takes the Snapshot of the collection and returns a list of (key, value). Metrics
+  which can't be read on the machine return no value (or None values) rather than failing.
+  """
+  def decorator(func):
+    METRICS[name] = func
+    return func
+  return decorator
+
+@register_metric('cpu')
+def collect_core_usages(snapshot):
+  usages = snapshot.get_cpu_usages()[1]
+  values = [('cpu_max_pct', max(usages) if usages else None)]
+  values.extend(('cpu%d_pct' % i, usage) for i, usage in enumerate(usages))
+  return values
+
+@register_metric('load')
+def collect_load(snapshot):
+  if hasattr(os, 'getloadavg'):
+    load1, load5, load15 = os.getloadavg()
+  else:
+    # Emulated by psutil on Windows
+    load1, load5, load15 = get_psutil().getloadavg()
+  return [('load1', load1), ('load5', load5), ('load15', load15)]
+
+@register_metric('swap')
+def collect_swap(snapshot):
+  if USE_PROC:
+    meminfo = read_meminfo()
+    total = meminfo.get('SwapTotal', 0)
+    return [('swap_pct', 100.0 * (total - meminfo.get('SwapFree', 0)) / total if total else 0.0)]
+  return [('swap_pct', get_psutil().swap_memory().percent)]
+
+def read_disk_io():
+  """Return (read bytes, written bytes) of the disks, None if unknown."""
+  if not USE_PROC:
+    counters = get_psutil().disk_io_counters()
+    return (counters.read_bytes, counters.write_bytes) if counters else None
+  read_bytes = write_bytes = 0
+  for line in read_proc_file('diskstats').splitlines():
+    fields = line.split()
+    # Partitions are already accounted for by their disk, only devices of /sys/block are summed
+    if len(fields) < 10 or not os.path.exists('/sys/block/%s' % fields[2].replace('/', '!')):
+      continue
+    read_bytes += int(fields[5]) * DISKSTATS_SECTOR_SIZE
+    write_bytes += int(fields[9]) * DISKSTATS_SECTOR_SIZE
+  return read_bytes, write_bytes
+
+@register_metric('disk')
+def collect_disk(snapshot):
+  if os.name == 'nt':
+    root = os.environ.get('SystemDrive', 'C:') + '\\'
+    values = [('disk_pct', get_psutil().disk_usage(root).percent)]
+  else:
+    # Same as psutil.disk_usage: the space reserved to root isn't available
+    stat = os.statvfs('/')
+    used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+    available = used + stat.f_bavail * stat.f_frsize
+    values = [('disk_pct', 100.0 * used / available if available else 0.0)]
+  counters = read_disk_io()
+  if counters:
+    values.append(('disk_read_bps', snapshot.get_rate('disk_read_bytes', counters[0])))
+    values.append(('disk_write_bps', snapshot.get_rate('disk_write_bytes', counters[1])))
+  return values
+
+def read_net_io():
+  """Return (received bytes, sent bytes) of all the interfaces, None if unknown."""
+  if not USE_PROC:
+    counters = get_psutil().net_io_counters()
+    return (counters.bytes_recv, counters.bytes_sent) if counters else None
+  bytes_recv = bytes_sent = 0
+  # Two header lines, then: interface: rx bytes packets errs drop fifo frame compressed multicast
+  # tx bytes ...
+  for line in read_proc_file('net/dev').splitlines()[2:]:
+    fields = line.split(':', 1)[1].split()
+    bytes_recv += int(fields[0])
+    bytes_sent += int(fields[8])
+  return bytes_recv, bytes_sent
+
+@register_metric('net')
+def collect_net(snapshot):
+  counters = read_net_io()
+  if not counters:
+    return []
+  return [('net_rx_bps', snapshot.get_rate('net_bytes_recv', counters[0])),
+          ('net_tx_bps', snapshot.get_rate('net_bytes_sent', counters[1]))]
+
+def iter_processes():
+  """Yield (pid, name, cpu seconds, create time) of each process."""
+  if not USE_PROC:
+    # process_iter reads the attributes of each process within its oneshot() context
+    for proc in get_psutil().process_iter(['name', 'cpu_times', 'create_time']):
+      info = proc.info
+      if info['cpu_times'] is not None and info['create_time'] is not None:
+        yield (proc.pid, info['name'] or '', info['cpu_times'].user + info['cpu_times'].system,
+               info['create_time'])
+    return
+  ticks = float(os.sysconf('SC_CLK_TCK'))
+  boot_time = read_boot_time()
+  for entry in os.listdir(PROC_DIR):
+    if not entry.isdigit():
+      continue
+    try:
+      data = read_proc_file(os.path.join(entry, 'stat'))
+    except (IOError, OSError):
+      # The process exited meanwhile
+      continue
+    # pid (name) state ppid ... the name can contain spaces and parentheses
+    name_end = data.rfind(')')
+    fields = data[name_end + 2:].split()
+    yield (int(entry), data[data.find('(') + 1:name_end],
+           (int(fields[11]) + int(fields[12])) / ticks, boot_time + int(fields[19]) / ticks)
+
+@register_metric('procs')
+def collect_top_processes(snapshot, count=DEFAULT_TOP_PROCESSES):
+  # Value has the format name:pid:cpu_pct|... ordered by cpu usage. The cpu usage of a process is
+  # computed since the previous collection, or since it started
+  previous = snapshot.previous.get('procs', {})
+  cpu_times = {}
+  processes = []
+  for pid, name, cpu_time, create_time in iter_processes():
+    key = '%d:%d' % (pid, create_time)
+    cpu_times[key] = cpu_time
+    if key in previous and snapshot.elapsed:
+      usage = (cpu_time - previous[key]) / snapshot.elapsed
+    else:
+      usage = cpu_time / max(1, snapshot.now - create_time)
+    processes.append((100.0 * usage, pid, name))
+  snapshot.counters['procs'] = cpu_times
+  processes.sort(reverse=True)
+  return [('procs', '|'.join('%s:%d:%.1f' % (name.translate(EXTRA_METRICS_TABLE), pid, usage)
+                             for usage, pid, name in processes[:count]))]
+
+def collect_extra_metrics(snapshot, metric_names=None):
+  """Return the extra metrics as ({key: number}, {key: str}), unknown values being skipped."""
+  metrics = {}
+  labels = {}
+  for name in metric_names if metric_names is not None else METRICS:
+    try:
+      values = METRICS[name](snapshot)
+    except (ImportError, OSError, ValueError, IndexError):
+      # Platform or permission issue, psutil missing..., the other metrics are still reported
+      continue
+    except Exception as e:
+      if not is_psutil_error(e):
+        raise
+      continue
+    for key, value in values:
+      if isinstance(value, str):
+        labels[key] = value
+      elif value is not None:
+        metrics[key] = float(value)
+  return metrics, labels
+
 def collect_uptime():
-  now = datetime.datetime.now()
-  current_timestamp = time.mktime(now.timetuple())
-  return current_timestamp - psutil.boot_time()
+  if USE_PROC:
+    return float(read_proc_file('uptime').split()[0])
+  return time.time() - get_psutil().boot_time()
 
 def collect_event_logs():
   return 'empty'
 
+def get_lib_module(name):
+  """Return the module name of server_script/lib bundled with the script."""
+  try:
+    module = __import__(name)
+  except ImportError:
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SERVER_LIB_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+  return module
+
+def get_envelope():
+  """Return the envelope module (server_script/lib/envelope.py) bundled with the script."""
+  return get_lib_module('envelope')
+
+def get_wire():
+  """Return the wire module (server_script/lib/wire.py) bundled with the script."""
+  return get_lib_module('wire')
+
 def encrypt_text(message, public_key):
-  #public_key = serialization.load_pem_public_key(public_pem_data, backend=default_backend())
-  #print('debug public key: %s' % isinstance(public_key, rsa.RSAPublicKey))
-  #return isinstance(public_key, rsa.RSAPublicKey)
-
-  ciphertext = public_key.encrypt(message.encode('utf-8'), padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                        algorithm=hashes.SHA256(),
-                                                        label=None))
-  return ciphertext
-
-def format_results(results, csv_char=','):
-  # format according to csv format
-  return csv_char.join(results)
-
-def collect_sys_stats(public_key=None): #metrics
-  os_family = os.name # or sys,platform
-  # metrics is a list which contains the metrics that need to be collected
-  #canonical_metrics = [m.lower() for m in metrics]
-  #if 'cpu' in canonical_metrics:
-  # return value is a tuple of the format: os, cpu_usage, mem_usage, uptime, event_logs
-  cpu_usage = collect_cpu_usage()
-  mem_usage = collect_mem_usage()
-  uptime =  collect_uptime()
-  event_logs = collect_event_logs() if os.name == 'nt' else 'empty'
-
-  # need tocheck whether to use tuple or namedtuple or list or other...
-  stats_results = format_results((os.name, str(cpu_usage), str(mem_usage), str(uptime), event_logs))
-  #print('debug: %s, %s' % (str(cpu_usage), str(mem_usage)))
-  #return cpu_usage, mem_usage
+  """Encrypt message into an envelope, see server_script/lib/envelope.py."""
+  plaintext = message if isinstance(message, bytes) else message.encode('utf-8')
+  return get_envelope().encrypt(plaintext, public_key)
+
+def collect_sys_stats(public_key=None, metric_names=None, state_filepath=STATE_FILEPATH):
+  # metric_names is the list of the extra METRICS to collect, all of them if None
+  # return value is a batch (see server_script/lib/wire.py) of a single record, encrypted if public_key is set
+  sampled_at = time.time()
+  snapshot = Snapshot(load_state(state_filepath), sampled_at)
+  metrics, labels = collect_extra_metrics(snapshot, metric_names)
+  wire = get_wire()
+  record = wire.Record(sampled_at=sampled_at, os=os.name, cpu_usage=snapshot.get_cpu_usages()[0],
+                       mem_usage=float(collect_mem_usage()), uptime=collect_uptime(),
+                       event_logs=collect_event_logs() if os.name == 'nt' else 'empty',
+                       metrics=metrics, labels=labels)
+  save_state(snapshot, state_filepath)
+
+  batch = wire.encode_batch([record])
+  if public_key:
+    return encrypt_text(batch, public_key)
+  else:
+    return batch
+
+class SampleRing(object):
+  """Fixed size ring buffer of samples, memory mapped so the agent and drains share it.
+
+  The file starts with a RING_HEADER_SIZE bytes header followed by capacity records. Records are
+  numbered from 1, record seq lives in slot seq % capacity. The writer stores the record first
+  and only then publishes it by updating next_seq in the header.
+
+  Drains acknowledge the samples the server stored (acked_seq), they are never sent again, even to
+  a server which lost its cursor, and their slots are free to be overwritten. Samples overwritten
+  before being acknowledged are reported as dropped.
+  """
+
+  def __init__(self, filepath=RING_FILEPATH, capacity=DEFAULT_RING_CAPACITY, create=True):
+    self.filepath = filepath
+    self.record_size = struct.calcsize(RING_RECORD_FORMAT)
+    if not self._is_valid(filepath):
+      if not create:
+        raise IOError('No valid sample ring in %s' % filepath)
+      self._create(filepath, capacity)
+    self.file = open(filepath, 'r+b')
+    self.map = mmap.mmap(self.file.fileno(), 0)
+    self.capacity = self._read_header()[3]
+
+  def _is_valid(self, filepath):
+    try:
+      with open(filepath, 'rb') as f:
+        header = f.read(struct.calcsize(RING_HEADER_FORMAT))
+        size = os.fstat(f.fileno()).st_size
+      magic, version, record_size, capacity = struct.unpack(RING_HEADER_FORMAT, header)[:4]
+    except (IOError, OSError, struct.error):
+      return False
+    return (magic == RING_MAGIC and version == RING_VERSION and record_size == self.record_size
+            and size == RING_HEADER_SIZE + capacity * record_size)
+
+  def _create(self, filepath, capacity):
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory, mode=0o700)
+    tmp_filepath = '%s.%d.tmp' % (filepath, os.getpid())
+    header = struct.pack(RING_HEADER_FORMAT, RING_MAGIC, RING_VERSION, self.record_size, capacity,
+                         struct.unpack('<Q', os.urandom(8))[0], 1, time.time(), 0)
+    fd = os.open(tmp_filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(header.ljust(RING_HEADER_SIZE, b'\0'))
+      f.truncate(RING_HEADER_SIZE + capacity * self.record_size)
+    os.rename(tmp_filepath, filepath)
+
+  def _read_header(self):
+    return struct.unpack_from(RING_HEADER_FORMAT, self.map, 0)
+
+  def _write_header_field(self, offset, field_format, value):
+    # Rewriting the whole header would revert the fields written meanwhile by the other process.
+    struct.pack_into(field_format, self.map, offset, value)
+
+  def append(self, timestamp, cpu_usage, mem_usage, uptime):
+    seq = self._read_header()[5]
+    offset = RING_HEADER_SIZE + (seq % self.capacity) * self.record_size
+    struct.pack_into(RING_RECORD_FORMAT, self.map, offset, seq, timestamp, cpu_usage, mem_usage,
+                     uptime)
+    self._write_header_field(RING_NEXT_SEQ_OFFSET, '<Q', seq + 1)
+    return seq
+
+  def read_since(self, ring_id, cursor):
+    """Return the samples recorded after cursor.
+
+    Args:
+      ring_id: int, id of the ring the cursor refers to. If the ring was re-created since
+        (reboot for eg.), all its samples are returned.
+      cursor: int, seq of the last sample already received.
+
+    Returns:
+      tuple (ring_id, last_seq, list of (seq, timestamp, cpu_usage, mem_usage, uptime)).
+    """
+    current_ring_id, next_seq = self._read_header()[4:6]
+    if ring_id != current_ring_id or cursor >= next_seq:
+      cursor = 0
+    first_seq = max(cursor + 1, next_seq - self.capacity, 1)
+    records = []
+    for seq in range(first_seq, next_seq):
+      offset = RING_HEADER_SIZE + (seq % self.capacity) * self.record_size
+      record = struct.unpack_from(RING_RECORD_FORMAT, self.map, offset)
+      # The slot was overwritten by the agent while draining
+      if record[0] == seq:
+        records.append(record)
+    return current_ring_id, next_seq - 1, records
+
+  def acknowledge(self, ring_id, seq):
+    """Record that the server stored the samples up to seq of ring_id.
+
+    Returns:
+      int, seq of the last acknowledged sample of the ring (whichever ring_id was passed).
+    """
+    header = self._read_header()
+    current_ring_id, next_seq, acked_seq = header[4], header[5], header[7]
+    if ring_id == current_ring_id and acked_seq < seq < next_seq:
+      self._write_header_field(RING_ACKED_SEQ_OFFSET, '<Q', seq)
+      acked_seq = seq
+    return acked_seq
+
+  def get_last_sample_time(self):
+    """Return the time of the most recent sample, None if the ring is empty."""
+    seq = self._read_header()[5] - 1
+    if seq < 1:
+      return None
+    offset = RING_HEADER_SIZE + (seq % self.capacity) * self.record_size
+    record = struct.unpack_from(RING_RECORD_FORMAT, self.map, offset)
+    return record[1] if record[0] == seq else None
+
+  def touch_drain(self):
+    self._write_header_field(RING_LAST_DRAIN_OFFSET, '<d', time.time())
+
+  def get_last_drain(self):
+    return self._read_header()[6]
+
+  def get_ring_id(self):
+    return self._read_header()[4]
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+def is_agent_running(pid_filepath=AGENT_PID_FILEPATH):
+  try:
+    with open(pid_filepath) as f:
+      pid = int(f.read().strip())
+    os.kill(pid, 0)
+    return True
+  except (IOError, OSError, ValueError):
+    return False
+
+def is_ring_fed(rate, filepath=RING_FILEPATH):
+  """Return whether samples are appended to the ring by a schedule (see sample_once)."""
+  try:
+    ring = SampleRing(filepath, create=False)
+  except IOError:
+    return False
+  try:
+    last_sample_time = ring.get_last_sample_time()
+  finally:
+    ring.close()
+  return last_sample_time is not None and time.time() - last_sample_time < 2 * rate
+
+def start_agent(rate, capacity, idle_exit):
+  """Start a detached agent process which outlives the current ssh session."""
+  import subprocess
+  # argv[0] rather than __file__ which is inside the archive when run as a zipapp
+  command = [sys.executable, os.path.abspath(sys.argv[0]), '--agent', '--rate', str(rate),
+             '--ring_capacity', str(capacity), '--agent_idle_exit', str(idle_exit)]
+  if not USE_PROC:
+    command.append('--psutil')
+  devnull = open(os.devnull, 'r+b')
+  subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+                   start_new_session=True)
+
+def lock_pid_file(pid_filepath):
+  """Hold an exclusive lock on the pid file of the agent and write the pid of the process to it.
+
+  Returns:
+    int, file descriptor keeping the lock, None if another agent holds it.
+  """
+  import fcntl
+  while True:
+    fd = os.open(pid_filepath, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+      os.close(fd)
+      return None
+    try:
+      locked_current_file = os.stat(pid_filepath).st_ino == os.fstat(fd).st_ino
+    except OSError:
+      locked_current_file = False
+    if locked_current_file:
+      break
+    # The file was removed by an exiting agent after it was opened, the next agent would lock
+    # another one.
+    os.close(fd)
+  os.ftruncate(fd, 0)
+  os.write(fd, str(os.getpid()).encode('ascii'))
+  return fd
+
+def unlock_pid_file(pid_filepath, fd):
+  """Remove the pid file if it's still the one of the process, then release its lock."""
+  try:
+    with open(pid_filepath) as f:
+      own_file = f.read().strip() == str(os.getpid())
+    if own_file:
+      os.remove(pid_filepath)
+  except (IOError, OSError):
+    pass
+  finally:
+    os.close(fd)
+
+def run_agent(rate, capacity, idle_exit, pid_filepath=AGENT_PID_FILEPATH):
+  """Sample the machine every rate seconds into the ring until the samples stop being drained."""
+  directory = os.path.dirname(pid_filepath)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory, mode=0o700)
+  # Two collections starting an agent at the same time only get one of them running.
+  pid_fd = lock_pid_file(pid_filepath)
+  if pid_fd is None:
+    return
+  try:
+    ring = SampleRing(capacity=capacity)
+    # Primes the cpu counters, each sample reports the usage since the previous one
+    snapshot = Snapshot()
+    snapshot.get_cpu_usages()
+    counters = snapshot.counters
+    # last_drain is only written by the drains, the agent counts its idle time from its start too.
+    started_at = time.time()
+    next_sample = started_at + rate
+    try:
+      while time.time() - max(started_at, ring.get_last_drain()) < idle_exit:
+        time.sleep(max(0, next_sample - time.time()))
+        next_sample += rate
+        snapshot = Snapshot(counters)
+        ring.append(snapshot.now, snapshot.get_cpu_usages()[0], float(collect_mem_usage()),
+                    collect_uptime())
+        counters = snapshot.counters
+    finally:
+      ring.close()
+  finally:
+    unlock_pid_file(pid_filepath, pid_fd)
+
+def sample_once(capacity=DEFAULT_RING_CAPACITY, filepath=RING_FILEPATH,
+                state_filepath=STATE_FILEPATH):
+  """Append a sample to the ring, to be run by a schedule (cron...) instead of a resident agent.
+
+  The cpu usage is the one since the previous sample, taken from the saved counters.
+  """
+  sampled_at = time.time()
+  snapshot = Snapshot(load_state(state_filepath), sampled_at)
+  ring = SampleRing(filepath, capacity)
+  try:
+    seq = ring.append(sampled_at, snapshot.get_cpu_usages()[0], float(collect_mem_usage()),
+                      collect_uptime())
+  finally:
+    ring.close()
+  save_state(snapshot, state_filepath)
+  return seq
+
+def encode_drained_samples(ring_id, last_seq, samples, dropped=0):
+  # The cursor of the agent (ring_id, last_seq) is the meta of the batch
+  wire = get_wire()
+  return wire.encode_batch([wire.Record(seq=seq, sampled_at=timestamp, os=os.name,
+                                        cpu_usage=cpu_usage, mem_usage=mem_usage, uptime=uptime,
+                                        event_logs='empty')
+                            for seq, timestamp, cpu_usage, mem_usage, uptime in samples],
+                           meta={'agent': '1', 'ring_id': str(ring_id),
+                                 'last_seq': str(last_seq), 'dropped': str(dropped)},
+                           fields=wire.AGENT_FIELDS)
+
+def drain_samples(ring_id, cursor, public_key=None, filepath=RING_FILEPATH):
+  """Return the samples recorded by the agent after cursor as a batch (encrypted).
+
+  The server only sends a cursor once the samples up to it are stored, the drain acknowledges them.
+  """
+  ring = SampleRing(filepath, create=False)
+  try:
+    acked_seq = ring.acknowledge(ring_id, cursor)
+    current_ring_id, last_seq, records = ring.read_since(ring.get_ring_id(), acked_seq)
+    ring.touch_drain()
+  finally:
+    ring.close()
+  # Samples after the acknowledged ones which were overwritten before being drained
+  dropped = records[0][0] - acked_seq - 1 if records else 0
+  results = encode_drained_samples(current_ring_id, last_seq, records, dropped)
   if public_key:
-    return encrypt_text(stats_results, public_key)
+    return encrypt_text(results, public_key)
   else:
-    return stats_results
+    return results
 
 def get_public_key(pk_file):
   pk_file = open(pk_file, 'rb')
   public_pem_data = pk_file.read()#.encode('utf-8')
-  public_key = serialization.load_pem_public_key(public_pem_data, backend=default_backend())
+  public_key = get_envelope().load_public_key(public_pem_data)
   return public_key
 
+def write_frame(data, stream):
+  # Frame layout has to be kept in sync with server_script/lib/framing.py
+  stream.write(struct.pack(FRAME_HEADER_FORMAT, len(data)))
+  stream.write(data)
+  stream.flush()
+
 def write_data_to_file(data, data_filepath):
   data_file = open(data_filepath, 'wb')
   data_file.write(data)
@@ -94,15 +713,44 @@ def write_data_to_file(data, data_filepath):
   return data_filepath
 
 def main():
+  global USE_PROC
+  import argparse
   parser = argparse.ArgumentParser()
   parser.add_argument('-p', '--public_pem_data', required=False,
                       help='Public pem data to be used to generate the public key that will be'
                            ' used to encrypt output.')
 
-  parser.add_argument('-f', '--public_key_file', required=True,
+  parser.add_argument('-f', '--public_key_file', required=False,
                       help='File that containt the public key that will be used to encrypt output.')
   parser.add_argument('-o', '--output_data_file', required=False, default=OUTPUT_DATA_FILEPATH,
                       help='File that containt the public key that will be used to encrypt output.')
+  parser.add_argument('-s', '--stream', required=False, action='store_true',
+                      help='Write the encrypted output as length prefixed frames on stdout instead'
+                           ' of writing it to --output_data_file.')
+  parser.add_argument('--agent', required=False, action='store_true',
+                      help='Run as a resident agent sampling the machine into a ring buffer.')
+  parser.add_argument('--ensure_agent', required=False, action='store_true',
+                      help='Start the resident agent if it isn\'t running and the ring isn\'t fed'
+                           ' by --sample_once.')
+  parser.add_argument('--sample_once', required=False, action='store_true',
+                      help='Append a single sample to the ring buffer and exit, to be scheduled'
+                           ' (cron...) every --rate seconds instead of running the agent.')
+  parser.add_argument('--drain', required=False, nargs=2, type=int, metavar=('RING_ID', 'CURSOR'),
+                      help='Output the samples recorded by the agent after CURSOR instead of'
+                           ' taking a sample.')
+  parser.add_argument('--rate', required=False, type=float, default=DEFAULT_SAMPLING_RATE,
+                      help='Number of seconds between two samples of the agent.')
+  parser.add_argument('--ring_capacity', required=False, type=int, default=DEFAULT_RING_CAPACITY,
+                      help='Number of samples kept by the agent.')
+  parser.add_argument('--agent_idle_exit', required=False, type=float,
+                      default=DEFAULT_AGENT_IDLE_EXIT,
+                      help='The agent stops when its samples weren\'t drained for that many'
+                           ' seconds.')
+  parser.add_argument('--psutil', required=False, action='store_true',
+                      help='Read the stats with psutil rather than from /proc on Linux.')
+  parser.add_argument('--metrics', required=False, default=','.join(METRICS),
+                      help='Comma separated extra metrics to collect among: %s. Empty to only'
+                           ' collect cpu, mem and uptime.' % ', '.join(METRICS))
   #parser.add_argument('public_pem_data')
 
   args = parser.parse_args()
@@ -119,9 +767,35 @@ def main():
   #pem_test = clean_pem.splitlines()
   #PK_TEST.encode('utf-8')
   #clean_pem
-  stats = collect_sys_stats(get_public_key(args.public_key_file))
+  if args.psutil:
+    USE_PROC = False
+  if args.agent:
+    run_agent(args.rate, args.ring_capacity, args.agent_idle_exit)
+    return
+  if args.sample_once:
+    sample_once(args.ring_capacity)
+    return
+  if not args.public_key_file:
+    parser.error('the following arguments are required: -f/--public_key_file')
+  if args.ensure_agent and not is_agent_running() and not is_ring_fed(args.rate):
+    start_agent(args.rate, args.ring_capacity, args.agent_idle_exit)
+  if args.drain:
+    try:
+      stats = drain_samples(args.drain[0], args.drain[1], get_public_key(args.public_key_file))
+    except IOError:
+      # The agent was just started and didn't create its ring yet
+      stats = encrypt_text(encode_drained_samples(0, 0, []), get_public_key(args.public_key_file))
+  else:
+    metric_names = [m for m in args.metrics.split(',') if m]
+    unknown = [m for m in metric_names if m not in METRICS]
+    if unknown:
+      parser.error('unknown metrics: %s' % ', '.join(unknown))
+    stats = collect_sys_stats(get_public_key(args.public_key_file), metric_names)
   #print('data: %s' % stats)
   #output_file = write_data_to_file(stats, args.output_data_file)
+  if args.stream:
+    write_frame(stats, sys.stdout.buffer)
+    return
   output_file = write_data_to_file(stats, args.output_data_file.strip())
   print(output_file)
   #return args.output_data_file
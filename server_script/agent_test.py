@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+import testutil
+
+from lib import agent
+
+
+def append_samples(ring_file, count, results):
+  """Append count samples to the ring, as the agent does, run in a child process."""
+  ring = testutil.load_local_collector().SampleRing(ring_file, create=False)
+  seqs = [ring.append(1000.0 + i, 1.0, 2.0, 3.0) for i in range(count)]
+  ring.close()
+  results.put(('append', seqs == list(range(1, count + 1))))
+
+
+def acknowledge_samples(ring_file, count, results):
+  """Drain and acknowledge the ring until count samples were acknowledged, run in a child
+  process."""
+  ring = testutil.load_local_collector().SampleRing(ring_file, create=False)
+  ring_id = ring.get_ring_id()
+  acked_seq = 0
+  rewound = False
+  # A rewound next_seq would never reach count.
+  deadline = time.time() + 30
+  while acked_seq < count and time.time() < deadline:
+    # acknowledge(ring_id, 0) only reads the acknowledged seq.
+    rewound = rewound or ring.acknowledge(ring_id, 0) != acked_seq
+    ring.touch_drain()
+    last_seq = ring.read_since(ring_id, acked_seq)[1]
+    acked_seq = ring.acknowledge(ring_id, last_seq) if last_seq > acked_seq else acked_seq
+  ring.close()
+  results.put(('acknowledge', acked_seq == count and not rewound))
+
+
+class SampleRingTest(unittest.TestCase):
+  def setUp(self):
+    self.local_collector = testutil.load_local_collector()
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.ring_file = os.path.join(self.tmp_dir.name, 'samples.ring')
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_read_since_cursor(self):
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=8)
+    for i in range(5):
+      ring.append(1000.0 + i, 10.0 + i, 50.0, 3600.0)
+    ring_id, last_seq, records = ring.read_since(0, 0)
+    self.assertEqual(5, last_seq)
+    self.assertEqual([1, 2, 3, 4, 5], [r[0] for r in records])
+    _, _, records = ring.read_since(ring_id, 3)
+    self.assertEqual([(4, 1003.0, 13.0, 50.0, 3600.0), (5, 1004.0, 14.0, 50.0, 3600.0)], records)
+    self.assertEqual([], ring.read_since(ring_id, 5)[2])
+    ring.close()
+
+  def test_overwritten_samples_skipped(self):
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    for i in range(10):
+      ring.append(1000.0 + i, 1.0, 2.0, 3.0)
+    ring_id, last_seq, records = ring.read_since(0, 0)
+    # Only the capacity most recent samples are still available
+    self.assertEqual([7, 8, 9, 10], [r[0] for r in records])
+    ring.close()
+
+  def test_recreated_ring_resets_cursor(self):
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    ring.append(1000.0, 1.0, 2.0, 3.0)
+    ring_id = ring.read_since(0, 0)[0]
+    ring.close()
+    os.remove(self.ring_file)
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    ring.append(2000.0, 1.0, 2.0, 3.0)
+    new_ring_id, last_seq, records = ring.read_since(ring_id, 1)
+    self.assertNotEqual(ring_id, new_ring_id)
+    self.assertEqual([1], [r[0] for r in records])
+    ring.close()
+
+  def test_shared_between_writer_and_reader(self):
+    writer = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    reader = self.local_collector.SampleRing(self.ring_file, create=False)
+    writer.append(1000.0, 1.0, 2.0, 3.0)
+    self.assertEqual(1, reader.read_since(0, 0)[1])
+    writer.close()
+    reader.close()
+
+  def test_acknowledged_samples_not_drained_again(self):
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    for i in range(3):
+      ring.append(1000.0 + i, 1.0, 2.0, 3.0)
+    ring_id = ring.get_ring_id()
+    ring.close()
+    self.assertEqual(3, len(self.drain(0, 0).samples))
+    self.assertEqual([3], [s.seq for s in self.drain(ring_id, 2).samples])
+    # A server which lost its cursor only gets the samples which weren't acknowledged
+    self.assertEqual([3], [s.seq for s in self.drain(0, 0).samples])
+
+  def test_dropped_samples_reported(self):
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=4)
+    ring.append(1000.0, 1.0, 2.0, 3.0)
+    ring_id = ring.get_ring_id()
+    self.assertEqual(1, ring.acknowledge(ring_id, 1))
+    for i in range(6):
+      ring.append(1001.0 + i, 1.0, 2.0, 3.0)
+    ring.close()
+    drained = self.drain(ring_id, 1)
+    self.assertEqual(([4, 5, 6, 7], 2), ([s.seq for s in drained.samples], drained.dropped))
+
+  def test_append_and_acknowledge_from_two_processes(self):
+    count = 20000
+    ring = self.local_collector.SampleRing(self.ring_file, capacity=count)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=target, args=(self.ring_file, count, results))
+                 for target in (append_samples, acknowledge_samples)]
+    for process in processes:
+      process.start()
+    outcomes = dict(results.get(timeout=60) for _ in processes)
+    for process in processes:
+      process.join()
+    # Neither process reverted the field of the other one.
+    self.assertEqual({'append': True, 'acknowledge': True}, outcomes)
+    ring_id, last_seq, records = ring.read_since(0, 0)
+    self.assertEqual(count, last_seq)
+    self.assertEqual(list(range(1, count + 1)), [r[0] for r in records])
+    self.assertEqual(count, ring.acknowledge(ring_id, 0))
+    ring.close()
+
+  def test_single_agent_pid_file(self):
+    pid_file = os.path.join(self.tmp_dir.name, 'agent.pid')
+    fd = self.local_collector.lock_pid_file(pid_file)
+    self.assertIsNotNone(fd)
+    self.assertTrue(self.local_collector.is_agent_running(pid_file))
+    # Another agent started meanwhile doesn't run.
+    self.assertIsNone(self.local_collector.lock_pid_file(pid_file))
+    self.local_collector.unlock_pid_file(pid_file, fd)
+    self.assertFalse(os.path.exists(pid_file))
+
+    fd = self.local_collector.lock_pid_file(pid_file)
+    with open(pid_file, 'w') as f:
+      f.write('1')
+    # The file isn't the one of this agent any more, it's left in place.
+    self.local_collector.unlock_pid_file(pid_file, fd)
+    self.assertTrue(os.path.exists(pid_file))
+
+  def test_sample_once(self):
+    state_file = os.path.join(self.tmp_dir.name, 'counters.state')
+    self.assertFalse(self.local_collector.is_ring_fed(10, self.ring_file))
+    self.assertEqual(1, self.local_collector.sample_once(4, self.ring_file, state_file))
+    self.assertEqual(2, self.local_collector.sample_once(4, self.ring_file, state_file))
+    self.assertTrue(self.local_collector.is_ring_fed(10, self.ring_file))
+    self.assertEqual(2, len(self.drain(0, 0).samples))
+
+  def drain(self, ring_id, cursor):
+    return agent.parse_drained_output(self.local_collector.drain_samples(
+        ring_id, cursor, filepath=self.ring_file))
+
+
+class AgentTest(unittest.TestCase):
+  def test_parse_drained_output(self):
+    drained = agent.parse_drained_output('agent,42,7\n6,1000.5,posix,1.0,2.0,3.0,empty\n'
+                                         '7,1010.5,posix,4.0,5.0,6.0,empty')
+    self.assertEqual(42, drained.ring_id)
+    self.assertEqual(7, drained.last_seq)
+    self.assertEqual(agent.AgentSample(seq=7, timestamp=1010.5, stats='posix,4.0,5.0,6.0,empty'),
+                     drained.samples[1])
+
+  def test_parse_drained_batch(self):
+    local_collector = testutil.load_local_collector()
+    drained = agent.parse_drained_output(local_collector.encode_drained_samples(
+        42, 7, [(6, 1000.5, 1.0, 2.0, 3.0), (7, 1010.5, 4.0, 5.0, 6.0)]))
+    self.assertEqual((42, 7), (drained.ring_id, drained.last_seq))
+    sample = drained.samples[1]
+    self.assertEqual((7, 1010.5), (sample.seq, sample.timestamp))
+    self.assertEqual((4.0, 5.0, 6.0, 'empty'), (sample.stats.cpu_usage, sample.stats.mem_usage,
+                                                sample.stats.uptime, sample.stats.event_logs))
+
+  def test_invalid_drained_output(self):
+    with self.assertRaises(agent.AgentError):
+      agent.parse_drained_output('posix,1.0,2.0,3.0,empty')
+
+  def test_cursor_store_persisted(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      cursors_file = os.path.join(tmp_dir, 'cursors.json')
+      self.assertEqual((0, 0), agent.CursorStore(cursors_file).get('1.2.3.4'))
+      agent.CursorStore(cursors_file).set('1.2.3.4', 42, 7)
+      self.assertEqual((42, 7), agent.CursorStore(cursors_file).get('1.2.3.4'))
+
+
+if __name__ == '__main__':
+  unittest.main()
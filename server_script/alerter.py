@@ -4,112 +4,285 @@
 
 import logging
 import argparse
+import os
+import signal
+import threading
+import time
 
 
 from lib import storage
+from lib import baselines
 from lib import config
-
-import smtplib
-
-from email.mime import multipart
-from email.mime import text
+from lib import mailer
+from lib import metrics
+from lib import notify
+from lib import rules
+from lib import sharding
 
 # METRICS_MAP: {xml_key: db_key} 
-METRICS_MAP = {'memory': 'mem_usage', 'cpu': 'cpu_usage', 'uptime': 'uptime'}
+METRICS_MAP = rules.METRICS_MAP
 
 
 class Alerter(object):
-"""
+  """
   Main class which hots methods responsible of:
   - Collecting config from xml file
   - Querying DB to get non treated machine records
   - Send email notification in case of rule violation
-"""
+  """
 
 
   # Below aren't supposed to get non dev/tet accounts
   DEFAULT_SMTP_SERVER = 'smtp.gmail.com'
+  DEFAULT_SMTP_PORT = 465
   DEFAULT_EMAIL_USERNAME = ''  
   DEFAULT_EMAIL_PASSWORD = ''
+  # Number of seconds given to the background delivery of the alerts before exiting.
+  DEFAULT_MAIL_TIMEOUT = 120
+  # Maximum number of seconds the follow mode waits for notifications before checking it's stopped.
+  FOLLOW_POLL_INTERVAL = 1
 
   # TODO(mohamedzouaghi): Remove the local logger in favour of global oen
-  def __init__(self, username, password, logger=None):
-    """Initialize logger and Storage instance"""
+  def __init__(self, username, password, logger=None,
+               state_file=config.DEFAULT_ALERT_STATE_FILE, node_id=None,
+               lease_ttl=sharding.DEFAULT_LEASE_TTL, backend=config.DEFAULT_STORAGE_BACKEND,
+               sqlite_file=config.DEFAULT_SQLITE_FILE,
+               baselines_file=config.DEFAULT_BASELINES_FILE):
+    """Initialize logger and Storage instance
+
+    Args:
+      node_id: str, if set the fleet is shared with the other alerters having a node_id, each
+        machine being alerted by a single node (see sharding.Shard).
+      lease_ttl: int, number of seconds after which the machines of a node which stopped running
+        are taken over by the others, has to exceed the time between two runs.
+      backend: str, storage backend, see storage.open_storage.
+      sqlite_file: str, database file of the sqlite backend.
+      baselines_file: str, .npz file of the baselines of the anomaly alerts (see baselines.py).
+    """
     if not logger:
       logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
       self.logger = logging.getLogger(__name__)
     else:
       self.logger = logger
-    self.db = storage.Storage(username, password)
-
-  def run_alerts(self, dryrun):
+    self.db = storage.open_storage(backend, username, password, sqlite_file=sqlite_file)
+    # {ip_addr: id of the last record of the machine which doesn't need to be treated again}
+    self.watermarks = {}
+    spool_dir = config.DEFAULT_MAIL_SPOOL_DIR
+    if node_id:
+      # Nodes run from the same directory mustn't retry (or overwrite) the files of each other.
+      state_file = sharding.get_node_path(state_file, node_id)
+      spool_dir = os.path.join(spool_dir, node_id)
+      baselines_file = sharding.get_node_path(baselines_file, node_id)
+    self.state_file = state_file
+    # Loaded by the first run and kept in memory by the following ones (follow mode).
+    self.baselines_file = baselines_file
+    self.baselines = None
+    # TODO(mohamedzouaghi): Change below to also support non-gmail account
+    self.mailer = mailer.Mailer(self.DEFAULT_SMTP_SERVER, self.DEFAULT_SMTP_PORT,
+                                self.DEFAULT_EMAIL_USERNAME, self.DEFAULT_EMAIL_PASSWORD,
+                                spool_dir=spool_dir, logger=self.logger)
+    self.shard = None
+    if node_id:
+      self.shard = sharding.Shard(self.db, sharding.ALERTER, node_id, ttl=lease_ttl,
+                                  logger=self.logger)
+
+  @metrics.instrument('run_alerts')
+  def run_alerts(self, dryrun, ip_addrs=None):
     """Starting point for all other mtehods.
       
       First, calls get_clients_details() to get config xml file which hosts machine config details,
-      Seond, queries DB to get the non treated records. Non treated means all records that weren't
-      consulted previously.
-      Then, decide whether there is a need to trigger an alert.
-      Finally, update DB with records that were treated.
+      keeps the machines leased by this node when the fleet is shared with other alerters, and
+      compiles their alerts (see rules.CompiledRules).
+      Seond, queries DB to get the non treated records of the whole fleet at once. Non treated
+      means all records after the watermark (last treated record id) of their machine.
+      Then, evaluate all the records at once and trigger an alert for those reaching a threshold
+      or deviating from the baseline of their machine (anomaly alerts, see baselines.py).
+      Machines having stateful rules (see rules.CompiledRules.advance) have all their records
+      fed to the state of their rules, which is persisted along with the watermarks.
+      Finally, spool the alerts (a digest per recipient, see mailer.Mailer) and move the watermark
+      of each machine past the records that were treated, which are folded into the baselines.
+      Spooled alerts are delivered in the background and retried by the next runs if needed.
+      When an alert can't be queued, the watermark stops right before its record so it's treated
+      again (as well as the following records of the machine) on the next run.
 
      Args:
        dryrun: boolean, if True, no email is sent.
+       ip_addrs: set of str, only the machines of these ip addresses are treated (those notified
+         by the collector in follow mode), all of them if None.
 
     Retuns:
       List of machine IPs whose at least one of their records were treated.
     """
     alerted_machines = []
+    if not dryrun:
+      self.mailer.retry_spool()
     self.clients = config.get_clients_details()
+    if self.shard is not None:
+      try:
+        self.clients = self.shard.assign(self.clients)
+      except storage.StorageError as e:
+        # Alerting every machine would duplicate the alerts of the other nodes.
+        self.logger.error('Machines of node %s couldn\'t be leased: %s', self.shard.node_id, e.msg)
+        return []
+    if ip_addrs is not None:
+      self.clients = [m for m in self.clients if m.ip in ip_addrs]
+    self.rules = rules.CompiledRules(self.clients, self.logger)
+    self.watermarks = {}
+    self.rule_states = rules.RuleStateStore(self.state_file, self.logger)
+    if self.baselines is None:
+      self.baselines = baselines.Baselines(self.baselines_file, logger=self.logger)
+
+    # The backlog is ordered by ip_addr: {ip_addr: (first row, last row + 1)}
+    backlog = self.db.get_fleet_backlog([m.ip for m in self.clients])
+    rows_by_ip = {}
+    for i, s in enumerate(backlog):
+      start, _ = rows_by_ip.get(s.ip_addr, (i, i))
+      rows_by_ip[s.ip_addr] = (start, i + 1)
+    with metrics.timed('evaluate_rules'):
+      violations = self.rules.evaluate(backlog, self.baselines)
 
     for m in self.clients:
-      stats = self.db.get_non_treated_stats(m.ip)
-
-      if not stats:
+      if m.ip not in rows_by_ip:
         # Don't forget to include event logs!!
         self.logger.info('All stats for client[%s] has been already treated. Nothing to do.', m.ip)
         continue
+      start, end = rows_by_ip[m.ip]
+      if self.rules.has_stateful_rules(m.ip):
+        if self.treat_stateful_stats(m, backlog, start, end, violations, dryrun):
+          alerted_machines.append(m.ip)
+        continue
+      for i in violations.get_rows(start, end):
+        if i > start:
+          # Records before this one didn't reach any threshold.
+          self.watermarks[m.ip] = backlog[i - 1].id
+        if (self.treat_stat(m, backlog[i], dryrun=dryrun, violations=violations.get(i)) and
+            m.ip not in alerted_machines):
+          alerted_machines.append(m.ip)
+        if self.watermarks.get(m.ip) != backlog[i].id:
+          # The alert wasn't sent, this record and the next ones are treated on the next run.
+          break
       else:
-        for s in stats:
-          if self.treat_stat(m, s, dryrun=dryrun) and m.ip not in alerted_machines:
-            alerted_machines.append(m.ip)
+        self.watermarks[m.ip] = backlog[end - 1].id
+
+    if not dryrun:
+      try:
+        self.mailer.flush()
+      except mailer.MailerError as e:
+        # Nothing is marked as treated, the records are alerted again on the next run.
+        self.logger.error('Alerts couldn\'t be spooled: %s', e.msg)
+        return []
+    if self.watermarks and not dryrun:
+      self.db.advance_watermarks(self.watermarks)
+      self.rule_states.save()
+      with metrics.timed('advance_baselines'):
+        self.baselines.advance(backlog, self.watermarks)
+        self.baselines.save()
     return alerted_machines
 
-  def treat_stat(self, machine, stat, dryrun):
+  def follow(self, dryrun, listener, stop_event, catchup_interval=config.DEFAULT_CATCHUP_INTERVAL,
+             on_run=None):
+    """Treat the records of the machines notified by the collector, until stop_event is set.
+
+    The whole backlog is scanned first (records stored while no alerter was following) then every
+    catchup_interval seconds, for the notifications which were dropped. Notifications received
+    while a run is in progress are treated by the next one.
+
+    Args:
+      dryrun: boolean, if True, no email is sent.
+      listener: notify.Listener, bound before the first scan so no record is missed.
+      stop_event: threading.Event, returns as soon as it's set (after the current run).
+      catchup_interval: float, number of seconds between two scans of the whole backlog.
+      on_run: callable, called with the start time of each run once it's over.
+
+    Returns:
+      int, number of runs.
+    """
+    runs = 0
+    next_catchup = time.time()
+    while not stop_event.is_set():
+      now = time.time()
+      if now >= next_catchup:
+        ip_addrs = None
+        next_catchup = now + catchup_interval
+      else:
+        ip_addrs = listener.wait(min(self.FOLLOW_POLL_INTERVAL, next_catchup - now))
+        if not ip_addrs:
+          continue
+      start_time = time.time()
+      try:
+        self.run_alerts(dryrun, ip_addrs)
+      except storage.StorageError as e:
+        # The records stay after their watermark, the next runs treat them.
+        self.logger.error('Alerts run failed: %s', e.msg)
+      runs += 1
+      if on_run is not None:
+        on_run(start_time)
+    return runs
+
+  def close(self, timeout=DEFAULT_MAIL_TIMEOUT):
+    """Wait (up to timeout seconds) for the alerts to be delivered and release the resources.
+
+    Alerts which weren't delivered stay spooled for the next run.
+    """
+    self.mailer.close(timeout)
+    self.db.close()
+
+  def treat_stateful_stats(self, machine, backlog, start, end, violations, dryrun):
+    """Feed the records [start, end) of backlog to the rules of machine, in order.
+
+    The state of the rules is left as it was before the first record whose alert couldn't be sent,
+    this record is treated again on the next run.
+
+    Returns:
+      boolean whether the machine was alerted or not.
+    """
+    state = self.rule_states.get(machine.ip)
+    alerted_machine = False
+    for i in range(start, end):
+      snapshot = state.snapshot()
+      raised = violations.get(i) + self.rules.advance(state, backlog[i])
+      if not raised:
+        self.watermarks[machine.ip] = backlog[i].id
+        continue
+      if self.treat_stat(machine, backlog[i], dryrun=dryrun, violations=raised):
+        alerted_machine = True
+      if self.watermarks.get(machine.ip) != backlog[i].id:
+        state.restore(snapshot)
+        break
+    return alerted_machine
+
+  def treat_stat(self, machine, stat, dryrun, violations=None):
     """Compare data from xml and from DB and decide whether to send an email.
 
     Args:
       machine: config.Client namedtuple, represents a single machine record from xml config file.
       stat: storage.MachineStats namedtuple, represents a single record of a machine from the DB.
       dryrun: If True, no email should be sent.
+      violations: list of rules.Violation, the alerts of machine reached by stat when already
+        evaluated (see run_alerts), the plain rules of machine are evaluated here if None.
 
     Returns:
       boolean whether the machine was alerted or not. if dryrun is activated, False will be
       returned.
     """
     alerted_machine = False
-    alert_to_be_triggered = False
+    if violations is None:
+      violations = rules.CompiledRules([machine], self.logger).evaluate([stat]).get(0)
     metrics_to_be_alerted = []
-    for alert in machine.alerts:
-      metric_name = alert.type
-      # This makes the % sign optional in the xml file
-      xml_val = float(alert.limit[:-1]) if alert.limit.endswith('%') else float(alert.limit)
-      db_val = float(getattr(stat, METRICS_MAP[alert.type]))
-
-      # TODO(mohamedzouaghi): Need to support dfferent comparaison operations.
-      if  xml_val <= db_val:
-        metrics_to_be_alerted.append((metric_name, xml_val, db_val))
-        self.logger.info('Alert to be triggered, machine: %s\txml: %s db: %s metric: %s' % (
-            machine.ip, xml_val, db_val, metric_name))
-        alert_to_be_triggered = True
-    if alert_to_be_triggered:
-      # Following ensure that the stat record won't be treated in the next iteration
+    for metric_name, xml_val, db_val in violations:
+      metrics_to_be_alerted.append((metric_name, xml_val, db_val))
+      self.logger.info('Alert to be triggered, machine: %s\txml: %s db: %s metric: %s' % (
+          machine.ip, xml_val, db_val, metric_name))
+    if metrics_to_be_alerted:
+      # Following ensure that the stat record won't be treated in the next iteration. The alert
+      # is only queued, its delivery is retried independently.
       if self.send_alert(machine, metrics_to_be_alerted, dryrun=dryrun):
-        # TODO(mohamedzouaghi): Double check this. Following shoud be made independantly from
-        # email sending.
-        self.db.mark_stat_as_treated(stat.id)
-        self.logger.info('Alert [%s] marked as treated in the DB.' % stat.id)
+        self.watermarks[machine.ip] = stat.id
+        self.logger.info('Alert [%s] marked as treated.' % stat.id)
         alerted_machine = True
     else:
-      self.logger.info('No alert to be trigeered for: %s' % machine.ip)
+      self.watermarks[machine.ip] = stat.id
+      self.logger.debug('No alert to be trigeered for: %s' % machine.ip)
 
     return alerted_machine
 
@@ -122,7 +295,7 @@ class Alerter(object):
       dryrun: If True, no email should be sent.
 
     Returns:
-      boolean whether the email was sent or not. if dryrun is activated, False will be
+      boolean whether the email was queued or not. if dryrun is activated, False will be
       returned.
     """
     subject = 'Notification alert related to machine: %s' % machine.ip
@@ -141,43 +314,21 @@ class Alerter(object):
     else:
       return self.send_email(''.join(email_text), destination, subject)
 
-  def send_email(self, email_text, destination, subject, email_username=DEFAULT_EMAIL_USERNAME,
-                 email_password=DEFAULT_EMAIL_PASSWORD):
-    """Send a plain text email with the passsed arguments.
+  @metrics.instrument('send_email')
+  def send_email(self, email_text, destination, subject):
+    """Queue a plain text email with the passsed arguments.
+
+    Emails queued during a run are sent as a single digest per destination at the end of the run.
 
     Args:
       email_text: String, represents the email body. No need to include any headers on here.
       destination: String, represents the email destination.
       subject: String, represents the email subject.
-      email_username: String, represents the account username from which to send the email.
-      email_password: String, represents the account password from which to send the email.
 
     Returns:
-      boolean whether the email was sent or not.
+      boolean whether the email was queued or not.
     """
-    sent_from = email_username
-    sent_to = destination
-
-    msg = multipart.MIMEMultipart('alternative')
-    msg['Subject'] = subject
-    msg['From'] = sent_from
-    msg['To'] = sent_to
-
-    body = text.MIMEText(email_text, 'plain')
-    msg.attach(body)
-    
-    # TODO(mohamedzouaghi): Change below to also support non-gmail account 
-    server = smtplib.SMTP_SSL(self.DEFAULT_SMTP_SERVER, 465)
-    server.ehlo()
-    server.login(email_username, email_password)
-
-    sent_result = server.sendmail(sent_from, sent_to, msg.as_string())
-    print(sent_result)
-    print(msg.as_string())
-    server.close()
-    # sent_result will be an empty dict if all messages were sent
-    # otherwise it contains the address of the recipient who didn't receive the notification
-    return not sent_result
+    return self.mailer.add(destination, subject, email_text)
 
 
 def main():
@@ -187,14 +338,77 @@ def main():
                       help='username used for DB operations.')
   parser.add_argument('-p', '--password', required=False, default=config.DEFAULT_PASSWORD,
                       help='username used for DB operations.')
+  parser.add_argument('--backend', required=False, default=config.DEFAULT_STORAGE_BACKEND,
+                      choices=storage.BACKENDS, help='Database the stats are read from.')
+  parser.add_argument('--sqlite-file', required=False, default=config.DEFAULT_SQLITE_FILE,
+                      help='Database file of the sqlite backend.')
   parser.add_argument('-d', '--dryrun', required=False, dest='dryrun', action='store_true',
                       help='If set to false no alert will be sent. Mosly used for debug purpose.')
   parser.add_argument('--no-d', '--no-dryrun', required=False, dest='dryrun', action='store_false',
                       help='If set to false no alert will be sent. Mosly used for debug purpose.')
+  parser.add_argument('--node-id', required=False, default=None,
+                      help='Share the fleet with the other alerters run with a --node-id (against'
+                           ' the same DB), each machine is then alerted by a single node.')
+  parser.add_argument('--lease-ttl', required=False, default=sharding.DEFAULT_LEASE_TTL, type=int,
+                      help='Number of seconds after which the machines of a node which stopped are'
+                           ' taken over by the other nodes, has to exceed the time between two'
+                           ' runs of a node.')
+  parser.add_argument('--metrics-file', required=False,
+                      default=config.DEFAULT_ALERTER_METRICS_FILE,
+                      help='Prometheus text format snapshot of the phase timings, rewritten at the'
+                           ' end of the run. Empty to disable it.')
+  parser.add_argument('--profile', required=False, default=None,
+                      help='Record a cProfile of the run into this file (pstats format).')
+  parser.add_argument('--follow', required=False, action='store_true',
+                      help='Keep running and treat the records as soon as the collector notifies'
+                           ' them on --notify-socket, instead of being run periodically.')
+  parser.add_argument('--notify-socket', required=False, default=config.DEFAULT_NOTIFY_SOCKET,
+                      help='Unix socket the collector notifies the stored stats to, in follow'
+                           ' mode. Suffixed with --node-id if set, like the one of the collector.')
+  parser.add_argument('--catchup-interval', required=False,
+                      default=config.DEFAULT_CATCHUP_INTERVAL, type=float,
+                      help='Number of seconds between two scans of the whole backlog in follow'
+                           ' mode, which treat the records whose notification was dropped.')
   args = parser.parse_args()
 
-  alerter = Alerter(args.username, args.password)
-  alerter.run_alerts(args.dryrun)
+  metrics_file = sharding.get_node_path(args.metrics_file, args.node_id)
+  # Several alerter nodes can't be bound to the same socket.
+  args.notify_socket = sharding.get_node_path(args.notify_socket, args.node_id)
+  start_time = time.time()
+  with metrics.profiled(args.profile):
+    alerter = Alerter(args.username, args.password, node_id=args.node_id,
+                      lease_ttl=args.lease_ttl, backend=args.backend, sqlite_file=args.sqlite_file)
+    try:
+      if args.follow:
+        follow(alerter, args, metrics_file)
+      else:
+        alerter.run_alerts(args.dryrun)
+    finally:
+      # Once the background deliveries are over, so they're part of the snapshot.
+      alerter.close()
+  metrics.write_run('alerter', start_time, metrics_file, alerter.logger)
+
+
+def follow(alerter, args, metrics_file):
+  """Run alerter in follow mode until it receives SIGTERM or SIGINT."""
+  stop_event = threading.Event()
+
+  def stop(signum, frame):
+    alerter.logger.info('Received signal %d, stopping after the current run.', signum)
+    stop_event.set()
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  listener = notify.Listener(args.notify_socket)
+
+  def write_run(start_time):
+    metrics.write_run('alerter', start_time, metrics_file, alerter.logger)
+
+  try:
+    alerter.follow(args.dryrun, listener, stop_event, catchup_interval=args.catchup_interval,
+                   on_run=write_run)
+  finally:
+    listener.close()
 
 
 if __name__ == '__main__':
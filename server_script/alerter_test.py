@@ -1,3 +1,8 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 from unittest import mock
@@ -11,18 +16,23 @@ from lib import storage
 # TODO(mohamedzouaghi): Add more tests to cover 
 class AlerterTest(unittest.TestCase):
   def setUp(self):
-    self.alerter = alerter.Alerter(None, None)
+    self.tmp_dir = tempfile.mkdtemp()
+    self.alerter = alerter.Alerter(None, None,
+                                   baselines_file=os.path.join(self.tmp_dir, 'baselines.npz'))
 
-  @mock.patch('lib.storage.Storage.get_non_treated_stats')
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
   @mock.patch('lib.config.get_clients_details') 
-  def test_empty_run_alerts(self, mock_get_cl_details, mock_get_non_treated):
+  def test_empty_run_alerts(self, mock_get_cl_details, mock_get_fleet_backlog):
     mock_get_cl_details.return_value = []
     alerted_machines = self.alerter.run_alerts(dryrun=True)
     self.assertEqual([], alerted_machines)
 
-  @mock.patch('lib.storage.Storage.get_non_treated_stats')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
   @mock.patch('lib.config.get_clients_details')
-  def test_dryrun_valid_run_alerts(self, mock_get_cl_details, mock_get_non_treated):
+  def test_dryrun_valid_run_alerts(self, mock_get_cl_details, mock_get_fleet_backlog):
     mock_al1 = config.Alert(type='cpu', limit='10')
     mock_cl1 = config.Client(ip='1.2.3.4', port='111', username='yo', password='man', mail='m@m.m', alerts=[mock_al1])
     nock_db_c1 = storage.MachineStats(
@@ -30,17 +40,19 @@ class AlerterTest(unittest.TestCase):
 
 
     mock_get_cl_details.return_value = [mock_cl1]
-    mock_get_non_treated.return_value = [nock_db_c1]
+    mock_get_fleet_backlog.return_value = [nock_db_c1]
 
     dryrun_alerted_machines = self.alerter.run_alerts(dryrun=True)
     # Empty list because dryrun activated
     self.assertEqual([], dryrun_alerted_machines)
 
 
-  @mock.patch('lib.storage.Storage.get_non_treated_stats')
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
   @mock.patch('lib.config.get_clients_details')
   @mock.patch('alerter.Alerter.treat_stat') 
-  def test_valid_run_alerts(self, mock_treat_stat, mock_get_cl_details, mock_get_non_treated):
+  def test_valid_run_alerts(self, mock_treat_stat, mock_get_cl_details, mock_get_fleet_backlog,
+                            mock_advance_watermarks):
     mock_al1 = config.Alert(type='cpu', limit='10')
     mock_cl1 = config.Client(ip='1.2.3.4', port='111', username='yo', password='man', mail='m@m.m', alerts=[mock_al1])
     nock_db_c1 = storage.MachineStats(
@@ -48,11 +60,187 @@ class AlerterTest(unittest.TestCase):
 
 
     mock_get_cl_details.return_value = [mock_cl1]
-    mock_get_non_treated.return_value = [nock_db_c1]
+    mock_get_fleet_backlog.return_value = [nock_db_c1]
     mock_treat_stat.return_value = [mock_cl1.ip]
 
     alerted_machines = self.alerter.run_alerts(dryrun=False)
     self.assertEqual([mock_cl1.ip], alerted_machines)
 
+  @mock.patch('alerter.Alerter.send_email')
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_watermarks_run_alerts(self, mock_get_cl_details, mock_get_backlog,
+                                 mock_advance_watermarks, mock_send_email):
+    mock_al1 = config.Alert(type='cpu', limit='50%')
+    mock_cl1 = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                             alerts=[mock_al1])
+    mock_cl2 = config.Client(ip='2.2.2.2', port='22', username='u', password='p', mail='m@m.m',
+                             alerts=[mock_al1])
+    mock_get_cl_details.return_value = [mock_cl1, mock_cl2]
+    mock_get_backlog.return_value = [
+        storage.MachineStats(id=1, ip_addr='1.1.1.1', cpu_usage='10', mem_usage='1', uptime=1,
+                             event_logs='', collection_date=''),
+        storage.MachineStats(id=4, ip_addr='1.1.1.1', cpu_usage='90', mem_usage='1', uptime=1,
+                             event_logs='', collection_date=''),
+        storage.MachineStats(id=2, ip_addr='2.2.2.2', cpu_usage='20', mem_usage='1', uptime=1,
+                             event_logs='', collection_date=''),
+        storage.MachineStats(id=3, ip_addr='2.2.2.2', cpu_usage='95', mem_usage='1', uptime=1,
+                             event_logs='', collection_date=''),
+        storage.MachineStats(id=5, ip_addr='2.2.2.2', cpu_usage='5', mem_usage='1', uptime=1,
+                             event_logs='', collection_date='')]
+    # The alert of 1.1.1.1 is sent, the one of 2.2.2.2 fails.
+    mock_send_email.side_effect = [True, False]
+
+    alerted_machines = self.alerter.run_alerts(dryrun=False)
+    self.assertEqual(['1.1.1.1'], alerted_machines)
+    mock_get_backlog.assert_called_once_with(['1.1.1.1', '2.2.2.2'])
+    # 2.2.2.2 stops before the record whose alert failed, it's treated again next run.
+    mock_advance_watermarks.assert_called_once_with({'1.1.1.1': 4, '2.2.2.2': 2})
+
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_dryrun_keeps_watermarks_run_alerts(self, mock_get_cl_details, mock_get_backlog,
+                                              mock_advance_watermarks):
+    mock_cl1 = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                             alerts=[])
+    mock_get_cl_details.return_value = [mock_cl1]
+    mock_get_backlog.return_value = [storage.MachineStats(
+        id=1, ip_addr='1.1.1.1', cpu_usage='10', mem_usage='1', uptime=1, event_logs='',
+        collection_date='')]
+
+    self.alerter.run_alerts(dryrun=True)
+    self.assertFalse(mock_advance_watermarks.called)
+
+  @mock.patch('alerter.Alerter.send_email')
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_stateful_rules_run_alerts(self, mock_get_cl_details, mock_get_backlog,
+                                     mock_advance_watermarks, mock_send_email):
+    self.alerter.state_file = os.path.join(tempfile.mkdtemp(), 'alert_state.json')
+    mock_cl1 = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                             alerts=[config.Alert(type='cpu', limit='50%', for_samples=2)])
+    mock_get_cl_details.return_value = [mock_cl1]
+    backlog = [storage.MachineStats(id=i, ip_addr='1.1.1.1', cpu_usage=cpu, mem_usage=1,
+                                    uptime=1, event_logs='', collection_date='')
+               for i, cpu in ((1, 90), (2, 10), (3, 90), (4, 95), (5, 99))]
+    mock_get_backlog.return_value = backlog
+    mock_send_email.return_value = False
+
+    self.assertEqual([], self.alerter.run_alerts(dryrun=False))
+    # The alert raised by record 4 couldn't be sent, the watermark stops right before it.
+    mock_advance_watermarks.assert_called_once_with({'1.1.1.1': 3})
+
+    # Next run starts after record 3, whose streak was saved.
+    mock_get_backlog.return_value = backlog[3:]
+    mock_send_email.return_value = True
+    self.assertEqual(['1.1.1.1'], self.alerter.run_alerts(dryrun=False))
+    self.assertEqual(2, mock_send_email.call_count)
+    mock_advance_watermarks.assert_called_with({'1.1.1.1': 5})
+
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_notified_machines_run_alerts(self, mock_get_cl_details, mock_get_backlog):
+    mock_get_cl_details.return_value = [
+        config.Client(ip=ip, port='22', username='u', password='p', mail='m@m.m', alerts=[])
+        for ip in ('1.1.1.1', '2.2.2.2', '3.3.3.3')]
+    mock_get_backlog.return_value = []
+    self.alerter.run_alerts(dryrun=True, ip_addrs={'3.3.3.3', '1.1.1.1', '9.9.9.9'})
+    mock_get_backlog.assert_called_once_with(['1.1.1.1', '3.3.3.3'])
+
+  @mock.patch('alerter.Alerter.send_email')
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_anomaly_run_alerts(self, mock_get_cl_details, mock_get_backlog,
+                              mock_advance_watermarks, mock_send_email):
+    self.alerter.state_file = os.path.join(self.tmp_dir, 'alert_state.json')
+    mock_get_cl_details.return_value = [
+        config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                      alerts=[config.Alert(type='cpu', limit=None, sigma='4')])]
+    mock_send_email.return_value = True
+    date = datetime.datetime(2017, 1, 2)
+    backlog = [storage.MachineStats(id=i, ip_addr='1.1.1.1', cpu_usage=20 + i % 2, mem_usage=1,
+                                    uptime=1, event_logs='', collection_date=date)
+               for i in range(1, 41)]
+    mock_get_backlog.return_value = backlog
+    self.assertEqual([], self.alerter.run_alerts(dryrun=False))
+    mock_advance_watermarks.assert_called_once_with({'1.1.1.1': 40})
+
+    # A new alerter starts from the saved baselines.
+    self.alerter = alerter.Alerter(None, None, state_file=self.alerter.state_file,
+                                   baselines_file=self.alerter.baselines_file)
+    mock_get_backlog.return_value = [backlog[0]._replace(id=41, cpu_usage=95),
+                                     backlog[0]._replace(id=42, cpu_usage=21)]
+    self.assertEqual(['1.1.1.1'], self.alerter.run_alerts(dryrun=False))
+    self.assertEqual(1, mock_send_email.call_count)
+    self.assertEqual(42, self.alerter.baselines.last_id[0])
+
+  @mock.patch('alerter.Alerter.run_alerts')
+  def test_follow(self, mock_run_alerts):
+    stop_event = threading.Event()
+    listener = mock.Mock()
+    notifications = [set(), {'1.1.1.1'}]
+
+    def wait(timeout):
+      if not notifications:
+        stop_event.set()
+        return set()
+      return notifications.pop(0)
+    listener.wait.side_effect = wait
+    mock_run_alerts.side_effect = [[], storage.StorageError('DB down')]
+    runs = []
+
+    self.assertEqual(2, self.alerter.follow(True, listener, stop_event, catchup_interval=60,
+                                            on_run=runs.append))
+    # The whole backlog is scanned first, then only the notified machines.
+    self.assertEqual([mock.call(True, None), mock.call(True, {'1.1.1.1'})],
+                     mock_run_alerts.call_args_list)
+    self.assertEqual(2, len(runs))
+
+  @mock.patch('lib.mailer.Mailer._enqueue')
+  @mock.patch('lib.mailer.Mailer._spool')
+  @mock.patch('lib.storage.Storage.advance_watermarks')
+  @mock.patch('lib.storage.Storage.get_fleet_backlog')
+  @mock.patch('lib.config.get_clients_details')
+  def test_spool_failure_follow(self, mock_get_cl_details, mock_get_backlog,
+                                mock_advance_watermarks, mock_spool, mock_enqueue):
+    self.alerter.state_file = os.path.join(self.tmp_dir, 'alert_state.json')
+    self.alerter.mailer.spool_dir = self.tmp_dir
+    mock_get_cl_details.return_value = [
+        config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                      alerts=[config.Alert(type='cpu', limit='50%')])]
+    mock_get_backlog.return_value = [
+        storage.MachineStats(id=1, ip_addr='1.1.1.1', cpu_usage=90, mem_usage=1, uptime=1,
+                             event_logs='', collection_date=datetime.datetime(2017, 1, 2))]
+    spooled = []
+
+    def spool(message):
+      if not spooled:
+        spooled.append(None)
+        raise OSError('disk full')
+      spooled.append(message)
+      return 'path'
+    mock_spool.side_effect = spool
+    stop_event = threading.Event()
+    listener = mock.Mock()
+    notifications = [{'1.1.1.1'}]
+
+    def wait(timeout):
+      if not notifications:
+        stop_event.set()
+        return set()
+      return notifications.pop(0)
+    listener.wait.side_effect = wait
+
+    self.assertEqual(2, self.alerter.follow(False, listener, stop_event))
+    # The alert whose spooling failed is raised again by the next pass, only once.
+    self.assertEqual(2, len(spooled))
+    self.assertNotIn('digest', spooled[1]['subject'])
+    mock_advance_watermarks.assert_called_once_with({'1.1.1.1': 1})
+    self.assertEqual(0, self.alerter.mailer.pending_count())
+
 if __name__ == '__main__':
   unittest.main()
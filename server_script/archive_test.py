@@ -0,0 +1,83 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from lib import archive
+
+
+def get_row(i, date, cpu_usage=10.5, event_logs='log'):
+  return (i, 'posix', cpu_usage, 20.0, 300.0, event_logs, date - datetime.timedelta(seconds=5),
+          date, None)
+
+
+class ArchiveTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.date = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    self.month = datetime.date(2017, 1, 1)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_round_trip(self):
+    rows = [get_row(1, self.date), get_row(3, self.date, None, None),
+            (7, None, 1.0, None, None, u'caf\xe9\n', None, self.date, 'load=0.5')]
+    self.assertEqual(3, archive.store_rows(self.tmp_dir, '1.1.1.1', self.month, rows))
+    path = archive.get_path(self.tmp_dir, '1.1.1.1', self.month)
+    self.assertTrue(path.endswith(os.path.join('1.1.1.1', '2017-01.fha')))
+    with archive.Reader(path) as reader:
+      self.assertEqual(3, len(reader))
+      self.assertEqual([1, 3, 7], reader.read('id').tolist())
+      self.assertTrue(numpy.isnan(reader.read('cpu_usage')[1]))
+      self.assertEqual(['log', None, u'caf\xe9\n'], reader.read('event_logs').tolist())
+      self.assertEqual([None, None, 'load=0.5'], reader.read('extra_metrics').tolist())
+      sampled_at = reader.read('sampled_at')
+      self.assertEqual(self.date - datetime.timedelta(seconds=5), sampled_at[0].item())
+      self.assertTrue(numpy.isnat(sampled_at[2]))
+      self.assertEqual([self.date] * 3, reader.read('collection_date').tolist())
+      self.assertRaises(archive.ArchiveError, reader.read, 'ip_addr')
+
+  def test_store_rows_merges_and_skips_archived(self):
+    rows = [get_row(i, self.date, cpu_usage=i) for i in range(1, 6)]
+    self.assertEqual(3, archive.store_rows(self.tmp_dir, '1.1.1.1', self.month, rows[2:]))
+    # Rows archived again after an interruption aren't duplicated.
+    self.assertEqual(2, archive.store_rows(self.tmp_dir, '1.1.1.1', self.month, rows))
+    self.assertEqual(0, archive.store_rows(self.tmp_dir, '1.1.1.1', self.month, rows[:2]))
+    with archive.Reader(archive.get_path(self.tmp_dir, '1.1.1.1', self.month)) as reader:
+      self.assertEqual([1, 2, 3, 4, 5], reader.read('id').tolist())
+      self.assertEqual([1.0, 2.0, 3.0, 4.0, 5.0], reader.read('cpu_usage').tolist())
+
+  def test_read_history(self):
+    february = datetime.datetime(2017, 2, 10)
+    archive.store_rows(self.tmp_dir, '1.1.1.1', self.month, [get_row(1, self.date, 1.0)])
+    archive.store_rows(self.tmp_dir, '1.1.1.1', february,
+                       [get_row(2, february, 2.0), get_row(3, february.replace(day=20), 3.0)])
+    archive.store_rows(self.tmp_dir, '2.2.2.2', february, [get_row(4, february, 4.0)])
+    self.assertEqual([datetime.date(2017, 1, 1), datetime.date(2017, 2, 1)],
+                     archive.get_months(self.tmp_dir, '1.1.1.1'))
+
+    history = archive.read_history(self.tmp_dir, '1.1.1.1', ['cpu_usage'])
+    self.assertEqual(['cpu_usage'], list(history))
+    self.assertEqual([1.0, 2.0, 3.0], history['cpu_usage'].tolist())
+    history = archive.read_history(self.tmp_dir, '1.1.1.1', ['id', 'cpu_usage'],
+                                   start=datetime.datetime(2017, 2, 1),
+                                   end=datetime.datetime(2017, 2, 15))
+    self.assertEqual([2], history['id'].tolist())
+    self.assertEqual([], archive.read_history(self.tmp_dir, '3.3.3.3', ['id'])['id'].tolist())
+    self.assertRaises(archive.ArchiveError, archive.read_history, self.tmp_dir, '1.1.1.1',
+                      ['unknown'])
+
+  def test_invalid_file(self):
+    path = os.path.join(self.tmp_dir, 'invalid.fha')
+    with open(path, 'wb') as f:
+      f.write(b'not an archive')
+    self.assertRaises(archive.ArchiveError, archive.Reader, path)
+    self.assertRaises(archive.ArchiveError, archive.Reader, path + '.missing')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from lib import baselines
+from lib import storage
+
+
+def get_stat(id, ip_addr, cpu_usage, mem_usage=50.0, hour=0):
+  return storage.MachineStats(id=id, ip_addr=ip_addr, cpu_usage=cpu_usage, mem_usage=mem_usage,
+                              uptime=1.0, event_logs='',
+                              collection_date=datetime.datetime(2017, 1, 2, hour))
+
+
+class BaselinesTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'baselines.npz')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_matches_sequential_ewma(self):
+    values = {'1.1.1.1': [10.0, 12.0, 11.0, None, 30.0, 9.0], '2.2.2.2': [50.0, 70.0]}
+    stats = [get_stat(i * 10 + j + 1, ip_addr, value)
+             for i, (ip_addr, series) in enumerate(sorted(values.items()))
+             for j, value in enumerate(series)]
+    b = baselines.Baselines(alpha=0.3, warmup=2, seasonal_warmup=100)
+    expected, std = b.evaluate(stats)
+    # Reference: one sample at a time.
+    mean = var = None
+    count = 0
+    for row, value in enumerate(values['1.1.1.1']):
+      if count < 2:
+        self.assertTrue(numpy.isnan(expected[row, 0]))
+      else:
+        self.assertAlmostEqual(mean, expected[row, 0])
+        self.assertAlmostEqual(max(var ** 0.5, baselines.MIN_STD), std[row, 0])
+      if value is not None:
+        mean, var = baselines.update_ewma(mean or 0.0, var or 0.0, count, value, 0.3)
+        count += 1
+    # evaluate() doesn't change the baselines.
+    self.assertEqual(0, b.count.sum())
+
+  def test_advance_up_to_watermarks(self):
+    b = baselines.Baselines(self.path)
+    stats = [get_stat(i, '1.1.1.1', 10.0 * i) for i in range(1, 5)]
+    b.advance(stats, {'1.1.1.1': 2})
+    self.assertEqual([2, 2], b.count[0].tolist())
+    self.assertEqual([15.0], b.mean[:, 0].tolist())
+    # Records already folded aren't folded again.
+    b.advance(stats, {'1.1.1.1': 4})
+    self.assertEqual([4], b.count[:, 0].tolist())
+    self.assertEqual([4], b.last_id.tolist())
+    b.save()
+
+    loaded = baselines.Baselines(self.path)
+    self.assertEqual(['1.1.1.1'], loaded.hosts)
+    numpy.testing.assert_array_equal(b.seasonal_mean, loaded.seasonal_mean)
+    self.assertEqual(25.0, loaded.mean[0, 0])
+
+  def test_seasonal_baseline(self):
+    b = baselines.Baselines(warmup=3, seasonal_warmup=3)
+    # Busy every night at 2, idle the rest of the day.
+    stats = []
+    for day in range(4):
+      stats.append(get_stat(2 * day + 1, '1.1.1.1', 90.0, hour=2))
+      stats.append(get_stat(2 * day + 2, '1.1.1.1', 10.0, hour=3))
+    b.advance(stats, {'1.1.1.1': 8})
+    expected, _ = b.evaluate([get_stat(9, '1.1.1.1', 90.0, hour=2)])
+    self.assertAlmostEqual(90.0, expected[0, 0])
+    # No sample at 5 yet, the overall baseline is used.
+    expected, _ = b.evaluate([get_stat(9, '1.1.1.1', 90.0, hour=5)])
+    self.assertAlmostEqual(50.0, expected[0, 0])
+
+  def test_unreadable_file(self):
+    with open(self.path, 'w') as f:
+      f.write('not an archive')
+    self.assertEqual(0, len(baselines.Baselines(self.path)))
+
+
+if __name__ == '__main__':
+  unittest.main()
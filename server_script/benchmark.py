@@ -0,0 +1,559 @@
+"""End to end benchmark of the collector and the alerter against simulated hosts.
+
+N stand-in hosts (paramiko in server mode, each listening on its own loopback address) are started
+in a separate process. They accept the collector ssh and sftp sessions and answer the local
+collector command with an encrypted random sample after a configurable latency, a configurable
+share of the connections being dropped. A matching config.xml is generated and collector.main()
+then Alerter.run_alerts() (dryrun) are run against a local database, optionally prefilled with
+--rows records.
+
+Usage (from server_script):
+  python3 benchmark.py --hosts 1000 --latency 0.05 --failure-rate 0.01 --rows 1000000 \\
+      --output benchmark.json
+
+The cold start of the client (a regular collection: python3 local_collector.py -f pk --stream)
+is measured as well, run as a plain script and as the zipapp the collector deploys.
+
+The results (hosts/s, p50/p99 per host latency, rows/s, alerter drain time, peak memory of the
+benchmark process, client cold start) are written as json along with the parameters and the git
+commit, so runs of different commits can be compared. Everything runs in a temporary directory, removed at the end.
+Loopback addresses other than 127.0.0.1 are only routed by Linux.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import selectors
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import alerter
+import collector
+from lib import config
+from lib import envelope
+from lib import framing
+from lib import storage
+from lib import wire
+
+
+RESULTS_VERSION = 1
+DEFAULT_HOSTS = 100
+DEFAULT_LATENCY = 0.02
+DEFAULT_OUTPUT = 'benchmark.json'
+DEFAULT_CLIENT_RUNS = 10
+USERNAME = 'bench'
+PASSWORD = 'bench'
+# Seconds a simulated host waits for the collector to close the stdin of a command.
+COMMAND_TIMEOUT = 10
+# Records of the prefilled backlog are spread over the last PREFILL_DAYS days.
+PREFILL_DAYS = 7
+PREFILL_BATCH = 5000
+# Threshold of the generated cpu alert, samples are uniform over [0, 100).
+ALERT_LIMIT = 90
+
+logger = logging.getLogger('benchmark')
+
+
+def get_host_ip(index):
+  """Return the loopback address of the index-th simulated host."""
+  return '127.%d.%d.%d' % (100 + index // 62500, (index // 250) % 250, index % 250 + 1)
+
+
+def get_percentile(values, q):
+  """Return the q-quantile (nearest rank) of values, None if empty."""
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def get_peak_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+class SimulatedHost(object):
+  """State of a simulated host: its files (under root) and its behavior."""
+
+  def __init__(self, ip, root, latency, failure_rate, seed):
+    self.ip = ip
+    self.root = root
+    self.latency = latency
+    self.failure_rate = failure_rate
+    self.random = random.Random(seed)
+    self.uptime = self.random.randint(60, 10 ** 6)
+    self._public_keys = {}
+    os.makedirs(os.path.join(root, 'tmp'))
+
+  def get_path(self, path):
+    return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+  def should_fail(self):
+    return self.random.random() < self.failure_rate
+
+  def get_public_key(self, path):
+    with open(self.get_path(path), 'rb') as f:
+      pem_data = f.read()
+    if pem_data not in self._public_keys:
+      self._public_keys[pem_data] = serialization.load_pem_public_key(pem_data)
+    return self._public_keys[pem_data]
+
+  def run_command(self, channel, command):
+    """Answer a local collector command like the client script would (without its agent mode)."""
+    try:
+      args = shlex.split(command)
+      if '--drain' in args or '-f' not in args:
+        channel.sendall_stderr(b'Unsupported command')
+        channel.send_exit_status(2)
+        return
+      time.sleep(self.latency * self.random.uniform(0.5, 1.5))
+      self.uptime += 60
+      stats = wire.encode_batch([wire.Record(
+          sampled_at=time.time(), os='Linux', cpu_usage=self.random.uniform(0, 100),
+          mem_usage=self.random.uniform(0, 100), uptime=self.uptime, event_logs='empty',
+          metrics={'load1': self.random.uniform(0, 8), 'swap_pct': self.random.uniform(0, 100)},
+          labels={'procs': 'sshd:22:0.1'})])
+      public_key = self.get_public_key(args[args.index('-f') + 1])
+      channel.sendall(framing.encode_frame(envelope.encrypt(stats, public_key)))
+      # The reply to the exec request is only sent once run_command started, closing the channel
+      # before the collector closed stdin could make its exec_command fail.
+      channel.settimeout(COMMAND_TIMEOUT)
+      while channel.recv(1024):
+        pass
+      channel.send_exit_status(0)
+    except (IOError, OSError, paramiko.SSHException) as e:
+      channel.sendall_stderr(str(e).encode())
+      channel.send_exit_status(1)
+    finally:
+      channel.close()
+
+
+class SimulatedServer(paramiko.ServerInterface):
+  """ssh server side of a simulated host: password auth, sessions and exec requests."""
+
+  def __init__(self, host):
+    self.host = host
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+  def check_auth_password(self, username, password):
+    if (username, password) == (USERNAME, PASSWORD):
+      return paramiko.AUTH_SUCCESSFUL
+    return paramiko.AUTH_FAILED
+
+  def check_channel_request(self, kind, chanid):
+    if kind == 'session':
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_channel_exec_request(self, channel, command):
+    thread = threading.Thread(target=self.host.run_command, args=(channel, command.decode()))
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+class SimulatedSFTPServer(paramiko.SFTPServerInterface):
+  """sftp server side of a simulated host, remote paths are mapped under the host root."""
+
+  def __init__(self, server, *args, **kwargs):
+    super(SimulatedSFTPServer, self).__init__(server, *args, **kwargs)
+    self.host = server.host
+
+  @classmethod
+  def call(cls, func, *args):
+    try:
+      result = func(*args)
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK if result is None else result
+
+  def open(self, path, flags, attr):
+    def open_handle():
+      f = os.fdopen(os.open(self.host.get_path(path), flags, 0o600),
+                    'r+b' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb')
+      handle = paramiko.SFTPHandle(flags)
+      handle.readfile = handle.writefile = f
+      return handle
+    return self.call(open_handle)
+
+  def stat(self, path):
+    return self.call(lambda: paramiko.SFTPAttributes.from_stat(os.stat(self.host.get_path(path))))
+
+  lstat = stat
+
+  def list_folder(self, path):
+    def list_attributes():
+      folder = self.host.get_path(path)
+      attributes = []
+      for filename in os.listdir(folder):
+        attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(folder, filename)))
+        attr.filename = filename
+        attributes.append(attr)
+      return attributes
+    return self.call(list_attributes)
+
+  def remove(self, path):
+    return self.call(os.remove, self.host.get_path(path))
+
+  def rename(self, oldpath, newpath):
+    return self.call(os.rename, self.host.get_path(oldpath), self.host.get_path(newpath))
+
+  def posix_rename(self, oldpath, newpath):
+    return self.call(os.replace, self.host.get_path(oldpath), self.host.get_path(newpath))
+
+  def mkdir(self, path, attr):
+    return self.call(os.mkdir, self.host.get_path(path))
+
+
+def run_host_farm(hosts, root, latency, failure_rate, seed, connection, stop_event):
+  """Serve hosts simulated hosts until stop_event is set, run in a child process.
+
+  The (ip, port) of each host is sent on connection once they all listen.
+  """
+  # Sessions closed by the collector are logged as errors by paramiko.
+  logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+  host_key = paramiko.RSAKey.generate(2048)
+  selector = selectors.DefaultSelector()
+  addresses = []
+  for i in range(hosts):
+    ip = get_host_ip(i)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((ip, 0))
+    sock.listen(128)
+    sock.setblocking(False)
+    host = SimulatedHost(ip, os.path.join(root, ip), latency, failure_rate, seed + i)
+    selector.register(sock, selectors.EVENT_READ, host)
+    addresses.append((ip, sock.getsockname()[1]))
+  connection.send(addresses)
+
+  transports = []
+  while not stop_event.is_set():
+    for key, _ in selector.select(timeout=0.2):
+      try:
+        client, _ = key.fileobj.accept()
+      except OSError:
+        continue
+      host = key.data
+      if host.should_fail():
+        client.close()
+        continue
+      client.setblocking(True)
+      transport = paramiko.Transport(client)
+      transport.add_server_key(host_key)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SimulatedSFTPServer)
+      # Negotiation happens in the transport thread.
+      transport.start_server(threading.Event(), SimulatedServer(host))
+      transports.append(transport)
+    transports = [t for t in transports if t.is_active()]
+  for transport in transports:
+    transport.close()
+
+
+class HostFarm(object):
+  """Simulated hosts running in a child process."""
+
+  def __init__(self, hosts, root, latency=DEFAULT_LATENCY, failure_rate=0.0, seed=0):
+    self.args = (hosts, root, latency, failure_rate, seed)
+    self.addresses = []
+    self._process = None
+    self._stop_event = None
+
+  def start(self, timeout=120):
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    self._stop_event = context.Event()
+    self._process = context.Process(target=run_host_farm,
+                                    args=self.args + (sender, self._stop_event), name='host-farm')
+    self._process.daemon = True
+    self._process.start()
+    if not receiver.poll(timeout):
+      self.stop()
+      raise RuntimeError('Simulated hosts didn\'t start within %d seconds' % timeout)
+    self.addresses = receiver.recv()
+    return self.addresses
+
+  def stop(self):
+    if self._process is not None:
+      self._stop_event.set()
+      self._process.join(10)
+      if self._process.is_alive():
+        self._process.terminate()
+      self._process = None
+
+
+def write_config(xml_file, addresses):
+  """Write a config.xml listing the simulated hosts, sharing their settings and alert."""
+  with open(xml_file, 'w') as f:
+    f.write('<config>\n<template name="bench" username="%s" password="%s" mail="bench@localhost">\n'
+            '  <alert type="cpu" limit="%d%%" />\n</template>\n<group template="bench">\n' % (
+                USERNAME, PASSWORD, ALERT_LIMIT))
+    for ip, port in addresses:
+      f.write('  <client ip="%s" port="%d" />\n' % (ip, port))
+    f.write('</group>\n</config>\n')
+
+
+def open_storage(args, **kwargs):
+  return storage.open_storage(args.backend, args.username, args.password,
+                              sqlite_file=args.sqlite_file, **kwargs)
+
+
+def count_rows(args):
+  db = open_storage(args)
+  try:
+    return db.db.ExecuteQuery('SELECT COUNT(*) FROM collected_stats', 'fetchall()',
+                              raise_errors=True)[0][0]
+  finally:
+    db.close()
+
+
+def prefill(args, addresses):
+  """Store args.rows records (without rollups) spread over the hosts, return their metrics."""
+  rng = random.Random(args.seed)
+  db = open_storage(args, max_batch=PREFILL_BATCH, max_delay=3600, rollups=False)
+  now = datetime.datetime.now()
+  start_time = time.time()
+  try:
+    for i in range(args.rows):
+      ip, _ = addresses[i % len(addresses)]
+      sampled_at = now - datetime.timedelta(seconds=rng.uniform(0, PREFILL_DAYS * 86400))
+      db.buffer_machine_stats(ip, ['Linux', '%.1f' % rng.uniform(0, 100),
+                                   '%.1f' % rng.uniform(0, 100), str(rng.randint(60, 10 ** 6)),
+                                   ''], sampled_at)
+  finally:
+    db.close()
+  duration = time.time() - start_time
+  return {'rows': args.rows, 'duration_s': duration,
+          'rows_per_s': args.rows / duration if duration else None,
+          'peak_rss_kb': get_peak_rss_kb()}
+
+
+def run_collector(args, cycle):
+  """Run collector.main() once against the simulated hosts, return the metrics of the cycle."""
+  latencies = []
+  failures = []
+  collected = set()
+  lock = threading.Lock()
+  collect_machine_once = collector.collect_machine_once
+
+  def timed_collect(machine, *collect_args, **collect_kwargs):
+    start_time = time.time()
+    try:
+      result = collect_machine_once(machine, *collect_args, **collect_kwargs)
+      with lock:
+        collected.add(machine.ip)
+      return result
+    except Exception:
+      with lock:
+        failures.append(machine.ip)
+      raise
+    finally:
+      with lock:
+        latencies.append(time.time() - start_time)
+
+  argv = ['collector.py', '--backend', args.backend, '--sqlite-file', args.sqlite_file,
+          '-u', args.username, '-p', args.password, '-c', str(args.concurrency),
+          '-r', str(args.retry), '--host-deadline', str(args.host_deadline)]
+  rows_before = count_rows(args)
+  saved_argv = sys.argv
+  collector.collect_machine_once = timed_collect
+  sys.argv = argv
+  start_time = time.time()
+  try:
+    collector.main()
+  finally:
+    duration = time.time() - start_time
+    sys.argv = saved_argv
+    collector.collect_machine_once = collect_machine_once
+  rows = count_rows(args) - rows_before
+  # Hosts whose attempts all failed don't count in the throughput.
+  return {'cycle': cycle, 'hosts': args.hosts, 'collected_hosts': len(collected),
+          'failed_hosts': args.hosts - len(collected), 'attempts': len(latencies),
+          'failed_attempts': len(failures), 'duration_s': duration,
+          'hosts_per_s': len(collected) / duration if duration else None,
+          'latency_p50_s': get_percentile(latencies, 0.5),
+          'latency_p99_s': get_percentile(latencies, 0.99),
+          'rows': rows, 'rows_per_s': rows / duration if duration else None,
+          'peak_rss_kb': get_peak_rss_kb()}
+
+
+def run_alerter(args):
+  """Run a dryrun of the alerter over the whole backlog, return its metrics."""
+  backlog = count_rows(args)
+  # Dryrun alerts are logged as warnings, one per violating record.
+  alerter_logger = logging.getLogger('benchmark.alerter')
+  if not args.verbose:
+    alerter_logger.setLevel(logging.ERROR)
+  bench_alerter = alerter.Alerter(args.username, args.password, logger=alerter_logger,
+                                  backend=args.backend, sqlite_file=args.sqlite_file)
+  start_time = time.time()
+  try:
+    bench_alerter.run_alerts(dryrun=True)
+  finally:
+    duration = time.time() - start_time
+    bench_alerter.close(timeout=0)
+  return {'backlog_rows': backlog, 'drain_s': duration,
+          'rows_per_s': backlog / duration if duration else None,
+          'peak_rss_kb': get_peak_rss_kb()}
+
+
+def measure_client_startup(work_dir, runs):
+  """Time runs collections of the client in a new interpreter, as a script and as a zipapp.
+
+  Returns:
+    dict, p50 and max duration (seconds) of each.
+  """
+  key_file = os.path.join(work_dir, 'client.pk')
+  private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+  with open(key_file, 'wb') as f:
+    f.write(collector.get_public_pem_data(private_key.public_key()))
+  script_path = os.path.join(work_dir, 'client_script', 'local_collector.py')
+  bundle_path = os.path.join(work_dir, 'local_collector.pyz')
+  with open(bundle_path, 'wb') as f:
+    f.write(collector.get_client_bundle(script_path))
+  results = {}
+  for name, path in (('script', script_path), ('zipapp', bundle_path)):
+    durations = []
+    for _ in range(runs):
+      start_time = time.time()
+      subprocess.check_call([sys.executable, path, '-f', key_file, '--stream'],
+                            stdout=subprocess.DEVNULL)
+      durations.append(time.time() - start_time)
+    results[name] = {'p50_s': get_percentile(durations, 0.5),
+                     'max_s': max(durations) if durations else None}
+  return results
+
+
+def run_benchmark(args):
+  """Run the benchmark described by args (see get_parser), return its results."""
+  work_dir = tempfile.mkdtemp(prefix='fleet_health_bench_')
+  # Same layout as the repository: the collector deploys ../client_script/local_collector.py
+  server_dir = os.path.join(work_dir, 'server_script')
+  os.makedirs(os.path.join(server_dir, 'lib'))
+  shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client_script'),
+                  os.path.join(work_dir, 'client_script'))
+  # Imported by the client script when it runs as a plain script.
+  for name in collector.CLIENT_MODULES:
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', name + '.py'),
+                os.path.join(server_dir, 'lib'))
+  args.sqlite_file = os.path.join(server_dir, os.path.basename(args.sqlite_file))
+  farm = HostFarm(args.hosts, os.path.join(work_dir, 'hosts'), args.latency, args.failure_rate,
+                  args.seed)
+  cwd = os.getcwd()
+  results = {}
+  try:
+    addresses = farm.start()
+    os.chdir(server_dir)
+    # State cached by the collector module is relative to the working directory.
+    collector._deployer = None
+    collector._keyrings.clear()
+    write_config(config.DEFAULT_XML_FILE, addresses)
+    if args.rows:
+      results['prefill'] = prefill(args, addresses)
+    results['collector'] = [run_collector(args, cycle) for cycle in range(args.cycles)]
+    results['alerter'] = run_alerter(args)
+    if args.client_runs:
+      results['client_startup'] = measure_client_startup(work_dir, args.client_runs)
+  finally:
+    os.chdir(cwd)
+    collector._deployer = None
+    collector._keyrings.clear()
+    farm.stop()
+    if args.keep:
+      logger.info('Benchmark files kept in %s', work_dir)
+    else:
+      shutil.rmtree(work_dir, ignore_errors=True)
+  return results
+
+
+def write_results(args, results):
+  params = dict((k, v) for k, v in vars(args).items() if k not in ('password', 'output'))
+  document = {'version': RESULTS_VERSION, 'commit': get_commit(),
+              'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+              'params': params, 'results': results}
+  tmp_file = args.output + '.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(document, f, indent=2, sort_keys=True)
+  os.replace(tmp_file, args.output)
+  return document
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(description='End to end benchmark of the collector and the '
+                                               'alerter against simulated hosts.')
+  parser.add_argument('--hosts', default=DEFAULT_HOSTS, type=int,
+                      help='Number of simulated hosts.')
+  parser.add_argument('--latency', default=DEFAULT_LATENCY, type=float,
+                      help='Average number of seconds a host takes to answer the collector.')
+  parser.add_argument('--failure-rate', default=0.0, type=float,
+                      help='Share of the ssh connections dropped by the hosts.')
+  parser.add_argument('--rows', default=0, type=int,
+                      help='Number of records stored before the collection, all of them are in'
+                           ' the alerter backlog.')
+  parser.add_argument('--cycles', default=1, type=int, help='Number of collector runs.')
+  parser.add_argument('-c', '--concurrency', default=config.DEFAULT_CONCURRENCY, type=int,
+                      help='Collector concurrency.')
+  parser.add_argument('-r', '--retry', default=0, type=int,
+                      help='Collector connection retries (each waits for the retry backoff).')
+  parser.add_argument('--host-deadline', default=config.DEFAULT_HOST_DEADLINE, type=float,
+                      help='Collector deadline of each host.')
+  parser.add_argument('--backend', default=storage.SQLITE, choices=storage.BACKENDS,
+                      help='Database of the benchmark, a MySQL database is modified in place.')
+  parser.add_argument('--sqlite-file', default=config.DEFAULT_SQLITE_FILE,
+                      help='Name of the database file (sqlite backend), in the benchmark'
+                           ' directory.')
+  parser.add_argument('-u', '--username', default=config.DEFAULT_USERNAME,
+                      help='username used for DB operations (mysql backend).')
+  parser.add_argument('-p', '--password', default=config.DEFAULT_PASSWORD,
+                      help='password used for DB operations (mysql backend).')
+  parser.add_argument('--client-runs', default=DEFAULT_CLIENT_RUNS, type=int,
+                      help='Number of runs of the client cold start measure, 0 to skip it.')
+  parser.add_argument('--seed', default=0, type=int, help='Seed of the simulated values.')
+  parser.add_argument('--keep', action='store_true',
+                      help='Keep the benchmark directory (config, database, host files).')
+  parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Json file of the results.')
+  parser.add_argument('-v', '--verbose', action='store_true', help='Log the collector progress.')
+  return parser
+
+
+def main():
+  args = get_parser().parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+  if not args.verbose:
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+  results = run_benchmark(args)
+  write_results(args, results)
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+  def test_end_to_end_run_benchmark(self):
+    args = benchmark.get_parser().parse_args([
+        '--hosts', '3', '--latency', '0', '--rows', '30', '--cycles', '2', '--client-runs', '1',
+        '--output', os.path.join(self.tmp_dir, 'results.json')])
+    results = benchmark.run_benchmark(args)
+
+    self.assertEqual(30, results['prefill']['rows'])
+    for cycle in results['collector']:
+      self.assertEqual((3, 0, 3), (cycle['attempts'], cycle['failed_attempts'], cycle['rows']))
+      self.assertEqual((3, 0), (cycle['collected_hosts'], cycle['failed_hosts']))
+      self.assertLessEqual(cycle['latency_p50_s'], cycle['latency_p99_s'])
+    self.assertEqual(36, results['alerter']['backlog_rows'])
+    self.assertEqual(['script', 'zipapp'], sorted(results['client_startup']))
+
+    benchmark.write_results(args, results)
+    with open(args.output) as f:
+      document = json.load(f)
+    self.assertEqual(results, document['results'])
+    self.assertEqual(3, document['params']['hosts'])
+    self.assertNotIn('password', document['params'])
+
+  def test_failed_hosts_run_benchmark(self):
+    args = benchmark.get_parser().parse_args([
+        '--hosts', '2', '--latency', '0', '--failure-rate', '1', '--retry', '0', '--rows', '0',
+        '--cycles', '1', '--client-runs', '0', '--output', os.path.join(self.tmp_dir, 'out.json')])
+    cycle = benchmark.run_benchmark(args)['collector'][0]
+    self.assertEqual((0, 2), (cycle['collected_hosts'], cycle['failed_hosts']))
+    self.assertEqual(0, cycle['hosts_per_s'])
+
+  def test_get_percentile(self):
+    values = [5, 1, 4, 2, 3]
+    self.assertEqual(3, benchmark.get_percentile(values, 0.5))
+    self.assertEqual(5, benchmark.get_percentile(values, 0.99))
+    self.assertIsNone(benchmark.get_percentile([], 0.5))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,36 +3,150 @@ import sys
 
 import paramiko
 import argparse
+import datetime
+import functools
+import heapq
 import logging
+import signal
+import threading
 import time
 
-from random import randint
+from collections import namedtuple
+from concurrent import futures
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import serialization
 
 from lib import storage
+from lib import agent
 from lib import config
+from lib import deploy
+from lib import envelope
+from lib import framing
+from lib import metrics
+from lib import notify
+from lib import sharding
+from lib import ssh_pool
+from lib import wire
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
 global_logger = logging.getLogger(__name__)
 
-
-def store_stats(ip_addr, stats, username, password):
-  #stats has the format: os, cpu_usage, mem_usage, uptime, event_logs
-  db = storage.Storage(username, password)
-  db_row_id = db.store_machine_stats(ip_addr, stats.split(','))
-  global_logger.info('Stats recorded: %s', db_row_id)
-
-
-def get_crypto_keys():
-  private_key = rsa.generate_private_key(public_exponent=65537,
-                                         key_size=2048,
-                                         backend=default_backend())
+CLIENT_SCRIPT_PATH = os.path.join('..', 'client_script', 'local_collector.py')
+# Modules of lib bundled with the client script, see get_client_bundle.
+CLIENT_MODULES = ('envelope', 'wire')
+# Version of the text stats of older local collectors, see parse_stats.
+STATS_FORMAT = 'v2'
+_client_script_cache = {}
+_client_bundle_cache = {}
+_deployer = None
+_deployer_lock = threading.Lock()
+_keyrings = {}
+_keyrings_lock = threading.Lock()
+
+
+def get_storage(args):
+  """Return a Storage whose connection pool (db.pool) is sized to be shared with workers.
+
+  The stored stats are notified to the alerter (see notify.Publisher) if args.notify_socket is set.
+  """
+  db = storage.open_storage(args.backend, args.username, args.password,
+                            sqlite_file=args.sqlite_file, pool_size=config.DEFAULT_DB_POOL_SIZE)
+  if args.notify_socket:
+    db.add_flush_listener(notify.Publisher(args.notify_socket, logger=global_logger))
+  return db
+
+
+def parse_stats(stats):
+  """Split the text stats of a machine into their fields.
+
+  Current local collectors send wire batches instead (see lib/wire.py), this is kept for the
+  clients which weren't redeployed yet.
+
+  Args:
+    stats: str, has the format: v2, sampled_at, os, cpu_usage, mem_usage, uptime, extra_metrics,
+      event_logs (where sampled_at is the epoch time of the measure on the client and
+      extra_metrics has the format key=value;key=value). Outputs of older clients don't start with
+      v2 nor have extra_metrics (and the oldest don't have sampled_at either).
+
+  Returns:
+    tuple (list of str: os, cpu_usage, mem_usage, uptime, event_logs and extra_metrics if
+    reported, datetime.datetime or None).
+
+  Raises:
+    CollectorError: if stats doesn't have the expected number of fields.
+  """
+  if stats.startswith(STATS_FORMAT + ','):
+    fields = stats.split(',', 7)
+    if len(fields) != 8:
+      raise CollectorError('Invalid stats: %s' % stats)
+    _, sampled_at, os_name, cpu_usage, mem_usage, uptime, extra_metrics, event_logs = fields
+    try:
+      sampled_at = datetime.datetime.fromtimestamp(float(sampled_at))
+    except ValueError:
+      raise CollectorError('Invalid sample time: %s' % sampled_at)
+    return [os_name, cpu_usage, mem_usage, uptime, event_logs, extra_metrics], sampled_at
+
+  fields = stats.split(',', 5)
+  sampled_at = None
+  if len(fields) == 6:
+    try:
+      sampled_at = datetime.datetime.fromtimestamp(float(fields[0]))
+    except ValueError:
+      raise CollectorError('Invalid sample time: %s' % fields[0])
+    fields = fields[1:]
+  elif len(fields) != 5:
+    raise CollectorError('Invalid stats: %s' % stats)
+  return fields, sampled_at
+
+
+def store_stats(db, ip_addr, stats, sampled_at=None, on_stored=None):
+  """Buffer the stats of a machine, they are stored by batch (see Storage.flush).
+
+  Args:
+    db: storage.Storage instance shared by the whole collection.
+    ip_addr: str, ip address of the machine.
+    stats: bytes, a wire batch whose records are all buffered, wire.Record or str, text stats of
+      older clients (see parse_stats). If sampled_at is passed, text stats don't start with the
+      sample time.
+    sampled_at: datetime.datetime, time at which the stats were sampled on the machine.
+    on_stored: callable called once each record is stored, see Storage.buffer_machine_stats.
+
+  Raises:
+    CollectorError: if stats can't be decoded.
+  """
+  if isinstance(stats, bytes):
+    try:
+      batch = wire.decode_batch(stats)
+    except wire.WireError as e:
+      raise CollectorError(e.msg)
+    for record in batch.records:
+      store_stats(db, ip_addr, record, sampled_at, on_stored)
+    return
+  if isinstance(stats, wire.Record):
+    fields = wire.get_stats_fields(stats)
+    if sampled_at is None and stats.sampled_at is not None:
+      sampled_at = datetime.datetime.fromtimestamp(stats.sampled_at)
+  elif sampled_at is None:
+    fields, sampled_at = parse_stats(stats)
+  else:
+    fields = stats.split(',', 4)
+  db.buffer_machine_stats(ip_addr, fields, sampled_at, on_stored)
+
+
+def get_keyring(key_dir=None):
+  """Return the server KeyRing of key_dir, shared by all the collections of the process."""
+  key_dir = key_dir or config.DEFAULT_KEYS_DIR
+  with _keyrings_lock:
+    if key_dir not in _keyrings:
+      _keyrings[key_dir] = envelope.KeyRing(key_dir, logger=global_logger)
+    return _keyrings[key_dir]
+
+
+@metrics.instrument('get_crypto_keys')
+def get_crypto_keys(key_dir=None):
+  """Return the long lived server key pair, it's only generated the very first time."""
+  private_key = get_keyring(key_dir).get_current()
   public_key = private_key.public_key()
   return private_key, public_key
 
@@ -41,17 +155,33 @@ def get_public_pem_data(public_key):
                                 format=serialization.PublicFormat.SubjectPublicKeyInfo)
 
 
-def get_decrypted_output(encrypted_file, private_key):
-  file = open(encrypted_file, 'rb')
-  ciphertext = file.read()
-  plaintext = ''
-  try:
-    plaintext = private_key.decrypt(ciphertext, padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                             algorithm=hashes.SHA256(), label=None))
-  except ValueError as e:
-    global_logger.error('Major issue happened with decryption: %s', e)
+@metrics.instrument('get_decrypted_output')
+def get_decrypted_output(encrypted_file, private_key, batch=False):
+  """Decrypt the content of encrypted_file.
 
-  return plaintext
+  Args:
+    encrypted_file: str, path of a file holding one or more envelopes.
+    private_key: envelope.KeyRing instance or RSA private key used to decrypt.
+    batch: boolean, if True all the envelopes of the file are decrypted.
+
+  Returns:
+    bytes, the plaintext of the single envelope of the file, or list of bytes if batch is True.
+    On decryption error, an empty string (or list if batch is True) is returned.
+  """
+  with open(encrypted_file, 'rb') as file:
+    ciphertext = file.read()
+  try:
+    plaintexts = envelope.decrypt_batch(ciphertext, private_key)
+  except envelope.EnvelopeError as e:
+    global_logger.error('Major issue happened with decryption: %s', e.msg)
+    return [] if batch else ''
+
+  if batch:
+    return plaintexts
+  if len(plaintexts) != 1:
+    global_logger.error('Expected a single encrypted output, got %d', len(plaintexts))
+    return ''
+  return plaintexts[0]
 
 def write_to_file(filename, content, mode):
   try:
@@ -63,71 +193,604 @@ def write_to_file(filename, content, mode):
     global_logger.error('Error while writin to file')
     return False
 
-# TODO(mohamedzouaghi): Refactor the ssh_connect function to make it shorter
-def ssh_connect(machine, max_retry=config.DEFAULT_RETRY):
-  # machine is of a type Client namedtuple
+class CollectorError(Exception):
+  """Base class exceptions for the collector module."""
+
+  def __init__(self, msg):
+    super(CollectorError, self).__init__(msg)
+    self.msg = msg
+
+
+class ConnectionFailure(CollectorError):
+  """Exception raised when an ssh connection to a machine can't be established."""
+
+
+class DeadlineExceeded(CollectorError):
+  """Exception raised when a machine couldn't be collected within its deadline."""
+
+
+# HostResult: outcome of a single machine collection as reported by collect_fleet.
+HostResult = namedtuple('HostResult', 'machine stats error attempts elapsed')
+
+
+def get_remaining_time(deadline):
+  """Return the number of seconds left before deadline or None if there is no deadline."""
+  if deadline is None:
+    return None
+  remaining = deadline - time.time()
+  if remaining <= 0:
+    raise DeadlineExceeded('Deadline exceeded')
+  return remaining
+
+
+def open_ssh_client(machine, deadline=None):
+  """Make a single ssh connection attempt to machine.
+
+  Args:
+    machine: config.Client namedtuple, machine to connect to.
+    deadline: float, epoch time after which no more time should be spent on machine.
+
+  Returns:
+    paramiko.SSHClient instance connected to machine.
+
+  Raises:
+    ConnectionFailure: if the connection couldn't be established.
+  """
+  remaining = get_remaining_time(deadline)
+  timeout = config.DEFAULT_SSH_TIMEOUT if remaining is None else min(config.DEFAULT_SSH_TIMEOUT,
+                                                                     remaining)
   ssh_client = paramiko.SSHClient()
   ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+  try:
+    with metrics.timed('ssh_connect', machine.ip):
+      ssh_client.connect(machine.ip, int(machine.port), username=machine.username,
+                         password=machine.password, timeout=timeout, banner_timeout=timeout,
+                         auth_timeout=timeout)
+  except (paramiko.ssh_exception.SSHException, OSError) as e:
+    ssh_client.close()
+    raise ConnectionFailure('Issue with ssh connection to %s: %s' % (machine.ip, e))
+  return ssh_client
+
+
+def ssh_connect(machine, max_retry=config.DEFAULT_RETRY, deadline=None):
+  """Connect to machine (retrying and sleeping between attempts) and collect its stats.
+
+  Args:
+    machine: config.Client namedtuple, machine to collect.
+    max_retry: int, number of extra connection attempts when the first one fails.
+    deadline: float, epoch time after which the collection is abandoned.
+
+  Returns:
+    str, the decrypted stats of the machine.
+
+  Raises:
+    ConnectionFailure: if no connection could be established after max_retry retries.
+  """
   retry = 0
-  while retry <= max_retry:
+  while True:
     try:
-      ssh_client.connect(machine.ip, int(machine.port), username=machine.username,
-                         password=machine.password, timeout=4)
+      ssh_client = open_ssh_client(machine, deadline)
       break
-    except (paramiko.ssh_exception.NoValidConnectionsError, OSError) as e:
-      global_logger.warn('Issue wih ssh connection: %s.', e)
-      if retry + 1 <= max_retry:
-        sleep_duration = 30 + 30 * retry
-        global_logger.warn('Sleeping for %d seconds before retrying.', sleep_duration)
-        time.sleep(sleep_duration)
+    except ConnectionFailure as e:
+      global_logger.warn('%s', e.msg)
+      if retry + 1 > max_retry:
+        global_logger.error('Fatal error with connection to %s.', machine.ip)
+        raise
+      sleep_duration = get_retry_delay(retry)
+      global_logger.warn('Sleeping for %d seconds before retrying.', sleep_duration)
+      metrics.RETRIES.inc(phase='ssh_connect')
+      time.sleep(sleep_duration)
       retry += 1
 
-  if retry > max_retry:
-    fatal_error_msg = 'Fatal error with connection. Exiting.'
-    global_logger.fatal(fatal_error_msg)
-    sys.exit('Fatal error with connection. Exiting.')
-
-  source_file_path = os.path.join('..', 'client_script')
-  client_script = 'local_collector.py'
-  # below is for linux only
-  target_file_path = '/tmp/'
-  # below to be removed only useful for debug
-  target_client_script = client_script[:-3] + str(randint(0, 10000)) + client_script[-3:]
-  local_copy_stats_results_filepath = 'encrypted_stats'
-
+  try:
+    return collect_from_client(ssh_client, machine, deadline)
+  finally:
+    ssh_client.close()
+
+
+def collect_machine_once(machine, deadline=None, pool=None, cursors=None,
+                         agent_rate=config.DEFAULT_AGENT_RATE):
+  """Make a single, non sleeping, collection attempt of machine. Used by collect_fleet.
+
+  Args:
+    machine: config.Client namedtuple, machine to collect.
+    deadline: float, epoch time after which the collection is abandoned.
+    pool: ssh_pool.SSHConnectionPool instance, if set the connection of machine is taken from (and
+      kept in) the pool instead of being opened and closed.
+    cursors: agent.CursorStore instance, if set the machine is collected in agent mode: the
+      samples recorded by its resident agent since the stored cursor are drained.
+    agent_rate: float, number of seconds between two samples of the resident agent.
+
+  Returns:
+    str, the decrypted stats of the machine (or the drained output in agent mode).
+  """
+  drain = None
+  if cursors is not None:
+    drain = cursors.get(machine.ip) + (agent_rate,)
+  if pool is None:
+    ssh_client = open_ssh_client(machine, deadline)
+    try:
+      return collect_from_client(ssh_client, machine, deadline, drain=drain)
+    finally:
+      ssh_client.close()
 
-  private_key, public_key = get_crypto_keys()
+  connection, reused = pool.acquire(machine, deadline)
+  try:
+    return collect_from_client(connection.ssh_client, machine, deadline, connection.get_sftp(),
+                               drain=drain)
+  except (paramiko.ssh_exception.SSHException, OSError, EOFError) as e:
+    pool.discard(machine)
+    if not reused:
+      raise ConnectionFailure('Issue with ssh connection to %s: %s' % (machine.ip, e))
+    # The pooled connection went stale since the previous cycle, make one fresh attempt.
+    global_logger.info('Pooled connection to %s is stale (%s), reconnecting.', machine.ip, e)
+  finally:
+    pool.release(connection)
+  return collect_machine_once(machine, deadline, pool, cursors, agent_rate)
+
+
+def get_retry_delay(retry, backoff=config.DEFAULT_RETRY_BACKOFF):
+  """Return the number of seconds to wait before the retry-th retry (starting from 0)."""
+  return backoff + backoff * retry
+
+
+def collect_from_client(ssh_client, machine, deadline=None, sftp=None, drain=None):
+  """Deploy the local collector to an already connected machine and return its decrypted stats.
+
+  Args:
+    ssh_client: paramiko.SSHClient instance connected to machine.
+    machine: config.Client namedtuple, machine to collect.
+    deadline: float, epoch time after which the collection is abandoned.
+    sftp: paramiko.SFTPClient instance to reuse, a new one is opened (and closed) if None.
+    drain: tuple (ring_id, cursor, rate), if set the resident agent of the machine is started if
+      needed and the samples it recorded after cursor are returned instead of a fresh sample.
+
+  Returns:
+    str, the decrypted stats of the machine (or the drained output if drain is set).
+  """
+  _, public_key = get_crypto_keys()
+  keyring = get_keyring()
   # pem_data is the serialization of the pubic_key to bytes so client machine can re-generate
   # the public key
   public_pem_data = get_public_pem_data(public_key)
-  source_pk_filepath = 'public_keys' 
-  pk_filename = 'pk_' + machine.ip + str(randint(0, 100000)) + '.pk'
 
+  own_sftp = sftp is None
+  if own_sftp:
+    sftp = ssh_client.open_sftp()
+  try:
+    return _deploy_and_run(ssh_client, sftp, machine, deadline, keyring, public_pem_data, drain)
+  finally:
+    if own_sftp:
+      sftp.close()
+
+
+def get_client_script(script_path=CLIENT_SCRIPT_PATH):
+  """Return the content of the client script, only reading it again if it changed on disk."""
+  mtime = os.stat(script_path).st_mtime
+  cached = _client_script_cache.get(script_path)
+  if cached is None or cached[0] != mtime:
+    with open(script_path, 'rb') as f:
+      cached = (mtime, f.read())
+    _client_script_cache[script_path] = cached
+  return cached[1]
+
+
+def get_client_bundle(script_path=CLIENT_SCRIPT_PATH):
+  """Return the client script bundled as a zipapp (see deploy.build_zipapp) along with
+  CLIENT_MODULES, built once per version of the script and modules."""
+  script = get_client_script(script_path)
+  lib_dir = os.path.dirname(os.path.abspath(envelope.__file__))
+  modules = tuple((name, get_client_script(os.path.join(lib_dir, name + '.py')))
+                  for name in CLIENT_MODULES)
+  sources = (script,) + tuple(source for _, source in modules)
+  cached = _client_bundle_cache.get(script_path)
+  if cached is None or any(old is not new for old, new in zip(cached[0], sources)):
+    cached = (sources, deploy.build_zipapp(script, 'local_collector', modules))
+    _client_bundle_cache[script_path] = cached
+  return cached[1]
+
+
+def get_deployer():
+  """Return the Deployer shared by all the collections of the process."""
+  global _deployer
+  with _deployer_lock:
+    if _deployer is None:
+      _deployer = deploy.Deployer(deploy.DeployCache(config.DEFAULT_DEPLOY_CACHE_FILE,
+                                                     logger=global_logger),
+                                  logger=global_logger)
+  return _deployer
+
+
+def decrypt_frames(frames, keyring):
+  """Decrypt the envelopes streamed by the local collector.
+
+  Args:
+    frames: list of bytes, payloads of the frames read from the local collector stdout.
+    keyring: envelope.KeyRing instance used to decrypt.
+
+  Returns:
+    list of bytes, the decrypted outputs.
+
+  Raises:
+    envelope.EnvelopeError: if any frame can't be decrypted.
+  """
+  # Envelopes carry their own length so all the frames are decrypted as a single batch.
+  return envelope.decrypt_batch(b''.join(frames), keyring)
+
+
+def _deploy_and_run(ssh_client, sftp, machine, deadline, keyring, public_pem_data, drain=None):
+  deployer = get_deployer()
+  # Both are only uploaded when their content changed since the last collection of machine.
+  with metrics.timed('deploy', machine.ip):
+    pk_path = deployer.ensure(sftp, machine.ip, 'pk', public_pem_data, '.pk')
+    script_path = deployer.ensure(sftp, machine.ip, 'local_collector_app', get_client_bundle(),
+                                  '.pyz')
 
-  if not write_to_file(os.path.join(source_pk_filepath, pk_filename), public_pem_data, 'wb'):
-    global_logger.fatal('Fatal error with public key storing. Exiting.')
+  # TODO(mohamedzouaghi): Need to change this so it suports Windows and MacOS
+  # The encrypted output is streamed back on stdout, nothing is written to disk on either side.
+  command = 'python3 ' + script_path + ' -f ' + pk_path + ' --stream'
+  if drain:
+    command += ' --ensure_agent --drain %d %d --rate %s' % drain
+  with metrics.timed('remote_run', machine.ip):
+    stdin, stdout, stderr = ssh_client.exec_command(command,
+                                                    timeout=get_remaining_time(deadline))
+    stdin.close()
+    try:
+      frames = list(framing.read_frames(stdout))
+    except framing.FramingError as e:
+      raise CollectorError('Invalid output stream from %s: %s' % (machine.ip, e.msg))
+    exit_status = stdout.channel.recv_exit_status()
+  if exit_status != 0 or not frames:
+    raise CollectorError('Local collector failed on %s (exit status %d): %s' % (
+        machine.ip, exit_status, stderr.read().decode('utf-8', 'replace').strip()))
+
+  try:
+    # The keyring (rather than the current key) is used in case the key was rotated meanwhile.
+    with metrics.timed('decrypt', machine.ip):
+      decrypted_outputs = decrypt_frames(frames, keyring)
+  except envelope.EnvelopeError as e:
+    raise CollectorError('Output of %s couldn\'t be decrypted: %s' % (machine.ip, e.msg))
+  if len(decrypted_outputs) != 1:
+    raise CollectorError('Expected a single output from %s, got %d' % (machine.ip,
+                                                                       len(decrypted_outputs)))
+  output = decrypted_outputs[0]
+  global_logger.debug('received_output_aftr_decryption: %d bytes', len(output))
+  # Wire batches are decoded when stored, outputs of older clients are text.
+  return output if wire.is_batch(output) else output.decode('utf-8')
+
+
+def collect_fleet(machines, concurrency=config.DEFAULT_CONCURRENCY, max_retry=config.DEFAULT_RETRY,
+                  host_deadline=config.DEFAULT_HOST_DEADLINE,
+                  retry_backoff=config.DEFAULT_RETRY_BACKOFF, on_result=None, pool=None,
+                  collect=None):
+  """Collect stats of all machines using a bounded pool of workers.
+
+  Each machine gets its own wall clock deadline starting when its first attempt starts, so the
+  machines waiting for a free worker in a large fleet don't use up their deadline. Failed
+  connection attempts aren't retried by sleeping in a worker: they are scheduled back with a
+  backoff so the worker is free to collect other machines in the meantime. A machine which can't
+  be collected is reported as failed without interrupting the others.
+
+  Args:
+    machines: list of config.Client namedtuple, machines to collect.
+    concurrency: int, maximum number of machines collected at the same time.
+    max_retry: int, number of extra connection attempts when the first one fails.
+    host_deadline: float, number of seconds allowed for each machine (retries included).
+    retry_backoff: float, base number of seconds to wait before retrying a connection.
+    on_result: callable, called from the calling thread with each HostResult as soon as it's known.
+    pool: ssh_pool.SSHConnectionPool instance used to reuse connections across calls.
+    collect: callable taking (machine, deadline, pool) and returning the machine stats,
+      collect_machine_once if None.
+
+  Returns:
+    list of HostResult namedtuple, one per machine.
+  """
+  collect = collect or collect_machine_once
+  start_time = time.time()
+  results = []
+  # pending is a heap of (due_time, sequence, machine, attempt, deadline), the deadline of a machine
+  # being set (None before) when its first attempt starts.
+  pending = [(start_time, i, m, 0, None) for i, m in enumerate(machines)]
+  heapq.heapify(pending)
+  sequence = len(pending)
+  in_flight = {}
+
+  def report(machine, stats, error, attempts):
+    result = HostResult(machine=machine, stats=stats, error=error, attempts=attempts,
+                        elapsed=time.time() - start_time)
+    results.append(result)
+    metrics.HOSTS.inc(result='failed' if error else 'collected')
+    if error:
+      global_logger.error('Collection of %s failed after %d attempt(s): %s', machine.ip, attempts,
+                          error)
+    if on_result:
+      on_result(result)
+
+  def collect_host(machine, deadline, pool):
+    with metrics.timed('collect_host', machine.ip):
+      return collect(machine, deadline, pool)
+
+  executor = futures.ThreadPoolExecutor(max_workers=max(1, concurrency))
+  try:
+    while pending or in_flight:
+      now = time.time()
+      while pending and pending[0][0] <= now and len(in_flight) < max(1, concurrency):
+        _, _, machine, attempt, deadline = heapq.heappop(pending)
+        if deadline is None and host_deadline:
+          deadline = now + host_deadline
+        if deadline is not None and now >= deadline:
+          report(machine, None, 'Deadline exceeded before attempt %d' % (attempt + 1), attempt)
+          continue
+        future = executor.submit(collect_host, machine, deadline, pool)
+        in_flight[future] = (machine, attempt, deadline)
+
+      wait_timeout = None
+      if pending:
+        wait_timeout = max(0, pending[0][0] - now)
+      deadlines = [d for _, _, d in in_flight.values() if d is not None]
+      if deadlines:
+        deadline_timeout = max(0, min(deadlines) - now)
+        wait_timeout = deadline_timeout if wait_timeout is None else min(wait_timeout,
+                                                                          deadline_timeout)
+      if not in_flight:
+        time.sleep(wait_timeout)
+        continue
+      done, _ = futures.wait(list(in_flight), timeout=wait_timeout,
+                             return_when=futures.FIRST_COMPLETED)
+
+      for future in done:
+        machine, attempt, deadline = in_flight.pop(future)
+        try:
+          report(machine, future.result(), None, attempt + 1)
+        except ConnectionFailure as e:
+          retry_at = time.time() + get_retry_delay(attempt, retry_backoff)
+          if attempt + 1 > max_retry or (deadline is not None and retry_at >= deadline):
+            report(machine, None, e.msg, attempt + 1)
+          else:
+            global_logger.warn('%s. Retrying in %d seconds.', e.msg, retry_at - time.time())
+            metrics.RETRIES.inc(phase='ssh_connect')
+            heapq.heappush(pending, (retry_at, sequence, machine, attempt + 1, deadline))
+            sequence += 1
+        except Exception as e:
+          report(machine, None, str(e) or e.__class__.__name__, attempt + 1)
+
+      # Workers can't be interrupted, the sockets timeouts will eventually release them but the
+      # results of machines past their deadline are no longer waited for.
+      now = time.time()
+      for future, (machine, attempt, deadline) in list(in_flight.items()):
+        if deadline is not None and now >= deadline and not future.done():
+          del in_flight[future]
+          report(machine, None, 'Deadline exceeded', attempt + 1)
+  finally:
+    # Abandoned workers (deadline exceeded) are not waited for.
+    executor.shutdown(wait=False)
+
+  return results
+
+
+def run_cycles(collect_cycle, interval, stop_event, max_cycles=None):
+  """Internal scheduler of the daemon mode: call collect_cycle every interval seconds.
+
+  Cycles are scheduled at a fixed rate. If a cycle overruns the interval, the missed ticks are
+  skipped rather than queued so the daemon never runs back to back cycles to catch up.
+
+  Args:
+    collect_cycle: callable without argument, runs a single collection cycle.
+    interval: float, number of seconds between the start of two cycles.
+    stop_event: threading.Event, the scheduler returns as soon as it's set.
+    max_cycles: int, maximum number of cycles to run, unlimited if None.
+
+  Returns:
+    int, number of cycles which were run.
+  """
+  cycles = 0
+  next_run = time.time()
+  while not stop_event.is_set() and (max_cycles is None or cycles < max_cycles):
+    collect_cycle()
+    cycles += 1
+    next_run += interval
+    now = time.time()
+    if next_run < now:
+      skipped = int((now - next_run) // interval) + 1
+      global_logger.warn('Collection cycle overran the interval, skipping %d tick(s).', skipped)
+      next_run += skipped * interval
+    stop_event.wait(next_run - now)
+  return cycles
+
+
+def run_daemon(args, cursors=None):
+  """Run the collector as a long lived process which keeps its ssh connections between cycles."""
+  pool = ssh_pool.SSHConnectionPool(open_ssh_client,
+                                    idle_timeout=args.idle_timeout,
+                                    logger=global_logger)
+  stop_event = threading.Event()
+
+  def stop(signum, frame):
+    global_logger.info('Received signal %d, stopping after the current cycle.', signum)
+    stop_event.set()
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  db = get_storage(args)
+  shard = get_shard(args, db)
+  # config.xml changes are picked up by the next cycle, without restarting the daemon.
+  watcher = config.ConfigWatcher(include_alerts=False, logger=global_logger)
+  watcher.start()
+
+  def collect_cycle():
+    start_time = time.time()
+    collect_once(args, pool, cursors, db, machines=watcher.get_clients(), shard=shard)
+    pool.evict_idle()
+    metrics.write_run('collector', start_time, args.metrics_file, global_logger)
 
-  
-  sftp = ssh_client.open_sftp()
-  copy_pk_results = sftp.put(os.path.join(source_pk_filepath, pk_filename), os.path.join(target_file_path, pk_filename))
-  global_logger.info('copy_pk_results: %s', copy_pk_results)
+  try:
+    run_cycles(collect_cycle, args.interval, stop_event)
+  finally:
+    watcher.stop()
+    pool.close_all()
+    if shard is not None:
+      leave_shard(shard)
+    db.close()
 
-  sftp = ssh_client.open_sftp()
-  sftp_results = sftp.put(os.path.join(source_file_path, client_script), os.path.join(target_file_path, target_client_script))
-  global_logger.info('sftp_results: %s', sftp_results)
 
-  # TODO(mohamedzouaghi): Need to change this so it suports Windows and MacOS
-  command = 'python3 ' + target_file_path + target_client_script + ' -f ' + target_file_path + pk_filename
-  stdin, stdout, stderr = ssh_client.exec_command(command)
-  encrypted_remote_filename = stdout.read().decode('utf-8').rstrip()
+def get_shard(args, db):
+  """Return the sharding.Shard of this collector, None if it collects the whole fleet."""
+  if not args.node_id:
+    return None
+  return sharding.Shard(db, sharding.COLLECTOR, args.node_id, ttl=args.lease_ttl,
+                        logger=global_logger)
 
-  encrypted_local_name = os.path.join(local_copy_stats_results_filepath, encrypted_remote_filename.split('/')[-1].rstrip())
 
-  global_logger.info('received stdout:\n%s\nReceived stderr:\n%s' % (encrypted_remote_filename, stderr.read()))
-  copy_stats_results = sftp.get(encrypted_remote_filename, encrypted_local_name)
-  decrypted_output = get_decrypted_output(encrypted_local_name, private_key)
-  global_logger.info('received_output_aftr_decryption: %s', decrypted_output.decode('utf-8'))
-  return decrypted_output.decode('utf-8')
+def leave_shard(shard):
+  try:
+    shard.leave()
+  except storage.StorageError as e:
+    global_logger.error('Leases of node %s couldn\'t be dropped, its machines are taken over once '
+                        'they expire: %s', shard.node_id, e.msg)
+
+
+def collect_once(args, pool=None, cursors=None, db=None, machines=None, shard=None):
+  """Run a single collection of all configured machines and store their stats.
+
+  Args:
+    args: argparse.Namespace, parsed command line arguments.
+    pool: ssh_pool.SSHConnectionPool instance used to reuse connections across calls.
+    cursors: agent.CursorStore instance, if set machines are collected in agent mode.
+    db: storage.Storage instance to reuse across calls, a new one is used (and closed) if None.
+    machines: list of config.Client namedtuple, the machines of config.xml if None.
+    shard: sharding.Shard instance, if set only the machines leased by this node are collected.
+
+  Returns:
+    list of str, ip addresses of the machines which couldn't be collected.
+  """
+  remote_machines = machines
+  if remote_machines is None:
+    remote_machines = config.get_clients_details(include_alerts=False)
+  own_db = db is None
+  if own_db:
+    db = get_storage(args)
+  if shard is not None:
+    try:
+      remote_machines = shard.assign(remote_machines)
+    except storage.StorageError as e:
+      # Collecting every machine would duplicate the work of the other nodes.
+      global_logger.error('Machines of node %s couldn\'t be leased, skipping this collection: %s',
+                          shard.node_id, e.msg)
+      if own_db:
+        db.close()
+      return []
+  # Agent cursors are only moved over the drained samples which were flushed to the DB.
+  drained_cursors = []
+
+  def store_result(result):
+    if result.stats is None:
+      return
+    try:
+      if cursors is None:
+        store_stats(db, result.machine.ip, result.stats)
+      else:
+        store_drained_stats(db, result.machine.ip, result.stats, drained_cursors)
+    except storage.StorageError as e:
+      global_logger.error('Stats of %s couldn\'t be stored: %s', result.machine.ip, e.msg)
+    except agent.AgentError as e:
+      global_logger.error('Drained stats of %s couldn\'t be parsed: %s', result.machine.ip, e.msg)
+    except CollectorError as e:
+      global_logger.error('Stats of %s couldn\'t be parsed: %s', result.machine.ip, e.msg)
+
+  collect = collect_machine_once
+  if cursors is not None:
+    collect = functools.partial(collect_machine_once, cursors=cursors, agent_rate=args.agent_rate)
+  results = collect_fleet(remote_machines, concurrency=args.concurrency, max_retry=args.retry,
+                          host_deadline=args.host_deadline, on_result=store_result, pool=pool,
+                          collect=collect)
+  try:
+    db.flush()
+  except storage.StorageError as e:
+    global_logger.error('Stats couldn\'t be stored: %s', e.msg)
+  finally:
+    # Samples stored by an earlier flush mustn't be drained again when the last one fails.
+    for drained_cursor in drained_cursors:
+      acked_seq = drained_cursor.get_acked_seq()
+      if acked_seq is not None:
+        cursors.set(drained_cursor.ip_addr, drained_cursor.ring_id, acked_seq)
+    if own_db:
+      try:
+        # Retries the flush of the stats kept buffered by a failed flush, a last time.
+        db.close()
+      except storage.StorageError as e:
+        global_logger.error('Buffered stats were dropped: %s', e.msg)
+  failed = [r.machine.ip for r in results if r.error]
+  global_logger.info('Collected %d machine(s), %d failed%s', len(results) - len(failed),
+                     len(failed), (': %s' % ', '.join(failed)) if failed else '.')
+  return failed
+
+
+class DrainedCursor(object):
+  """Cursor of a machine following the storage of the samples drained from its agent.
+
+  The cursor acknowledges the samples up to the first one which wasn't stored: the next drain sends
+  the samples after it again.
+  """
+
+  def __init__(self, ip_addr, ring_id, last_seq, seqs):
+    """Create a DrainedCursor.
+
+    Args:
+      ip_addr: str, ip address of the machine.
+      ring_id: int, id of the ring the samples were drained from.
+      last_seq: int, sequence number of the last sample of the ring.
+      seqs: list of int, sequence numbers of the drained samples, ascending.
+    """
+    self.ip_addr = ip_addr
+    self.ring_id = ring_id
+    self.last_seq = last_seq
+    self.seqs = seqs
+    self._stored = set()
+    self._lock = threading.Lock()
+
+  def get_callback(self, seq):
+    """Return the on_stored callback (see Storage.buffer_machine_stats) of the sample seq."""
+    return functools.partial(self._on_stored, seq)
+
+  def _on_stored(self, seq):
+    with self._lock:
+      self._stored.add(seq)
+
+  def get_acked_seq(self):
+    """Return the sequence number the cursor is moved to, None if it isn't moved."""
+    acked_seq = None
+    with self._lock:
+      for seq in self.seqs:
+        if seq not in self._stored:
+          return acked_seq
+        acked_seq = seq
+    return self.last_seq
+
+
+def store_drained_stats(db, ip_addr, output, drained_cursors):
+  """Buffer the samples drained from the agent of ip_addr.
+
+  The cursor of the machine has to be moved only over the samples which were flushed (see
+  DrainedCursor), the samples of a failed flush are drained again by the next collection. The
+  next drain sends the moved cursor, which acknowledges the samples to the client.
+
+  Args:
+    drained_cursors: list, the DrainedCursor of the machine is added to it before its samples are
+      buffered.
+  """
+  drained = agent.parse_drained_output(output)
+  drained_cursor = DrainedCursor(ip_addr, drained.ring_id, drained.last_seq,
+                                 [sample.seq for sample in drained.samples])
+  drained_cursors.append(drained_cursor)
+  for sample in drained.samples:
+    store_stats(db, ip_addr, sample.stats,
+                sampled_at=datetime.datetime.fromtimestamp(sample.timestamp),
+                on_stored=drained_cursor.get_callback(sample.seq))
+  global_logger.info('%d sample(s) drained from %s.', len(drained.samples), ip_addr)
+  if drained.dropped:
+    metrics.DROPPED_SAMPLES.inc(drained.dropped)
+    global_logger.warn('%d sample(s) of %s were overwritten before being drained, its ring is too'
+                       ' small for the collection interval.', drained.dropped, ip_addr)
 
 
 def main():
@@ -136,17 +799,82 @@ def main():
       help='username used for DB operations.')
   parser.add_argument('-p', '--password', required=False, default=config.DEFAULT_PASSWORD,
       help='username used for DB operations.')
+  parser.add_argument('--backend', required=False, default=config.DEFAULT_STORAGE_BACKEND,
+      choices=storage.BACKENDS, help='Database the stats are stored into.')
+  parser.add_argument('--sqlite-file', required=False, default=config.DEFAULT_SQLITE_FILE,
+      help='Database file of the sqlite backend.')
   parser.add_argument('-r', '--retry', required=False, default=config.DEFAULT_RETRY, type=int,
       help='Numbr of ssh connection attempts in case first attemp fails. Eg: If 1, there will be on more attempt etc...')
+  parser.add_argument('-c', '--concurrency', required=False, default=config.DEFAULT_CONCURRENCY,
+      type=int, help='Maximum number of machines collected in parallel.')
+  parser.add_argument('--host-deadline', required=False, default=config.DEFAULT_HOST_DEADLINE,
+      type=float, help='Number of seconds after which the collection of a machine is abandoned.')
+  parser.add_argument('--agent', required=False, action='store_true',
+      help='Collect machines in agent mode: a resident agent samples each machine every'
+           ' --agent-rate seconds and each collection drains the samples recorded since the'
+           ' previous one.')
+  parser.add_argument('--agent-rate', required=False, default=config.DEFAULT_AGENT_RATE,
+      type=float, help='Number of seconds between two samples of the resident agents.')
+  parser.add_argument('--rotate-keys', required=False, action='store_true',
+      help='Generate a new server key pair and exit. The previous keys are kept for a while to'
+           ' decrypt outputs which were encrypted before the rotation.')
+  parser.add_argument('--daemon', required=False, action='store_true',
+      help='Keep running and collect every --interval seconds, reusing ssh connections.')
+  parser.add_argument('-i', '--interval', required=False, default=config.DEFAULT_INTERVAL,
+      type=float, help='Number of seconds between two collections in daemon mode.')
+  parser.add_argument('--idle-timeout', required=False, default=None, type=float,
+      help='Number of seconds after which an unused ssh connection is closed in daemon mode, has'
+           ' to be at least twice --interval so connections outlive a cycle. %d or twice'
+           ' --interval if not set.' % ssh_pool.DEFAULT_IDLE_TIMEOUT)
+  parser.add_argument('--node-id', required=False, default=None,
+      help='Share the fleet with the other collectors run with a --node-id (against the same DB),'
+           ' each machine is then collected by a single node. Ids have to be unique.')
+  parser.add_argument('--lease-ttl', required=False, default=sharding.DEFAULT_LEASE_TTL, type=int,
+      help='Number of seconds after which the machines of a node which stopped are taken over by'
+           ' the other nodes, has to exceed the time between two collections of a node plus'
+           ' --host-deadline.')
+  parser.add_argument('--metrics-file', required=False,
+      default=config.DEFAULT_COLLECTOR_METRICS_FILE,
+      help='Prometheus text format snapshot of the phase timings, rewritten after each collection.'
+           ' Empty to disable it.')
+  parser.add_argument('--profile', required=False, default=None,
+      help='Record a cProfile of the run into this file (pstats format).')
+  parser.add_argument('--notify-socket', required=False, default=config.DEFAULT_NOTIFY_SOCKET,
+      help='Unix socket of the alerter (alerter.py --follow) notified of the stored stats, suffixed'
+           ' with --node-id if set. Empty to disable the notifications.')
 
   args = parser.parse_args()
-
-  remote_machines = config.get_clients_details(include_alerts=False)
-  for m in remote_machines:
-    machine_stat = ssh_connect(m, max_retry=args.retry)
-    store_stats(m.ip, (machine_stat), args.username, args.password)
-
+  if args.idle_timeout is None:
+    args.idle_timeout = max(ssh_pool.DEFAULT_IDLE_TIMEOUT, 2 * args.interval)
+  elif args.daemon and args.idle_timeout < 2 * args.interval:
+    parser.error('--idle-timeout has to be at least twice --interval, the connections would be '
+                 'closed between two collections.')
+  if args.node_id and args.lease_ttl <= args.host_deadline + (args.interval if args.daemon else 0):
+    parser.error('--lease-ttl has to exceed --host-deadline (plus --interval with --daemon), the '
+                 'leases of the machines would expire while they are collected.')
+  # Like the files of the alerter nodes, see alerter.Alerter. The stored stats are notified to the
+  # alerter node having the same node id.
+  args.metrics_file = sharding.get_node_path(args.metrics_file, args.node_id)
+  args.notify_socket = sharding.get_node_path(args.notify_socket, args.node_id)
+
+  cursors = None
+  if args.agent:
+    cursors = agent.CursorStore(config.DEFAULT_AGENT_CURSORS_FILE, logger=global_logger)
+
+  with metrics.profiled(args.profile):
+    if args.rotate_keys:
+      get_keyring().rotate()
+    elif args.daemon:
+      run_daemon(args, cursors)
+    else:
+      start_time = time.time()
+      db = get_storage(args)
+      try:
+        collect_once(args, cursors=cursors, db=db, shard=get_shard(args, db))
+      finally:
+        db.close()
+      metrics.write_run('collector', start_time, args.metrics_file, global_logger)
 
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
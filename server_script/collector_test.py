@@ -1,8 +1,23 @@
+import datetime
+import io
+import tempfile
+import threading
+import time
 import unittest
 import collector
+import testutil
 
 from unittest import mock
 
+import pymysql
+
+from lib import config
+from lib import envelope
+from lib import framing
+from lib import ssh_pool
+from lib import storage
+from lib import wire
+
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 
@@ -17,9 +32,12 @@ class CollectorTest(unittest.TestCase):
 
 
   def test_valid_get_crypto_keys(self):
-    calculated_private_key, calculated_public_key = collector.get_crypto_keys()
-    self.assertEqual(isinstance(calculated_private_key, rsa.RSAPrivateKey), True)
-    self.assertEqual(isinstance(calculated_public_key, rsa.RSAPublicKey), True)
+    with tempfile.TemporaryDirectory() as key_dir:
+      calculated_private_key, calculated_public_key = collector.get_crypto_keys(key_dir)
+      self.assertEqual(isinstance(calculated_private_key, rsa.RSAPrivateKey), True)
+      self.assertEqual(isinstance(calculated_public_key, rsa.RSAPublicKey), True)
+      # The key pair is long lived, no new key is generated by later calls
+      self.assertIs(calculated_private_key, collector.get_crypto_keys(key_dir)[0])
 
   def test_valid_get_public_pem_data(self):
     calculated_pem = collector.get_public_pem_data(self.public_key_example)
@@ -31,6 +49,172 @@ class CollectorTest(unittest.TestCase):
                                                            self.private_key_example)
       self.assertEqual(resulting_plain_text, '')
 
+  @mock.patch('collector.collect_machine_once')
+  def test_failing_host_collect_fleet(self, mock_collect_once):
+    machines = [config.Client(ip='1.1.1.%d' % i, port='22', username='u', password='p', mail='',
+                              alerts=[]) for i in range(4)]
+
+    def fake_collect(machine, deadline, pool=None):
+      if machine.ip == '1.1.1.2':
+        raise collector.ConnectionFailure('unreachable')
+      return 'posix,1,2,3,empty'
+    mock_collect_once.side_effect = fake_collect
+
+    results = collector.collect_fleet(machines, concurrency=2, max_retry=2, retry_backoff=0)
+    self.assertEqual(4, len(results))
+    failed = [r for r in results if r.error]
+    self.assertEqual(['1.1.1.2'], [r.machine.ip for r in failed])
+    # First attempt plus the two retries
+    self.assertEqual(3, failed[0].attempts)
+    self.assertEqual(6, mock_collect_once.call_count)
+
+  @mock.patch('collector.collect_machine_once')
+  def test_deadline_collect_fleet(self, mock_collect_once):
+    machine = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='', alerts=[])
+    mock_collect_once.side_effect = collector.ConnectionFailure('unreachable')
+
+    results = collector.collect_fleet([machine], max_retry=3, host_deadline=0.5, retry_backoff=10)
+    self.assertEqual(1, len(results))
+    self.assertEqual(1, mock_collect_once.call_count)
+    self.assertEqual('unreachable', results[0].error)
+
+  @mock.patch('collector.collect_machine_once')
+  def test_deadline_per_host_collect_fleet(self, mock_collect_once):
+    machines = [config.Client(ip='1.1.1.%d' % i, port='22', username='u', password='p', mail='',
+                              alerts=[]) for i in range(4)]
+    deadlines = {}
+
+    def fake_collect(machine, deadline, pool=None):
+      deadlines[machine.ip] = deadline - time.time()
+      time.sleep(0.2)
+      return 'posix,1,2,3,empty'
+    mock_collect_once.side_effect = fake_collect
+
+    # The last machines only get a worker after the deadline of the first ones expired.
+    results = collector.collect_fleet(machines, concurrency=1, host_deadline=0.5)
+    self.assertEqual([None] * 4, [r.error for r in results])
+    self.assertEqual(4, mock_collect_once.call_count)
+    for ip_addr, remaining in deadlines.items():
+      self.assertGreater(remaining, 0.4, ip_addr)
+
+  def test_stale_connection_collect_machine_once(self):
+    machine = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='', alerts=[])
+    stale_client = mock.Mock()
+    fresh_client = mock.Mock()
+    connect = mock.Mock(side_effect=[stale_client, fresh_client])
+    pool = ssh_pool.SSHConnectionPool(connect)
+    # Simulate a connection kept from a previous cycle
+    pool.acquire(machine)
+    pool.release(pool._connections[machine.ip])
+
+    with mock.patch('collector.collect_from_client') as mock_collect_from_client:
+      mock_collect_from_client.side_effect = [EOFError(), 'posix,1,2,3,empty']
+      self.assertEqual('posix,1,2,3,empty', collector.collect_machine_once(machine, pool=pool))
+    self.assertEqual(2, connect.call_count)
+    stale_client.close.assert_called_once_with()
+    self.assertIs(fresh_client, pool._connections[machine.ip].ssh_client)
+
+  def test_idle_eviction_ssh_pool(self):
+    machine = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='', alerts=[])
+    pool = ssh_pool.SSHConnectionPool(mock.Mock(), idle_timeout=10)
+    connection, reused = pool.acquire(machine)
+    self.assertFalse(reused)
+    pool.release(connection)
+    self.assertEqual([], pool.evict_idle(now=connection.last_used + 5))
+    self.assertEqual(['1.1.1.1'], pool.evict_idle(now=connection.last_used + 11))
+    self.assertEqual(0, len(pool))
+
+  def test_max_cycles_run_cycles(self):
+    stop_event = threading.Event()
+    calls = []
+    cycles = collector.run_cycles(lambda: calls.append(time.time()), 0.01, stop_event, max_cycles=3)
+    self.assertEqual(3, cycles)
+    self.assertEqual(3, len(calls))
+
+  @mock.patch('collector.get_deployer')
+  def test_streamed_output_collect_from_client(self, mock_get_deployer):
+    local_collector = testutil.load_local_collector()
+    machine = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='', alerts=[])
+    keyring = envelope.KeyRing.from_private_key(self.private_key_example)
+    stream = io.BytesIO()
+    local_collector.write_frame(local_collector.encrypt_text('posix,1,2,3,empty',
+                                                             self.public_key_example), stream)
+    stdout = io.BytesIO(stream.getvalue())
+    stdout.channel = mock.Mock()
+    stdout.channel.recv_exit_status.return_value = 0
+    ssh_client = mock.Mock()
+    ssh_client.exec_command.return_value = (mock.Mock(), stdout, io.BytesIO())
+
+    with mock.patch('collector.get_keyring', return_value=keyring):
+      stats = collector.collect_from_client(ssh_client, machine, sftp=mock.Mock())
+    self.assertEqual('posix,1,2,3,empty', stats)
+    self.assertTrue(ssh_client.exec_command.call_args[0][0].endswith(' --stream'))
+
+  def test_truncated_stream_read_frames(self):
+    data = framing.encode_frame(b'first') + framing.encode_frame(b'second')
+    self.assertEqual([b'first', b'second'], list(framing.read_frames(io.BytesIO(data))))
+    with self.assertRaises(framing.FramingError):
+      list(framing.read_frames(io.BytesIO(data[:-1])))
+
+  def test_sample_time_parse_stats(self):
+    fields, sampled_at = collector.parse_stats('1500000000.5,posix,1,2,3,a,b')
+    self.assertEqual(['posix', '1', '2', '3', 'a,b'], fields)
+    self.assertEqual(datetime.datetime.fromtimestamp(1500000000.5), sampled_at)
+    # Output of an older client, without sample time
+    self.assertEqual((['posix', '1', '2', '3', 'empty'], None),
+                     collector.parse_stats('posix,1,2,3,empty'))
+    with self.assertRaises(collector.CollectorError):
+      collector.parse_stats('posix,1')
+
+  def test_extra_metrics_parse_stats(self):
+    fields, sampled_at = collector.parse_stats(
+        'v2,1500000000.5,posix,1,2,3,load1=0.50;procs=sshd:22:0.1,a,b')
+    self.assertEqual(['posix', '1', '2', '3', 'a,b', 'load1=0.50;procs=sshd:22:0.1'], fields)
+    self.assertEqual(datetime.datetime.fromtimestamp(1500000000.5), sampled_at)
+    with self.assertRaises(collector.CollectorError):
+      collector.parse_stats('v2,1500000000.5,posix,1,2,3')
+
+  def test_wire_batch_store_stats(self):
+    db = mock.Mock()
+    record = wire.Record(sampled_at=1500000000.5, os='posix', cpu_usage=1.5, mem_usage=2.0,
+                         uptime=3.0, event_logs='empty', metrics={'load1': 0.5},
+                         labels={'procs': 'sshd:22:0.1'})
+    collector.store_stats(db, '1.1.1.1', wire.encode_batch([record, record]))
+    self.assertEqual(2, db.buffer_machine_stats.call_count)
+    db.buffer_machine_stats.assert_called_with(
+        '1.1.1.1', ['posix', 1.5, 2.0, 3.0, 'empty', 'load1=0.50;procs=sshd:22:0.1'],
+        datetime.datetime.fromtimestamp(1500000000.5), None)
+    with self.assertRaises(collector.CollectorError):
+      collector.store_stats(db, '1.1.1.1', b'FHW\x01')
+
+  @mock.patch('pymysql.connect')
+  def test_flushed_samples_acknowledged_collect_once(self, mock_connect):
+    cursor = mock_connect.return_value.cursor.return_value
+    # The flush triggered by the second sample succeeds, the last one fails.
+    cursor.executemany.side_effect = [None, pymysql.OperationalError('gone away')]
+    db = storage.Storage(None, None, max_batch=2, max_delay=60, rollups=False)
+    outputs = {'1.1.1.1': 'agent,42,7\n5,1000.5,posix,1.0,2.0,3.0,empty\n'
+                          '6,1010.5,posix,1.0,2.0,3.0,empty\n7,1020.5,posix,1.0,2.0,3.0,empty',
+               '2.2.2.2': 'agent,43,3\n3,1000.5,posix,1.0,2.0,3.0,empty'}
+    machines = [config.Client(ip=ip, port='22', username='u', password='p', mail='', alerts=[])
+                for ip in sorted(outputs)]
+
+    def fake_collect_fleet(machines, on_result, **unused_kwargs):
+      results = [collector.HostResult(machine=m, stats=outputs[m.ip], error=None, attempts=1,
+                                      elapsed=0) for m in machines]
+      for result in results:
+        on_result(result)
+      return results
+
+    cursors = mock.Mock()
+    args = mock.Mock(concurrency=1, retry=0, host_deadline=1, agent_rate=10)
+    with mock.patch('collector.collect_fleet', side_effect=fake_collect_fleet):
+      collector.collect_once(args, cursors=cursors, db=db, machines=machines)
+    # Only the samples stored by the first flush are acknowledged, the others are drained again
+    # rather than kept buffered.
+    cursors.set.assert_called_once_with('1.1.1.1', 42, 6)
+    self.assertEqual(0, db.pending_count())
+
 
 if __name__ == '__main__':
   unittest.main()
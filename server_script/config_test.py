@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from lib import config
+
+
+CONFIG_XML = '''<config>
+<template name="web" username="stats" mail="ops@example.com">
+  <alert type="cpu" limit="90%" />
+</template>
+<template name="db" port="2222">
+  <alert type="memory" limit="80%" for_samples="3" />
+</template>
+<group template="web" port="22" password="secret">
+  <client ip="10.0.0.1" />
+  <client ip="10.0.0.2" template="db" mail="dba@example.com">
+    <alert type="uptime" limit="100" op="&lt;" />
+  </client>
+</group>
+<client ip="10.0.0.3" port="22" username="u" password="p" mail="m@m.m">
+  <alert type="cpu" limit="5%" />
+</client>
+<client ip="10.0.0.1" port="23" username="dup" password="dup" mail="dup" />
+</config>
+'''
+
+
+class ConfigTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.xml_file = os.path.join(self.tmp_dir, 'config.xml')
+    self.write(CONFIG_XML)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write(self, content):
+    with open(self.xml_file, 'w') as f:
+      f.write(content)
+
+  def test_groups_templates_parse_clients(self):
+    clients = config.get_clients_details(self.xml_file, use_cache=False)
+    self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'], [c.ip for c in clients])
+    web, db, plain = clients
+    self.assertEqual(('22', 'stats', 'secret', 'ops@example.com'),
+                     (web.port, web.username, web.password, web.mail))
+    self.assertEqual([config.Alert(type='cpu', limit='90%')], web.alerts)
+    # Client attributes override its group, which overrides its templates (port of db).
+    self.assertEqual(('22', 'stats', 'dba@example.com'), (db.port, db.username, db.mail))
+    self.assertEqual([config.Alert(type='cpu', limit='90%'),
+                      config.Alert(type='memory', limit='80%', for_samples=3),
+                      config.Alert(type='uptime', limit='100', op='<')], db.alerts)
+    # Alerts of templates are shared rather than duplicated per client.
+    self.assertIs(web.alerts[0], db.alerts[0])
+    self.assertEqual(('22', 'u', 'p', 'm@m.m'), plain[1:5])
+    self.assertEqual([config.Alert(type='cpu', limit='5%')], plain.alerts)
+
+  def test_attributes_precedence_parse_clients(self):
+    self.write('<config><template name="t" port="2222" username="t" mail="t" password="t" />'
+               '<group port="22" username="g" mail="g"><client ip="10.0.0.1" template="t" '
+               'username="c" /></group></config>')
+    client = config.get_clients_details(self.xml_file, use_cache=False)[0]
+    self.assertEqual(('22', 'c', 't', 'g'),
+                     (client.port, client.username, client.password, client.mail))
+
+  def test_invalid_alert_parse_clients(self):
+    self.write('<config><template name="t"><alert type="cpu" limit="90%" for_samples="x" />'
+               '</template><client ip="10.0.0.1" template="t"><alert type="memory" limit="80%" />'
+               '<alert type="cpu" limit="90%" for_minutes="soon" /></client>'
+               '<client ip="10.0.0.2" /></config>')
+    with self.assertLogs('lib.config', level='WARNING') as logs:
+      clients = config.get_clients_details(self.xml_file, use_cache=False)
+    # Only the invalid alerts are skipped.
+    self.assertEqual(['10.0.0.1', '10.0.0.2'], [c.ip for c in clients])
+    self.assertEqual([config.Alert(type='memory', limit='80%')], clients[0].alerts)
+    self.assertEqual(2, len(logs.output))
+    self.assertIn('(line 1)', logs.output[0])
+
+  def test_unknown_template_parse_clients(self):
+    self.write('<config><client ip="10.0.0.1" template="nope" /></config>')
+    with self.assertRaises(config.ConfigError):
+      config.get_clients_details(self.xml_file, use_cache=False)
+
+  def test_no_alerts_get_clients_details(self):
+    clients = config.get_clients_details(self.xml_file, include_alerts=False, use_cache=False)
+    self.assertEqual([[], [], []], [c.alerts for c in clients])
+
+  @mock.patch('lib.config.parse_clients', wraps=config.parse_clients)
+  def test_cache_loader(self, mock_parse):
+    expected = config.get_clients_details(self.xml_file, use_cache=False)
+    mock_parse.reset_mock()
+    self.assertEqual(expected, config.ConfigLoader(self.xml_file).load())
+    self.assertEqual(1, mock_parse.call_count)
+    self.assertTrue(os.path.exists(self.xml_file + config.DEFAULT_CACHE_SUFFIX))
+
+    # A new process (loader) reads the compiled cache, even if the file was only touched.
+    stat = os.stat(self.xml_file)
+    os.utime(self.xml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    self.assertEqual(expected, config.ConfigLoader(self.xml_file).load())
+    self.assertEqual(1, mock_parse.call_count)
+
+    self.write(CONFIG_XML.replace('10.0.0.3', '10.0.0.4'))
+    os.utime(self.xml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    clients = config.ConfigLoader(self.xml_file).load()
+    self.assertEqual(2, mock_parse.call_count)
+    self.assertEqual('10.0.0.4', clients[-1].ip)
+
+  def test_cache_private_data(self):
+    old_umask = os.umask(0o022)
+    try:
+      config.ConfigLoader(self.xml_file).load()
+    finally:
+      os.umask(old_umask)
+    cache_file = self.xml_file + config.DEFAULT_CACHE_SUFFIX
+    # It holds the passwords of the clients.
+    self.assertEqual(0o600, os.stat(cache_file).st_mode & 0o777)
+    with open(cache_file) as f:
+      self.assertEqual(config.CACHE_VERSION, json.load(f)['version'])
+    self.assertEqual(['config.xml', 'config.xml.cache'], sorted(os.listdir(self.tmp_dir)))
+
+  def test_reload_watcher(self):
+    watcher = config.ConfigWatcher(loader=config.ConfigLoader(self.xml_file, cache_file=''))
+    reloaded = []
+    watcher.add_listener(reloaded.append)
+    self.assertFalse(watcher.check())
+    self.assertEqual(3, len(watcher.get_clients()))
+
+    stat = os.stat(self.xml_file)
+    self.write('<config><client ip="10.0.0.9" /></config>')
+    os.utime(self.xml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    self.assertTrue(watcher.check())
+    self.assertEqual(['10.0.0.9'], [c.ip for c in watcher.get_clients()])
+    self.assertEqual([watcher.get_clients()], reloaded)
+
+    # An invalid file is ignored until it's fixed.
+    self.write('<config><client ip=')
+    os.utime(self.xml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    self.assertFalse(watcher.check())
+    self.assertEqual(['10.0.0.9'], [c.ip for c in watcher.get_clients()])
+
+
+if __name__ == '__main__':
+  unittest.main()
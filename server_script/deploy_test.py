@@ -0,0 +1,114 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from lib import deploy
+
+
+class FakeAttr(object):
+  def __init__(self, filename, size, mtime):
+    self.filename = filename
+    self.st_size = size
+    self.st_mtime = mtime
+    self.st_mode = 0o100600
+
+
+class FakeSFTP(object):
+  """In memory stand-in of paramiko.SFTPClient supporting the calls made by Deployer."""
+
+  def __init__(self):
+    self.files = {}
+    self.now = 1000
+    self.uploads = 0
+
+  def stat(self, path):
+    if path == deploy.DEFAULT_REMOTE_DIR:
+      return FakeAttr(path, 0, self.now)
+    if path not in self.files:
+      raise IOError('No such file')
+    content, mtime = self.files[path]
+    return FakeAttr(path.split('/')[-1], len(content), mtime)
+
+  def mkdir(self, path, mode=0o777):
+    raise IOError('Failure')
+
+  def putfo(self, fl, path):
+    self.uploads += 1
+    self.files[path] = (fl.read(), self.now)
+
+  def posix_rename(self, old_path, new_path):
+    self.files[new_path] = self.files.pop(old_path)
+
+  def listdir_attr(self, path):
+    return [FakeAttr(p.split('/')[-1], len(c), m) for p, (c, m) in self.files.items()
+            if p.rsplit('/', 1)[0] == path]
+
+  def listdir(self, path):
+    return [a.filename for a in self.listdir_attr(path)]
+
+  def remove(self, path):
+    del self.files[path]
+
+
+class DeployerTest(unittest.TestCase):
+  def setUp(self):
+    self.sftp = FakeSFTP()
+    self.deployer = deploy.Deployer(deploy.DeployCache(cache_file=None), gc_grace=10)
+
+  def test_unchanged_artifact_not_uploaded(self):
+    first_path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'content', '.py')
+    second_path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'content', '.py')
+    self.assertEqual(first_path, second_path)
+    self.assertEqual(1, self.sftp.uploads)
+
+  def test_vanished_artifact_uploaded_again(self):
+    path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'content', '.py')
+    del self.sftp.files[path]
+    self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'content', '.py')
+    self.assertEqual(2, self.sftp.uploads)
+    self.assertIn(path, self.sftp.files)
+
+  def test_stale_artifacts_garbage_collected(self):
+    old_path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'v1', '.py')
+    self.sftp.now += 5
+    recent_path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'v2', '.py')
+    # v1 is still within the grace period
+    self.assertIn(old_path, self.sftp.files)
+    self.sftp.now += 20
+    new_path = self.deployer.ensure(self.sftp, '1.2.3.4', 'script', b'v3', '.py')
+    self.assertEqual([new_path], sorted(self.sftp.files))
+    self.assertNotIn(recent_path, self.sftp.files)
+
+  def test_legacy_artifacts_removed_on_first_deployment(self):
+    self.sftp.files['/tmp/local_collector42.py'] = (b'old', 0)
+    self.sftp.files['/tmp/pk_1.2.3.4123.pk'] = (b'old', 0)
+    self.sftp.files['/tmp/unrelated.txt'] = (b'keep', 0)
+    self.deployer.ensure(self.sftp, '1.2.3.4', 'pk', b'key', '.pk')
+    self.assertEqual(['/tmp/unrelated.txt'],
+                     sorted(p for p in self.sftp.files if p.startswith('/tmp/') and
+                            not p.startswith(deploy.DEFAULT_REMOTE_DIR)))
+
+  def test_zipapp_runs(self):
+    script = b'import sys\n\ndef main():\n  sys.stdout.write(" ".join(sys.argv[1:]))\n'
+    bundle = deploy.build_zipapp(script, 'client')
+    self.assertEqual(bundle, deploy.build_zipapp(script, 'client'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'client.pyz')
+      with open(path, 'wb') as f:
+        f.write(bundle)
+      self.assertEqual(b'-f pk', subprocess.check_output([sys.executable, path, '-f', 'pk']))
+
+  def test_zipapp_bundled_module(self):
+    script = b'import sys\n\ndef main():\n  import helper\n  sys.stdout.write(helper.NAME)\n'
+    bundle = deploy.build_zipapp(script, 'client', [('helper', b'NAME = "bundled"\n')])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'client.pyz')
+      with open(path, 'wb') as f:
+        f.write(bundle)
+      self.assertEqual(b'bundled', subprocess.check_output([sys.executable, path], cwd=tmp_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
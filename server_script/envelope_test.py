@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+import testutil
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+from lib import envelope
+
+
+class EnvelopeTest(unittest.TestCase):
+  def setUp(self):
+    self.key_dir = tempfile.TemporaryDirectory()
+    self.keyring = envelope.KeyRing(self.key_dir.name)
+    self.public_key = self.keyring.get_current().public_key()
+
+  def tearDown(self):
+    self.key_dir.cleanup()
+
+  def test_client_envelope_decrypted(self):
+    local_collector = testutil.load_local_collector()
+    # Far beyond the ~190 bytes a bare RSA-OAEP encryption can handle
+    message = 'posix,1.0,2.0,3.0,' + 'x' * 100000
+    ciphertext = local_collector.encrypt_text(message, self.public_key)
+    self.assertEqual(message.encode('utf-8'), envelope.decrypt(ciphertext, self.keyring))
+
+  def test_client_loaded_key(self):
+    local_collector = testutil.load_local_collector()
+    pem_data = self.public_key.public_bytes(encoding=serialization.Encoding.PEM,
+                                            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    client_envelope = local_collector.get_envelope()
+    public_key = client_envelope.load_public_key(pem_data)
+    self.assertIsInstance(public_key, client_envelope.PublicKey)
+    self.assertEqual(envelope.get_key_id(self.public_key), client_envelope.get_key_id(public_key))
+    ciphertext = local_collector.encrypt_text(b'posix,1.0,2.0,3.0,empty', public_key)
+    self.assertEqual(b'posix,1.0,2.0,3.0,empty', envelope.decrypt(ciphertext, self.keyring))
+
+  def test_decrypt_batch(self):
+    messages = [b'first', b'second', b'third' * 1000]
+    data = b''.join(envelope.encrypt(m, self.public_key) for m in messages)
+    self.assertEqual(messages, envelope.decrypt_batch(data, self.keyring))
+
+  def test_tampered_envelope(self):
+    data = bytearray(envelope.encrypt(b'message', self.public_key))
+    data[-1] ^= 1
+    with self.assertRaises(envelope.EnvelopeError):
+      envelope.decrypt(bytes(data), self.keyring)
+
+  def test_rotated_key_still_decrypts(self):
+    old_ciphertext = envelope.encrypt(b'before rotation', self.public_key)
+    new_key = self.keyring.rotate()
+    self.assertNotEqual(envelope.get_key_id(new_key.public_key()),
+                        envelope.get_key_id(self.public_key))
+    # A fresh key ring loads the retired key from disk
+    keyring = envelope.KeyRing(self.key_dir.name)
+    self.assertEqual(b'before rotation', envelope.decrypt(old_ciphertext, keyring))
+    self.assertEqual(new_key.private_numbers(), keyring.get_current().private_numbers())
+
+  def test_rotated_by_other_process_reloaded(self):
+    old_ciphertext = envelope.encrypt(b'before rotation', self.public_key)
+    # Stands for collector.py --rotate-keys run while the daemon holds self.keyring
+    new_key = envelope.KeyRing(self.key_dir.name).rotate()
+    new_ciphertext = envelope.encrypt(b'after rotation', new_key.public_key())
+    self.assertEqual(new_key.private_numbers(), self.keyring.get_current().private_numbers())
+    self.assertEqual([b'before rotation', b'after rotation'],
+                     envelope.decrypt_batch(old_ciphertext + new_ciphertext, self.keyring))
+
+  def test_retired_keys_pruned(self):
+    for _ in range(envelope.DEFAULT_RETIRED_KEYS + 2):
+      self.keyring.rotate()
+    self.assertEqual(envelope.DEFAULT_RETIRED_KEYS + 1, len(os.listdir(self.key_dir.name)))
+
+  def test_legacy_ciphertext(self):
+    ciphertext = self.public_key.encrypt(b'posix,1,2,3,empty', padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))
+    self.assertEqual(b'posix,1,2,3,empty', envelope.decrypt(ciphertext, self.keyring))
+
+  def test_unknown_key(self):
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                         backend=default_backend())
+    with self.assertRaises(envelope.EnvelopeError):
+      envelope.decrypt(envelope.encrypt(b'message', other_key.public_key()), self.keyring)
+
+
+if __name__ == '__main__':
+  unittest.main()
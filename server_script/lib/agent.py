@@ -0,0 +1,116 @@
+"""Server side of the resident agent mode of the local collector.
+
+In agent mode the local collector keeps running on the client and samples it into a ring buffer.
+Each collection drains the samples recorded since the last one, this module keeps track of the
+per-machine cursor and parses the drained output.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from collections import namedtuple
+
+from lib import wire
+
+
+DEFAULT_CURSORS_FILE = 'agent_cursors.json'
+
+# AgentSample: stats is a wire.Record, or for older clients a str with the format of a regular
+# collection: os, cpu_usage, mem_usage, uptime, event_logs. timestamp is the epoch time at which
+# the sample was taken on the client.
+AgentSample = namedtuple('AgentSample', 'seq timestamp stats')
+# dropped: number of samples the client overwrote before they were drained (ring full).
+DrainedOutput = namedtuple('DrainedOutput', 'ring_id last_seq samples dropped')
+DrainedOutput.__new__.__defaults__ = (0,)
+
+
+class AgentError(Exception):
+  """Exception raised when the output of an agent drain can't be parsed."""
+
+  def __init__(self, msg):
+    super(AgentError, self).__init__(msg)
+    self.msg = msg
+
+
+def parse_drained_output(output):
+  """Parse the output of local_collector.py --drain.
+
+  Args:
+    output: bytes, wire batch of wire.AGENT_FIELDS records whose meta holds ring_id, last_seq and
+      dropped.
+      Older clients send a str whose first line has the format: agent,ring_id,last_seq. Following
+      lines have the format: seq,timestamp,os,cpu_usage,mem_usage,uptime,event_logs
+
+  Returns:
+    DrainedOutput namedtuple.
+
+  Raises:
+    AgentError: if output isn't a drained output.
+  """
+  if isinstance(output, bytes):
+    return _parse_drained_batch(output)
+  lines = output.split('\n')
+  header = lines[0].split(',')
+  if len(header) != 3 or header[0] != 'agent':
+    raise AgentError('Invalid drained output header: %s' % lines[0])
+  try:
+    samples = []
+    for line in lines[1:]:
+      seq, timestamp, stats = line.split(',', 2)
+      samples.append(AgentSample(seq=int(seq), timestamp=float(timestamp), stats=stats))
+    return DrainedOutput(ring_id=int(header[1]), last_seq=int(header[2]), samples=samples)
+  except ValueError as e:
+    raise AgentError('Invalid drained sample: %s' % e)
+
+
+def _parse_drained_batch(output):
+  try:
+    batch = wire.decode_batch(output)
+  except wire.WireError as e:
+    raise AgentError(e.msg)
+  if 'ring_id' not in batch.meta or 'last_seq' not in batch.meta:
+    raise AgentError('Drained batch without cursor: %s' % batch.meta)
+  samples = []
+  for record in batch.records:
+    if record.seq is None or record.sampled_at is None:
+      raise AgentError('Drained sample without seq or timestamp')
+    samples.append(AgentSample(seq=int(record.seq), timestamp=record.sampled_at, stats=record))
+  try:
+    return DrainedOutput(ring_id=int(batch.meta['ring_id']), last_seq=int(batch.meta['last_seq']),
+                         samples=samples, dropped=int(batch.meta.get('dropped', 0)))
+  except ValueError as e:
+    raise AgentError('Invalid drained cursor: %s' % e)
+
+
+class CursorStore(object):
+  """Per-machine position (ring id and last received seq) in the agent ring, persisted as json."""
+
+  def __init__(self, cursors_file=DEFAULT_CURSORS_FILE, logger=None):
+    self.cursors_file = cursors_file
+    self.logger = logger or logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    self._cursors = {}
+    if cursors_file and os.path.exists(cursors_file):
+      try:
+        with open(cursors_file) as f:
+          self._cursors = json.load(f)
+      except (IOError, ValueError) as e:
+        self.logger.warn('Ignoring unreadable agent cursors %s: %s', cursors_file, e)
+
+  def get(self, ip_addr):
+    """Return (ring_id, seq) of the last sample received from ip_addr, (0, 0) if none."""
+    with self._lock:
+      cursor = self._cursors.get(ip_addr, [0, 0])
+    return cursor[0], cursor[1]
+
+  def set(self, ip_addr, ring_id, seq):
+    with self._lock:
+      self._cursors[ip_addr] = [ring_id, seq]
+      if not self.cursors_file:
+        return
+      tmp_file = self.cursors_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(self._cursors, f, sort_keys=True)
+      os.replace(tmp_file, self.cursors_file)
@@ -0,0 +1,291 @@
+"""Compressed, column oriented archives of the collected_stats records (see retention.py).
+
+Records purged from collected_stats are kept in one file per machine and month of collection_date:
+<archive dir>/<ip_addr>/<YYYY-MM>.fha. A file starts with a small header (magic, version, JSON
+description of the columns) followed by one zlib compressed block per column. The blocks of the
+fixed width columns are byte shuffled first (the i-th bytes of all the values stored together),
+and the ids and times are stored as deltas, which compresses the slowly changing values of a
+machine well.
+
+Readers memory-map the file and only decompress the blocks of the columns they ask for: scanning
+the cpu usage of a year of a machine doesn't read its event logs.
+"""
+
+import datetime
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy
+
+
+MAGIC = b'FHA1'
+FILE_VERSION = 1
+SUFFIX = '.fha'
+# Magic, version and size of the JSON header.
+PREAMBLE = struct.Struct('<4sII')
+COMPRESSION_LEVEL = 6
+
+# Kinds of columns: integers and times (delta encoded), floats (nan when None) and strings.
+INT = 'int'
+TIME = 'time'
+FLOAT = 'float'
+STR = 'str'
+# Archived columns of collected_stats, in the order of the rows given to the writer. ip_addr is
+# the directory of the files.
+COLUMNS = (('id', INT), ('os', STR), ('cpu_usage', FLOAT), ('mem_usage', FLOAT),
+           ('uptime', FLOAT), ('event_logs', STR), ('sampled_at', TIME),
+           ('collection_date', TIME), ('extra_metrics', STR))
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+COLUMN_KINDS = dict(COLUMNS)
+# Times are stored as int64 microseconds since the epoch (naive local times, like the DB), None
+# as NaT.
+TIME_DTYPE = 'datetime64[us]'
+
+
+class ArchiveError(Exception):
+  """Exception raised when an archive can't be read or written."""
+
+  def __init__(self, msg):
+    super(ArchiveError, self).__init__(msg)
+    self.msg = msg
+
+
+def get_path(archive_dir, ip_addr, month):
+  """Return the path of the archive of ip_addr for month (datetime.date or datetime)."""
+  return os.path.join(archive_dir, ip_addr, '%04d-%02d%s' % (month.year, month.month, SUFFIX))
+
+
+def get_months(archive_dir, ip_addr):
+  """Return the first days (datetime.date) of the months archived for ip_addr, ascending."""
+  host_dir = os.path.join(archive_dir, ip_addr)
+  if not os.path.isdir(host_dir):
+    return []
+  months = []
+  for name in os.listdir(host_dir):
+    if not name.endswith(SUFFIX):
+      continue
+    try:
+      month = datetime.datetime.strptime(name[:-len(SUFFIX)], '%Y-%m')
+    except ValueError:
+      continue
+    months.append(month.date())
+  return sorted(months)
+
+
+def to_columns(rows):
+  """Return {column: numpy array} of rows (tuples in the order of COLUMNS), strings being object
+  arrays."""
+  values = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+  columns = {}
+  for (name, kind), column in zip(COLUMNS, values):
+    if kind == INT:
+      columns[name] = numpy.array(column, dtype=numpy.int64)
+    elif kind == FLOAT:
+      columns[name] = numpy.array([numpy.nan if v is None else v for v in column], dtype=float)
+    elif kind == TIME:
+      columns[name] = numpy.array([numpy.datetime64('NaT') if v is None else v for v in column],
+                                  dtype=TIME_DTYPE)
+    else:
+      columns[name] = numpy.array(column, dtype=object)
+  return columns
+
+
+def _shuffle(array):
+  return numpy.ascontiguousarray(array).view(numpy.uint8).reshape(
+      len(array), array.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, rows):
+  dtype = numpy.dtype(dtype)
+  return numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+      dtype.itemsize, rows).T.copy().view(dtype).reshape(rows)
+
+
+def _encode(kind, column):
+  if kind in (INT, TIME):
+    # Deltas wrap around on overflow (NaT), which the cumulative sum of the reader undoes.
+    ints = column.view(numpy.int64)
+    return _shuffle(numpy.diff(ints, prepend=numpy.int64(0)))
+  if kind == FLOAT:
+    return _shuffle(column.astype(float))
+  # Strings: lengths (-1 for None) followed by the utf-8 bytes.
+  encoded = [None if v is None else v.encode('utf-8', 'surrogateescape') for v in column]
+  lengths = numpy.array([-1 if v is None else len(v) for v in encoded], dtype=numpy.int64)
+  return _shuffle(lengths) + b''.join(v for v in encoded if v)
+
+
+def _decode(kind, data, rows):
+  if kind in (INT, TIME):
+    ints = numpy.cumsum(_unshuffle(data, numpy.int64, rows), dtype=numpy.int64)
+    return ints if kind == INT else ints.view(TIME_DTYPE)
+  if kind == FLOAT:
+    return _unshuffle(data, float, rows)
+  lengths = _unshuffle(data[:rows * 8], numpy.int64, rows)
+  values = numpy.empty(rows, dtype=object)
+  offset = rows * 8
+  for i, length in enumerate(lengths.tolist()):
+    if length >= 0:
+      values[i] = data[offset:offset + length].decode('utf-8', 'surrogateescape')
+      offset += length
+  return values
+
+
+def write(path, columns):
+  """Write the columns (see to_columns) to the archive file path, atomically.
+
+  The file is synced before replacing path: records can be deleted from the DB once it returns.
+  """
+  rows = len(columns['id'])
+  blocks = []
+  header = {'rows': rows, 'columns': {}}
+  offset = 0
+  for name, kind in COLUMNS:
+    block = zlib.compress(_encode(kind, columns[name]), COMPRESSION_LEVEL)
+    header['columns'][name] = {'kind': kind, 'offset': offset, 'size': len(block)}
+    blocks.append(block)
+    offset += len(block)
+  header = json.dumps(header, sort_keys=True).encode('ascii')
+
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(PREAMBLE.pack(MAGIC, FILE_VERSION, len(header)))
+    f.write(header)
+    for block in blocks:
+      f.write(block)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+class Reader(object):
+  """Memory-mapped archive file, decompressing only the columns which are read."""
+
+  def __init__(self, path):
+    """Open the archive of path.
+
+    Raises:
+      ArchiveError: if path isn't a readable archive.
+    """
+    self.path = path
+    try:
+      with open(path, 'rb') as f:
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as e:
+      raise ArchiveError('Archive %s can\'t be opened: %s' % (path, e))
+    try:
+      magic, version, header_size = PREAMBLE.unpack_from(self._map)
+      if magic != MAGIC or version != FILE_VERSION:
+        raise ValueError('not an archive of version %d' % FILE_VERSION)
+      header = json.loads(self._map[PREAMBLE.size:PREAMBLE.size + header_size].decode('ascii'))
+      self.rows = header['rows']
+      self._columns = header['columns']
+    except (struct.error, ValueError, KeyError) as e:
+      self._map.close()
+      raise ArchiveError('Archive %s is invalid: %s' % (path, e))
+    self._data_offset = PREAMBLE.size + header_size
+
+  def __len__(self):
+    return self.rows
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused):
+    self.close()
+
+  def close(self):
+    self._map.close()
+
+  def read(self, name):
+    """Return the values of the column name: numpy array, object array for the strings.
+
+    Raises:
+      ArchiveError: if the column is unknown or its block is corrupted.
+    """
+    column = self._columns.get(name)
+    if column is None:
+      raise ArchiveError('Unknown column %s of %s' % (name, self.path))
+    start = self._data_offset + column['offset']
+    try:
+      data = zlib.decompress(self._map[start:start + column['size']])
+      return _decode(column['kind'], data, self.rows)
+    except (zlib.error, ValueError) as e:
+      raise ArchiveError('Column %s of %s is corrupted: %s' % (name, self.path, e))
+
+  def read_columns(self, names):
+    """Return {name: values} of the columns names."""
+    return dict((name, self.read(name)) for name in names)
+
+
+def store_rows(archive_dir, ip_addr, month, rows):
+  """Add rows (see COLUMNS) of ip_addr collected during month to its archive.
+
+  Rows already archived (same id) are skipped, storing rows again after an interruption is
+  harmless. The archive is rewritten with the rows ordered by id.
+
+  Returns:
+    int, number of added rows.
+  """
+  path = get_path(archive_dir, ip_addr, month)
+  columns = to_columns(rows)
+  if os.path.exists(path):
+    with Reader(path) as reader:
+      archived = reader.read_columns(COLUMN_NAMES)
+    new = ~numpy.isin(columns['id'], archived['id'])
+    added = int(numpy.count_nonzero(new))
+    if not added:
+      return 0
+    columns = dict((name, numpy.concatenate([archived[name], columns[name][new]]))
+                   for name in COLUMN_NAMES)
+  else:
+    added = len(rows)
+  order = numpy.argsort(columns['id'], kind='stable')
+  write(path, dict((name, values[order]) for name, values in columns.items()))
+  return added
+
+
+def read_history(archive_dir, ip_addr, names, start=None, end=None):
+  """Return the archived values of ip_addr collected between start and end.
+
+  Only the files of the months of the range are opened, and only the columns names (and
+  collection_date) are decompressed.
+
+  Args:
+    names: list of str, columns (see COLUMNS).
+    start, end: datetime.datetime, range of collection_date (end excluded), unbounded if None.
+
+  Returns:
+    {name: numpy array} ordered by id within each month.
+
+  Raises:
+    ArchiveError: if a column is unknown or an archive can't be read.
+  """
+  for name in names:
+    if name not in COLUMN_KINDS:
+      raise ArchiveError('Unknown column: %s' % name)
+  read_names = sorted(set(names) | set(['collection_date']))
+  parts = []
+  for month in get_months(archive_dir, ip_addr):
+    month_start = datetime.datetime(month.year, month.month, 1)
+    month_end = datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+    if (start and month_end <= start) or (end and month_start >= end):
+      continue
+    with Reader(get_path(archive_dir, ip_addr, month)) as reader:
+      columns = reader.read_columns(read_names)
+    dates = columns['collection_date']
+    selected = numpy.ones(len(dates), dtype=bool)
+    if start:
+      selected &= dates >= numpy.datetime64(start, 'us')
+    if end:
+      selected &= dates < numpy.datetime64(end, 'us')
+    parts.append(dict((name, columns[name][selected]) for name in names))
+  if not parts:
+    columns = to_columns([])
+    return dict((name, columns[name]) for name in names)
+  return dict((name, numpy.concatenate([part[name] for part in parts])) for name in names)
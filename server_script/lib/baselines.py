@@ -0,0 +1,231 @@
+"""Per machine baselines of the metrics, which the anomaly rules (sigma alerts) compare samples to.
+
+The baseline of a machine and metric (rules.ANOMALY_METRICS) is the exponentially weighted mean and
+variance of its samples, plus a seasonal one per hour of the day so daily patterns (nightly backups
+for eg.) aren't anomalies. A sample is compared to the baseline of its hour once that bucket has
+seen seasonal_warmup samples, to the overall one once it has seen warmup samples, and isn't
+evaluated before. Until 1 / alpha samples the weights are those of a plain mean, so a baseline
+doesn't start biased towards its first sample.
+
+Baselines take constant memory per machine (a few arrays of machines x metrics [x hours]). They
+are updated by the records treated by the alerter and saved in a compressed .npz file, so past
+records are never read again. A backlog is evaluated with array operations over all the machines
+at once: the k-th records of every machine are handled together, the number of passes being the
+number of records of the busiest machine.
+"""
+
+import datetime
+import logging
+import os
+
+import numpy
+
+from lib import rules
+
+
+# Seasonal buckets: hours of the day (local time of the samples).
+SEASONS = 24
+DEFAULT_ALPHA = 0.05
+DEFAULT_SEASONAL_ALPHA = 0.02
+DEFAULT_WARMUP = 30
+DEFAULT_SEASONAL_WARMUP = 60
+# Standard deviations are at least this (metrics are percentages), so a flat baseline doesn't turn
+# every fluctuation into an anomaly.
+MIN_STD = 1.0
+# Version of the layout of the saved arrays, files of another version are ignored.
+FILE_VERSION = 1
+# Saved arrays, indexed by machine first.
+ARRAYS = ('mean', 'var', 'count', 'seasonal_mean', 'seasonal_var', 'seasonal_count', 'last_id')
+
+
+class Baselines(object):
+  """Baselines of the machines of the fleet, persisted as a .npz file."""
+
+  def __init__(self, path=None, alpha=DEFAULT_ALPHA, seasonal_alpha=DEFAULT_SEASONAL_ALPHA,
+               warmup=DEFAULT_WARMUP, seasonal_warmup=DEFAULT_SEASONAL_WARMUP, logger=None):
+    """Load the baselines of path, if it exists.
+
+    Args:
+      path: str, .npz file the baselines are saved to, not saved if None.
+      alpha: float, weight of a new sample in the overall mean and variance.
+      seasonal_alpha: float, weight of a new sample in the mean and variance of its hour.
+      warmup: int, number of samples of a machine before it's compared to its overall baseline.
+      seasonal_warmup: int, number of samples of an hour before it's compared to its baseline.
+    """
+    self.path = path
+    self.alpha = alpha
+    self.seasonal_alpha = seasonal_alpha
+    self.warmup = warmup
+    self.seasonal_warmup = seasonal_warmup
+    self.logger = logger or logging.getLogger(__name__)
+    metric_count = len(rules.ANOMALY_METRICS)
+    self.hosts = []
+    self.mean = numpy.zeros((0, metric_count))
+    self.var = numpy.zeros((0, metric_count))
+    self.count = numpy.zeros((0, metric_count), dtype=numpy.int64)
+    self.seasonal_mean = numpy.zeros((0, metric_count, SEASONS))
+    self.seasonal_var = numpy.zeros((0, metric_count, SEASONS))
+    self.seasonal_count = numpy.zeros((0, metric_count, SEASONS), dtype=numpy.int64)
+    # Id of the last record folded into the baselines of each machine.
+    self.last_id = numpy.zeros(0, dtype=numpy.int64)
+    self._host_index = {}
+    if path and os.path.exists(path):
+      try:
+        self._load()
+      except (IOError, KeyError, ValueError) as e:
+        self.logger.warn('Ignoring unreadable baselines %s: %s', path, e)
+
+  def _load(self):
+    with numpy.load(self.path, allow_pickle=False) as data:
+      if int(data['version']) != FILE_VERSION:
+        raise ValueError('version %d' % int(data['version']))
+      if data['metrics'].tolist() != list(rules.ANOMALY_METRICS):
+        raise ValueError('other metrics')
+      hosts = [str(ip_addr) for ip_addr in data['hosts']]
+      arrays = dict((name, data[name]) for name in ARRAYS)
+    for name, array in arrays.items():
+      if len(array) != len(hosts) or array.shape[1:] != getattr(self, name).shape[1:]:
+        raise ValueError('%s has the shape %s' % (name, array.shape))
+    for name, array in arrays.items():
+      setattr(self, name, array)
+    self.hosts = hosts
+    self._host_index = dict((ip_addr, i) for i, ip_addr in enumerate(hosts))
+
+  def save(self):
+    """Write the baselines to path (atomically)."""
+    if not self.path:
+      return
+    tmp_file = self.path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+      numpy.savez_compressed(f, version=FILE_VERSION, metrics=numpy.array(rules.ANOMALY_METRICS),
+                             hosts=numpy.array(self.hosts, dtype=str),
+                             **dict((name, getattr(self, name)) for name in ARRAYS))
+    os.replace(tmp_file, self.path)
+
+  def __len__(self):
+    return len(self.hosts)
+
+  def _get_hosts(self, ip_addrs):
+    """Return the indexes of ip_addrs, adding (empty) baselines for the new machines."""
+    new_hosts = sorted(set(ip_addrs) - set(self._host_index))
+    if new_hosts:
+      for ip_addr in new_hosts:
+        self._host_index[ip_addr] = len(self.hosts)
+        self.hosts.append(ip_addr)
+      for name in ARRAYS:
+        array = getattr(self, name)
+        padding = numpy.zeros((len(new_hosts),) + array.shape[1:], dtype=array.dtype)
+        setattr(self, name, numpy.concatenate([array, padding]))
+    return numpy.array([self._host_index[ip_addr] for ip_addr in ip_addrs], dtype=numpy.intp)
+
+  def _prepare(self, stats):
+    """Return (hosts, values, seasons, ids) arrays of stats, values being nan when invalid and
+    seasons -1 when the sample time is unknown."""
+    hosts = self._get_hosts([s.ip_addr for s in stats])
+    values = numpy.array([[rules.to_float(getattr(s, metric)) for metric in rules.ANOMALY_METRICS]
+                          for s in stats], dtype=float).reshape(len(stats),
+                                                                len(rules.ANOMALY_METRICS))
+    seasons = numpy.array([get_season(s) for s in stats], dtype=numpy.intp)
+    ids = numpy.array([s.id for s in stats], dtype=numpy.int64)
+    return hosts, values, seasons, ids
+
+  def evaluate(self, stats):
+    """Return the baselines each of stats is compared to, as they were before the sample.
+
+    Records which weren't folded into the baselines yet are folded into a copy of them, in order,
+    the baselines themselves only change with advance().
+
+    Args:
+      stats: list of storage.MachineStats namedtuple, ordered by id within each machine.
+
+    Returns:
+      (expected, std) arrays (rows x rules.ANOMALY_METRICS), nan for the samples whose baseline
+      isn't warmed up yet.
+    """
+    hosts, values, seasons, ids = self._prepare(stats)
+    arrays = [getattr(self, name).copy() for name in ARRAYS]
+    return self._fold(arrays, hosts, values, seasons, ids > arrays[-1][hosts])
+
+  def advance(self, stats, watermarks):
+    """Fold the treated records of stats into the baselines.
+
+    Args:
+      stats: list of storage.MachineStats namedtuple, ordered by id within each machine.
+      watermarks: dict, {ip_addr: id of the last treated record of the machine}, records after it
+        are evaluated again by the next run and aren't folded yet.
+    """
+    hosts, values, seasons, ids = self._prepare(stats)
+    treated = numpy.array([s.id <= watermarks.get(s.ip_addr, -1) for s in stats], dtype=bool)
+    arrays = [getattr(self, name) for name in ARRAYS]
+    self._fold(arrays, hosts, values, seasons, treated & (ids > self.last_id[hosts]))
+    numpy.maximum.at(self.last_id, hosts[treated], ids[treated])
+
+  def _fold(self, arrays, hosts, values, seasons, folded):
+    """Fold the rows of values whose folded is set into arrays (see ARRAYS), in place.
+
+    Returns:
+      (expected, std) arrays, the baselines each row is compared to.
+    """
+    mean, var, count, seasonal_mean, seasonal_var, seasonal_count, _ = arrays
+    expected = numpy.full(values.shape, numpy.nan)
+    std = numpy.full(values.shape, numpy.nan)
+    if not len(hosts):
+      return expected, std
+    # Rank of each row among those of its machine, the rows of a rank are handled together.
+    order = numpy.argsort(hosts, kind='stable')
+    sorted_hosts = hosts[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_hosts[1:] != sorted_hosts[:-1]])
+    ranks = numpy.arange(len(hosts)) - numpy.repeat(starts, numpy.diff(numpy.r_[starts,
+                                                                                len(hosts)]))
+    by_rank = order[numpy.argsort(ranks, kind='stable')]
+    bounds = numpy.r_[0, numpy.cumsum(numpy.bincount(ranks))]
+    metric_columns = numpy.arange(len(rules.ANOMALY_METRICS))[None, :]
+
+    for rank in range(len(bounds) - 1):
+      rows = by_rank[bounds[rank]:bounds[rank + 1]]
+      host = hosts[rows][:, None]
+      season = numpy.maximum(seasons[rows], 0)[:, None]
+      seasonal = (seasons[rows] >= 0)[:, None]
+      x = values[rows]
+
+      n, m, v = count[host, metric_columns], mean[host, metric_columns], var[host, metric_columns]
+      sn = seasonal_count[host, metric_columns, season]
+      sm = seasonal_mean[host, metric_columns, season]
+      sv = seasonal_var[host, metric_columns, season]
+      use_season = seasonal & (sn >= self.seasonal_warmup)
+      warm = use_season | (n >= self.warmup)
+      expected[rows] = numpy.where(use_season, sm, numpy.where(warm, m, numpy.nan))
+      std[rows] = numpy.where(warm, numpy.maximum(numpy.sqrt(numpy.where(use_season, sv, v)),
+                                                  MIN_STD), numpy.nan)
+
+      update = folded[rows][:, None] & ~numpy.isnan(x)
+      m, v = update_ewma(m, v, n, x, self.alpha)
+      mean[host, metric_columns] = numpy.where(update, m, mean[host, metric_columns])
+      var[host, metric_columns] = numpy.where(update, v, var[host, metric_columns])
+      count[host, metric_columns] = n + update
+      update &= seasonal
+      sm, sv = update_ewma(sm, sv, sn, x, self.seasonal_alpha)
+      seasonal_mean[host, metric_columns, season] = numpy.where(update, sm, seasonal_mean[
+          host, metric_columns, season])
+      seasonal_var[host, metric_columns, season] = numpy.where(update, sv, seasonal_var[
+          host, metric_columns, season])
+      seasonal_count[host, metric_columns, season] = sn + update
+    return expected, std
+
+
+def update_ewma(mean, var, count, value, alpha):
+  """Return the exponentially weighted (mean, var) once value is added.
+
+  The weight of value is 1 / (count + 1) until it drops below alpha: a plain mean and variance
+  of the first samples.
+  """
+  weight = numpy.maximum(alpha, 1.0 / (count + 1))
+  diff = value - mean
+  increment = weight * diff
+  return mean + increment, (1 - weight) * (var + diff * increment)
+
+
+def get_season(stat):
+  """Return the seasonal bucket of stat (hour of its sample time), -1 if it's unknown."""
+  date = getattr(stat, 'sampled_at', None) or stat.collection_date
+  return date.hour if isinstance(date, datetime.datetime) else -1
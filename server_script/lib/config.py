@@ -1,4 +1,38 @@
 
+"""Configuration of the fleet: config.xml parsing, its compiled cache and the default settings.
+
+config.xml lists the clients (machines) with their ssh settings and alerts:
+
+  <config>
+    <template name="web" username="stats" mail="ops@example.com">
+      <alert type="cpu" limit="90%" />
+    </template>
+    <group template="web" port="22">
+      <client ip="192.168.1.90" password="..." />
+      <client ip="192.168.1.91" password="..." template="db">
+        <alert type="memory" limit="85%" />
+      </client>
+    </group>
+  </config>
+
+A template holds default attributes and alerts shared by the clients referring to it (template
+attribute, a comma separated list of names), a group gives default attributes (template included)
+to the clients it encloses. Client attributes override those of its group, which override those of
+its templates. Templates have to be defined before being used, the file is parsed in a single
+streaming pass so its size doesn't matter.
+
+The parsed clients are compiled into a cache file next to config.xml, reused as long as the file
+doesn't change (same mtime and size, or same sha256 when only its mtime changed). The cache holds
+the ssh passwords: it's plain JSON data, only readable by its owner.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
 from lxml import etree
 from collections import namedtuple
 
@@ -6,44 +40,420 @@ from collections import namedtuple
 DEFAULT_XML_FILE = 'config.xml'
 
 # Structure to organize the XML data
-Alert = namedtuple('Alert', 'type limit')
+# Alert: the alert is raised when the metric (or its rate of change per minute if rate is set)
+# compares (op) to limit for for_samples consecutive samples spanning at least for_minutes.
+# Once raised, it's only raised again after the metric stopped comparing to clear (limit if None).
+# With sigma (and no limit), the alert is raised by the samples deviating from the baseline of the
+# machine by more than sigma standard deviations, in the direction of op (!= for both).
+Alert = namedtuple('Alert', 'type limit op for_samples for_minutes rate clear sigma')
+Alert.__new__.__defaults__ = ('>=', 1, 0, False, None, None)
 Client = namedtuple('Client', 'ip port username password mail alerts')
 
 DEFAULT_USERNAME = ''
 DEFAULT_PASSWORD = ''
 DEFAULT_RETRY = 3
+DEFAULT_RETRY_BACKOFF = 30
+DEFAULT_SSH_TIMEOUT = 4
+DEFAULT_CONCURRENCY = 16
+DEFAULT_DB_POOL_SIZE = 4
+# Storage backend: 'mysql' (crossover_db on a MySQL server) or 'sqlite' (a local file, for single
+# node deployments).
+DEFAULT_STORAGE_BACKEND = 'mysql'
+DEFAULT_SQLITE_FILE = 'fleet_health.db'
+# Number of seconds allowed to collect a single machine, retries included.
+DEFAULT_HOST_DEADLINE = 300
+# Number of seconds between two collections when the collector runs as a daemon.
+DEFAULT_INTERVAL = 60
+# Local record of the artifacts deployed to each client.
+DEFAULT_DEPLOY_CACHE_FILE = 'deploy_cache.json'
+# Directory holding the long lived server key pair (and the recently retired ones).
+DEFAULT_KEYS_DIR = 'keys'
+# Per machine state of the alert rules (sustained conditions, raised alerts...).
+DEFAULT_ALERT_STATE_FILE = 'alert_state.json'
+# Baselines of the metrics of each machine, for the anomaly alerts (sigma).
+DEFAULT_BASELINES_FILE = 'baselines.npz'
+# Alert emails not delivered yet.
+DEFAULT_MAIL_SPOOL_DIR = 'mail_spool'
+# Agent mode: seconds between two samples of the resident agents and local record of the last
+# sample received from each of them.
+DEFAULT_AGENT_RATE = 10
+DEFAULT_AGENT_CURSORS_FILE = 'agent_cursors.json'
+# Prometheus text format snapshots of the phase timings, rewritten at the end of each run.
+DEFAULT_COLLECTOR_METRICS_FILE = 'collector_metrics.prom'
+DEFAULT_ALERTER_METRICS_FILE = 'alerter_metrics.prom'
+# Unix socket the collector notifies the stored stats to, listened by the alerter in follow mode.
+DEFAULT_NOTIFY_SOCKET = 'alerter.sock'
+# Number of seconds between two full scans of the backlog by the alerter in follow mode.
+DEFAULT_CATCHUP_INTERVAL = 300
+# Address and port of the HTTP server answering the stats queries (query.py --serve).
+DEFAULT_QUERY_ADDRESS = '127.0.0.1'
+DEFAULT_QUERY_PORT = 8089
+# Records older than this number of days are moved from collected_stats to the archives of this
+# directory (retention.py).
+DEFAULT_RETENTION_DAYS = 90
+DEFAULT_ARCHIVE_DIR = 'archive'
+# Compiled cache of the config file: <xml file><suffix>.
+DEFAULT_CACHE_SUFFIX = '.cache'
+# Number of seconds between two checks of the config file by long running processes.
+DEFAULT_WATCH_INTERVAL = 5
+# Version of the compiled cache layout, caches of another version are ignored.
+CACHE_VERSION = 4
+# Attributes of a client which can be inherited from its group and templates.
+CLIENT_ATTRIBUTES = ('port', 'username', 'password', 'mail')
+
+
+class ConfigError(Exception):
+  """Exception raised when the config file is invalid."""
+
+  def __init__(self, msg):
+    super(ConfigError, self).__init__(msg)
+    self.msg = msg
 
-def get_clients_details(xml_file=DEFAULT_XML_FILE, include_alerts=True):
+
+def get_clients_details(xml_file=DEFAULT_XML_FILE, include_alerts=True, use_cache=True):
   """Open the config xml file and retrieves client details.
     If there is no need for alert details it can be skipped by desactivating include_alerts.
 
   Args:
     xml_file: str, xml filepath and file name.
     include_alerts: bolean, include alert details if True.
+    use_cache: bool, reuse the compiled cache of the file (and the clients already loaded by this
+      process) when it didn't change.
 
   Returns:
     list of Client namedtuple instances.
+
+  Raises:
+    ConfigError: if the file is invalid.
+  """
+  if use_cache:
+    clients = get_loader(xml_file).load()
+  else:
+    with open(xml_file, 'rb') as f:
+      clients = parse_clients(f)
+  if not include_alerts:
+    clients = [c._replace(alerts=[]) for c in clients]
+  return clients
+
+
+def parse_alert(elem):
+  """Return the Alert of an <alert> element.
+
+  Raises:
+    ValueError: if for_samples or for_minutes isn't a number.
+  """
+  return Alert(type=elem.get('type'), limit=elem.get('limit'), op=elem.get('op', '>='),
+               for_samples=int(elem.get('for_samples', 1)),
+               for_minutes=float(elem.get('for_minutes', 0)),
+               rate=elem.get('rate', 'false').lower() in ('true', '1', 'yes'),
+               clear=elem.get('clear'), sigma=elem.get('sigma'))
+
+
+def parse_alerts(elem):
+  """Return the Alerts of the <alert> children of elem, the invalid ones are logged and skipped so
+  they don't prevent the other machines from being collected and alerted."""
+  alerts = []
+  for child in elem.iterchildren('alert'):
+    try:
+      alerts.append(parse_alert(child))
+    except ValueError as e:
+      logging.getLogger(__name__).warn('Ignoring invalid alert (line %s): %s', child.sourceline, e)
+  return alerts
+
+
+def get_template_names(elem):
+  return [name.strip() for name in (elem.get('template') or '').split(',') if name.strip()]
+
+
+def parse_clients(source):
+  """Parse the clients of a config file in a single streaming pass.
+
+  Elements are released as soon as they're parsed, so the memory used doesn't depend on the
+  size of the file (beside the returned clients). Alerts of templates are shared by their clients.
+
+  Args:
+    source: str or file object, the xml file.
+
+  Returns:
+    list of Client namedtuple instances, in the order of the file. When an ip address is listed
+    several times, only its first record is kept.
+
+  Raises:
+    ConfigError: if the file is invalid.
   """
   clients = []
-  uniq_ip_addresses = []
-  tree = etree.parse(xml_file)
-  root = tree.getroot()
-  client_tags = root.findall('client')
-  for c in client_tags:
-    # If ip addr is duplicated we only consider the first record. following ones
-    # are ignored
-    if c.get('ip') in uniq_ip_addresses:
-      continue
-    else:
-      uniq_ip_addresses.append(c.get('ip'))
-
-    client = Client(ip=c.get('ip'), port=c.get('port'), username=c.get('username'),
-                    password=c.get('password'), mail=c.get('mail'), alerts=[])
-    if include_alerts:
-      alert_tags = c.findall('alert')
-      for a in alert_tags:
-        client.alerts.append(Alert(type=a.get('type'), limit=a.get('limit')))
-    clients.append(client)
-
-  return clients 
+  uniq_ip_addresses = set()
+  # {name: (attributes, alerts)}
+  templates = {}
+  # Attributes of the enclosing groups, innermost last.
+  groups = []
+
+  def get_defaults(elem, attributes):
+    defaults = {}
+    alerts = []
+    for name in get_template_names(elem):
+      if name not in templates:
+        raise ConfigError('Unknown template %s (line %s), templates have to be defined before '
+                          'being used' % (name, elem.sourceline))
+      defaults.update(templates[name][0])
+      alerts.extend(templates[name][1])
+    defaults.update((k, v) for k, v in attributes.items() if k in CLIENT_ATTRIBUTES)
+    return defaults, alerts
+
+  try:
+    for event, elem in etree.iterparse(source, events=('start', 'end'),
+                                       tag=('template', 'group', 'client')):
+      if event == 'start':
+        if elem.tag == 'group':
+          group_defaults, group_alerts = get_defaults(elem, elem.attrib)
+          if groups:
+            parent_defaults, parent_alerts = groups[-1]
+            group_defaults = dict(parent_defaults, **group_defaults)
+            group_alerts = parent_alerts + group_alerts
+          groups.append((group_defaults, group_alerts))
+        continue
+
+      if elem.tag == 'group':
+        groups.pop()
+      elif elem.tag == 'template':
+        if not elem.get('name'):
+          raise ConfigError('Template without name (line %s)' % elem.sourceline)
+        defaults, alerts = get_defaults(elem, elem.attrib)
+        alerts.extend(parse_alerts(elem))
+        templates[elem.get('name')] = (defaults, tuple(alerts))
+      elif elem.get('ip') not in uniq_ip_addresses:
+        # If ip addr is duplicated we only consider the first record. following ones
+        # are ignored
+        uniq_ip_addresses.add(elem.get('ip'))
+        group_attributes, alerts = groups[-1] if groups else ({}, [])
+        # Client attributes override those of its group, which override those of its templates.
+        attributes, own_alerts = get_defaults(elem, {})
+        attributes.update(group_attributes)
+        attributes.update((k, v) for k, v in elem.attrib.items() if k in CLIENT_ATTRIBUTES)
+        clients.append(Client(ip=elem.get('ip'), port=attributes.get('port'),
+                              username=attributes.get('username'),
+                              password=attributes.get('password'), mail=attributes.get('mail'),
+                              alerts=alerts + own_alerts +
+                              parse_alerts(elem)))
+      # Release the parsed element along with its already parsed siblings.
+      elem.clear()
+      while elem.getprevious() is not None:
+        del elem.getparent()[0]
+  except etree.XMLSyntaxError as e:
+    raise ConfigError('Invalid config file: %s' % e)
+  return clients
+
+
+class _HashingReader(object):
+  """File object wrapper computing the sha256 of what is read through it."""
+
+  def __init__(self, f):
+    self.f = f
+    self.sha256 = hashlib.sha256()
+
+  def read(self, size=-1):
+    data = self.f.read(size)
+    self.sha256.update(data)
+    return data
+
+
+def get_file_sha256(path):
+  sha256 = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), b''):
+      sha256.update(block)
+  return sha256.hexdigest()
+
+
+class ConfigLoader(object):
+  """Load the clients of a config file, from its compiled cache when the file didn't change."""
+
+  def __init__(self, xml_file=DEFAULT_XML_FILE, cache_file=None, logger=None):
+    """Create a loader, nothing is read until load() is called.
+
+    Args:
+      xml_file: str, path of the config file.
+      cache_file: str, path of its compiled cache, <xml_file>.cache if None. No cache is written if
+        empty.
+    """
+    self.xml_file = xml_file
+    self.logger = logger or logging.getLogger(__name__)
+    self.cache_file = xml_file + DEFAULT_CACHE_SUFFIX if cache_file is None else cache_file
+    self._lock = threading.Lock()
+    # (mtime, size) of the file the clients were loaded from.
+    self._key = None
+    self._clients = None
+
+  def get_key(self):
+    stat = os.stat(self.xml_file)
+    return stat.st_mtime_ns, stat.st_size
+
+  def has_changed(self):
+    """Return True if the file changed since the last load()."""
+    try:
+      return self.get_key() != self._key
+    except OSError:
+      return True
+
+  def load(self):
+    """Return the clients of the config file, the returned list mustn't be modified.
+
+    The file is only parsed if neither this loader nor the compiled cache have its current
+    version.
+
+    Raises:
+      ConfigError: if the file is invalid.
+      IOError, OSError: if the file can't be read.
+    """
+    with self._lock:
+      key = self.get_key()
+      if key == self._key:
+        return self._clients
+      cache = self._read_cache()
+      if cache is not None and (cache['mtime'], cache['size']) != key:
+        # Touched (or copied) but maybe not changed.
+        if cache['sha256'] != get_file_sha256(self.xml_file):
+          cache = None
+        else:
+          cache['mtime'], cache['size'] = key
+          self._write_cache(cache)
+      if cache is None:
+        with open(self.xml_file, 'rb') as f:
+          reader = _HashingReader(f)
+          clients = parse_clients(reader)
+        cache = {'version': CACHE_VERSION, 'mtime': key[0], 'size': key[1],
+                 'sha256': reader.sha256.hexdigest(), 'clients': clients}
+        self._write_cache(cache)
+      self._key, self._clients = key, cache['clients']
+      return self._clients
+
+  def _read_cache(self):
+    if not self.cache_file or not os.path.exists(self.cache_file):
+      return None
+    try:
+      with open(self.cache_file, 'r') as f:
+        cache = json.load(f)
+      if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return None
+      # Clients are stored as lists of their fields, alerts included.
+      cache['clients'] = [Client(*(fields[:-1] + [[Alert(*alert) for alert in fields[-1]]]))
+                          for fields in cache['clients']]
+    except (IOError, OSError, ValueError, TypeError, KeyError, IndexError) as e:
+      self.logger.warn('Ignoring unreadable config cache %s: %s', self.cache_file, e)
+      return None
+    return cache
+
+  def _write_cache(self, cache):
+    if not self.cache_file:
+      return
+    directory, name = os.path.split(os.path.abspath(self.cache_file))
+    try:
+      # Unique to the writer (the collector and the alerter load the same file), created 0600.
+      fd, tmp_file = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    except (IOError, OSError) as e:
+      self.logger.warn('Config cache %s couldn\'t be written: %s', self.cache_file, e)
+      return
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(dict(cache, clients=[list(client) for client in cache['clients']]), f)
+      os.replace(tmp_file, self.cache_file)
+    except (IOError, OSError) as e:
+      self.logger.warn('Config cache %s couldn\'t be written: %s', self.cache_file, e)
+      try:
+        os.remove(tmp_file)
+      except OSError:
+        pass
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def get_loader(xml_file=DEFAULT_XML_FILE):
+  """Return the ConfigLoader of xml_file shared by this process."""
+  path = os.path.abspath(xml_file)
+  with _loaders_lock:
+    if path not in _loaders:
+      _loaders[path] = ConfigLoader(xml_file)
+    return _loaders[path]
+
+
+class ConfigWatcher(object):
+  """Keep the clients of a config file up to date in a long running process.
+
+  The file is checked every interval seconds (by a background thread once started, or by calling
+  check()) and reloaded when it changed. Listeners are then called with the new clients. A file
+  which can't be loaded is logged and the previous clients are kept.
+  """
+
+  def __init__(self, xml_file=DEFAULT_XML_FILE, include_alerts=True,
+               interval=DEFAULT_WATCH_INTERVAL, loader=None, logger=None):
+    """Create a watcher and load the clients of xml_file.
+
+    Raises:
+      ConfigError: if the file is invalid.
+      IOError, OSError: if the file can't be read.
+    """
+    self.include_alerts = include_alerts
+    self.interval = interval
+    self.loader = loader or get_loader(xml_file)
+    self.logger = logger or logging.getLogger(__name__)
+    self._listeners = []
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._thread = None
+    self._clients = self._load()
+
+  def _load(self):
+    clients = self.loader.load()
+    if not self.include_alerts:
+      clients = [c._replace(alerts=[]) for c in clients]
+    return clients
+
+  def get_clients(self):
+    with self._lock:
+      return self._clients
+
+  def add_listener(self, callback):
+    """Call callback(clients) each time the config file is reloaded."""
+    self._listeners.append(callback)
+
+  def check(self):
+    """Reload the config file if it changed.
+
+    Returns:
+      bool, True if new clients were loaded.
+    """
+    if not self.loader.has_changed():
+      return False
+    try:
+      clients = self._load()
+    except (ConfigError, IOError, OSError) as e:
+      self.logger.error('Config file %s couldn\'t be reloaded, keeping the previous one: %s',
+                        self.loader.xml_file, getattr(e, 'msg', e))
+      return False
+    with self._lock:
+      self._clients = clients
+    self.logger.info('Config file %s reloaded: %d clients.', self.loader.xml_file, len(clients))
+    for callback in self._listeners:
+      callback(clients)
+    return True
+
+  def start(self):
+    """Check the config file in a background thread until stop() is called."""
+    if self._thread is not None:
+      return
+    self._stop_event.clear()
+    self._thread = threading.Thread(target=self._run, name='config-watcher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
 
+  def _run(self):
+    while not self._stop_event.wait(self.interval):
+      self.check()
@@ -0,0 +1,225 @@
+"""Content addressed deployment of the collector artifacts (client script, public key) to clients.
+
+Artifacts are uploaded under a name derived from their sha256 digest. A per-machine record of what
+was deployed is kept locally so, as long as the artifact doesn't change, a deployment costs a
+single sftp stat call instead of an upload.
+
+The client script is deployed as a zipapp (see build_zipapp) holding its compiled bytecode, so
+the clients don't compile it again on each collection.
+"""
+
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import marshal
+import os
+import posixpath
+import stat
+import threading
+import zipfile
+
+
+# below is for linux only
+DEFAULT_REMOTE_DIR = '/tmp/fleet_health'
+DEFAULT_CACHE_FILE = 'deploy_cache.json'
+# Stale artifacts younger than this (relative to the current one) are kept, they might still be
+# used by a collection running concurrently.
+DEFAULT_GC_GRACE = 3600
+# Artifacts uploaded under random names by previous versions of the collector, and client scripts
+# deployed as plain scripts.
+LEGACY_ARTIFACTS = (('/tmp', 'local_collector', '.py'), ('/tmp', 'pk_', '.pk'),
+                    (DEFAULT_REMOTE_DIR, 'local_collector_', '.py'))
+DIGEST_LENGTH = 16
+ZIPAPP_SHEBANG = b'#!/usr/bin/env python3\n'
+# Entries of the built zipapps all have this date so the same script always gives the same bytes.
+ZIPAPP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def get_digest(content):
+  return hashlib.sha256(content).hexdigest()[:DIGEST_LENGTH]
+
+
+def get_pyc(source, filename):
+  """Return the bytecode of source as an unchecked hash-based .pyc (PEP 552), it doesn't depend
+  on any mtime so it's reproducible."""
+  code = compile(source, filename, 'exec', dont_inherit=True)
+  return (importlib.util.MAGIC_NUMBER + (0b01).to_bytes(4, 'little') +
+          importlib.util.source_hash(source) + marshal.dumps(code))
+
+
+def build_zipapp(script, module_name, modules=()):
+  """Bundle a script, the modules it imports and their bytecode into a zipapp, run with:
+  python3 <path>.
+
+  The bytecode is the one of the Python version of the server. Clients running another version
+  don't load it and compile the script as they did before.
+
+  Args:
+    script: bytes, source of the script, its main() is called when the zipapp runs.
+    module_name: str, name the script is imported as.
+    modules: sequence of (name, source) of the modules bundled along with the script.
+
+  Returns:
+    bytes, the zipapp.
+  """
+  main = ('import %s\n%s.main()\n' % (module_name, module_name)).encode('utf-8')
+  entries = [('__main__.py', main)]
+  for name, source in [(module_name, script)] + list(modules):
+    entries.append((name + '.py', source))
+    entries.append((name + '.pyc', get_pyc(source, name + '.py')))
+  stream = io.BytesIO()
+  stream.write(ZIPAPP_SHEBANG)
+  with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+    for name, content in entries:
+      info = zipfile.ZipInfo(name, ZIPAPP_DATE_TIME)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      info.external_attr = 0o644 << 16
+      archive.writestr(info, content)
+  return stream.getvalue()
+
+
+class DeployCache(object):
+  """Local record of the artifacts deployed to each machine, persisted as a json file.
+
+  The record has the format: {ip_addr: {artifact_name: {'hash': str, 'path': str}}}
+  """
+
+  def __init__(self, cache_file=DEFAULT_CACHE_FILE, logger=None):
+    self.cache_file = cache_file
+    self.logger = logger or logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    self._records = {}
+    if cache_file and os.path.exists(cache_file):
+      try:
+        with open(cache_file) as f:
+          self._records = json.load(f)
+      except (IOError, ValueError) as e:
+        self.logger.warn('Ignoring unreadable deploy cache %s: %s', cache_file, e)
+
+  def get(self, ip_addr, name):
+    with self._lock:
+      return self._records.get(ip_addr, {}).get(name)
+
+  def set(self, ip_addr, name, digest, path):
+    with self._lock:
+      self._records.setdefault(ip_addr, {})[name] = {'hash': digest, 'path': path}
+      self._save()
+
+  def forget(self, ip_addr, name):
+    with self._lock:
+      if self._records.get(ip_addr, {}).pop(name, None) is not None:
+        self._save()
+
+  def _save(self):
+    if not self.cache_file:
+      return
+    tmp_file = self.cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+      json.dump(self._records, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, self.cache_file)
+
+
+class Deployer(object):
+  """Upload artifacts to machines only when their content changed and clean up stale ones."""
+
+  def __init__(self, cache=None, remote_dir=DEFAULT_REMOTE_DIR, gc_grace=DEFAULT_GC_GRACE,
+               logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+    self.cache = cache if cache is not None else DeployCache(logger=self.logger)
+    self.remote_dir = remote_dir
+    self.gc_grace = gc_grace
+
+  def get_remote_path(self, name, content, suffix=''):
+    return posixpath.join(self.remote_dir, '%s_%s%s' % (name, get_digest(content), suffix))
+
+  def ensure(self, sftp, ip_addr, name, content, suffix=''):
+    """Make sure content is deployed on the machine and return its remote path.
+
+    Args:
+      sftp: paramiko.SFTPClient instance connected to the machine.
+      ip_addr: str, ip address of the machine, used as key of the deploy cache.
+      name: str, artifact name, used as prefix of the remote file name.
+      content: bytes, artifact content.
+      suffix: str, remote file name extension.
+
+    Returns:
+      str, remote path of the deployed artifact.
+    """
+    digest = get_digest(content)
+    remote_path = self.get_remote_path(name, content, suffix)
+    record = self.cache.get(ip_addr, name)
+    if record and record['hash'] == digest and record['path'] == remote_path:
+      try:
+        if sftp.stat(remote_path).st_size == len(content):
+          return remote_path
+      except IOError:
+        # Most likely /tmp was cleaned up (reboot for eg.), deploy it again.
+        pass
+      self.logger.info('Deployed %s vanished from %s, uploading it again.', remote_path, ip_addr)
+
+    self._makedirs(sftp)
+    tmp_path = remote_path + '.tmp'
+    sftp.putfo(io.BytesIO(content), tmp_path)
+    sftp.posix_rename(tmp_path, remote_path)
+    self.logger.info('Deployed %s to %s:%s', name, ip_addr, remote_path)
+    first_deployment = record is None
+    self.cache.set(ip_addr, name, digest, remote_path)
+    self.collect_garbage(sftp, name, remote_path, suffix)
+    if first_deployment:
+      self.collect_legacy_garbage(sftp)
+    return remote_path
+
+  def collect_garbage(self, sftp, name, current_path, suffix=''):
+    """Remove the stale versions of artifact name from the remote directory.
+
+    Returns:
+      list of str, removed remote paths.
+    """
+    current_mtime = sftp.stat(current_path).st_mtime
+    prefix = name + '_'
+    current_filename = posixpath.basename(current_path)
+    removed = []
+    for attr in sftp.listdir_attr(self.remote_dir):
+      filename = attr.filename
+      if (filename == current_filename or not filename.startswith(prefix) or
+          not (filename.endswith(suffix) or filename.endswith(suffix + '.tmp')) or
+          not stat.S_ISREG(attr.st_mode or 0)):
+        continue
+      if attr.st_mtime is not None and attr.st_mtime > current_mtime - self.gc_grace:
+        continue
+      path = posixpath.join(self.remote_dir, filename)
+      try:
+        sftp.remove(path)
+        removed.append(path)
+      except IOError as e:
+        self.logger.warn('Couldn\'t remove stale artifact %s: %s', path, e)
+    return removed
+
+  def collect_legacy_garbage(self, sftp):
+    """Remove the randomly named artifacts left in /tmp by previous collector versions."""
+    removed = []
+    for directory, prefix, suffix in LEGACY_ARTIFACTS:
+      try:
+        filenames = sftp.listdir(directory)
+      except IOError:
+        continue
+      for filename in filenames:
+        if filename.startswith(prefix) and filename.endswith(suffix):
+          path = posixpath.join(directory, filename)
+          try:
+            sftp.remove(path)
+            removed.append(path)
+          except IOError:
+            pass
+    if removed:
+      self.logger.info('Removed %d legacy artifact(s).', len(removed))
+    return removed
+
+  def _makedirs(self, sftp):
+    try:
+      sftp.mkdir(self.remote_dir, mode=0o700)
+    except IOError:
+      # sftp doesn't reliably report EEXIST, make sure the directory is actually there.
+      sftp.stat(self.remote_dir)
@@ -0,0 +1,375 @@
+"""Hybrid envelope encryption used between the local collector and the server.
+
+Each message is encrypted with a random AES-256-GCM session key, the session key itself being
+encrypted (wrapped) with the long lived RSA public key of the server. An envelope has the
+following layout (all integers are big endian):
+
+  magic       3 bytes  b'FHE'
+  version     1 byte   ENVELOPE_VERSION
+  key_id      8 bytes  first bytes of the sha256 of the server public key (DER)
+  wrapped_len 2 bytes  length of wrapped_key
+  body_len    4 bytes  length of ciphertext
+  wrapped_key          RSA-OAEP(SHA256) encrypted session key
+  nonce       12 bytes AES-GCM nonce
+  ciphertext           AES-GCM ciphertext followed by its 16 bytes tag
+
+Everything before the nonce is authenticated as associated data. Since envelopes carry their own
+length they can be concatenated and decrypted as a batch. Messages produced by older clients (the
+payload directly encrypted with RSA-OAEP) are still accepted.
+
+This module is also bundled with local_collector.py (see collector.get_client_bundle), which
+encrypts with it. Each collection starts a new interpreter on the client, so cryptography is only
+imported by the functions using it, see load_public_key.
+"""
+
+import binascii
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = b'FHE'
+ENVELOPE_VERSION = 1
+HEADER_FORMAT = '>3sB8sHI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NONCE_SIZE = 12
+SESSION_KEY_SIZE = 32
+KEY_ID_SIZE = 8
+# 1.2.840.113549.1.1.1
+RSA_ENCRYPTION_OID = b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+PEM_PUBLIC_KEY_BEGIN = b'-----BEGIN PUBLIC KEY-----'
+PEM_PUBLIC_KEY_END = b'-----END PUBLIC KEY-----'
+
+DEFAULT_KEY_SIZE = 2048
+DEFAULT_KEYS_DIR = 'keys'
+CURRENT_KEY_FILENAME = 'server_key.pem'
+RETIRED_KEY_PREFIX = 'server_key.'
+# Number of retired keys kept to decrypt messages encrypted before a rotation.
+DEFAULT_RETIRED_KEYS = 2
+
+
+class EnvelopeError(Exception):
+  """Exception raised when an envelope can't be parsed or decrypted."""
+
+  def __init__(self, msg):
+    super(EnvelopeError, self).__init__(msg)
+    self.msg = msg
+
+
+def get_oaep_padding():
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.hazmat.primitives.asymmetric import padding
+  return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(),
+                      label=None)
+
+
+def get_key_id(public_key):
+  if isinstance(public_key, PublicKey):
+    return public_key.key_id
+  from cryptography.hazmat.primitives import serialization
+  der = public_key.public_bytes(encoding=serialization.Encoding.DER,
+                                format=serialization.PublicFormat.SubjectPublicKeyInfo)
+  return hashlib.sha256(der).digest()[:KEY_ID_SIZE]
+
+
+class PublicKey(object):
+  """RSA public key along with its key id, see load_public_key."""
+
+  def __init__(self, key, der):
+    self.key = key
+    self.key_id = hashlib.sha256(der).digest()[:KEY_ID_SIZE]
+
+  def encrypt(self, plaintext, padding):
+    return self.key.encrypt(plaintext, padding)
+
+
+def read_der_element(der, offset, expected_tag):
+  """Return (start, end) of the content of the DER element at offset."""
+  if der[offset] != expected_tag:
+    raise ValueError('Unexpected DER tag %d' % der[offset])
+  length = der[offset + 1]
+  start = offset + 2
+  if length & 0x80:
+    start += length & 0x7f
+    length = int.from_bytes(der[offset + 2:start], 'big')
+  if start + length > len(der):
+    raise ValueError('Truncated DER element')
+  return start, start + length
+
+
+def parse_rsa_public_key(der):
+  """Return (n, e) of a SubjectPublicKeyInfo holding an RSA key.
+
+  Raises:
+    ValueError: if der isn't an RSA SubjectPublicKeyInfo.
+  """
+  start, _ = read_der_element(der, 0, 0x30)
+  algorithm_start, algorithm_end = read_der_element(der, start, 0x30)
+  oid_start, oid_end = read_der_element(der, algorithm_start, 0x06)
+  if der[oid_start:oid_end] != RSA_ENCRYPTION_OID:
+    raise ValueError('Not an RSA key')
+  # The bit string starts with its number of unused bits
+  bits_start, _ = read_der_element(der, algorithm_end, 0x03)
+  start, _ = read_der_element(der, bits_start + 1, 0x30)
+  n_start, n_end = read_der_element(der, start, 0x02)
+  e_start, e_end = read_der_element(der, n_end, 0x02)
+  return int.from_bytes(der[n_start:n_end], 'big'), int.from_bytes(der[e_start:e_end], 'big')
+
+
+def load_public_key(pem_data):
+  """Load a PEM public key.
+
+  RSA keys are built from their numbers: the serialization module of cryptography takes about as
+  long to import as the rest of a collection. Other keys go through serialization.
+  """
+  lines = pem_data.strip().splitlines()
+  if len(lines) > 2 and lines[0] == PEM_PUBLIC_KEY_BEGIN and lines[-1] == PEM_PUBLIC_KEY_END:
+    try:
+      der = binascii.a2b_base64(b''.join(lines[1:-1]))
+      n, e = parse_rsa_public_key(der)
+    except (ValueError, IndexError):
+      pass
+    else:
+      from cryptography.hazmat.primitives.asymmetric import rsa
+      return PublicKey(rsa.RSAPublicNumbers(e, n).public_key(), der)
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  return serialization.load_pem_public_key(pem_data, backend=default_backend())
+
+
+def encrypt(plaintext, public_key):
+  """Encrypt plaintext (bytes of any size) into an envelope for the owner of public_key."""
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+  session_key = AESGCM.generate_key(bit_length=SESSION_KEY_SIZE * 8)
+  wrapped_key = public_key.encrypt(session_key, get_oaep_padding())
+  nonce = os.urandom(NONCE_SIZE)
+  header = struct.pack(HEADER_FORMAT, MAGIC, ENVELOPE_VERSION, get_key_id(public_key),
+                       len(wrapped_key), len(plaintext) + 16)
+  ciphertext = AESGCM(session_key).encrypt(nonce, plaintext, header)
+  return header + wrapped_key + nonce + ciphertext
+
+
+def split_envelopes(data):
+  """Split concatenated envelopes.
+
+  Args:
+    data: bytes, one or more envelopes.
+
+  Returns:
+    list of tuple (header, key_id, wrapped_key, nonce, ciphertext).
+
+  Raises:
+    EnvelopeError: if data isn't made of complete envelopes.
+  """
+  envelopes = []
+  offset = 0
+  while offset < len(data):
+    if len(data) - offset < HEADER_SIZE:
+      raise EnvelopeError('Truncated envelope header at offset %d' % offset)
+    magic, version, key_id, wrapped_len, body_len = struct.unpack_from(HEADER_FORMAT, data, offset)
+    if magic != MAGIC:
+      raise EnvelopeError('Invalid envelope magic at offset %d' % offset)
+    if version != ENVELOPE_VERSION:
+      raise EnvelopeError('Unsupported envelope version: %d' % version)
+    header = data[offset:offset + HEADER_SIZE]
+    start = offset + HEADER_SIZE
+    end = start + wrapped_len + NONCE_SIZE + body_len
+    if end > len(data):
+      raise EnvelopeError('Truncated envelope at offset %d' % offset)
+    nonce_start = start + wrapped_len
+    wrapped_key = data[start:nonce_start]
+    nonce = data[nonce_start:nonce_start + NONCE_SIZE]
+    envelopes.append((header, key_id, wrapped_key, nonce, data[nonce_start + NONCE_SIZE:end]))
+    offset = end
+  return envelopes
+
+
+def decrypt_batch(data, keyring):
+  """Decrypt all the envelopes contained in data.
+
+  Args:
+    data: bytes, concatenated envelopes or a single legacy RSA-OAEP ciphertext.
+    keyring: KeyRing instance, or a single RSA private key.
+
+  Returns:
+    list of bytes, the plaintexts in the order of the envelopes.
+
+  Raises:
+    EnvelopeError: if any envelope can't be decrypted.
+  """
+  from cryptography.exceptions import InvalidTag
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+  if not isinstance(keyring, KeyRing):
+    keyring = KeyRing.from_private_key(keyring)
+  if not data.startswith(MAGIC):
+    return [decrypt_legacy(data, keyring)]
+
+  plaintexts = []
+  for header, key_id, wrapped_key, nonce, ciphertext in split_envelopes(data):
+    # Every envelope carries its own random session key.
+    private_key = keyring.find(key_id)
+    if private_key is None:
+      raise EnvelopeError('Unknown key id: %s' % key_id.hex())
+    try:
+      session_key = private_key.decrypt(wrapped_key, get_oaep_padding())
+    except ValueError as e:
+      raise EnvelopeError('Session key can\'t be unwrapped: %s' % e)
+    try:
+      plaintexts.append(AESGCM(session_key).decrypt(nonce, ciphertext, header))
+    except InvalidTag:
+      raise EnvelopeError('Envelope authentication failed')
+  return plaintexts
+
+
+def decrypt(data, keyring):
+  """Decrypt a single envelope (or legacy ciphertext) and return its plaintext."""
+  plaintexts = decrypt_batch(data, keyring)
+  if len(plaintexts) != 1:
+    raise EnvelopeError('Expected a single envelope, got %d' % len(plaintexts))
+  return plaintexts[0]
+
+
+def decrypt_legacy(ciphertext, keyring):
+  """Decrypt a payload directly encrypted with RSA-OAEP by a pre-envelope client."""
+  for private_key in keyring.private_keys():
+    try:
+      return private_key.decrypt(ciphertext, get_oaep_padding())
+    except ValueError:
+      continue
+  raise EnvelopeError('Legacy ciphertext can\'t be decrypted with any known key')
+
+
+class KeyRing(object):
+  """Long lived server RSA key pair, along with the recently retired ones.
+
+  The current key is stored in key_dir/server_key.pem. rotate() retires it to
+  key_dir/server_key.<timestamp>.pem and generates a new one, retired keys are only used to
+  decrypt messages that were encrypted before the rotation.
+  """
+
+  def __init__(self, key_dir=DEFAULT_KEYS_DIR, retired_keys=DEFAULT_RETIRED_KEYS, logger=None):
+    self.key_dir = key_dir
+    self.retired_keys = retired_keys
+    self.logger = logger or logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    self._keys = {}
+    self._current = None
+    # Modification times of key_dir and of the current key when the keys were loaded.
+    self._stamp = None
+
+  @classmethod
+  def from_private_key(cls, private_key):
+    """Return an in memory KeyRing holding a single key."""
+    keyring = cls(key_dir=None)
+    keyring._current = private_key
+    keyring._keys = {get_key_id(private_key.public_key()): private_key}
+    return keyring
+
+  def get_current(self):
+    """Return the current private key, loading or generating it on first use.
+
+    The keys are loaded again when the key directory or the current key changed on disk, so keys
+    rotated by another process (collector.py --rotate-keys) are picked up.
+    """
+    with self._lock:
+      if self._current is None:
+        self._load()
+      elif self.key_dir is not None:
+        stamp = self._get_stamp()
+        # No stamp while another process is between the retirement and the new key.
+        if stamp is not None and stamp != self._stamp:
+          try:
+            self._load()
+          except (IOError, OSError, ValueError) as e:
+            self.logger.warn('Server keys of %s can\'t be reloaded: %s', self.key_dir, e)
+      return self._current
+
+  def find(self, key_id):
+    self.get_current()
+    return self._keys.get(key_id)
+
+  def private_keys(self):
+    current = self.get_current()
+    return [current] + [k for k in self._keys.values() if k is not current]
+
+  def rotate(self):
+    """Retire the current key and generate a new one.
+
+    Returns:
+      the new private key.
+    """
+    with self._lock:
+      current_path = os.path.join(self.key_dir, CURRENT_KEY_FILENAME)
+      if os.path.exists(current_path):
+        retired_path = os.path.join(self.key_dir, '%s%d.pem' % (RETIRED_KEY_PREFIX,
+                                                                int(time.time() * 1000)))
+        os.rename(current_path, retired_path)
+        self.logger.info('Server key retired to %s', retired_path)
+      self._prune_retired()
+      self._current = None
+      self._load()
+      return self._current
+
+  def _get_stamp(self):
+    try:
+      return (os.stat(self.key_dir).st_mtime_ns,
+              os.stat(os.path.join(self.key_dir, CURRENT_KEY_FILENAME)).st_mtime_ns)
+    except OSError:
+      return None
+
+  def _load(self):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    if self.key_dir is None:
+      raise EnvelopeError('In memory key ring can\'t be loaded')
+    if not os.path.isdir(self.key_dir):
+      os.makedirs(self.key_dir, mode=0o700)
+    current_path = os.path.join(self.key_dir, CURRENT_KEY_FILENAME)
+    if not os.path.exists(current_path):
+      self._write_new_key(current_path)
+
+    stamp = self._get_stamp()
+    keys = {}
+    current = None
+    for path in [current_path] + self._get_retired_paths():
+      with open(path, 'rb') as f:
+        private_key = serialization.load_pem_private_key(f.read(), password=None,
+                                                         backend=default_backend())
+      keys[get_key_id(private_key.public_key())] = private_key
+      if path == current_path:
+        current = private_key
+    self._keys = keys
+    self._current = current
+    self._stamp = stamp
+
+  def _write_new_key(self, path):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=DEFAULT_KEY_SIZE,
+                                           backend=default_backend())
+    pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                    format=serialization.PrivateFormat.PKCS8,
+                                    encryption_algorithm=serialization.NoEncryption())
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(pem)
+    os.rename(tmp_path, path)
+    self.logger.info('New server key generated in %s', path)
+
+  def _get_retired_paths(self):
+    """Return the retired key paths, most recent first."""
+    filenames = [f for f in os.listdir(self.key_dir)
+                 if f.startswith(RETIRED_KEY_PREFIX) and f.endswith('.pem') and
+                 f[len(RETIRED_KEY_PREFIX):-4].isdigit()]
+    filenames.sort(key=lambda f: int(f[len(RETIRED_KEY_PREFIX):-4]), reverse=True)
+    return [os.path.join(self.key_dir, f) for f in filenames]
+
+  def _prune_retired(self):
+    for path in self._get_retired_paths()[self.retired_keys:]:
+      os.remove(path)
+      self.logger.info('Retired server key %s removed', path)
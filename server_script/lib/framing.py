@@ -0,0 +1,61 @@
+"""Length prefixed frames used by the local collector to stream its results on stdout.
+
+Each frame is a 4 bytes big endian payload length followed by the payload (an encrypted
+envelope). local_collector.py has its own copy of the writing side.
+"""
+
+import struct
+
+
+FRAME_HEADER = struct.Struct('>I')
+# Guards against reading garbage (a python traceback for eg.) as a huge length.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FramingError(Exception):
+  """Exception raised when a frame stream is malformed or truncated."""
+
+  def __init__(self, msg):
+    super(FramingError, self).__init__(msg)
+    self.msg = msg
+
+
+def encode_frame(payload):
+  return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _read_exact(stream, size):
+  chunks = []
+  remaining = size
+  while remaining:
+    chunk = stream.read(remaining)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return b''.join(chunks)
+
+
+def read_frames(stream, max_frame_size=MAX_FRAME_SIZE):
+  """Yield the payloads of the frames read from stream until its end.
+
+  Args:
+    stream: file like object opened in binary mode (the stdout of an ssh exec_command for eg.).
+    max_frame_size: int, maximum accepted payload size.
+
+  Raises:
+    FramingError: if a frame is truncated or bigger than max_frame_size.
+  """
+  while True:
+    header = _read_exact(stream, FRAME_HEADER.size)
+    if not header:
+      return
+    if len(header) < FRAME_HEADER.size:
+      raise FramingError('Truncated frame header')
+    size, = FRAME_HEADER.unpack(header)
+    if size > max_frame_size:
+      raise FramingError('Frame of %d bytes exceeds the %d bytes limit' % (size, max_frame_size))
+    payload = _read_exact(stream, size)
+    if len(payload) < size:
+      raise FramingError('Truncated frame: %d/%d bytes' % (len(payload), size))
+    yield payload
@@ -0,0 +1,315 @@
+"""Delivery of the alert emails: per recipient digests, a reused SMTP connection and a retry spool.
+
+Alerts added during a run are grouped by recipient. flush() turns each group into a single digest
+message which is first written to the spool directory, an alert is considered treated from then
+on whatever happens to its delivery. Spooled messages are sent in the background over a single
+authenticated SMTP connection, and removed once delivered. A message which couldn't be delivered
+stays in the spool and is retried (by the next retry_spool() call) with an exponential backoff.
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import smtplib
+import socket
+import threading
+import time
+import uuid
+
+from email.mime import multipart
+from email.mime import text
+
+from lib import metrics
+
+
+DEFAULT_SPOOL_DIR = 'mail_spool'
+DEFAULT_TIMEOUT = 30
+# Delay before the first retry of an undelivered message, doubled on each attempt.
+DEFAULT_BACKOFF = 60
+DEFAULT_MAX_BACKOFF = 3600
+# Undelivered messages are dropped after this many attempts (~2 days with the default backoff).
+DEFAULT_MAX_ATTEMPTS = 50
+SPOOL_SUFFIX = '.json'
+
+
+class MailerError(Exception):
+  """Exception raised when messages can't be spooled."""
+
+  def __init__(self, msg):
+    super(MailerError, self).__init__(msg)
+    self.msg = msg
+
+
+class Mailer(object):
+  """Send digests of alerts through a pooled SMTP connection, spooling undelivered ones."""
+
+  def __init__(self, host, port=465, username='', password='', sender=None, use_ssl=True,
+               spool_dir=DEFAULT_SPOOL_DIR, timeout=DEFAULT_TIMEOUT, backoff=DEFAULT_BACKOFF,
+               max_backoff=DEFAULT_MAX_BACKOFF, max_attempts=DEFAULT_MAX_ATTEMPTS, logger=None):
+    """Create a Mailer, no connection is made until a message is sent.
+
+    Args:
+      host: str, SMTP server address.
+      port: int, SMTP server port.
+      username: str, account used to log in, no login if empty.
+      password: str, password of the account.
+      sender: str, From address of the messages, username if None.
+      use_ssl: bool, connect with SMTP over SSL rather than plain SMTP.
+      spool_dir: str, directory holding the messages not delivered yet.
+      timeout: float, number of seconds after which a blocking SMTP operation fails.
+      backoff: float, number of seconds before the first retry of an undelivered message.
+      max_backoff: float, maximum number of seconds between two attempts.
+      max_attempts: int, number of attempts after which an undelivered message is dropped.
+    """
+    self.host = host
+    self.port = port
+    self.username = username
+    self.password = password
+    self.sender = sender if sender is not None else username
+    self.use_ssl = use_ssl
+    self.spool_dir = spool_dir
+    self.timeout = timeout
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.max_attempts = max_attempts
+    self.logger = logger or logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    # {recipient: [(subject, text)]}
+    self._pending = {}
+    self._queue = queue.Queue()
+    self._queued = set()
+    self._worker = None
+    self._connection = None
+    self._sequence = itertools.count()
+
+  def add(self, recipient, subject, body):
+    """Add an alert to the digest of recipient, it's spooled by the next flush().
+
+    Returns:
+      bool, False if the alert can't be delivered (no recipient).
+    """
+    if not recipient:
+      return False
+    with self._lock:
+      self._pending.setdefault(recipient, []).append((subject, body))
+    return True
+
+  def pending_count(self):
+    with self._lock:
+      return sum(len(alerts) for alerts in self._pending.values())
+
+  @metrics.instrument('mail_spool')
+  def flush(self):
+    """Spool a digest message per recipient of the added alerts and send them in the background.
+
+    Returns:
+      int, number of spooled messages.
+
+    Raises:
+      MailerError: if the messages couldn't be written to the spool. The alerts are dropped: the
+        alerter doesn't mark their records as treated, they're alerted again by the next run.
+    """
+    with self._lock:
+      pending, self._pending = self._pending, {}
+    paths = []
+    try:
+      for recipient in sorted(pending):
+        subject, body = self.get_digest(pending[recipient])
+        paths.append(self._spool({'recipient': recipient, 'subject': subject, 'body': body,
+                                  'attempts': 0, 'next_attempt': 0, 'created': time.time()}))
+    except (IOError, OSError) as e:
+      for path in paths:
+        self._remove(path)
+      raise MailerError('Messages couldn\'t be spooled to %s: %s' % (self.spool_dir, e))
+    for path in paths:
+      self._enqueue(path)
+    return len(paths)
+
+  @classmethod
+  def get_digest(cls, alerts):
+    """Return (subject, body) of the message gathering alerts, list of (subject, body)."""
+    if len(alerts) == 1:
+      return alerts[0]
+    subject = 'Notification digest: %d alerts' % len(alerts)
+    parts = ['%s\n%s\n%s' % (s, '=' * len(s), body) for s, body in alerts]
+    return subject, '\n\n'.join(parts)
+
+  def retry_spool(self, now=None):
+    """Send (in the background) the spooled messages whose retry is due.
+
+    Returns:
+      int, number of messages to be sent.
+    """
+    now = time.time() if now is None else now
+    due = 0
+    for path in self._get_spooled_paths():
+      message = self._load(path)
+      if message is not None and message['next_attempt'] <= now:
+        due += self._enqueue(path)
+    return due
+
+  def wait(self, timeout=None):
+    """Wait for the messages to be sent, return False if some are still queued after timeout."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      with self._lock:
+        if not self._queued:
+          return True
+      if deadline is not None and time.time() >= deadline:
+        return False
+      time.sleep(0.05)
+
+  def close(self, timeout=None):
+    """Stop the background delivery once the queued messages are sent (or timeout expired).
+
+    Messages which weren't sent stay in the spool.
+    """
+    with self._lock:
+      worker, self._worker = self._worker, None
+    if worker is not None:
+      self._queue.put(None)
+      worker.join(timeout)
+
+  def _enqueue(self, path):
+    with self._lock:
+      if path in self._queued:
+        return 0
+      self._queued.add(path)
+      if self._worker is None:
+        self._worker = threading.Thread(target=self._run, name='mailer')
+        self._worker.daemon = True
+        self._worker.start()
+    self._queue.put(path)
+    return 1
+
+  def _run(self):
+    failing = False
+    try:
+      while True:
+        path = self._queue.get()
+        if path is None:
+          return
+        try:
+          # Once the server failed, the remaining messages wait for the next retry_spool().
+          if not failing:
+            failing = not self._deliver(path)
+        finally:
+          with self._lock:
+            self._queued.discard(path)
+        if self._queue.empty():
+          failing = False
+    finally:
+      self._disconnect()
+
+  @metrics.instrument('smtp_deliver')
+  def _deliver(self, path):
+    """Send the spooled message of path, return False if the SMTP server is failing."""
+    message = self._load(path)
+    if message is None:
+      return True
+    try:
+      refused = self._get_connection().sendmail(self.sender, [message['recipient']],
+                                                self._format(message))
+    except smtplib.SMTPRecipientsRefused as e:
+      self.logger.error('Message to %s refused, dropping it: %s', message['recipient'], e)
+      metrics.PHASE_FAILURES.inc(phase='smtp_deliver')
+      self._remove(path)
+      return True
+    except (smtplib.SMTPException, socket.error) as e:
+      self._disconnect()
+      self._reschedule(path, message, e)
+      return False
+    if refused:
+      self.logger.error('Message refused by %s', ', '.join(refused))
+    self._remove(path)
+    self.logger.info('Alert digest sent to %s.', message['recipient'])
+    return True
+
+  def _reschedule(self, path, message, error):
+    message['attempts'] += 1
+    if message['attempts'] >= self.max_attempts:
+      self.logger.error('Dropping message to %s after %d attempts: %s', message['recipient'],
+                        message['attempts'], error)
+      metrics.PHASE_FAILURES.inc(phase='smtp_deliver')
+      self._remove(path)
+      return
+    delay = min(self.max_backoff, self.backoff * 2 ** (message['attempts'] - 1))
+    message['next_attempt'] = time.time() + delay
+    metrics.RETRIES.inc(phase='smtp_deliver')
+    self.logger.warn('Message to %s not delivered (%s), retrying in %d seconds.',
+                     message['recipient'], error, delay)
+    try:
+      self._write(path, message)
+    except (IOError, OSError) as e:
+      self.logger.error('Spooled message %s couldn\'t be updated: %s', path, e)
+
+  def _get_connection(self):
+    if self._connection is None:
+      if self.use_ssl:
+        connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+      else:
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+      try:
+        connection.ehlo()
+        if self.username:
+          connection.login(self.username, self.password)
+      except Exception:
+        connection.close()
+        raise
+      self._connection = connection
+    return self._connection
+
+  def _disconnect(self):
+    connection, self._connection = self._connection, None
+    if connection is not None:
+      try:
+        connection.quit()
+      except (smtplib.SMTPException, socket.error):
+        connection.close()
+
+  def _format(self, message):
+    msg = multipart.MIMEMultipart('alternative')
+    msg['Subject'] = message['subject']
+    msg['From'] = self.sender
+    msg['To'] = message['recipient']
+    msg.attach(text.MIMEText(message['body'], 'plain'))
+    return msg.as_string()
+
+  def _get_spooled_paths(self):
+    if not self.spool_dir or not os.path.isdir(self.spool_dir):
+      return []
+    return [os.path.join(self.spool_dir, f) for f in sorted(os.listdir(self.spool_dir))
+            if f.endswith(SPOOL_SUFFIX)]
+
+  def _spool(self, message):
+    if not os.path.isdir(self.spool_dir):
+      os.makedirs(self.spool_dir, mode=0o700)
+    # Named after the creation time (and order) so the spool is retried in order
+    path = os.path.join(self.spool_dir, '%d_%06d_%s%s' % (
+        int(time.time() * 1000), next(self._sequence) % 1000000, uuid.uuid4().hex, SPOOL_SUFFIX))
+    self._write(path, message)
+    return path
+
+  def _write(self, path, message):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(message, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+  def _load(self, path):
+    try:
+      with open(path) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+      self.logger.warn('Ignoring unreadable spooled message %s: %s', path, e)
+      return None
+
+  def _remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
@@ -0,0 +1,316 @@
+"""Latency histograms and counters of the collector and alerter phases.
+
+Phases (ssh connection, deployment, remote sample, decryption, DB queries, email delivery...) are
+timed with timed() or instrument(), which feed a per phase histogram, a per phase and host
+histogram when the phase is about a host, and a failure counter when the phase raised. The
+registry is written as a Prometheus text format snapshot at the end of each run (see
+Registry.write), to be picked up by the textfile collector of node_exporter for eg.
+
+profiled() optionally records a cProfile of a run, threads included, for a closer look.
+"""
+
+import bisect
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+PREFIX = 'fleet_health_'
+# Seconds, from a fast DB query to a host collection hitting its deadline.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Up to Python 3.11 a cProfile.Profile only sees the thread which enabled it. From 3.12 it relies on
+# sys.monitoring: a single profiler sees every thread and no other one can be enabled meanwhile.
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+
+def format_labels(labelnames, values, extra=()):
+  pairs = list(zip(labelnames, values)) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                        .replace('"', '\\"').replace('\n', '\\n'))
+                           for name, value in pairs)
+
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+  """Base class of the metrics: a value per set of label values."""
+
+  kind = None
+
+  def __init__(self, name, help_text, labelnames=()):
+    self.name = PREFIX + name
+    self.help_text = help_text
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    # {label values: value}
+    self._values = {}
+
+  def _get_key(self, labels):
+    if set(labels) != set(self.labelnames):
+      raise ValueError('%s expects the labels %s, got %s' % (
+          self.name, ', '.join(self.labelnames), ', '.join(sorted(labels))))
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+  def reset(self):
+    with self._lock:
+      self._values = {}
+
+  def render(self):
+    """Return the lines of the metric in the Prometheus text format."""
+    lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.kind)]
+    with self._lock:
+      for key in sorted(self._values):
+        lines.extend(self._render_value(key, self._values[key]))
+    return lines
+
+  def _render_value(self, key, value):
+    return ['%s%s %s' % (self.name, format_labels(self.labelnames, key), format_value(value))]
+
+
+class Counter(Metric):
+  """Value which only goes up: number of retries, failures..."""
+
+  kind = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self._get_key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def get(self, **labels):
+    with self._lock:
+      return self._values.get(self._get_key(labels), 0)
+
+
+class Gauge(Metric):
+  """Value which is set: time of the last run..."""
+
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    key = self._get_key(labels)
+    with self._lock:
+      self._values[key] = value
+
+  def get(self, **labels):
+    with self._lock:
+      return self._values.get(self._get_key(labels))
+
+
+class Histogram(Metric):
+  """Distribution of durations: count of observations per bucket, their sum and count."""
+
+  kind = 'histogram'
+
+  def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    super(Histogram, self).__init__(name, help_text, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self._get_key(labels)
+    with self._lock:
+      if key not in self._values:
+        # Per bucket (non cumulative, +Inf last) counts, sum
+        self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+      counts, _ = self._values[key]
+      counts[bisect.bisect_left(self.buckets, value)] += 1
+      self._values[key][1] += value
+
+  def get(self, **labels):
+    """Return (count, sum) of the observations."""
+    with self._lock:
+      counts, total = self._values.get(self._get_key(labels), ([0], 0.0))
+      return sum(counts), total
+
+  def _render_value(self, key, value):
+    counts, total = value
+    lines = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float('inf'),), counts):
+      cumulative += count
+      lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labelnames, key,
+                                                                [('le', format_value(bound))]),
+                                       cumulative))
+    labels = format_labels(self.labelnames, key)
+    lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+    lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+    return lines
+
+
+class Registry(object):
+  """Set of metrics exported together."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = {}
+
+  def _register(self, cls, name, *args):
+    with self._lock:
+      if name not in self._metrics:
+        self._metrics[name] = cls(name, *args)
+      return self._metrics[name]
+
+  def counter(self, name, help_text, labelnames=()):
+    return self._register(Counter, name, help_text, labelnames)
+
+  def gauge(self, name, help_text, labelnames=()):
+    return self._register(Gauge, name, help_text, labelnames)
+
+  def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return self._register(Histogram, name, help_text, labelnames, buckets)
+
+  def reset(self):
+    with self._lock:
+      metrics = list(self._metrics.values())
+    for metric in metrics:
+      metric.reset()
+
+  def render(self):
+    """Return the snapshot of all the metrics in the Prometheus text format."""
+    with self._lock:
+      metrics = [self._metrics[name] for name in sorted(self._metrics)]
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+  def write(self, path):
+    """Write the snapshot to path, atomically so it's never read half written."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(self.render())
+    os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+PHASE_SECONDS = REGISTRY.histogram('phase_duration_seconds', 'Duration of each phase.', ('phase',))
+HOST_PHASE_SECONDS = REGISTRY.histogram('host_phase_duration_seconds',
+                                        'Duration of each phase, per host.', ('phase', 'host'))
+PHASE_FAILURES = REGISTRY.counter('phase_failures_total', 'Number of phases which failed.',
+                                  ('phase',))
+RETRIES = REGISTRY.counter('retries_total', 'Number of retried operations.', ('phase',))
+HOSTS = REGISTRY.counter('hosts_total', 'Number of host collections, per result.', ('result',))
+DROPPED_SAMPLES = REGISTRY.counter('agent_dropped_samples_total',
+                                   'Number of agent samples overwritten before being drained.')
+NOTIFICATIONS = REGISTRY.counter('notifications_total',
+                                 'Number of stored stats notifications, per result.', ('result',))
+QUERY_CACHE = REGISTRY.counter('query_cache_total', 'Number of query cache lookups, per result.',
+                               ('result',))
+LAST_RUN = REGISTRY.gauge('last_run_timestamp_seconds', 'End time of the last run.', ('program',))
+LAST_RUN_SECONDS = REGISTRY.gauge('last_run_duration_seconds', 'Duration of the last run.',
+                                  ('program',))
+
+
+class Timer(object):
+  """Context manager timing a phase, see timed()."""
+
+  def __init__(self, phase, host=None):
+    self.phase = phase
+    self.host = host
+    self.start_time = None
+    self.duration = None
+
+  def __enter__(self):
+    self.start_time = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.duration = time.time() - self.start_time
+    PHASE_SECONDS.observe(self.duration, phase=self.phase)
+    if self.host is not None:
+      HOST_PHASE_SECONDS.observe(self.duration, phase=self.phase, host=self.host)
+    if exc_type is not None:
+      PHASE_FAILURES.inc(phase=self.phase)
+    return False
+
+
+def timed(phase, host=None):
+  """Return a context manager recording the duration of phase (of host if set).
+
+  Example:
+    with metrics.timed('ssh_connect', machine.ip):
+      ...
+  """
+  return Timer(phase, host)
+
+
+def instrument(phase):
+  """Decorator recording the duration of each call of the function as phase."""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with Timer(phase):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def write_run(program, start_time, path, logger=None):
+  """Record the end of a run of program and write the snapshot of REGISTRY to path.
+
+  Metrics never fail a run, an error writing the snapshot is only logged.
+
+  Args:
+    program: str, name of the program (collector, alerter...) which ran.
+    start_time: float, epoch time the run started.
+    path: str, file of the snapshot, nothing is written if empty.
+    logger: logging.Logger instance.
+  """
+  end_time = time.time()
+  LAST_RUN.set(end_time, program=program)
+  LAST_RUN_SECONDS.set(end_time - start_time, program=program)
+  if not path:
+    return
+  try:
+    REGISTRY.write(path)
+  except (IOError, OSError) as e:
+    (logger or logging.getLogger(__name__)).error('Metrics couldn\'t be written to %s: %s', path,
+                                                  e)
+
+
+@contextlib.contextmanager
+def profiled(path):
+  """Record a cProfile of the block, and of the threads it starts, into path (pstats format).
+
+  Nothing is recorded if path is empty. Threads still running when the block exits are only
+  accounted for up to that point.
+  """
+  if not path:
+    yield
+    return
+  profiles = [cProfile.Profile()]
+  lock = threading.Lock()
+
+  def profile_thread(frame, event, arg):
+    # Called on the first event of each new thread, replaced by a profiler of the thread.
+    profile = cProfile.Profile()
+    with lock:
+      profiles.append(profile)
+    profile.enable()
+
+  if PER_THREAD_PROFILERS:
+    threading.setprofile(profile_thread)
+  profiles[0].enable()
+  try:
+    yield
+  finally:
+    profiles[0].disable()
+    if PER_THREAD_PROFILERS:
+      threading.setprofile(None)
+    with lock:
+      stats = pstats.Stats(profiles[0])
+      for profile in profiles[1:]:
+        stats.add(profile)
+    stats.dump_stats(path)
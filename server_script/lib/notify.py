@@ -0,0 +1,167 @@
+"""Notifications of the stats stored by the collector, which trigger the alerter (--follow mode).
+
+After each flush the collector sends the ip addresses of the machines whose stats were stored as
+datagrams on a Unix socket bound by the alerter, which then only evaluates the backlog of these
+machines (their records after the watermark, i.e. the new ones) within seconds of their insertion.
+
+Notifications are best effort: when no alerter listens, or it lags behind and the socket buffer is
+full, they are dropped and the records are picked up by the next catch-up scan of the alerter.
+"""
+
+import errno
+import os
+import select
+import socket
+import stat
+import threading
+
+from lib import metrics
+
+
+# Datagrams are kept well below the default socket buffer size.
+MAX_DATAGRAM_SIZE = 8192
+# Errors of a publisher which mean nobody is listening or the listener lags behind.
+DROPPED_ERRNOS = (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN, errno.ENOBUFS)
+
+
+class NotifyError(Exception):
+  """Exception raised when the notifications can't be listened to."""
+
+  def __init__(self, msg):
+    super(NotifyError, self).__init__(msg)
+    self.msg = msg
+
+
+def encode(ip_addrs):
+  """Return the datagrams notifying ip_addrs: their addresses, one per line."""
+  datagrams = []
+  lines = []
+  size = 0
+  for ip_addr in sorted(set(ip_addrs)):
+    line = ip_addr.encode('ascii')
+    if lines and size + len(line) + 1 > MAX_DATAGRAM_SIZE:
+      datagrams.append(b'\n'.join(lines))
+      lines, size = [], 0
+    lines.append(line)
+    size += len(line) + 1
+  if lines:
+    datagrams.append(b'\n'.join(lines))
+  return datagrams
+
+
+def decode(datagram):
+  """Return the set of ip addresses notified by datagram."""
+  return set(line for line in datagram.decode('ascii', 'replace').split('\n') if line)
+
+
+class Publisher(object):
+  """Sends the notifications of the collector, never blocks nor fails."""
+
+  def __init__(self, path, logger=None):
+    """
+    Args:
+      path: str, socket of the alerter.
+      logger: logging.Logger the dropped notifications are reported to.
+    """
+    self.path = path
+    self.logger = logger
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._socket.setblocking(False)
+    self._lock = threading.Lock()
+    # Only the first drop of a series is logged, the alerter isn't running most of the time.
+    self._dropping = False
+
+  def publish(self, ip_addrs):
+    """Notify that stats of ip_addrs were stored.
+
+    Returns:
+      boolean, whether the notification was handed to a listener.
+    """
+    with self._lock:
+      for datagram in encode(ip_addrs):
+        try:
+          self._socket.sendto(datagram, self.path)
+        except OSError as e:
+          if e.errno not in DROPPED_ERRNOS:
+            raise
+          metrics.NOTIFICATIONS.inc(result='dropped')
+          if not self._dropping and self.logger:
+            self.logger.info('Stored stats notifications to %s are dropped: %s', self.path, e)
+          self._dropping = True
+          return False
+        metrics.NOTIFICATIONS.inc(result='sent')
+      self._dropping = False
+    return True
+
+  def __call__(self, ip_addrs):
+    # Used as a storage flush listener, a failure mustn't fail the flush.
+    try:
+      self.publish(ip_addrs)
+    except OSError as e:
+      if self.logger:
+        self.logger.warn('Stored stats notification to %s failed: %s', self.path, e)
+
+  def close(self):
+    self._socket.close()
+
+
+class Listener(object):
+  """Receives the notifications on behalf of the alerter."""
+
+  def __init__(self, path):
+    """Bind the socket at path, replacing the one of a listener which didn't exit cleanly.
+
+    Raises:
+      NotifyError: if another listener is bound to path or it can't be bound.
+    """
+    self.path = path
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      self._remove_stale_socket()
+      self._socket.bind(path)
+      os.chmod(path, 0o600)
+    except OSError as e:
+      self._socket.close()
+      raise NotifyError('Notifications socket %s can\'t be bound: %s' % (path, e))
+    self._socket.setblocking(False)
+
+  def _remove_stale_socket(self):
+    try:
+      if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+        raise NotifyError('%s exists and isn\'t a socket' % self.path)
+    except FileNotFoundError:
+      return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      probe.connect(self.path)
+    except ConnectionRefusedError:
+      os.unlink(self.path)
+      return
+    finally:
+      probe.close()
+    raise NotifyError('Another listener is bound to %s' % self.path)
+
+  def wait(self, timeout):
+    """Wait up to timeout seconds for notifications.
+
+    Returns:
+      set of str, ip addresses of the machines notified since the previous call, empty if none was
+      received in time.
+    """
+    ip_addrs = set()
+    readable, _, _ = select.select([self._socket], [], [], max(timeout, 0))
+    while readable:
+      try:
+        datagram = self._socket.recv(MAX_DATAGRAM_SIZE)
+      except BlockingIOError:
+        break
+      metrics.NOTIFICATIONS.inc(result='received')
+      ip_addrs.update(decode(datagram))
+    return ip_addrs
+
+  def close(self):
+    self._socket.close()
+    try:
+      os.unlink(self.path)
+    except FileNotFoundError:
+      pass
@@ -0,0 +1,133 @@
+"""Bounded LRU cache of the fleet summaries and series read from the rollups (see query.py).
+
+A cached result is dropped as soon as stats of one of its machines are stored. Stats stored through
+the Storage of the cache are known right away (flush listener), those stored by other processes
+(the collector) are found by polling the ids stored since the previous check, at most every
+check_interval seconds. Ids being allocated before their transaction commits, a record can become
+visible after a check which already went past its id: results also expire after max_age seconds.
+"""
+
+import collections
+import threading
+import time
+
+from lib import metrics
+
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_CHECK_INTERVAL = 1
+DEFAULT_MAX_AGE = 300
+
+
+class QueryCache(object):
+  """Reads fleet summaries and series from a Storage, caching the results of the last queries.
+
+  Has the read API of the Storage (get_fleet_summary, get_fleet_series). Cached results are
+  shared between the callers and mustn't be modified.
+  """
+
+  def __init__(self, db, max_entries=DEFAULT_MAX_ENTRIES, check_interval=DEFAULT_CHECK_INTERVAL,
+               max_age=DEFAULT_MAX_AGE):
+    """
+    Args:
+      db: storage.Storage instance.
+      max_entries: int, maximum number of cached results, the least recently used are dropped.
+      check_interval: float, minimum number of seconds between two checks of the stored ids.
+      max_age: float, number of seconds after which a result is read again.
+    """
+    self.db = db
+    self.max_entries = max_entries
+    self.check_interval = check_interval
+    self.max_age = max_age
+    # {key: (time it was read, set of ip_addr, result)}, least recently used first.
+    self._entries = collections.OrderedDict()
+    # {ip_addr: set of keys whose result covers the machine}
+    self._keys_by_host = {}
+    self._lock = threading.Lock()
+    # Incremented by each invalidation, {ip_addr: generation of its last invalidation}: results
+    # covering a machine invalidated while they were read aren't cached.
+    self._generation = 0
+    self._invalidated = {}
+    self._last_id = None
+    self._checked_at = None
+    db.add_flush_listener(self.invalidate)
+
+  def get_fleet_summary(self, ip_addrs, metric_names, start, end):
+    """See storage.Storage.get_fleet_summary."""
+    ip_addrs, metric_names = frozenset(ip_addrs), frozenset(metric_names)
+    return self._get(('summary', ip_addrs, metric_names, start, end), ip_addrs,
+                     lambda: self.db.get_fleet_summary(ip_addrs, metric_names, start, end))
+
+  def get_fleet_series(self, ip_addrs, metric_names, start, end, step):
+    """See storage.Storage.get_fleet_series."""
+    ip_addrs, metric_names = frozenset(ip_addrs), frozenset(metric_names)
+    return self._get(('series', ip_addrs, metric_names, start, end, step), ip_addrs,
+                     lambda: self.db.get_fleet_series(ip_addrs, metric_names, start, end, step))
+
+  def _get(self, key, ip_addrs, read):
+    self._check_stored()
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and now - entry[0] < self.max_age:
+        self._entries.move_to_end(key)
+        metrics.QUERY_CACHE.inc(result='hit')
+        return entry[2]
+      generation = self._generation
+    metrics.QUERY_CACHE.inc(result='miss')
+    # Read outside of the lock, concurrent misses of a key are read twice rather than serialized.
+    result = read()
+    with self._lock:
+      if any(self._invalidated.get(ip_addr, 0) > generation for ip_addr in ip_addrs):
+        return result
+      self._remove(key)
+      self._entries[key] = (now, ip_addrs, result)
+      for ip_addr in ip_addrs:
+        self._keys_by_host.setdefault(ip_addr, set()).add(key)
+      while len(self._entries) > self.max_entries:
+        self._remove(next(iter(self._entries)))
+    return result
+
+  def _remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return
+    for ip_addr in entry[1]:
+      keys = self._keys_by_host.get(ip_addr)
+      keys.discard(key)
+      if not keys:
+        del self._keys_by_host[ip_addr]
+
+  def invalidate(self, ip_addrs):
+    """Drop the results covering any of ip_addrs, whose stats were stored."""
+    with self._lock:
+      self._generation += 1
+      keys = set()
+      for ip_addr in ip_addrs:
+        self._invalidated[ip_addr] = self._generation
+        keys.update(self._keys_by_host.get(ip_addr, ()))
+      for key in keys:
+        self._remove(key)
+    if keys:
+      metrics.QUERY_CACHE.inc(len(keys), result='invalidated')
+
+  def _check_stored(self):
+    now = time.time()
+    with self._lock:
+      if self._checked_at is not None and now - self._checked_at < self.check_interval:
+        return
+      self._checked_at = now
+      last_id = self._last_id
+    if last_id is None:
+      # Nothing is cached yet, results read from now on include the records up to this one.
+      self._last_id = self.db.get_last_stored_id()
+      return
+    stored = self.db.get_stored_since(last_id)
+    if stored:
+      self.invalidate(stored)
+      with self._lock:
+        self._last_id = max([self._last_id] + list(stored.values()))
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
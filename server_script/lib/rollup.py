@@ -0,0 +1,143 @@
+"""Per machine and metric rollups of the collected stats at minute, hour and day resolutions.
+
+A rollup holds the count, min, max, sum and a quantile sketch (see sketch.py) of the values of a
+metric within a time bucket. Rollups are updated as stats are stored (see Storage.flush) and a
+query over a time range is answered by merging the coarsest buckets covering it: a week is read
+from ~7 day buckets plus the hour and minute buckets of its unaligned edges.
+"""
+
+import datetime
+
+from collections import namedtuple
+
+from lib import sketch
+
+
+# Metrics of collected_stats which are rolled up.
+METRICS = ('cpu_usage', 'mem_usage', 'uptime')
+# Extra metrics reported by the clients (collected_stats.extra_metrics) which are rolled up too. The
+# others (per core usage, top processes...) are only kept in the records.
+EXTRA_METRICS = ('cpu_max_pct', 'load1', 'load5', 'load15', 'swap_pct', 'disk_pct',
+                 'disk_read_bps', 'disk_write_bps', 'net_rx_bps', 'net_tx_bps')
+
+Resolution = namedtuple('Resolution', 'name table seconds')
+MINUTE = Resolution(name='minute', table='stats_rollup_minute', seconds=60)
+HOUR = Resolution(name='hour', table='stats_rollup_hour', seconds=3600)
+DAY = Resolution(name='day', table='stats_rollup_day', seconds=86400)
+# Finest first
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+
+class Rollup(object):
+  """Summary of the values of a metric: count, min, max, sum and quantile sketch."""
+
+  __slots__ = ('count', 'min', 'max', 'sum', 'sketch')
+
+  def __init__(self, count=0, min=None, max=None, sum=0.0, sketch_=None):
+    self.count = count
+    self.min = min
+    self.max = max
+    self.sum = sum
+    self.sketch = sketch_ or sketch.QuantileSketch()
+
+  def add(self, value):
+    self.count += 1
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+    self.sum += value
+    self.sketch.add(value)
+    return self
+
+  def merge(self, other):
+    if not other.count:
+      return self
+    self.min = other.min if self.min is None else min(self.min, other.min)
+    self.max = other.max if self.max is None else max(self.max, other.max)
+    self.count += other.count
+    self.sum += other.sum
+    self.sketch.merge(other.sketch)
+    return self
+
+  @property
+  def mean(self):
+    return self.sum / self.count if self.count else None
+
+  def quantile(self, q):
+    return self.sketch.quantile(q)
+
+  def to_row(self):
+    """Return (count, min_value, max_value, sum_value, sketch) as stored in the rollup tables."""
+    return self.count, self.min, self.max, self.sum, self.sketch.to_bytes()
+
+  @classmethod
+  def from_row(cls, row):
+    count, min_value, max_value, sum_value, sketch_data = row
+    return cls(count, min_value, max_value, sum_value,
+               sketch.QuantileSketch.from_bytes(bytes(sketch_data)))
+
+
+def get_bucket_start(date, resolution):
+  """Return the start of the resolution bucket date belongs to."""
+  if resolution.seconds >= DAY.seconds:
+    return datetime.datetime(date.year, date.month, date.day)
+  date = date.replace(second=0, microsecond=0)
+  if resolution.seconds >= HOUR.seconds:
+    date = date.replace(minute=0)
+  return date
+
+
+def get_next_bucket_start(date, resolution):
+  """Return the first bucket start greater than or equal to date."""
+  start = get_bucket_start(date, resolution)
+  if start < date:
+    start += datetime.timedelta(seconds=resolution.seconds)
+  return start
+
+
+def aggregate(samples):
+  """Roll samples up at every resolution.
+
+  Args:
+    samples: iterable of tuple (ip_addr, datetime.datetime, {metric: float or None}).
+
+  Returns:
+    dict, {(resolution, ip_addr, metric, bucket_start): Rollup}.
+  """
+  rollups = {}
+  for ip_addr, date, values in samples:
+    for metric in METRICS + EXTRA_METRICS:
+      value = values.get(metric)
+      if value is None:
+        continue
+      for resolution in RESOLUTIONS:
+        key = (resolution, ip_addr, metric, get_bucket_start(date, resolution))
+        rollups.setdefault(key, Rollup()).add(value)
+  return rollups
+
+
+def plan_ranges(start, end, resolutions=RESOLUTIONS):
+  """Split [start, end) into ranges of the coarsest buckets which exactly cover them.
+
+  Minutes being the finest resolution, start is rounded down to the minute.
+
+  Returns:
+    list of tuple (Resolution, range_start, range_end), in chronological order. The buckets to read
+    are those of the resolution starting within [range_start, range_end).
+  """
+  if start >= end:
+    return []
+  if len(resolutions) == 1:
+    return [(resolutions[0], get_bucket_start(start, resolutions[0]), end)]
+  resolution, finer = resolutions[-1], resolutions[:-1]
+  first = get_next_bucket_start(start, resolution)
+  last = get_bucket_start(end, resolution)
+  if first >= last:
+    return plan_ranges(start, end, finer)
+  return (plan_ranges(start, first, finer) + [(resolution, first, last)] +
+          plan_ranges(last, end, finer))
+
+
+def get_series_resolution(step):
+  """Return the coarsest resolution whose buckets can be grouped into steps of step seconds."""
+  candidates = [r for r in RESOLUTIONS if r.seconds <= step and step % r.seconds == 0]
+  return candidates[-1] if candidates else MINUTE
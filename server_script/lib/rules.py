@@ -0,0 +1,386 @@
+"""Alert rules of the fleet compiled into arrays, so a whole backlog is evaluated at once.
+
+Plain rules (a metric compared to a limit, see config.Alert) of each machine are compiled once into
+a (machines x rules) matrix of thresholds, a matrix of operators and a matrix of the stats column
+each rule applies to, padded with rules which can't be reached for machines having fewer rules.
+Evaluating a batch of stats then boils down to a few array operations whatever the number of rows
+and rules, only the violating rows are handled one by one.
+
+Stateful rules (sustained for_samples / for_minutes conditions, rates of change and clear
+thresholds) depend on the previous samples of their machine. Each sample updates a constant size
+state per machine and rule (streak length and start, whether the alert is raised, last value of
+each metric), persisted by RuleStateStore between runs, so past records are never read again. A
+stateful rule is only reported when its alert is raised, not on every sample reaching it.
+
+Anomaly rules (sigma) compare each sample to the baseline of its machine (see baselines.py): they
+are compiled into matrices as well, of the number of standard deviations and of the direction of
+the deviation reaching them.
+"""
+
+import datetime
+import json
+import logging
+import operator
+import os
+import threading
+import time
+
+from collections import namedtuple
+
+import numpy
+
+
+# {xml alert type: collected_stats column}
+METRICS_MAP = {'memory': 'mem_usage', 'cpu': 'cpu_usage', 'uptime': 'uptime'}
+# Columns of the values matrix.
+METRICS = ('cpu_usage', 'mem_usage', 'uptime')
+# Metrics having a baseline, which anomaly rules apply to. Uptime only grows, it has no baseline.
+ANOMALY_METRICS = ('cpu_usage', 'mem_usage')
+# {xml op: sign of the deviations reaching an anomaly rule}, 0 for both.
+ANOMALY_DIRECTIONS = {'>=': 1, '>': 1, '<=': -1, '<': -1, '!=': 0}
+# {xml op: (python operator, numpy ufunc)}, the first one is used to pad the compiled matrices.
+OPERATORS = (('>=', operator.ge, numpy.greater_equal), ('>', operator.gt, numpy.greater),
+             ('<=', operator.le, numpy.less_equal), ('<', operator.lt, numpy.less),
+             ('==', operator.eq, numpy.equal), ('!=', operator.ne, numpy.not_equal))
+OPERATOR_CODES = dict((op, code) for code, (op, _, _) in enumerate(OPERATORS))
+
+DEFAULT_STATE_FILE = 'alert_state.json'
+
+# Violation: alert type (xml), its limit and the value (or rate) which reached it.
+Violation = namedtuple('Violation', 'type limit value')
+# Rule: compiled config.Alert, column is the index of its metric in METRICS. limit is the number of
+# standard deviations of anomaly rules (sigma set).
+Rule = namedtuple('Rule', 'type column op limit clear for_samples for_minutes rate sigma')
+Rule.__new__.__defaults__ = (False,)
+
+
+def parse_limit(limit):
+  # This makes the % sign optional in the xml file
+  return float(limit[:-1]) if limit.endswith('%') else float(limit)
+
+
+def compile_alert(alert):
+  """Return the Rule of a config.Alert.
+
+  Raises:
+    ValueError: if the alert is invalid.
+  """
+  if alert.type not in METRICS_MAP:
+    raise ValueError('unknown type %s' % alert.type)
+  if alert.op not in OPERATOR_CODES:
+    raise ValueError('unknown operator %s' % alert.op)
+  if getattr(alert, 'sigma', None) is not None:
+    return compile_anomaly_alert(alert)
+  limit = parse_limit(alert.limit)
+  return Rule(type=alert.type, column=METRICS.index(METRICS_MAP[alert.type]), op=alert.op,
+              limit=limit, clear=limit if alert.clear is None else parse_limit(alert.clear),
+              for_samples=max(1, int(alert.for_samples)), for_minutes=float(alert.for_minutes),
+              rate=bool(alert.rate))
+
+
+def compile_anomaly_alert(alert):
+  metric = METRICS_MAP[alert.type]
+  if metric not in ANOMALY_METRICS:
+    raise ValueError('%s has no baseline' % alert.type)
+  if alert.op not in ANOMALY_DIRECTIONS:
+    raise ValueError('operator %s doesn\'t apply to sigma' % alert.op)
+  if (alert.limit is not None or alert.clear is not None or alert.rate or
+      int(alert.for_samples) > 1 or float(alert.for_minutes) > 0):
+    raise ValueError('sigma can\'t be combined with limit, clear, rate, for_samples or '
+                     'for_minutes')
+  sigma = float(alert.sigma)
+  if not sigma > 0:
+    raise ValueError('sigma has to be positive')
+  return Rule(type=alert.type, column=METRICS.index(metric), op=alert.op, limit=sigma, clear=sigma,
+              for_samples=1, for_minutes=0.0, rate=False, sigma=True)
+
+
+def is_stateful(rule):
+  return (rule.for_samples > 1 or rule.for_minutes > 0 or rule.rate or
+          rule.clear != rule.limit)
+
+
+def get_rule_key(rule):
+  """Key of the state of rule, a changed rule starts over with a new state."""
+  return '%s%s%r/%r/%d/%r%s' % (rule.type, rule.op, rule.limit, rule.clear, rule.for_samples,
+                                rule.for_minutes, '/rate' if rule.rate else '')
+
+
+def get_sample_time(stat):
+  """Return the epoch time of stat (sample time, collection time otherwise), None if unknown."""
+  date = getattr(stat, 'sampled_at', None) or stat.collection_date
+  if isinstance(date, datetime.datetime):
+    return time.mktime(date.timetuple())
+  return None
+
+
+def to_float(value):
+  try:
+    value = float(value)
+  except (TypeError, ValueError):
+    return None
+  return None if value != value else value
+
+
+class CompiledRules(object):
+  """Thresholds of the alerts of a list of machines."""
+
+  def __init__(self, clients, logger=None):
+    """Compile the alerts of clients.
+
+    Invalid alerts (unknown type or operator, invalid limit) are ignored and logged.
+
+    Args:
+      clients: list of config.Client namedtuple.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+    self.host_index = {}
+    # Per machine: list of the plain Rule (in the matrices), of the stateful ones and of the
+    # anomaly ones (in their own matrices).
+    self.alerts = []
+    self.stateful = []
+    self.anomalies = []
+    for client in clients:
+      if client.ip in self.host_index:
+        continue
+      alerts, stateful, anomalies = [], [], []
+      for alert in client.alerts:
+        try:
+          rule = compile_alert(alert)
+        except (AttributeError, TypeError, ValueError) as e:
+          self.logger.warn('Ignoring alert %s of %s: %s', alert.type, client.ip, e)
+          continue
+        if rule.sigma:
+          anomalies.append(rule)
+        else:
+          (stateful if is_stateful(rule) else alerts).append(rule)
+      self.host_index[client.ip] = len(self.alerts)
+      self.alerts.append(alerts)
+      self.stateful.append(stateful)
+      self.anomalies.append(anomalies)
+
+    # The extra last row (no rule) is used for stats of unknown machines.
+    width = max([len(alerts) for alerts in self.alerts] + [1])
+    self.thresholds = numpy.full((len(self.alerts) + 1, width), numpy.inf)
+    self.operators = numpy.zeros((len(self.alerts) + 1, width), dtype=numpy.intp)
+    self.columns = numpy.zeros((len(self.alerts) + 1, width), dtype=numpy.intp)
+    for host, alerts in enumerate(self.alerts):
+      for slot, rule in enumerate(alerts):
+        self.thresholds[host, slot] = rule.limit
+        self.operators[host, slot] = OPERATOR_CODES[rule.op]
+        self.columns[host, slot] = rule.column
+    width = max([len(anomalies) for anomalies in self.anomalies] + [1])
+    self.sigmas = numpy.full((len(self.anomalies) + 1, width), numpy.inf)
+    self.directions = numpy.zeros((len(self.anomalies) + 1, width), dtype=numpy.intp)
+    # Columns of the baselines (ANOMALY_METRICS).
+    self.anomaly_columns = numpy.zeros((len(self.anomalies) + 1, width), dtype=numpy.intp)
+    for host, anomalies in enumerate(self.anomalies):
+      for slot, rule in enumerate(anomalies):
+        self.sigmas[host, slot] = rule.limit
+        self.directions[host, slot] = ANOMALY_DIRECTIONS[rule.op]
+        self.anomaly_columns[host, slot] = ANOMALY_METRICS.index(METRICS[rule.column])
+
+  def has_anomaly_rules(self):
+    return any(self.anomalies)
+
+  def has_stateful_rules(self, ip_addr):
+    host = self.host_index.get(ip_addr)
+    return host is not None and bool(self.stateful[host])
+
+  def evaluate(self, stats, baselines=None):
+    """Evaluate the plain rules (and the anomaly rules) against a batch of stats.
+
+    Args:
+      stats: list of storage.MachineStats namedtuple, of any machines.
+      baselines: baselines.Baselines instance, the anomaly rules are only evaluated if set.
+
+    Returns:
+      Violations instance.
+    """
+    hosts = numpy.array([self.host_index.get(s.ip_addr, len(self.alerts)) for s in stats],
+                        dtype=numpy.intp)
+    # Invalid (None) values are nan, which never reach a threshold.
+    values = numpy.array([[s.cpu_usage, s.mem_usage, s.uptime] for s in stats],
+                         dtype=float).reshape(len(stats), len(METRICS))
+    rule_values = values[numpy.arange(len(stats))[:, None], self.columns[hosts]]
+    thresholds = self.thresholds[hosts]
+    operators = self.operators[hosts]
+    exceeded = numpy.zeros(rule_values.shape, dtype=bool)
+    with numpy.errstate(invalid='ignore'):
+      for code, (_, _, ufunc) in enumerate(OPERATORS):
+        exceeded |= (operators == code) & ufunc(rule_values, thresholds)
+    # Padding slots can't be reached, whatever their value (inf for eg.)
+    exceeded &= numpy.isfinite(thresholds)
+    anomalies = None
+    if baselines is not None and self.has_anomaly_rules():
+      anomalies = self._evaluate_anomalies(hosts, values, *baselines.evaluate(stats))
+    return Violations(self, hosts, rule_values, exceeded, anomalies)
+
+  def _evaluate_anomalies(self, hosts, values, expected, std):
+    """Return (bounds, values, anomalous) matrices (rows x anomaly slots): the bound of the
+    baseline reached by the value, the value and whether it deviates beyond its rule."""
+    rows = numpy.arange(len(hosts))[:, None]
+    columns = self.anomaly_columns[hosts]
+    sigmas = self.sigmas[hosts]
+    directions = self.directions[hosts]
+    metric_columns = numpy.array([METRICS.index(m) for m in ANOMALY_METRICS],
+                                 dtype=numpy.intp)[columns]
+    rule_values = values[rows, metric_columns]
+    # Samples without (warmed up) baseline have a nan deviation, which never reaches sigma.
+    deviations = (rule_values - expected[rows, columns]) / std[rows, columns]
+    with numpy.errstate(invalid='ignore'):
+      anomalous = (((directions >= 0) & (deviations >= sigmas)) |
+                   ((directions <= 0) & (deviations <= -sigmas)))
+    anomalous &= numpy.isfinite(sigmas)
+    signs = numpy.where(deviations < 0, -1.0, 1.0)
+    bounds = expected[rows, columns] + signs * sigmas * std[rows, columns]
+    return bounds, rule_values, anomalous
+
+  def advance(self, state, stat):
+    """Update the state of the stateful rules of the machine of stat with stat.
+
+    Samples of a machine have to be passed in order, each costs O(number of rules).
+
+    Args:
+      state: HostState instance of the machine.
+      stat: storage.MachineStats namedtuple.
+
+    Returns:
+      list of Violation, the alerts raised by stat.
+    """
+    host = self.host_index.get(stat.ip_addr)
+    if host is None:
+      return []
+    sample_time = get_sample_time(stat)
+    values = [to_float(getattr(stat, metric)) for metric in METRICS]
+    raised = []
+    for rule in self.stateful[host]:
+      value = values[rule.column]
+      if rule.rate:
+        value = state.get_rate(METRICS[rule.column], value, sample_time)
+      if value is None:
+        continue
+      compare = OPERATORS[OPERATOR_CODES[rule.op]][1]
+      rule_state = state.get_rule(get_rule_key(rule))
+      streak, since, firing = rule_state
+      if firing:
+        if not compare(value, rule.clear):
+          streak, since, firing = 0, None, False
+      elif compare(value, rule.limit):
+        streak += 1
+        since = sample_time if since is None else since
+        if streak >= rule.for_samples and (
+            not rule.for_minutes or
+            (since is not None and sample_time - since >= rule.for_minutes * 60)):
+          firing = True
+          raised.append(Violation(type=rule.type, limit=rule.limit, value=value))
+      else:
+        streak, since = 0, None
+      rule_state[:] = [streak, since, firing]
+    for metric, value in zip(METRICS, values):
+      if value is not None and sample_time is not None:
+        state.set_value(metric, value, sample_time)
+    return raised
+
+
+class Violations(object):
+  """Result of CompiledRules.evaluate, the plain rules reached by each row of the batch."""
+
+  def __init__(self, rules, hosts, rule_values, exceeded, anomalies=None):
+    self.rules = rules
+    self.hosts = hosts
+    self.rule_values = rule_values
+    self.exceeded = exceeded
+    reached = exceeded.any(axis=1)
+    # (bounds, values, anomalous) matrices of the anomaly rules, see CompiledRules.evaluate.
+    self.anomalies = anomalies
+    if anomalies is not None:
+      reached |= anomalies[2].any(axis=1)
+    self.rows = numpy.flatnonzero(reached)
+
+  def get_rows(self, start=0, end=None):
+    """Return the indexes (ascending) of the rows of [start, end) which reached a rule."""
+    end = len(self.hosts) if end is None else end
+    return self.rows[numpy.searchsorted(self.rows, start):numpy.searchsorted(self.rows, end)]
+
+  def get(self, row):
+    """Return the list of Violation of row, in the order of the machine alerts."""
+    known = self.hosts[row] < len(self.rules.alerts)
+    alerts = self.rules.alerts[self.hosts[row]] if known else []
+    violations = [Violation(type=alerts[slot].type, limit=alerts[slot].limit,
+                            value=float(self.rule_values[row, slot]))
+                  for slot in numpy.flatnonzero(self.exceeded[row])]
+    if self.anomalies is not None and known:
+      # The limit of an anomaly is the bound of the baseline of the machine it went past.
+      bounds, values, anomalous = self.anomalies
+      anomalies = self.rules.anomalies[self.hosts[row]]
+      violations.extend(Violation(type=anomalies[slot].type,
+                                  limit=round(float(bounds[row, slot]), 2),
+                                  value=float(values[row, slot]))
+                        for slot in numpy.flatnonzero(anomalous[row]))
+    return violations
+
+
+class HostState(object):
+  """State of the stateful rules of a machine.
+
+  The state has the format: {'values': {metric: [value, time]},
+                             'rules': {rule key: [streak, streak start time, raised]}}
+  """
+
+  def __init__(self, state=None):
+    self.state = state if state is not None else {'values': {}, 'rules': {}}
+
+  def get_rule(self, key):
+    return self.state['rules'].setdefault(key, [0, None, False])
+
+  def get_rate(self, metric, value, sample_time):
+    """Return the change per minute of metric since its previous value, None if unknown."""
+    previous = self.state['values'].get(metric)
+    if value is None or previous is None or sample_time is None or sample_time <= previous[1]:
+      return None
+    return (value - previous[0]) * 60 / (sample_time - previous[1])
+
+  def set_value(self, metric, value, sample_time):
+    self.state['values'][metric] = [value, sample_time]
+
+  def snapshot(self):
+    return (dict((k, list(v)) for k, v in self.state['values'].items()),
+            dict((k, list(v)) for k, v in self.state['rules'].items()))
+
+  def restore(self, snapshot):
+    self.state['values'], self.state['rules'] = snapshot
+
+
+class RuleStateStore(object):
+  """Per machine HostState, persisted as a json file."""
+
+  def __init__(self, state_file=DEFAULT_STATE_FILE, logger=None):
+    self.state_file = state_file
+    self.logger = logger or logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    self._states = {}
+    self._hosts = {}
+    if state_file and os.path.exists(state_file):
+      try:
+        with open(state_file) as f:
+          self._states = json.load(f)
+      except (IOError, ValueError) as e:
+        self.logger.warn('Ignoring unreadable alert state %s: %s', state_file, e)
+
+  def get(self, ip_addr):
+    """Return the HostState of ip_addr, changes to it are persisted by the next save()."""
+    with self._lock:
+      if ip_addr not in self._hosts:
+        self._hosts[ip_addr] = HostState(self._states.setdefault(ip_addr, {'values': {},
+                                                                           'rules': {}}))
+      return self._hosts[ip_addr]
+
+  def save(self):
+    with self._lock:
+      if not self.state_file or not self._hosts:
+        return
+      tmp_file = self.state_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(self._states, f, sort_keys=True)
+      os.replace(tmp_file, self.state_file)
@@ -0,0 +1,130 @@
+"""Split the machines of the fleet between several collector (or alerter) nodes.
+
+Each node holds a lease in the node_leases table, renewed on every cycle. Machines are assigned to
+the live nodes (whose lease didn't expire) by consistent hashing, so a node joining or leaving only
+moves its share of the fleet: when a node stops renewing its lease, its machines are spread over
+the remaining nodes once the lease expired.
+
+The assignment alone isn't enough while nodes don't agree on the live nodes yet (a node joined
+since the last cycle of another one). A node only works on the machines it holds a lease on in the
+host_leases table: a machine is claimed once the lease of its previous owner expired or was
+released, so it's never collected (or alerted) by two nodes at the same time.
+
+Leases have to outlive a cycle of the node (the interval of a collector daemon, the period of a
+cron run) and a collection, which takes up to the host deadline: a lease expiring while the node
+collects a machine would let another node claim it. The default ttl covers a collector daemon
+with the default interval and host deadline.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import socket
+
+from lib import config
+
+
+COLLECTOR = 'collector'
+ALERTER = 'alerter'
+# Number of seconds a lease is valid for, renewed on every cycle.
+DEFAULT_LEASE_TTL = 2 * (config.DEFAULT_HOST_DEADLINE + config.DEFAULT_INTERVAL)
+# Points of each node on the ring, the more the evener the split.
+DEFAULT_REPLICAS = 64
+
+
+def get_default_node_id():
+  """Return an id unique to this process: hostname and pid."""
+  return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def get_node_path(path, node_id):
+  """Return path with node_id inserted before its extension, path itself if node_id isn't set.
+
+  Nodes run from the same directory mustn't overwrite (or retry) the files of each other.
+  """
+  if not path or not node_id:
+    return path
+  root, ext = os.path.splitext(path)
+  return '%s.%s%s' % (root, node_id, ext)
+
+
+def get_hash(key):
+  return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+  """Consistent hashing of keys (ip addresses) over a set of nodes."""
+
+  def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+    self.nodes = sorted(set(nodes))
+    points = sorted((get_hash('%s#%d' % (node, i)), node)
+                    for node in self.nodes for i in range(replicas))
+    self._hashes = [h for h, _ in points]
+    self._nodes = [node for _, node in points]
+
+  def get_node(self, key):
+    """Return the node owning key, None if the ring is empty."""
+    if not self._nodes:
+      return None
+    i = bisect.bisect(self._hashes, get_hash(key)) % len(self._hashes)
+    return self._nodes[i]
+
+
+class Shard(object):
+  """Machines of the fleet a node works on, among the live nodes of its role."""
+
+  def __init__(self, db, role, node_id=None, ttl=DEFAULT_LEASE_TTL, replicas=DEFAULT_REPLICAS,
+               logger=None):
+    """Create a Shard, the node only joins on the first assign().
+
+    Args:
+      db: storage.Storage instance.
+      role: str, COLLECTOR or ALERTER, nodes of different roles don't share their machines.
+      node_id: str, unique name of the node, see get_default_node_id() if None.
+      ttl: int, number of seconds the leases of the node are valid for.
+      replicas: int, points of each node on the hash ring.
+    """
+    self.db = db
+    self.role = role
+    self.node_id = node_id or get_default_node_id()
+    self.ttl = ttl
+    self.replicas = replicas
+    self.logger = logger or logging.getLogger(__name__)
+    self.nodes = []
+
+  def assign(self, machines):
+    """Renew the leases of the node and return the machines it works on until the next call.
+
+    Args:
+      machines: list of config.Client namedtuple, the whole fleet.
+
+    Returns:
+      list of config.Client namedtuple, in the order of machines.
+
+    Raises:
+      storage.StorageError: if the leases couldn't be renewed, the node shouldn't work on any
+        machine then.
+    """
+    nodes = self.db.heartbeat_node(self.role, self.node_id, self.ttl)
+    if self.node_id not in nodes:
+      nodes.append(self.node_id)
+    if sorted(nodes) != self.nodes:
+      self.logger.info('%s nodes changed, rebalancing over: %s', self.role, ', '.join(nodes))
+      self.nodes = sorted(nodes)
+    ring = HashRing(self.nodes, self.replicas)
+    assigned = [m for m in machines if ring.get_node(m.ip) == self.node_id]
+    # Machines moved to another node are released right away rather than when their lease expires.
+    self.db.release_hosts(self.role, self.node_id, keep=[m.ip for m in assigned])
+    claimed = set(self.db.claim_hosts(self.role, self.node_id, [m.ip for m in assigned],
+                                      self.ttl))
+    if len(claimed) < len(assigned):
+      self.logger.info('%d machines are still leased by other nodes.',
+                       len(assigned) - len(claimed))
+    return [m for m in assigned if m.ip in claimed]
+
+  def leave(self):
+    """Drop the leases of the node so its machines are taken over by the next cycle of the others.
+    """
+    self.db.leave_node(self.role, self.node_id)
+    self.nodes = []
@@ -0,0 +1,118 @@
+"""Mergeable quantile sketch with a bounded memory footprint, stored along with the stats rollups.
+
+Values are counted in logarithmic buckets: bucket i holds the values in (gamma^(i-1), gamma^i],
+gamma being derived from the relative accuracy, so any quantile is estimated within that relative
+error. Sketches of the same accuracy merge by adding their bucket counts, the hourly sketch of a
+machine is the merge of its minute sketches for eg. When there are more than max_buckets buckets
+the lowest ones are collapsed together, which only degrades the accuracy of the lowest quantiles.
+
+Values are expected to be positive (percentages, seconds): values lower than MIN_VALUE (0
+included) are counted as 0.
+"""
+
+import math
+import struct
+
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 512
+MIN_VALUE = 1e-6
+SKETCH_VERSION = 1
+# version, relative_accuracy, zero_count, number of buckets
+HEADER = struct.Struct('<BdII')
+BUCKET = struct.Struct('<iI')
+
+
+class SketchError(Exception):
+  """Exception raised when sketches can't be decoded or merged."""
+
+  def __init__(self, msg):
+    super(SketchError, self).__init__(msg)
+    self.msg = msg
+
+
+class QuantileSketch(object):
+  """Estimate quantiles of a stream of values within a relative accuracy."""
+
+  def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_buckets=DEFAULT_MAX_BUCKETS):
+    self.relative_accuracy = relative_accuracy
+    self.max_buckets = max_buckets
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self._log_gamma = math.log(self.gamma)
+    self.buckets = {}
+    self.zero_count = 0
+    self.count = 0
+
+  def add(self, value, count=1):
+    if value < MIN_VALUE:
+      self.zero_count += count
+    else:
+      index = int(math.ceil(math.log(value) / self._log_gamma))
+      self.buckets[index] = self.buckets.get(index, 0) + count
+      if len(self.buckets) > self.max_buckets:
+        self._collapse()
+    self.count += count
+
+  def merge(self, other):
+    """Add the values counted by other (a sketch of the same accuracy) to this sketch."""
+    if other.relative_accuracy != self.relative_accuracy:
+      raise SketchError('Sketches of different accuracies can\'t be merged: %s != %s' % (
+          self.relative_accuracy, other.relative_accuracy))
+    for index, count in other.buckets.items():
+      self.buckets[index] = self.buckets.get(index, 0) + count
+    self.zero_count += other.zero_count
+    self.count += other.count
+    if len(self.buckets) > self.max_buckets:
+      self._collapse()
+    return self
+
+  def quantile(self, q):
+    """Return the estimated q-quantile (0 <= q <= 1), None if the sketch is empty."""
+    if not self.count:
+      return None
+    rank = q * (self.count - 1)
+    seen = self.zero_count
+    if rank < seen:
+      return 0.0
+    for index in sorted(self.buckets):
+      seen += self.buckets[index]
+      if rank < seen:
+        # Middle of the bucket (in relative terms), within relative_accuracy of any of its values
+        return 2 * self.gamma ** index / (self.gamma + 1)
+    return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+  def _collapse(self):
+    indexes = sorted(self.buckets)
+    excess = len(indexes) - self.max_buckets
+    target = indexes[excess]
+    for index in indexes[:excess]:
+      self.buckets[target] += self.buckets.pop(index)
+
+  def to_bytes(self):
+    parts = [HEADER.pack(SKETCH_VERSION, self.relative_accuracy, self.zero_count,
+                         len(self.buckets))]
+    parts.extend(BUCKET.pack(index, count) for index, count in sorted(self.buckets.items()))
+    return b''.join(parts)
+
+  @classmethod
+  def from_bytes(cls, data, max_buckets=DEFAULT_MAX_BUCKETS):
+    """Decode a sketch serialized by to_bytes().
+
+    Raises:
+      SketchError: if data isn't a valid sketch.
+    """
+    if len(data) < HEADER.size:
+      raise SketchError('Truncated sketch header')
+    version, relative_accuracy, zero_count, size = HEADER.unpack_from(data)
+    if version != SKETCH_VERSION:
+      raise SketchError('Unsupported sketch version: %d' % version)
+    if len(data) != HEADER.size + size * BUCKET.size:
+      raise SketchError('Invalid sketch size: %d bytes for %d buckets' % (len(data), size))
+    sketch = cls(relative_accuracy, max_buckets)
+    sketch.zero_count = zero_count
+    sketch.count = zero_count
+    for offset in range(HEADER.size, len(data), BUCKET.size):
+      index, count = BUCKET.unpack_from(data, offset)
+      sketch.buckets[index] = count
+      sketch.count += count
+    return sketch
@@ -0,0 +1,302 @@
+"""Storage on an embedded SQLite database, for single node deployments and tests.
+
+SQLiteStorage is a storage.Storage whose queries run on a local SQLite file (in WAL mode, so
+readers don't block the writer) instead of a MySQL server. The tables are those of
+crossover_db.sql (collected_stats at schema version 2, rollups, watermarks and leases), created
+when the file is opened. Queries are those of Storage, only the MySQL specific ones (upserts, row
+locks, server time) are rewritten for SQLite, and the %s placeholders are translated by SQLiteDB.
+
+Writes are serialized by SQLite: transactions take the write lock upfront (BEGIN IMMEDIATE) and
+wait for it up to DEFAULT_BUSY_TIMEOUT seconds, several processes can share the same file.
+"""
+
+import contextlib
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+
+from lib import config
+from lib import storage
+
+
+# Number of seconds a query waits for the lock held by another connection.
+DEFAULT_BUSY_TIMEOUT = 30
+
+# Tables of crossover_db.sql, using the SQLite types.
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS collected_stats (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ip_addr VARCHAR(45) NOT NULL,
+      os VARCHAR(45) DEFAULT NULL,
+      cpu_usage REAL DEFAULT NULL,
+      mem_usage REAL DEFAULT NULL,
+      uptime REAL DEFAULT NULL,
+      event_logs TEXT,
+      sampled_at DATETIME DEFAULT NULL,
+      collection_date DATETIME NOT NULL,
+      extra_metrics TEXT)''',
+    'CREATE INDEX IF NOT EXISTS idx_ip_addr_id ON collected_stats(ip_addr, id)',
+    'CREATE INDEX IF NOT EXISTS idx_ip_addr_date ON collected_stats(ip_addr, collection_date)',
+    '''CREATE TABLE IF NOT EXISTS alert_watermarks (
+      ip_addr VARCHAR(45) NOT NULL PRIMARY KEY,
+      last_id INTEGER NOT NULL DEFAULT 0,
+      updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)''',
+) + tuple(
+    '''CREATE TABLE IF NOT EXISTS %s (
+      ip_addr VARCHAR(45) NOT NULL,
+      metric VARCHAR(16) NOT NULL,
+      bucket_start DATETIME NOT NULL,
+      count INTEGER NOT NULL,
+      min_value REAL NOT NULL,
+      max_value REAL NOT NULL,
+      sum_value REAL NOT NULL,
+      sketch BLOB NOT NULL,
+      PRIMARY KEY (ip_addr, metric, bucket_start))''' % table
+    for table in ('stats_rollup_minute', 'stats_rollup_hour', 'stats_rollup_day')) + (
+    '''CREATE TABLE IF NOT EXISTS node_leases (
+      role VARCHAR(16) NOT NULL,
+      node_id VARCHAR(64) NOT NULL,
+      expires_at DATETIME NOT NULL,
+      PRIMARY KEY (role, node_id))''',
+    '''CREATE TABLE IF NOT EXISTS host_leases (
+      role VARCHAR(16) NOT NULL,
+      ip_addr VARCHAR(45) NOT NULL,
+      owner VARCHAR(64) NOT NULL,
+      expires_at DATETIME NOT NULL,
+      PRIMARY KEY (role, ip_addr))''',
+    'CREATE INDEX IF NOT EXISTS idx_owner ON host_leases(role, owner)',
+    '''CREATE TABLE IF NOT EXISTS schema_version (
+      version INTEGER NOT NULL PRIMARY KEY,
+      applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)''',
+)
+# Columns added to the tables since the first layout, added to older databases when opened.
+ADDED_COLUMNS = (('collected_stats', 'extra_metrics', 'TEXT'),)
+
+
+def adapt_datetime(value):
+  return value.isoformat(' ')
+
+
+def convert_datetime(value):
+  value = value.decode()
+  return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else
+                                    '%Y-%m-%d %H:%M:%S')
+
+
+# DATETIME columns are stored as 'YYYY-MM-DD HH:MM:SS' strings (ordered like the dates) and read
+# back as datetime.datetime.
+sqlite3.register_adapter(datetime.datetime, adapt_datetime)
+sqlite3.register_converter('DATETIME', convert_datetime)
+
+
+class Cursor(object):
+  """sqlite3 cursor running the queries of Storage (with %s placeholders)."""
+
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  @classmethod
+  def Translate(cls, query):
+    return query.replace('%s', '?')
+
+  def execute(self, query, params=None):
+    self.cursor.execute(self.Translate(query), tuple(params or ()))
+
+  def executemany(self, query, rows):
+    self.cursor.executemany(self.Translate(query), rows)
+
+  def fetchall(self):
+    return self.cursor.fetchall()
+
+  def fetchone(self):
+    return self.cursor.fetchone()
+
+  @property
+  def lastrowid(self):
+    return self.cursor.lastrowid
+
+  @property
+  def rowcount(self):
+    return self.cursor.rowcount
+
+
+class SQLiteDB(storage.DB):
+  """storage.DB running its queries on a SQLite file."""
+
+  def __init__(self, path=config.DEFAULT_SQLITE_FILE, logger=None, pool_size=1,
+               timeout=DEFAULT_BUSY_TIMEOUT):
+    """Create a SQLiteDB instance.
+
+    Note: no connection is made until the first query.
+
+    Args:
+      path: str, path of the database file, created if missing.
+      pool_size: int, maximum number of connections used at the same time.
+      timeout: float, number of seconds a query waits for the lock of another connection.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+    self.path = path
+    self.timeout = timeout
+    self._slots = threading.BoundedSemaphore(pool_size)
+    self._idle = queue.Queue()
+    self._closed = False
+
+  def _Connect(self):
+    try:
+      connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+      connection.execute('PRAGMA journal_mode=WAL')
+      # Durable enough in WAL mode: a power loss can only lose the last transactions.
+      connection.execute('PRAGMA synchronous=NORMAL')
+      return connection
+    except sqlite3.Error as e:
+      raise storage.StorageUnavailableError('Error while opening %s: %s' % (self.path, e))
+
+  def _Acquire(self):
+    self._slots.acquire()
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    try:
+      return self._Connect()
+    except Exception:
+      self._slots.release()
+      raise
+
+  def _Release(self, connection, discard=False):
+    try:
+      if discard or self._closed:
+        connection.close()
+      else:
+        self._idle.put(connection)
+    finally:
+      self._slots.release()
+
+  def Close(self):
+    self._closed = True
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+  def ExecuteQuery(self, query, return_type='lastrowid', params=None, raise_errors=False):
+    """See storage.DB.ExecuteQuery."""
+    connection = self._Acquire()
+    try:
+      cursor = Cursor(connection.cursor())
+      self.logger.debug('query to be executed: %s', query)
+      cursor.execute(query, params)
+      return self._GetResults(cursor, return_type)
+    except sqlite3.Error as e:
+      self.logger.error('issue found with query: %s', query)
+      if raise_errors:
+        raise storage.StorageError('Query failed: %s' % e)
+    finally:
+      self._Release(connection)
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    """See storage.DB.Transaction, the write lock is taken when the transaction starts."""
+    connection = self._Acquire()
+    discard = False
+    try:
+      try:
+        connection.execute('BEGIN IMMEDIATE')
+      except sqlite3.Error as e:
+        raise storage.StorageError('Transaction couldn\'t start: %s' % e)
+      try:
+        yield Cursor(connection.cursor())
+        connection.execute('COMMIT')
+      except sqlite3.Error as e:
+        self.logger.error('issue found with transaction: %s', e)
+        discard = self._Rollback(connection)
+        raise storage.StorageError('Transaction failed: %s' % e)
+      except Exception:
+        discard = self._Rollback(connection)
+        raise
+    finally:
+      self._Release(connection, discard)
+
+  def ExecuteMany(self, query, rows):
+    """See storage.DB.ExecuteMany."""
+    with self.Transaction() as cursor:
+      self.logger.debug('query to be executed for %d rows: %s', len(rows), query)
+      cursor.executemany(query, rows)
+      return cursor.rowcount
+
+  def _Rollback(self, connection):
+    try:
+      connection.execute('ROLLBACK')
+      return False
+    except sqlite3.Error:
+      return True
+
+  def CreateSchema(self):
+    """Create the missing tables, a new database is at the current schema version."""
+    with self.Transaction() as cursor:
+      for statement in SCHEMA:
+        cursor.execute(statement)
+      for table, column, column_type in ADDED_COLUMNS:
+        cursor.execute('PRAGMA table_info(%s)' % table)
+        if column not in [row[1] for row in cursor.fetchall()]:
+          cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+      cursor.execute('INSERT OR IGNORE INTO schema_version(version) VALUES (%s)',
+                     (storage.SCHEMA_VERSION,))
+
+
+class SQLiteStorage(storage.Storage):
+  """storage.Storage on a SQLite file."""
+
+  advance_watermark_qry = '''INSERT INTO alert_watermarks(ip_addr, last_id) VALUES (%s, %s)
+    ON CONFLICT(ip_addr) DO UPDATE SET last_id = MAX(last_id, excluded.last_id),
+    updated_at = CURRENT_TIMESTAMP'''
+  # Writers are serialized by the transaction, rows don't need to be locked. SQLite only accepts a
+  # subquery on the right hand side of a row value IN.
+  lock_rollups_qry = '''SELECT ip_addr, metric, bucket_start, count, min_value, max_value,
+    sum_value, sketch FROM %s WHERE (ip_addr, metric, bucket_start) IN (VALUES %s)'''
+  upsert_rollup_qry = '''INSERT INTO %s(ip_addr, metric, bucket_start, count, min_value, max_value,
+    sum_value, sketch) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+    ON CONFLICT(ip_addr, metric, bucket_start) DO UPDATE SET count = excluded.count,
+    min_value = excluded.min_value, max_value = excluded.max_value,
+    sum_value = excluded.sum_value, sketch = excluded.sketch'''
+  heartbeat_node_qry = '''INSERT INTO node_leases(role, node_id, expires_at)
+    VALUES (%s, %s, DATETIME('now', '+' || %s || ' seconds'))
+    ON CONFLICT(role, node_id) DO UPDATE SET expires_at = excluded.expires_at'''
+  get_live_nodes_qry = '''SELECT node_id FROM node_leases
+    WHERE role = %s AND expires_at > DATETIME('now') ORDER BY node_id'''
+  create_host_leases_qry = '''INSERT OR IGNORE INTO host_leases(role, ip_addr, owner, expires_at)
+    VALUES (%s, %s, '', '1970-01-01 00:00:00')'''
+  claim_hosts_qry = '''UPDATE host_leases SET owner = %%s,
+    expires_at = DATETIME('now', '+' || %%s || ' seconds')
+    WHERE role = %%s AND ip_addr IN (%s) AND (owner = %%s OR expires_at <= DATETIME('now'))'''
+  get_owned_hosts_qry = '''SELECT ip_addr FROM host_leases
+    WHERE role = %s AND owner = %s AND expires_at > DATETIME('now') ORDER BY ip_addr'''
+  release_hosts_qry = '''UPDATE host_leases
+    SET owner = '', expires_at = DATETIME('now', '-1 seconds')
+    WHERE role = %%s AND owner = %%s AND ip_addr IN (%s)'''
+
+  def __init__(self, path=config.DEFAULT_SQLITE_FILE, pool_size=1,
+               max_batch=storage.Storage.DEFAULT_MAX_BATCH,
+               max_delay=storage.Storage.DEFAULT_MAX_DELAY, rollups=True):
+    """Open (creating it if needed) the SQLite database of path.
+
+    Args:
+      path: str, path of the database file.
+      pool_size: int, maximum number of connections used at the same time.
+      max_batch: int, number of buffered stats which triggers a flush.
+      max_delay: float, number of seconds after which buffered stats are flushed.
+      rollups: bool, update the minute/hour/day rollups of the stored stats.
+
+    Raises:
+      StorageUnavailableError: if the database can't be opened.
+      StorageError: if its tables can't be created.
+    """
+    logger = logging.getLogger(storage.__name__)
+    super(SQLiteStorage, self).__init__(
+        '', '', max_batch=max_batch, max_delay=max_delay, rollups=rollups,
+        db=SQLiteDB(path, logger=logger, pool_size=pool_size))
+    self.db.CreateSchema()
@@ -0,0 +1,131 @@
+"""Pool of authenticated ssh connections reused by the collector across polling cycles.
+"""
+
+import logging
+import threading
+import time
+
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class PooledConnection(object):
+  """Authenticated ssh client of a single machine along with its lazily opened sftp session."""
+
+  def __init__(self, machine, ssh_client):
+    self.machine = machine
+    self.ssh_client = ssh_client
+    self.last_used = time.time()
+    self.lock = threading.Lock()
+    self._sftp = None
+
+  def is_active(self):
+    transport = self.ssh_client.get_transport()
+    return transport is not None and transport.is_active()
+
+  def get_sftp(self):
+    """Return the sftp session of the connection, opening it on first use."""
+    if self._sftp is None:
+      self._sftp = self.ssh_client.open_sftp()
+    return self._sftp
+
+  def close(self):
+    try:
+      if self._sftp is not None:
+        self._sftp.close()
+    finally:
+      self._sftp = None
+      self.ssh_client.close()
+
+
+class SSHConnectionPool(object):
+  """Keep one authenticated connection per machine, keyed by its ip address.
+
+  Connections are opened lazily the first time a machine is acquired, transparently re-opened
+  when their transport died and closed once they haven't been used for idle_timeout seconds.
+  """
+
+  def __init__(self, connect, idle_timeout=DEFAULT_IDLE_TIMEOUT, logger=None):
+    """Create an empty pool.
+
+    Args:
+      connect: callable taking (machine, deadline) and returning a connected paramiko.SSHClient.
+      idle_timeout: float, number of seconds after which an unused connection is closed.
+      logger: logging.Logger instance.
+    """
+    self.connect = connect
+    self.idle_timeout = idle_timeout
+    self.logger = logger or logging.getLogger(__name__)
+    self._connections = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._connections)
+
+  def acquire(self, machine, deadline=None):
+    """Return an active connection to machine, connecting (again) if needed.
+
+    The returned connection is locked and has to be handed back with release().
+
+    Args:
+      machine: config.Client namedtuple, machine to connect to.
+      deadline: float, epoch time after which no more time should be spent on machine.
+
+    Returns:
+      tuple (PooledConnection, reused) where reused is True if no new connection was made.
+    """
+    with self._lock:
+      connection = self._connections.get(machine.ip)
+    if connection is not None:
+      connection.lock.acquire()
+      if connection.is_active() and connection.machine == machine:
+        return connection, True
+      # Either the transport died or the machine credentials changed in the config.
+      connection.lock.release()
+      self.discard(machine)
+
+    connection = PooledConnection(machine, self.connect(machine, deadline))
+    connection.lock.acquire()
+    with self._lock:
+      self._connections[machine.ip] = connection
+    return connection, False
+
+  def release(self, connection):
+    connection.last_used = time.time()
+    connection.lock.release()
+
+  def discard(self, machine):
+    """Close and forget the connection of machine, next acquire() will reconnect."""
+    with self._lock:
+      connection = self._connections.pop(machine.ip, None)
+    if connection is not None:
+      self._close(connection)
+
+  def evict_idle(self, now=None):
+    """Close connections which weren't used for more than idle_timeout seconds.
+
+    Returns:
+      list of str, ip addresses whose connection was evicted.
+    """
+    now = now or time.time()
+    with self._lock:
+      idle_ips = [ip for ip, c in self._connections.items()
+                  if now - c.last_used > self.idle_timeout and not c.lock.locked()]
+      evicted = [self._connections.pop(ip) for ip in idle_ips]
+    for connection in evicted:
+      self.logger.info('Closing idle ssh connection to %s.', connection.machine.ip)
+      self._close(connection)
+    return idle_ips
+
+  def close_all(self):
+    with self._lock:
+      connections = list(self._connections.values())
+      self._connections.clear()
+    for connection in connections:
+      self._close(connection)
+
+  def _close(self, connection):
+    try:
+      connection.close()
+    except Exception as e:
+      self.logger.warn('Error while closing ssh connection to %s: %s', connection.machine.ip, e)
@@ -1,11 +1,49 @@
 """Storage layout used by server_collector to store stats of machines into the DB.
 """
 
+import contextlib
+import datetime
 import logging
+import queue
+import threading
+import time
 import pymysql
 from collections import namedtuple
 
-MachineStats = namedtuple('MachineStats', 'id ip_addr cpu_usage mem_usage uptime event_logs collection_date')
+from lib import config
+from lib import metrics
+from lib import rollup
+
+# cpu_usage, mem_usage (percentages) and uptime (seconds) are floats, None when the client
+# reported an invalid value. sampled_at is the time of the measure on the client, collection_date
+# the time it was stored.
+MachineStats = namedtuple('MachineStats',
+                          'id ip_addr cpu_usage mem_usage uptime event_logs collection_date '
+                          'sampled_at')
+MachineStats.__new__.__defaults__ = (None,)
+
+# Version of the collected_stats layout read and written by Storage, see migrate.py.
+SCHEMA_VERSION = 2
+
+# Storage backends, see open_storage().
+MYSQL = 'mysql'
+SQLITE = 'sqlite'
+BACKENDS = (MYSQL, SQLITE)
+
+
+def parse_extra_metrics(extra_metrics):
+  """Return the extra metrics of a record as {key: str}.
+
+  Args:
+    extra_metrics: str, has the format key=value;key=value (see client_script/local_collector.py),
+      None for the records of older clients.
+  """
+  values = {}
+  for item in (extra_metrics or '').split(';'):
+    key, _, value = item.partition('=')
+    if key:
+      values[key] = value
+  return values
 
 
 class StorageError(Exception):
@@ -23,39 +61,129 @@ class LogStatsError(StorageError):
     super(LogStatsError, self).__init__('Error detected with email query: %s' %
                                         self.query)
 
+class StorageUnavailableError(StorageError):
+  """Exception raised when no connection to the DB can be established."""
+
+
+def open_storage(backend=MYSQL, username='', password='', sqlite_file=None, **kwargs):
+  """Return the Storage of a backend.
+
+  Args:
+    backend: str, one of BACKENDS: a MySQL server or an embedded SQLite file.
+    username: str, DB username (MySQL).
+    password: str, DB password (MySQL).
+    sqlite_file: str, path of the database file (SQLite), config.DEFAULT_SQLITE_FILE if None.
+    kwargs: other arguments of the Storage constructor (pool_size, max_batch...).
+
+  Raises:
+    StorageError: if backend is unknown, or its database can't be opened (SQLite).
+  """
+  if backend == MYSQL:
+    return Storage(username, password, **kwargs)
+  if backend == SQLITE:
+    # Only imported when used, like the MySQL driver would ideally be.
+    from lib import sqlite_storage
+    return sqlite_storage.SQLiteStorage(sqlite_file or config.DEFAULT_SQLITE_FILE, **kwargs)
+  raise StorageError('Unknown storage backend: %s' % backend)
+
 
 class Storage(object):
   DEFAULT_DB_HOSTNAME = 'localhost'
   DEFAULT_DB_NAME = 'crossover_db'
-  insert_qry = '''INSERT INTO collected_stats(ip_addr, os, cpu_usage, mem_usage, uptime, event_logs)
-                  VALUES(%s)'''
-  not_treated_stats_qry = '''SELECT id, ip_addr, os, cpu_usage, mem_usage, uptime, event_logs
-    FROM collected_stats WHERE consulted_for_alerts != '0'  ORDER BY collection_date DESC;'''
-  get_machine_qry = '''SELECT id, ip_addr, cpu_usage, mem_usage, uptime, event_logs, collection_date
-    FROM collected_stats WHERE consulted_for_alerts = 0 and ip_addr = '%s';'''
-  mark_stat_as_treated_qry = '''UPDATE collected_stats SET consulted_for_alerts=1 WHERE id=%s;'''
-
-
-  def __init__(self, username, password, hostname=DEFAULT_DB_HOSTNAME, database=DEFAULT_DB_NAME):
+  # Buffered stats are flushed when either threshold is reached.
+  DEFAULT_MAX_BATCH = 500
+  DEFAULT_MAX_DELAY = 5
+  # Maximum number of buffered stats kept (for a later flush) while the DB is failing.
+  MAX_PENDING_BATCHES = 20
+  insert_qry = '''INSERT INTO collected_stats(ip_addr, os, cpu_usage, mem_usage, uptime, event_logs,
+                  sampled_at, collection_date, extra_metrics)
+                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)'''
+  get_watermarks_qry = '''SELECT ip_addr, last_id FROM alert_watermarks WHERE ip_addr IN (%s);'''
+  # One (ip_addr = %s AND id > %s) condition per machine, resolved as ranges of idx_ip_addr_id.
+  get_backlog_qry = '''SELECT id, ip_addr, cpu_usage, mem_usage, uptime, event_logs,
+    collection_date, sampled_at FROM collected_stats WHERE %s ORDER BY ip_addr, id;'''
+  advance_watermark_qry = '''INSERT INTO alert_watermarks(ip_addr, last_id) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE last_id = GREATEST(last_id, VALUES(last_id))'''
+  # Maximum number of machines per backlog query, keeps the query size bounded.
+  BACKLOG_CHUNK_SIZE = 500
+  # Rollup queries are formatted with the table of the resolution.
+  lock_rollups_qry = '''SELECT ip_addr, metric, bucket_start, count, min_value, max_value,
+    sum_value, sketch FROM %s WHERE (ip_addr, metric, bucket_start) IN (%s) FOR UPDATE'''
+  upsert_rollup_qry = '''INSERT INTO %s(ip_addr, metric, bucket_start, count, min_value, max_value,
+    sum_value, sketch) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+    ON DUPLICATE KEY UPDATE count = VALUES(count), min_value = VALUES(min_value),
+    max_value = VALUES(max_value), sum_value = VALUES(sum_value), sketch = VALUES(sketch)'''
+  get_rollups_qry = '''SELECT bucket_start, count, min_value, max_value, sum_value, sketch FROM %s
+    WHERE ip_addr = %%s AND metric = %%s AND bucket_start >= %%s AND bucket_start < %%s
+    ORDER BY bucket_start'''
+  # Formatted with the table of the resolution and the placeholders of the machines and metrics,
+  # resolved as ranges of the rollups primary key.
+  get_fleet_rollups_qry = '''SELECT ip_addr, metric, bucket_start, count, min_value, max_value,
+    sum_value, sketch FROM %s WHERE ip_addr IN (%s) AND metric IN (%s)
+    AND bucket_start >= %%s AND bucket_start < %%s ORDER BY ip_addr, metric, bucket_start'''
+  get_last_stored_id_qry = '''SELECT MAX(id) FROM collected_stats'''
+  get_stored_since_qry = '''SELECT ip_addr, MAX(id) FROM collected_stats WHERE id > %s
+    GROUP BY ip_addr'''
+  # Maximum number of rollup rows locked per query.
+  ROLLUP_CHUNK_SIZE = 500
+  # Leases of the nodes sharing the fleet (see sharding.py), times are those of the DB server so
+  # the clocks of the nodes don't matter.
+  heartbeat_node_qry = '''INSERT INTO node_leases(role, node_id, expires_at)
+    VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+    ON DUPLICATE KEY UPDATE expires_at = VALUES(expires_at)'''
+  get_live_nodes_qry = '''SELECT node_id FROM node_leases WHERE role = %s AND expires_at > NOW()
+    ORDER BY node_id'''
+  leave_node_qry = '''DELETE FROM node_leases WHERE role = %s AND node_id = %s'''
+  create_host_leases_qry = '''INSERT IGNORE INTO host_leases(role, ip_addr, owner, expires_at)
+    VALUES (%s, %s, '', '1970-01-01 00:00:00')'''
+  # A machine is claimed if its lease is already held by the node or expired.
+  claim_hosts_qry = '''UPDATE host_leases SET owner = %%s, expires_at = NOW() + INTERVAL %%s SECOND
+    WHERE role = %%s AND ip_addr IN (%s) AND (owner = %%s OR expires_at <= NOW())'''
+  get_owned_hosts_qry = '''SELECT ip_addr FROM host_leases
+    WHERE role = %s AND owner = %s AND expires_at > NOW() ORDER BY ip_addr FOR UPDATE'''
+  release_hosts_qry = '''UPDATE host_leases
+    SET owner = '', expires_at = NOW() - INTERVAL 1 SECOND
+    WHERE role = %%s AND owner = %%s AND ip_addr IN (%s)'''
+  # Maximum number of machines per lease query.
+  LEASE_CHUNK_SIZE = 500
+
+
+  def __init__(self, username, password, hostname=DEFAULT_DB_HOSTNAME, database=DEFAULT_DB_NAME,
+               pool=None, pool_size=1, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY,
+               rollups=True, db=None):
     """Contruct a Storage() instance and initiate a DB().
 
     Note: By defult a dev DB will be used unless database='prod' is passed to
     the contructor.
 
     Args:
-      cs_instance: CloudSql Instance.
       database: str, valid self.DB_DICT key. Examples: 'dev', 'prod'.
       username: DB username.
       password: DB password.
       hostname: str, host address of the DB. Used instead of CloudSql instance
         for tests purpose for eg.
-      port: int, port of the DB server. Used with host instead of CloudSql
-        instance for tests purpose for eg.
+      pool: ConnectionPool instance shared with other Storage instances, a private pool is used
+        if None.
+      pool_size: int, maximum number of connections of the private pool.
+      max_batch: int, number of buffered stats which triggers a flush.
+      max_delay: float, number of seconds after which buffered stats are flushed.
+      rollups: bool, update the minute/hour/day rollups of the stored stats.
+      db: DB instance running the queries (of another backend for eg.), a MySQL DB is used if
+        None.
     """
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
-    logger = logging.getLogger(__name__)
-
-    self.db = DB(database, username, password, hostname, logger)
+    self.logger = logging.getLogger(__name__)
+
+    self.db = db or DB(database, username, password, hostname, self.logger, pool=pool,
+                       pool_size=pool_size)
+    self.max_batch = max_batch
+    self.max_delay = max_delay
+    self.rollups = rollups
+    self._buffer = []
+    self._buffer_since = None
+    self._buffer_lock = threading.Lock()
+    # Callables notified of the ip addresses of the machines whose stats were stored.
+    self._flush_listeners = []
 
   @classmethod
   def WrapStr(cls, strings, quotechar='`'):
@@ -80,67 +208,563 @@ class Storage(object):
         values.append(('%c{0}%c' % (quotechar, quotechar)).format(s))
     return ', '.join(values)
 
-  def store_machine_stats(self, ip_addr, stats):
-    os, cpu_usage, mem_usage, uptime, event_logs = stats
-    query = self.insert_qry % (Storage.WrapStr([ip_addr, os, cpu_usage, mem_usage, uptime, event_logs], '\''))
-    record_id = self.db.ExecuteQuery(query, 'lastrowid')
-    if record_id is None:
-      self.logger.error('Machine stat hasn\'t been recorded correctly, query: %s', query)
-      raise LogStatsError(query)
-    else:
-      return record_id
+  @classmethod
+  def ToFloat(cls, value):
+    """Convert a reported metric to float, None if it isn't a valid number."""
+    if value is None:
+      return None
+    try:
+      value = float(value)
+    except (TypeError, ValueError):
+      return None
+    # nan and inf can't be stored in numeric columns
+    return value if value - value == 0 else None
+
+  @classmethod
+  def _GetInsertParams(cls, ip_addr, stats, sampled_at):
+    os, cpu_usage, mem_usage, uptime, event_logs = stats[:5]
+    extra_metrics = stats[5] if len(stats) > 5 else None
+    # Filled here rather than by the DB default so single and batched inserts share the query.
+    collection_date = datetime.datetime.now().replace(microsecond=0)
+    return (ip_addr, os, cls.ToFloat(cpu_usage), cls.ToFloat(mem_usage), cls.ToFloat(uptime),
+            event_logs, sampled_at.replace(microsecond=0) if sampled_at else None,
+            collection_date, extra_metrics or None)
+
+  @metrics.instrument('storage_store_machine_stats')
+  def store_machine_stats(self, ip_addr, stats, sampled_at=None):
+    """Store a single stats record of a machine.
+
+    Args:
+      ip_addr: str, ip address of the machine.
+      stats: list of str, following the format: os, cpu_usage, mem_usage, uptime, event_logs and
+        optionally extra_metrics (see parse_extra_metrics).
+      sampled_at: datetime.datetime, time at which the stats were sampled on the machine, None if
+        unknown.
+
+    Returns:
+      int, id of the inserted record.
+    """
+    params = self._GetInsertParams(ip_addr, stats, sampled_at)
+    try:
+      with self.db.Transaction() as cursor:
+        cursor.execute(self.insert_qry, params)
+        record_id = cursor.lastrowid
+        if self.rollups:
+          self._UpdateRollups(cursor, [params])
+    except StorageError:
+      self.logger.error('Machine stat hasn\'t been recorded correctly, query: %s', self.insert_qry)
+      raise LogStatsError(self.insert_qry)
+    self._NotifyStored([ip_addr])
+    return record_id
+
+  def buffer_machine_stats(self, ip_addr, stats, sampled_at=None, on_stored=None):
+    """Buffer a stats record of a machine, it's stored on the next flush.
+
+    The buffer is flushed as soon as it holds max_batch records or its oldest record was buffered
+    more than max_delay seconds ago.
+
+    Args:
+      ip_addr: str, ip address of the machine.
+      stats: list of str, following the format: os, cpu_usage, mem_usage, uptime, event_logs and
+        optionally extra_metrics (see parse_extra_metrics).
+      sampled_at: datetime.datetime, time at which the stats were sampled on the machine, None if
+        unknown.
+      on_stored: callable called without arguments once the record is stored. A failed flush
+        drops such records instead of keeping them buffered: the caller sends them again (the
+        samples of an agent are drained again).
+
+    Returns:
+      int, number of records stored by the flush this call triggered, 0 if none.
+    """
+    with self._buffer_lock:
+      self._buffer.append((self._GetInsertParams(ip_addr, stats, sampled_at), on_stored))
+      if self._buffer_since is None:
+        self._buffer_since = time.time()
+      due = (len(self._buffer) >= self.max_batch or
+             time.time() - self._buffer_since >= self.max_delay)
+    return self.flush() if due else 0
+
+  def pending_count(self):
+    with self._buffer_lock:
+      return len(self._buffer)
+
+  @metrics.instrument('storage_flush')
+  def flush(self):
+    """Store all the buffered records using multi-row inserts in a single transaction.
+
+    The rollups of the records are updated within the same transaction.
+
+    Returns:
+      int, number of stored records.
+
+    Raises:
+      LogStatsError: if the records couldn't be stored. They are kept buffered for the next
+        flush (up to MAX_PENDING_BATCHES * max_batch records), except those buffered with an
+        on_stored callback.
+    """
+    with self._buffer_lock:
+      entries, self._buffer = self._buffer, []
+      self._buffer_since = None
+    if not entries:
+      return 0
+    rows = [params for params, _ in entries]
+    try:
+      with self.db.Transaction() as cursor:
+        self.logger.debug('query to be executed for %d rows: %s', len(rows), self.insert_qry)
+        cursor.executemany(self.insert_qry, rows)
+        if self.rollups:
+          self._UpdateRollups(cursor, rows)
+    except StorageError:
+      with self._buffer_lock:
+        self._buffer = [entry for entry in entries if entry[1] is None] + self._buffer
+        max_pending = self.MAX_PENDING_BATCHES * self.max_batch
+        if len(self._buffer) > max_pending:
+          self.logger.error('Dropping %d buffered stats, the DB is failing.',
+                            len(self._buffer) - max_pending)
+          self._buffer = self._buffer[-max_pending:]
+        self._buffer_since = (self._buffer_since or time.time()) if self._buffer else None
+      raise LogStatsError(self.insert_qry)
+    self.logger.info('%d machine stats stored.', len(rows))
+    for _, on_stored in entries:
+      if on_stored is not None:
+        on_stored()
+    self._NotifyStored(sorted(set(row[0] for row in rows)))
+    return len(rows)
+
+  def add_flush_listener(self, listener):
+    """Call listener with the list of ip addresses of the machines whose stats were stored, once
+    they're committed (see notify.Publisher)."""
+    self._flush_listeners.append(listener)
+
+  def _NotifyStored(self, ip_addrs):
+    for listener in self._flush_listeners:
+      try:
+        listener(ip_addrs)
+      except Exception:
+        # The stats are stored whatever happens to the listeners.
+        self.logger.exception('Flush listener %r failed.', listener)
+
+  def _UpdateRollups(self, cursor, rows):
+    """Merge the values of rows (insert parameters) into the stored rollups.
+
+    Rollup rows are locked (in primary key order, so concurrent flushes can't deadlock), merged
+    with the rows values and written back.
+    """
+    samples = []
+    for ip_addr, _, cpu_usage, mem_usage, uptime, _, sampled_at, collection_date, extra in rows:
+      values = {'cpu_usage': cpu_usage, 'mem_usage': mem_usage, 'uptime': uptime}
+      for metric, value in parse_extra_metrics(extra).items():
+        if metric in rollup.EXTRA_METRICS:
+          values[metric] = self.ToFloat(value)
+      samples.append((ip_addr, sampled_at or collection_date, values))
+    partials = rollup.aggregate(samples)
+    for resolution in rollup.RESOLUTIONS:
+      keys = sorted(key[1:] for key in partials if key[0] == resolution)
+      merged = []
+      for i in range(0, len(keys), self.ROLLUP_CHUNK_SIZE):
+        chunk = keys[i:i + self.ROLLUP_CHUNK_SIZE]
+        query = self.lock_rollups_qry % (resolution.table, ', '.join(['(%s, %s, %s)'] * len(chunk)))
+        cursor.execute(query, tuple(value for key in chunk for value in key))
+        stored = {}
+        for result in cursor.fetchall() or []:
+          stored[tuple(result[:3])] = rollup.Rollup.from_row(result[3:])
+        for key in chunk:
+          current = stored.get(key, rollup.Rollup()).merge(partials[(resolution,) + key])
+          merged.append(key + current.to_row())
+      if merged:
+        cursor.executemany(self.upsert_rollup_qry % resolution.table, merged)
+
+  @metrics.instrument('storage_get_metric_summary')
+  def get_metric_summary(self, ip_addr, metric, start, end):
+    """Summarize the values of a metric of a machine over a time range.
+
+    The range is read from the coarsest rollups covering it, see rollup.plan_ranges.
+
+    Args:
+      ip_addr: str, ip address of the machine.
+      metric: str, one of rollup.METRICS or rollup.EXTRA_METRICS.
+      start: datetime.datetime, start of the range (rounded down to the minute).
+      end: datetime.datetime, end of the range (excluded).
+
+    Returns:
+      rollup.Rollup instance (count, min, max, mean, quantile(q)), its count is 0 if there is no
+      value in the range.
+    """
+    summary = rollup.Rollup()
+    for resolution, range_start, range_end in rollup.plan_ranges(start, end):
+      for _, value in self._GetRollups(resolution, ip_addr, metric, range_start, range_end):
+        summary.merge(value)
+    return summary
+
+  @metrics.instrument('storage_get_metric_series')
+  def get_metric_series(self, ip_addr, metric, start, end, step):
+    """Summarize the values of a metric of a machine per step over a time range.
+
+    Rollups are read at the coarsest resolution which step is a multiple of.
+
+    Args:
+      ip_addr: str, ip address of the machine.
+      metric: str, one of rollup.METRICS or rollup.EXTRA_METRICS.
+      start: datetime.datetime, start of the range.
+      end: datetime.datetime, end of the range (excluded).
+      step: int, number of seconds summarized by each point, steps are counted from start.
+
+    Returns:
+      list of tuple (datetime.datetime, rollup.Rollup), start of the step and summary of its
+      values, only for the steps having values.
+    """
+    resolution = rollup.get_series_resolution(step)
+    range_start = rollup.get_bucket_start(start, resolution)
+    series = []
+    for bucket_start, value in self._GetRollups(resolution, ip_addr, metric, range_start, end):
+      offset = int((bucket_start - range_start).total_seconds()) // step * step
+      step_start = range_start + datetime.timedelta(seconds=offset)
+      if series and series[-1][0] == step_start:
+        series[-1][1].merge(value)
+      else:
+        series.append((step_start, value))
+    return series
+
+  def _GetRollups(self, resolution, ip_addr, metric, start, end):
+    if metric not in rollup.METRICS + rollup.EXTRA_METRICS:
+      raise StorageError('Unknown metric: %s' % metric)
+    results = self.db.ExecuteQuery(self.get_rollups_qry % resolution.table, 'fetchall()',
+                                   (ip_addr, metric, start, end), raise_errors=True) or []
+    return [(result[0], rollup.Rollup.from_row(result[1:])) for result in results]
+
+  @metrics.instrument('storage_get_fleet_summary')
+  def get_fleet_summary(self, ip_addrs, metric_names, start, end):
+    """Summarize the values of metrics of several machines over a time range.
+
+    Same as get_metric_summary, with a query per resolution range and BACKLOG_CHUNK_SIZE machines
+    instead of one per machine and metric.
+
+    Args:
+      ip_addrs: list of str, ip addresses of the machines.
+      metric_names: list of str, each one of rollup.METRICS or rollup.EXTRA_METRICS.
+      start: datetime.datetime, start of the range (rounded down to the minute).
+      end: datetime.datetime, end of the range (excluded).
+
+    Returns:
+      dict, {(ip_addr, metric): rollup.Rollup}, only for the machines and metrics having values.
+    """
+    summaries = {}
+    for resolution, range_start, range_end in rollup.plan_ranges(start, end):
+      for ip_addr, metric, _, value in self._GetFleetRollups(resolution, ip_addrs, metric_names,
+                                                             range_start, range_end):
+        summaries.setdefault((ip_addr, metric), rollup.Rollup()).merge(value)
+    return summaries
+
+  @metrics.instrument('storage_get_fleet_series')
+  def get_fleet_series(self, ip_addrs, metric_names, start, end, step):
+    """Summarize the values of metrics of several machines per step over a time range.
+
+    Same as get_metric_series, for several machines and metrics at once.
+
+    Returns:
+      dict, {(ip_addr, metric): list of tuple (datetime.datetime, rollup.Rollup)}, only for the
+      machines and metrics having values.
+    """
+    resolution = rollup.get_series_resolution(step)
+    range_start = rollup.get_bucket_start(start, resolution)
+    series = {}
+    for ip_addr, metric, bucket_start, value in self._GetFleetRollups(
+        resolution, ip_addrs, metric_names, range_start, end):
+      points = series.setdefault((ip_addr, metric), [])
+      offset = int((bucket_start - range_start).total_seconds()) // step * step
+      step_start = range_start + datetime.timedelta(seconds=offset)
+      if points and points[-1][0] == step_start:
+        points[-1][1].merge(value)
+      else:
+        points.append((step_start, value))
+    return series
+
+  def _GetFleetRollups(self, resolution, ip_addrs, metric_names, start, end):
+    metric_names = sorted(set(metric_names))
+    for metric in metric_names:
+      if metric not in rollup.METRICS + rollup.EXTRA_METRICS:
+        raise StorageError('Unknown metric: %s' % metric)
+    ip_addrs = sorted(set(ip_addrs))
+    rollups = []
+    for i in range(0, len(ip_addrs) if metric_names else 0, self.BACKLOG_CHUNK_SIZE):
+      chunk = ip_addrs[i:i + self.BACKLOG_CHUNK_SIZE]
+      query = self.get_fleet_rollups_qry % (resolution.table, ', '.join(['%s'] * len(chunk)),
+                                            ', '.join(['%s'] * len(metric_names)))
+      results = self.db.ExecuteQuery(query, 'fetchall()',
+                                     tuple(chunk + metric_names + [start, end]),
+                                     raise_errors=True) or []
+      rollups.extend((result[0], result[1], result[2], rollup.Rollup.from_row(result[3:]))
+                     for result in results)
+    return rollups
+
+  def get_last_stored_id(self):
+    """Return the id of the last stored record, 0 if there is none."""
+    results = self.db.ExecuteQuery(self.get_last_stored_id_qry, 'fetchall()', raise_errors=True)
+    return (results[0][0] if results else None) or 0
+
+  def get_stored_since(self, last_id):
+    """Return {ip_addr: id of its last record} of the machines having records after last_id."""
+    results = self.db.ExecuteQuery(self.get_stored_since_qry, 'fetchall()', (last_id,),
+                                   raise_errors=True) or []
+    return dict((ip_addr, stored_id) for ip_addr, stored_id in results)
+
+  def close(self):
+    """Flush the buffered records and release the DB connections."""
+    try:
+      self.flush()
+    finally:
+      self.db.Close()
 
-  def get_non_treated_stats(self, ip_addr):
-    results = self.db.ExecuteQuery(self.get_machine_qry % ip_addr, 'fetchall()')
+  @metrics.instrument('storage_get_watermarks')
+  def get_watermarks(self, ip_addrs):
+    """Return {ip_addr: last_id}, id of the last record treated by the alerter for each machine.
+
+    Machines which never had any record treated are missing from the returned dict.
+    """
+    watermarks = {}
+    ip_addrs = list(ip_addrs)
+    for i in range(0, len(ip_addrs), self.BACKLOG_CHUNK_SIZE):
+      chunk = ip_addrs[i:i + self.BACKLOG_CHUNK_SIZE]
+      query = self.get_watermarks_qry % ', '.join(['%s'] * len(chunk))
+      for ip_addr, last_id in self.db.ExecuteQuery(query, 'fetchall()', tuple(chunk)) or []:
+        watermarks[ip_addr] = last_id
+    return watermarks
+
+  @metrics.instrument('storage_get_fleet_backlog')
+  def get_fleet_backlog(self, ip_addrs):
+    """Return the records of all machines that weren't treated by the alerter yet.
+
+    Instead of a query per machine, records after the watermark of each machine are fetched with a
+    single indexed range query (per BACKLOG_CHUNK_SIZE machines).
+
+    Args:
+      ip_addrs: list of str, ip addresses of the machines.
+
+    Returns:
+      list of MachineStats namedtuple, ordered by ip_addr then id.
+    """
+    ip_addrs = sorted(set(ip_addrs))
+    watermarks = self.get_watermarks(ip_addrs)
+    backlog = []
+    for i in range(0, len(ip_addrs), self.BACKLOG_CHUNK_SIZE):
+      chunk = ip_addrs[i:i + self.BACKLOG_CHUNK_SIZE]
+      query = self.get_backlog_qry % ' OR '.join(['(ip_addr = %s AND id > %s)'] * len(chunk))
+      params = []
+      for ip_addr in chunk:
+        params.extend((ip_addr, watermarks.get(ip_addr, 0)))
+      for result in self.db.ExecuteQuery(query, 'fetchall()', tuple(params)) or []:
+        backlog.append(MachineStats(*result))
+    return backlog
+
+  @metrics.instrument('storage_advance_watermarks')
+  def advance_watermarks(self, watermarks):
+    """Move the watermark of machines forward, in a single transaction.
+
+    Args:
+      watermarks: dict, {ip_addr: id of the last treated record of the machine}. A watermark never
+        moves backward.
+    """
+    if watermarks:
+      self.db.ExecuteMany(self.advance_watermark_qry, sorted(watermarks.items()))
+
+  @metrics.instrument('storage_heartbeat_node')
+  def heartbeat_node(self, role, node_id, ttl):
+    """Renew the lease of a node and return the nodes of its role whose lease didn't expire.
+
+    Args:
+      role: str, kind of work shared by the nodes, 'collector' or 'alerter'.
+      node_id: str, unique name of the node.
+      ttl: int, number of seconds the lease is valid for.
+
+    Returns:
+      list of str, ids of the live nodes (node_id included), sorted.
+
+    Raises:
+      StorageError: if the lease couldn't be renewed.
+    """
+    with self.db.Transaction() as cursor:
+      cursor.execute(self.heartbeat_node_qry, (role, node_id, int(ttl)))
+      cursor.execute(self.get_live_nodes_qry, (role,))
+      return [node for node, in cursor.fetchall()]
+
+  def leave_node(self, role, node_id):
+    """Drop the lease of a node and release its machines, for the other nodes to take them over.
+
+    Raises:
+      StorageError: if the leases couldn't be dropped.
+    """
+    with self.db.Transaction() as cursor:
+      cursor.execute(self.leave_node_qry, (role, node_id))
+      cursor.execute(self.get_owned_hosts_qry, (role, node_id))
+      self._ReleaseHosts(cursor, role, node_id, [ip_addr for ip_addr, in cursor.fetchall()])
+
+  @metrics.instrument('storage_claim_hosts')
+  def claim_hosts(self, role, owner, ip_addrs, ttl):
+    """Lease the machines which aren't leased by another node, renewing those owner already has.
+
+    Args:
+      role: str, kind of work the machines are leased for.
+      owner: str, id of the node claiming the machines.
+      ip_addrs: list of str, ip addresses of the machines.
+      ttl: int, number of seconds the leases are valid for.
+
+    Returns:
+      list of str, the ip addresses leased by owner, sorted.
+
+    Raises:
+      StorageError: if the machines couldn't be claimed.
+    """
+    ip_addrs = sorted(set(ip_addrs))
+    if not ip_addrs:
+      return []
+    with self.db.Transaction() as cursor:
+      cursor.executemany(self.create_host_leases_qry, [(role, ip_addr) for ip_addr in ip_addrs])
+      # Rows are locked in the same (sorted) order by all the nodes.
+      for i in range(0, len(ip_addrs), self.LEASE_CHUNK_SIZE):
+        chunk = ip_addrs[i:i + self.LEASE_CHUNK_SIZE]
+        cursor.execute(self.claim_hosts_qry % ', '.join(['%s'] * len(chunk)),
+                       tuple([owner, int(ttl), role] + chunk + [owner]))
+      cursor.execute(self.get_owned_hosts_qry, (role, owner))
+      claimed = set(ip_addrs)
+      return [ip_addr for ip_addr, in cursor.fetchall() if ip_addr in claimed]
+
+  @metrics.instrument('storage_release_hosts')
+  def release_hosts(self, role, owner, keep=()):
+    """Release the leases held by owner, except those of keep.
+
+    Args:
+      role: str, kind of work the machines are leased for.
+      owner: str, id of the node releasing the machines.
+      keep: iterable of str, ip addresses of the machines which stay leased.
+
+    Returns:
+      list of str, the released ip addresses.
+
+    Raises:
+      StorageError: if the leases couldn't be released.
+    """
+    keep = set(keep)
+    with self.db.Transaction() as cursor:
+      cursor.execute(self.get_owned_hosts_qry, (role, owner))
+      released = [ip_addr for ip_addr, in cursor.fetchall() if ip_addr not in keep]
+      self._ReleaseHosts(cursor, role, owner, released)
+    return released
+
+  def _ReleaseHosts(self, cursor, role, owner, ip_addrs):
+    for i in range(0, len(ip_addrs), self.LEASE_CHUNK_SIZE):
+      chunk = ip_addrs[i:i + self.LEASE_CHUNK_SIZE]
+      cursor.execute(self.release_hosts_qry % ', '.join(['%s'] * len(chunk)),
+                     tuple([role, owner] + chunk))
 
-    not_treated_stats =[]
 
-    for result in results:
-      id, ip_addr, cpu_usage, mem_usage, uptime, event_logs, collection_date = result
-      not_treated_stats.append(MachineStats(
-        id=id, ip_addr=ip_addr, cpu_usage=cpu_usage, mem_usage=mem_usage, uptime=uptime,
-        event_logs=event_logs, collection_date=collection_date))
-    return not_treated_stats
+class ConnectionPool(object):
+  """Thread safe pool of DB connections, opened lazily and reused across queries."""
+
+  DEFAULT_SIZE = 4
+
+  def __init__(self, username, password, hostname=Storage.DEFAULT_DB_HOSTNAME,
+               database=Storage.DEFAULT_DB_NAME, size=DEFAULT_SIZE, logger=None):
+    """Create a pool without opening any connection yet.
+
+    Args:
+      username: str, username used to connect to DB.
+      password: str, password used to connect to DB.
+      hostname: str, host address of the DB.
+      database: str, database name.
+      size: int, maximum number of connections opened at the same time.
+    """
+    self.db_params = {'host': hostname,
+                      'database': database,
+                      'user': username,
+                      'password': password}
+    self.hostname = hostname
+    self.database = database
+    self.size = size
+    self.logger = logger or logging.getLogger(__name__)
+    self._idle = queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+    self._closed = False
+
+  def acquire(self):
+    """Return a connection, waiting for one to be released if size connections are in use.
+
+    Raises:
+      StorageUnavailableError: if a new connection can't be established.
+    """
+    self._slots.acquire()
+    try:
+      try:
+        connection = self._idle.get_nowait()
+        # Transparently reconnects connections dropped by the server (wait_timeout for eg.)
+        connection.ping(reconnect=True)
+        return connection
+      except queue.Empty:
+        pass
+      connection = pymysql.connect(**self.db_params)
+      self.logger.info('Initialization of DB: %s.%s', self.hostname, self.database)
+      return connection
+    except pymysql.MySQLError as e:
+      self._slots.release()
+      raise StorageUnavailableError('Error while connecting to DB: %s' % e)
+    except Exception:
+      self._slots.release()
+      raise
+
+  def release(self, connection, discard=False):
+    """Hand back a connection, closing it if discard is set (after a failure for eg.)."""
+    try:
+      if discard or self._closed:
+        connection.close()
+      else:
+        self._idle.put(connection)
+    except pymysql.MySQLError:
+      pass
+    finally:
+      self._slots.release()
+
+  def close(self):
+    self._closed = True
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        return
+      except pymysql.MySQLError:
+        pass
 
-  def mark_stat_as_treated(self, stat_id):
-    return self.db.ExecuteQuery(self.mark_stat_as_treated_qry % int(stat_id), 'lastrowid')
 
 class DB(object):
   """Wrapper class that handles low level DB calls."""
 
-  def __init__(self, database, username, password, hostname, logger=None):
+  def __init__(self, database, username, password, hostname, logger=None, pool=None,
+               pool_size=1):
     """Create a DB instance.
 
+    Note: no connection is made until the first query.
+
     Args:
       database: str, database name.
       username: str, username used to connect to DB.
       password: str, password used to connect to DB.
-      hostname: str, host address of the DB. 
-      port: int, port of the DB server.
+      hostname: str, host address of the DB.
+      pool: ConnectionPool instance, a private pool is used if None.
+      pool_size: int, maximum number of connections of the private pool.
     """
-    db_params = {'host': hostname,
-                 'db': database,
-                 'user': username,
-                 'passwd': password}
-
     if not logger:
       logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
       self.logger = logging.getLogger(__name__)
     else:
       self.logger = logger
 
-    try:
-      self.db = pymysql.connect(**db_params)
-      self.cursor = self.db.cursor()
-      self.logger.info('Initialization of DB: %s.%s', hostname, database)
-    except pymysql.OperationalError as e:
-      self.logger.fatal('[Can be safely ignored in dev/test environment ] Error while connecting to DB: %s', e)
+    self.own_pool = pool is None
+    self.pool = pool or ConnectionPool(username, password, hostname, database, size=pool_size,
+                                       logger=self.logger)
 
   def Close(self):
-    if self.db:
-      self.db.close()
+    if self.own_pool:
+      self.pool.close()
 
-  def ExecuteQuery(self, query, return_type='lastrowid'):
+  def ExecuteQuery(self, query, return_type='lastrowid', params=None, raise_errors=False):
     """Execute SQL query and return the results according to return_type.
 
     Args:
@@ -148,25 +772,102 @@ class DB(object):
       return_type: string, the attribute or method of the cursor that needs to
         be returned. if it's a method it should include the parentheses, e.g:
         lastrowid, rowcount, fetchall()
+      params: tuple, values of the query placeholders (%s), escaped by the driver.
+      raise_errors: bool, raise a StorageError instead of returning None if the query failed.
 
     Returns:
       Return the values of the attribute or the method of Cursor spcified by
-        return_type.
+        return_type. None if the query failed.
+
+    Raises:
+      StorageUnavailableError: if no connection to the DB can be established.
+      StorageError: if the query failed and raise_errors is set.
     """
-    if self.cursor is None:
-      self.cursor = self.db.cursor()
+    connection = self.pool.acquire()
+    discard = False
     try:
-      self.logger.info('query to be executed: %s', query)
-      self.cursor.execute(query)
-      self.db.commit()
-      return self._GetResults(return_type)
-    except pymysql.MySQLError:
+      cursor = connection.cursor()
+      self.logger.debug('query to be executed: %s', query)
+      cursor.execute(query, params)
+      connection.commit()
+      return self._GetResults(cursor, return_type)
+    except pymysql.MySQLError as e:
       self.logger.error('issue found with query: %s', query)
+      discard = self._Rollback(connection)
+      if raise_errors:
+        raise StorageError('Query failed: %s' % e)
+    finally:
+      self.pool.release(connection, discard)
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    """Context manager yielding a cursor whose queries are run in a single transaction.
+
+    The transaction is committed when the block exits, rolled back if it raises.
+
+    Raises:
+      StorageUnavailableError: if no connection to the DB can be established.
+      StorageError: if a query failed.
+    """
+    connection = self.pool.acquire()
+    discard = False
+    try:
+      yield connection.cursor()
+      connection.commit()
+    except pymysql.MySQLError as e:
+      self.logger.error('issue found with transaction: %s', e)
+      discard = self._Rollback(connection)
+      raise StorageError('Transaction failed: %s' % e)
+    except Exception:
+      discard = self._Rollback(connection)
+      raise
+    finally:
+      self.pool.release(connection, discard)
+
+  def ExecuteMany(self, query, rows):
+    """Execute an INSERT query for all rows in a single transaction.
+
+    The driver turns the INSERT ... VALUES query into multi-row inserts, so all the rows only
+    cost a handful of round-trips.
+
+    Args:
+      query: string, INSERT query with a single VALUES (%s, ...) clause.
+      rows: list of tuple, the values of each row.
+
+    Returns:
+      int, number of inserted rows.
+
+    Raises:
+      StorageError: if the rows couldn't be inserted, the transaction is then rolled back.
+    """
+    connection = self.pool.acquire()
+    discard = False
+    try:
+      cursor = connection.cursor()
+      self.logger.debug('query to be executed for %d rows: %s', len(rows), query)
+      cursor.executemany(query, rows)
+      connection.commit()
+      return cursor.rowcount
+    except pymysql.MySQLError as e:
+      self.logger.error('issue found with batch query: %s', query)
+      discard = self._Rollback(connection)
+      raise StorageError('Batch of %d rows failed: %s' % (len(rows), e))
+    finally:
+      self.pool.release(connection, discard)
+
+  def _Rollback(self, connection):
+    """Rollback the current transaction, return True if the connection should be discarded."""
+    try:
+      connection.rollback()
+      return False
+    except pymysql.MySQLError:
+      return True
 
-  def _GetResults(self, return_type):
+  def _GetResults(self, cursor, return_type):
     """Wrapper to return either an attribute or a method of the cursor.
 
     Args:
+      cursor: pymysql cursor which executed the query.
       return_type: string, valid attribute or method of pymysql.connect.cursor.
       Valid examples: lastrowid, rowcount, fetchall()
 
@@ -174,6 +875,6 @@ class DB(object):
       Values of either the attribute or the method results of return_type.
     """
     if return_type[-2:] == '()':
-      return getattr(self.cursor, return_type[:-2])()
+      return getattr(cursor, return_type[:-2])()
     else:
-      return getattr(self.cursor, return_type)
+      return getattr(cursor, return_type)
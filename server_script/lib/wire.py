@@ -0,0 +1,281 @@
+"""Versioned binary format of the stats sent by the local collector.
+
+A batch holds any number of records (a single one for a regular collection, the drained samples
+in agent mode) and describes the layout of its records:
+
+  magic        3 bytes  b'FHW'
+  version      1 byte   WIRE_VERSION
+  flags        1 byte   FLAG_COMPRESSED if the body is zlib compressed
+  count        4 bytes  number of records
+  field_count  1 byte   number of fixed fields of the records
+  fields                field_count times: struct code (1 byte), name length (1 byte), name
+  meta                  SECTION_LABELS section describing the whole batch (agent cursor for eg.)
+  body                  compressed or not:
+    fixed part          count times the fixed fields, packed with their struct codes
+    sections            the variable length sections of each record (`sections` fixed field)
+
+All integers are little endian. A section is its type (1 byte), its length (4 bytes) and its data:
+  SECTION_OS, SECTION_EVENT_LOGS: utf-8 text.
+  SECTION_METRICS: repeated key length (1 byte), key, float64 value.
+  SECTION_LABELS: repeated key length (1 byte), key, value length (2 bytes), utf-8 value.
+
+Fixed fields are looked up by name: fields a reader doesn't know are skipped and missing ones are
+None, so fields can be added without a new version. Numbers which couldn't be measured are NaN on
+the wire and None once decoded.
+
+The module is bundled with local_collector.py (see collector.CLIENT_MODULES), which encodes its
+stats with it: it only depends on the standard library.
+"""
+
+import struct
+import zlib
+
+from collections import namedtuple
+
+
+MAGIC = b'FHW'
+WIRE_VERSION = 1
+FLAG_COMPRESSED = 0x01
+HEADER = struct.Struct('<3sBBIB')
+FIELD = struct.Struct('<BB')
+SECTION = struct.Struct('<BI')
+METRIC_VALUE = struct.Struct('<d')
+LABEL_LENGTH = struct.Struct('<H')
+SECTION_OS = 1
+SECTION_EVENT_LOGS = 2
+SECTION_METRICS = 3
+SECTION_LABELS = 4
+# (struct code, name) of the fixed fields of a record.
+FIELDS = (('d', 'sampled_at'), ('f', 'cpu_usage'), ('f', 'mem_usage'), ('d', 'uptime'),
+          ('H', 'sections'))
+# Fields of the samples drained from the agent.
+AGENT_FIELDS = FIELDS + (('Q', 'seq'),)
+# Bodies smaller than this aren't worth compressing.
+COMPRESS_THRESHOLD = 512
+# Guards against decompressing a bomb.
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Typed stats of a sample. metrics is {key: float} and labels {key: str} (extra metrics of the
+# client, see local_collector.METRICS), seq is the position of the sample in the agent ring.
+Record = namedtuple('Record', 'sampled_at os cpu_usage mem_usage uptime event_logs metrics labels '
+                              'seq')
+Record.__new__.__defaults__ = (None,) * len(Record._fields)
+Batch = namedtuple('Batch', 'version meta records')
+
+
+class WireError(Exception):
+  """Exception raised when a batch can't be decoded."""
+
+  def __init__(self, msg):
+    super(WireError, self).__init__(msg)
+    self.msg = msg
+
+
+def is_batch(data):
+  return data[:len(MAGIC)] == MAGIC
+
+
+def _encode_section(section_type, data):
+  return SECTION.pack(section_type, len(data)) + data
+
+
+def _encode_labels(labels):
+  parts = []
+  for key in sorted(labels):
+    key_data, value_data = key.encode('utf-8'), labels[key].encode('utf-8')
+    parts.extend((bytes((len(key_data),)), key_data, LABEL_LENGTH.pack(len(value_data)),
+                  value_data))
+  return _encode_section(SECTION_LABELS, b''.join(parts))
+
+
+def _encode_metrics(metrics):
+  parts = []
+  for key in sorted(metrics):
+    key_data = key.encode('utf-8')
+    parts.extend((bytes((len(key_data),)), key_data, METRIC_VALUE.pack(metrics[key])))
+  return _encode_section(SECTION_METRICS, b''.join(parts))
+
+
+def _get_number(code, value):
+  if value is None:
+    # Integers have no NaN, missing ones are 0
+    return float('nan') if code in 'fd' else 0
+  return value
+
+
+def encode_batch(records, meta=None, fields=FIELDS, compress=None):
+  """Encode records into a batch.
+
+  Args:
+    records: list of Record namedtuple.
+    meta: dict, {key: str} describing the whole batch.
+    fields: tuple of (struct code, name), fixed fields of the records.
+    compress: boolean, compress the body, only if it makes it smaller when None.
+
+  Returns:
+    bytes, the batch.
+  """
+  fixed = struct.Struct('<' + ''.join(code for code, _ in fields))
+  fixed_parts = []
+  section_parts = []
+  for record in records:
+    sections = []
+    if record.os is not None:
+      sections.append(_encode_section(SECTION_OS, record.os.encode('utf-8')))
+    if record.event_logs is not None:
+      sections.append(_encode_section(SECTION_EVENT_LOGS, record.event_logs.encode('utf-8')))
+    if record.metrics:
+      sections.append(_encode_metrics(record.metrics))
+    if record.labels:
+      sections.append(_encode_labels(record.labels))
+    fixed_parts.append(fixed.pack(*[
+        len(sections) if name == 'sections' else _get_number(code, getattr(record, name, None))
+        for code, name in fields]))
+    section_parts.extend(sections)
+  body = b''.join(fixed_parts + section_parts)
+  flags = 0
+  if compress or (compress is None and len(body) >= COMPRESS_THRESHOLD):
+    compressed = zlib.compress(body)
+    if compress or len(compressed) < len(body):
+      body = compressed
+      flags |= FLAG_COMPRESSED
+  header = [HEADER.pack(MAGIC, WIRE_VERSION, flags, len(records), len(fields))]
+  for code, name in fields:
+    name_data = name.encode('ascii')
+    header.extend((FIELD.pack(ord(code), len(name_data)), name_data))
+  header.append(_encode_labels(meta or {}))
+  return b''.join(header) + body
+
+
+def _decode_labels(view, start, end):
+  labels = {}
+  offset = start
+  while offset < end:
+    key_length = view[offset]
+    key = str(view[offset + 1:offset + 1 + key_length], 'utf-8')
+    offset += 1 + key_length
+    value_length, = LABEL_LENGTH.unpack_from(view, offset)
+    offset += LABEL_LENGTH.size
+    labels[key] = str(view[offset:offset + value_length], 'utf-8')
+    offset += value_length
+  if offset != end:
+    raise WireError('Labels section overflows')
+  return labels
+
+
+def _decode_metrics(view, start, end):
+  metrics = {}
+  offset = start
+  while offset < end:
+    key_length = view[offset]
+    key = str(view[offset + 1:offset + 1 + key_length], 'utf-8')
+    offset += 1 + key_length
+    metrics[key], = METRIC_VALUE.unpack_from(view, offset)
+    offset += METRIC_VALUE.size
+  if offset != end:
+    raise WireError('Metrics section overflows')
+  return metrics
+
+
+def _read_section(view, offset):
+  """Return (type, data start, data end) of the section at offset."""
+  section_type, length = SECTION.unpack_from(view, offset)
+  start = offset + SECTION.size
+  if start + length > len(view):
+    raise WireError('Truncated section')
+  return section_type, start, start + length
+
+
+def _get_value(values, index, name):
+  if name not in index:
+    return None
+  value = values[index[name]]
+  # NaN: not measured
+  return None if value != value else value
+
+
+def decode_batch(data):
+  """Decode a batch into typed records.
+
+  Fixed fields are unpacked in a single pass over the body and sections are decoded in place, only
+  their strings are copied.
+
+  Args:
+    data: bytes, a batch as made by encode_batch.
+
+  Returns:
+    Batch namedtuple.
+
+  Raises:
+    WireError: if data isn't a valid batch (or of a newer version).
+  """
+  view = memoryview(data)
+  try:
+    magic, version, flags, count, field_count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+      raise WireError('Not a stats batch')
+    if version > WIRE_VERSION:
+      raise WireError('Unsupported batch version %d' % version)
+    offset = HEADER.size
+    codes = []
+    index = {}
+    for i in range(field_count):
+      code, name_length = FIELD.unpack_from(view, offset)
+      offset += FIELD.size
+      index[str(view[offset:offset + name_length], 'ascii')] = i
+      codes.append(chr(code))
+      offset += name_length
+    section_type, start, offset = _read_section(view, offset)
+    meta = _decode_labels(view, start, offset) if section_type == SECTION_LABELS else {}
+
+    body = view[offset:]
+    if flags & FLAG_COMPRESSED:
+      decompressor = zlib.decompressobj()
+      body = memoryview(decompressor.decompress(body, MAX_BODY_SIZE))
+      if decompressor.unconsumed_tail:
+        raise WireError('Batch body exceeds %d bytes' % MAX_BODY_SIZE)
+    fixed = struct.Struct('<' + ''.join(codes))
+    offset = fixed.size * count
+    if offset > len(body):
+      raise WireError('Truncated batch: %d records expected' % count)
+
+    records = []
+    for values in fixed.iter_unpack(body[:offset]) if fixed.size else [()] * count:
+      os_name = event_logs = None
+      metrics = {}
+      labels = {}
+      for _ in range(values[index['sections']] if 'sections' in index else 0):
+        section_type, start, offset = _read_section(body, offset)
+        if section_type == SECTION_OS:
+          os_name = str(body[start:offset], 'utf-8')
+        elif section_type == SECTION_EVENT_LOGS:
+          event_logs = str(body[start:offset], 'utf-8')
+        elif section_type == SECTION_METRICS:
+          metrics = _decode_metrics(body, start, offset)
+        elif section_type == SECTION_LABELS:
+          labels = _decode_labels(body, start, offset)
+        # Sections of unknown types are skipped.
+      records.append(Record(
+          sampled_at=_get_value(values, index, 'sampled_at'), os=os_name,
+          cpu_usage=_get_value(values, index, 'cpu_usage'),
+          mem_usage=_get_value(values, index, 'mem_usage'),
+          uptime=_get_value(values, index, 'uptime'), event_logs=event_logs, metrics=metrics,
+          labels=labels, seq=_get_value(values, index, 'seq')))
+  except (struct.error, IndexError, UnicodeDecodeError, zlib.error) as e:
+    raise WireError('Invalid stats batch: %s' % e)
+  return Batch(version=version, meta=meta, records=records)
+
+
+def format_extra_metrics(record):
+  """Return the metrics and labels of record as stored in collected_stats.extra_metrics."""
+  items = ['%s=%.2f' % (key, value) for key, value in sorted(record.metrics.items())
+           if value == value]
+  items.extend('%s=%s' % (key, value) for key, value in sorted(record.labels.items()))
+  return ';'.join(items)
+
+
+def get_stats_fields(record):
+  """Return the stats of record as expected by storage.Storage: os, cpu_usage, mem_usage, uptime,
+  event_logs, extra_metrics."""
+  return [record.os, record.cpu_usage, record.mem_usage, record.uptime, record.event_logs,
+          format_extra_metrics(record)]
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+import psutil
+
+import testutil
+
+from lib import wire
+
+# The stats are read from /proc (Linux)
+USE_PROC = testutil.load_local_collector().USE_PROC
+
+class LocalCollectorTest(unittest.TestCase):
+  def setUp(self):
+    self.local_collector = testutil.load_local_collector()
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.state_file = os.path.join(self.tmp_dir.name, 'counters.state')
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  @unittest.skipUnless(USE_PROC, 'Linux /proc only')
+  def test_proc_matches_psutil(self):
+    cores = self.local_collector.read_cpu_times()
+    psutil_cores = [self.local_collector.get_cpu_times(t) for t in psutil.cpu_times(percpu=True)]
+    self.assertEqual(len(psutil_cores), len(cores))
+    for (busy, total), (psutil_busy, psutil_total) in zip(cores, psutil_cores):
+      self.assertAlmostEqual(psutil_total, total, delta=1)
+      self.assertAlmostEqual(psutil_busy, busy, delta=1)
+    memory = psutil.virtual_memory()
+    self.assertAlmostEqual(100 - memory.available / memory.total * 100,
+                           float(self.local_collector.collect_mem_usage()), delta=1)
+    self.assertAlmostEqual(psutil.disk_usage('/').percent,
+                           self.local_collector.collect_disk(self.local_collector.Snapshot())[0][1],
+                           delta=1)
+    processes = dict((pid, (name, create_time)) for pid, name, _, create_time
+                     in self.local_collector.iter_processes())
+    proc = psutil.Process(os.getpid())
+    self.assertEqual(proc.name()[:15], processes[proc.pid][0])
+    self.assertAlmostEqual(proc.create_time(), processes[proc.pid][1], delta=0.1)
+
+  @unittest.skipUnless(USE_PROC, 'Linux /proc only')
+  def test_collected_without_psutil(self):
+    for _ in range(2):
+      batch = wire.decode_batch(self.local_collector.collect_sys_stats(
+          state_filepath=self.state_file))
+    record = batch.records[0]
+    self.assertIsNone(self.local_collector._psutil)
+    self.assertGreater(record.uptime, 0)
+    self.assertIn('disk_read_bps', record.metrics)
+    self.assertIn('procs', record.labels)
+
+  def test_state_persisted(self):
+    snapshot = self.local_collector.Snapshot(now=1000.0)
+    snapshot.get_delta('net_bytes_recv', 10)
+    self.local_collector.save_state(snapshot, self.state_file)
+    state = self.local_collector.load_state(self.state_file)
+    self.assertEqual(5.0, self.local_collector.Snapshot(state, 1002.0).get_rate('net_bytes_recv',
+                                                                                 20))
+    with open(self.state_file, 'w') as f:
+      f.write('{"time": 1000.0}')
+    self.assertEqual({}, self.local_collector.load_state(self.state_file))
+
+
+if __name__ == '__main__':
+  unittest.main()
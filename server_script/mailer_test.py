@@ -0,0 +1,126 @@
+import email
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from lib import mailer
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+  """Minimal SMTP server side, enough for smtplib.SMTP to log in and send messages."""
+
+  def reply(self, line):
+    self.wfile.write(line.encode() + b'\r\n')
+
+  def handle(self):
+    server = self.server
+    server.connections += 1
+    self.reply('220 localhost ESMTP')
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      verb = line.decode().strip().split(' ')[0].upper()
+      if verb == 'EHLO':
+        self.reply('250-localhost')
+        self.reply('250 AUTH PLAIN')
+      elif verb == 'AUTH':
+        server.logins += 1
+        self.reply('235 Authentication successful')
+      elif verb == 'MAIL' and server.fail:
+        self.reply('451 Try again later')
+      elif verb == 'DATA':
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        data = []
+        for line in iter(self.rfile.readline, b''):
+          if line == b'.\r\n':
+            break
+          data.append(line)
+        server.messages.append(email.message_from_bytes(b''.join(data)))
+        self.reply('250 OK')
+      elif verb == 'QUIT':
+        self.reply('221 Bye')
+        return
+      else:
+        self.reply('250 OK')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self):
+    socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+    self.connections = 0
+    self.logins = 0
+    self.fail = False
+    self.messages = []
+
+
+class MailerTest(unittest.TestCase):
+  def setUp(self):
+    self.server = FakeSMTPServer()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.spool_dir = os.path.join(tempfile.mkdtemp(), 'spool')
+    self.mailer = mailer.Mailer('127.0.0.1', self.server.server_address[1], username='alerter',
+                                password='secret', use_ssl=False, spool_dir=self.spool_dir,
+                                timeout=5)
+    self.addCleanup(self.mailer.close)
+
+  def get_spooled(self):
+    if not os.path.isdir(self.spool_dir):
+      return []
+    spooled = []
+    for filename in sorted(os.listdir(self.spool_dir)):
+      with open(os.path.join(self.spool_dir, filename)) as f:
+        spooled.append(json.load(f))
+    return spooled
+
+  def test_digests_over_a_single_connection(self):
+    for i in range(3):
+      self.assertTrue(self.mailer.add('a@m.m', 'Alert %d' % i, 'cpu of %d' % i))
+    self.mailer.add('b@m.m', 'Alert 3', 'memory of 3')
+    self.assertFalse(self.mailer.add('', 'Alert 4', 'nobody'))
+    self.assertEqual(2, self.mailer.flush())
+    self.assertTrue(self.mailer.wait(5))
+
+    self.assertEqual((1, 1), (self.server.connections, self.server.logins))
+    messages = dict((m['To'], m) for m in self.server.messages)
+    self.assertEqual(['a@m.m', 'b@m.m'], sorted(messages))
+    self.assertEqual('Notification digest: 3 alerts', messages['a@m.m']['Subject'])
+    self.assertIn('cpu of 2', messages['a@m.m'].get_payload()[0].get_payload())
+    self.assertEqual('Alert 3', messages['b@m.m']['Subject'])
+    # Delivered messages are removed from the spool
+    self.assertEqual([], self.get_spooled())
+
+  def test_undelivered_messages_retried_with_backoff(self):
+    self.server.fail = True
+    self.mailer.add('a@m.m', 'Alert', 'cpu')
+    self.mailer.add('b@m.m', 'Alert', 'memory')
+    self.mailer.flush()
+    self.assertTrue(self.mailer.wait(5))
+    spooled = self.get_spooled()
+    # The second message wasn't attempted once the server failed
+    self.assertEqual([1, 0], [m['attempts'] for m in spooled])
+    self.assertGreater(spooled[0]['next_attempt'], time.time() + mailer.DEFAULT_BACKOFF - 5)
+
+    self.server.fail = False
+    self.assertEqual(1, self.mailer.retry_spool())
+    self.assertTrue(self.mailer.wait(5))
+    self.assertEqual(['b@m.m'], [m['To'] for m in self.server.messages])
+    self.assertEqual(1, self.mailer.retry_spool(now=time.time() + mailer.DEFAULT_BACKOFF))
+    self.assertTrue(self.mailer.wait(5))
+    self.assertEqual([], self.get_spooled())
+    self.assertEqual(['b@m.m', 'a@m.m'], [m['To'] for m in self.server.messages])
+
+
+if __name__ == '__main__':
+  unittest.main()
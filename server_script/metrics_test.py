@@ -0,0 +1,100 @@
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from lib import metrics
+
+
+class RegistryTest(unittest.TestCase):
+  def setUp(self):
+    self.registry = metrics.Registry()
+
+  def test_render_histogram(self):
+    histogram = self.registry.histogram('test_seconds', 'Test durations.', ('phase',),
+                                        buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+      histogram.observe(value, phase='connect')
+    self.assertEqual((4, 2.65), histogram.get(phase='connect'))
+    self.assertEqual('\n'.join([
+        '# HELP fleet_health_test_seconds Test durations.',
+        '# TYPE fleet_health_test_seconds histogram',
+        'fleet_health_test_seconds_bucket{phase="connect",le="0.1"} 2',
+        'fleet_health_test_seconds_bucket{phase="connect",le="1"} 3',
+        'fleet_health_test_seconds_bucket{phase="connect",le="+Inf"} 4',
+        'fleet_health_test_seconds_sum{phase="connect"} 2.65',
+        'fleet_health_test_seconds_count{phase="connect"} 4']) + '\n', self.registry.render())
+
+  def test_render_counter(self):
+    counter = self.registry.counter('test_total', 'Test counter.', ('host',))
+    counter.inc(host='a"b')
+    counter.inc(2, host='a"b')
+    self.assertIs(counter, self.registry.counter('test_total', 'Test counter.', ('host',)))
+    self.assertIn('fleet_health_test_total{host="a\\"b"} 3\n', self.registry.render())
+    with self.assertRaises(ValueError):
+      counter.inc(phase='connect')
+
+  def test_write(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    path = os.path.join(tmp_dir, 'test.prom')
+    self.registry.gauge('test_gauge', 'Test gauge.').set(1.5)
+    self.registry.write(path)
+    with open(path) as f:
+      self.assertEqual(self.registry.render(), f.read())
+    self.assertEqual(['test.prom'], os.listdir(tmp_dir))
+
+
+class TimedTest(unittest.TestCase):
+  def test_timed(self):
+    with metrics.timed('test_timed', '10.0.0.1') as timer:
+      pass
+    self.assertEqual((1, timer.duration), metrics.HOST_PHASE_SECONDS.get(phase='test_timed',
+                                                                         host='10.0.0.1'))
+    with self.assertRaises(KeyError):
+      with metrics.timed('test_timed'):
+        raise KeyError('failed')
+    self.assertEqual(2, metrics.PHASE_SECONDS.get(phase='test_timed')[0])
+    self.assertEqual(1, metrics.PHASE_FAILURES.get(phase='test_timed'))
+
+  def test_instrument(self):
+    @metrics.instrument('test_instrument')
+    def double(value):
+      return 2 * value
+    self.assertEqual(4, double(2))
+    self.assertEqual('double', double.__name__)
+    self.assertEqual(1, metrics.PHASE_SECONDS.get(phase='test_instrument')[0])
+
+  def test_profiled(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    path = os.path.join(tmp_dir, 'run.pstats')
+
+    def profiled_in_thread():
+      return sum(range(10))
+    with metrics.profiled(path):
+      thread = threading.Thread(target=profiled_in_thread)
+      thread.start()
+      thread.join()
+    functions = [f[2] for f in pstats.Stats(path).stats]
+    self.assertIn('profiled_in_thread', functions)
+
+  def test_profiled_single_profiler(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    path = os.path.join(tmp_dir, 'run.pstats')
+    # Python 3.12+: enabling a profiler per thread would raise ValueError.
+    with mock.patch.object(metrics, 'PER_THREAD_PROFILERS', False), \
+        mock.patch('threading.setprofile') as setprofile:
+      with metrics.profiled(path):
+        sum(range(10))
+    self.assertFalse(setprofile.called)
+    self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+  unittest.main()
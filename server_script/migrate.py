@@ -0,0 +1,336 @@
+"""Online migration of collected_stats to the typed and partitioned layout (schema version 2).
+
+Version 2 stores cpu_usage, mem_usage and uptime as numbers, records the time of the measure on
+the client (sampled_at), indexes (ip_addr, collection_date) and partitions the table by month
+of collection_date. consulted_for_alerts isn't copied: the alerter keeps its progress in
+alert_watermarks, sql_script/upgrade_001_alert_watermarks.sql has to be applied before.
+
+The migration never locks collected_stats for long: rows are copied by chunks of ids into
+collected_stats_v2 (each chunk being a short transaction). The rows inserted by the collector in
+the meantime are then copied under a short write lock of both tables, which are swapped before the
+lock is released: no row reaches the old table after it was copied, and the new table is complete
+(ids included) before anything reads it. The progress is saved after each chunk so an interrupted
+migration resumes where it stopped. The original table is kept as collected_stats_v1 and can be
+dropped once the migration is checked.
+
+The collector and alerter of this version read and write the version 2 layout: the collector of
+the previous version keeps running during the migration, they are deployed once it's done.
+
+Monthly partitions have to be created ahead of time, add-partitions is meant to run from cron
+(monthly is enough), rows collected past the last partition land in p_future.
+"""
+
+import argparse
+import datetime
+import logging
+import time
+
+from lib import config
+from lib import storage
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+global_logger = logging.getLogger(__name__)
+
+TABLE = 'collected_stats'
+NEW_TABLE = 'collected_stats_v2'
+OLD_TABLE = 'collected_stats_v1'
+MIGRATION_NAME = 'collected_stats_v2'
+DEFAULT_CHUNK_SIZE = 5000
+# Seconds slept between two chunks, leaves room to the collector and alerter queries.
+DEFAULT_PAUSE = 0.1
+DEFAULT_MONTHS_AHEAD = 3
+# collection_date is mandatory (it is the partitioning key), used for rows which have none.
+UNKNOWN_DATE = datetime.datetime(1970, 1, 1)
+
+TABLE_DDL = '''CREATE TABLE IF NOT EXISTS `%(table)s` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `ip_addr` varchar(45) NOT NULL,
+  `os` varchar(45) DEFAULT NULL,
+  `cpu_usage` float DEFAULT NULL,
+  `mem_usage` float DEFAULT NULL,
+  `uptime` double DEFAULT NULL,
+  `event_logs` longtext,
+  `sampled_at` datetime DEFAULT NULL,
+  `collection_date` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `extra_metrics` text,
+  PRIMARY KEY (`id`,`collection_date`),
+  KEY `idx_ip_addr_id` (`ip_addr`,`id`),
+  KEY `idx_ip_addr_date` (`ip_addr`,`collection_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1
+PARTITION BY RANGE (TO_DAYS(`collection_date`))
+(%(partitions)s)'''
+
+BOOKKEEPING_DDL = ('''CREATE TABLE IF NOT EXISTS `schema_version` (
+  `version` int(11) NOT NULL,
+  `applied_at` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1''', '''CREATE TABLE IF NOT EXISTS `schema_migrations` (
+  `name` varchar(64) NOT NULL,
+  `last_id` bigint(20) NOT NULL DEFAULT '0',
+  `updated_at` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1''')
+
+table_exists_qry = '''SELECT COUNT(*) FROM information_schema.TABLES
+  WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'''
+partitions_qry = '''SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+  WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL'''
+schema_version_qry = '''SELECT COALESCE(MAX(version), 1) FROM schema_version'''
+set_schema_version_qry = '''INSERT IGNORE INTO schema_version(version) VALUES (%s)'''
+get_progress_qry = '''SELECT last_id FROM schema_migrations WHERE name = %s'''
+set_progress_qry = '''INSERT INTO schema_migrations(name, last_id) VALUES (%s, %s)
+  ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)'''
+select_chunk_qry = '''SELECT id, ip_addr, os, cpu_usage, mem_usage, uptime, event_logs,
+  collection_date FROM `%s` WHERE id > %%s ORDER BY id LIMIT %%s'''
+# IGNORE makes copying a chunk twice (after an interruption) harmless.
+insert_chunk_qry = '''INSERT IGNORE INTO `%s`(id, ip_addr, os, cpu_usage, mem_usage, uptime,
+  event_logs, sampled_at, collection_date)
+  VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)'''
+
+
+class MigrationError(Exception):
+  """Exception raised when the migration can't proceed."""
+
+  def __init__(self, msg):
+    super(MigrationError, self).__init__(msg)
+    self.msg = msg
+
+
+def get_month_start(date):
+  return datetime.date(date.year, date.month, 1)
+
+
+def add_months(date, months):
+  month = date.month - 1 + months
+  return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
+
+def get_partition_name(month):
+  return 'p%04d%02d' % (month.year, month.month)
+
+
+def get_partition_clauses(months):
+  """Return the PARTITION definitions of months (first days of the months, ascending)."""
+  return ['PARTITION %s VALUES LESS THAN (TO_DAYS(\'%s\'))' % (
+      get_partition_name(month), add_months(month, 1).isoformat()) for month in months]
+
+
+def get_table_partitions(first_month, last_month):
+  """Return the partitions of a new table covering first_month up to last_month included."""
+  months = []
+  month = first_month
+  while month <= last_month:
+    months.append(month)
+    month = add_months(month, 1)
+  clauses = ['PARTITION p_history VALUES LESS THAN (TO_DAYS(\'%s\'))' % first_month.isoformat()]
+  clauses.extend(get_partition_clauses(months))
+  clauses.append('PARTITION p_future VALUES LESS THAN MAXVALUE')
+  return ',\n '.join(clauses)
+
+
+def convert_row(row):
+  """Convert a collected_stats version 1 row (str metrics) to the version 2 insert parameters.
+
+  Before version 2 the collection date of agent samples was their sample time, and the insertion
+  time of the other ones: it's the best known sample time of the old rows.
+  """
+  id, ip_addr, os, cpu_usage, mem_usage, uptime, event_logs, collection_date = row
+  collection_date = collection_date or UNKNOWN_DATE
+  return (id, ip_addr, os, storage.Storage.ToFloat(cpu_usage), storage.Storage.ToFloat(mem_usage),
+          storage.Storage.ToFloat(uptime), event_logs, collection_date, collection_date)
+
+
+class Migrator(object):
+  """Migrate collected_stats to the schema version 2 and maintain its partitions."""
+
+  def __init__(self, db, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_PAUSE, logger=None):
+    """Create a Migrator.
+
+    Args:
+      db: storage.DB instance.
+      chunk_size: int, number of rows copied per transaction.
+      pause: float, number of seconds slept between two chunks.
+    """
+    self.db = db
+    self.chunk_size = chunk_size
+    self.pause = pause
+    self.logger = logger or global_logger
+
+  def _execute(self, query, return_type='rowcount', params=None):
+    return self.db.ExecuteQuery(query, return_type, params, raise_errors=True)
+
+  def table_exists(self, table):
+    return self._execute(table_exists_qry, 'fetchone()', (table,))[0] > 0
+
+  def get_schema_version(self):
+    if not self.table_exists('schema_version'):
+      return 1
+    return self._execute(schema_version_qry, 'fetchone()')[0]
+
+  def get_progress(self):
+    result = self._execute(get_progress_qry, 'fetchone()', (MIGRATION_NAME,))
+    return result[0] if result else 0
+
+  def copy_chunk(self, source, target, after_id):
+    """Copy the chunk_size rows of source following after_id into target.
+
+    Returns:
+      tuple (int, int), number of copied rows and id of the last one (after_id if none).
+    """
+    rows = self._execute(select_chunk_qry % source, 'fetchall()', (after_id, self.chunk_size))
+    if not rows:
+      return 0, after_id
+    self.db.ExecuteMany(insert_chunk_qry % target, [convert_row(row) for row in rows])
+    return len(rows), rows[-1][0]
+
+  def copy_rows(self, source, target, after_id):
+    """Copy all the rows of source following after_id into target, saving the progress.
+
+    Returns:
+      int, id of the last copied row.
+    """
+    copied = 0
+    while True:
+      count, after_id = self.copy_chunk(source, target, after_id)
+      if count:
+        self._execute(set_progress_qry, params=(MIGRATION_NAME, after_id))
+        copied += count
+        self.logger.info('%d row(s) copied from %s (last id: %d).', copied, source, after_id)
+      if count < self.chunk_size:
+        return after_id
+      time.sleep(self.pause)
+
+  def run(self, months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    """Migrate collected_stats to the schema version 2, resuming an interrupted migration.
+
+    Returns:
+      bool, True if the table was migrated, False if it already was.
+    """
+    if self.get_schema_version() >= storage.SCHEMA_VERSION:
+      self.logger.info('%s already has the schema version %d.', TABLE, storage.SCHEMA_VERSION)
+      return False
+    for ddl in BOOKKEEPING_DDL:
+      self._execute(ddl)
+
+    if not self.table_exists(OLD_TABLE):
+      if not self.table_exists(NEW_TABLE):
+        self.create_table(NEW_TABLE, months_ahead, today)
+      last_id = self.copy_rows(TABLE, NEW_TABLE, self.get_progress())
+      self.swap_tables(last_id)
+    elif not self.table_exists(TABLE):
+      # Interrupted between the renames of swap_tables.
+      self._execute('ALTER TABLE `%s` RENAME TO `%s`' % (NEW_TABLE, TABLE))
+    self._execute('ALTER TABLE `alert_watermarks` MODIFY `last_id` bigint(20) NOT NULL '
+                  'DEFAULT \'0\'')
+    self._execute(set_schema_version_qry, params=(storage.SCHEMA_VERSION,))
+    self.logger.info('%s migrated to the schema version %d, the previous table is kept as %s.',
+                     TABLE, storage.SCHEMA_VERSION, OLD_TABLE)
+    return True
+
+  def swap_tables(self, after_id):
+    """Copy the rows of collected_stats following after_id and swap it with the new table.
+
+    Both tables are write locked (the collector waits) while the last rows are copied and the
+    tables renamed, so collected_stats has all its rows, with their ids, as soon as it's the new
+    table: the alerter never skips rows copied after it moved its watermarks past their ids.
+    """
+    with self.db.Transaction() as cursor:
+      cursor.execute('LOCK TABLES `%s` WRITE, `%s` WRITE' % (TABLE, NEW_TABLE))
+      try:
+        copied = 0
+        while True:
+          cursor.execute(select_chunk_qry % TABLE, (after_id, self.chunk_size))
+          rows = cursor.fetchall()
+          if not rows:
+            break
+          cursor.executemany(insert_chunk_qry % NEW_TABLE, [convert_row(row) for row in rows])
+          copied += len(rows)
+          after_id = rows[-1][0]
+        # RENAME TABLE isn't allowed on locked tables before MySQL 8.0.13, ALTER TABLE is.
+        cursor.execute('ALTER TABLE `%s` RENAME TO `%s`' % (TABLE, OLD_TABLE))
+        cursor.execute('ALTER TABLE `%s` RENAME TO `%s`' % (NEW_TABLE, TABLE))
+      finally:
+        cursor.execute('UNLOCK TABLES')
+    self._execute(set_progress_qry, params=(MIGRATION_NAME, after_id))
+    self.logger.info('%d row(s) copied under lock, %s swapped with %s.', copied, TABLE, NEW_TABLE)
+
+  def create_table(self, table, months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    """Create table with monthly partitions covering the existing rows up to months_ahead."""
+    today = today or datetime.date.today()
+    first_date = self._execute('SELECT MIN(collection_date) FROM `%s`' % TABLE, 'fetchone()')[0]
+    first_month = get_month_start(first_date or today)
+    last_month = add_months(get_month_start(today), months_ahead)
+    self._execute(TABLE_DDL % {'table': table,
+                               'partitions': get_table_partitions(first_month, last_month)})
+    self.logger.info('%s created with partitions from %s to %s.', table, first_month, last_month)
+
+  def add_partitions(self, months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    """Split p_future so collected_stats has a partition per month up to months_ahead.
+
+    Returns:
+      list of str, names of the created partitions.
+    """
+    today = today or datetime.date.today()
+    existing = [row[0] for row in self._execute(partitions_qry, 'fetchall()', (TABLE,)) or []]
+    if 'p_future' not in existing:
+      raise MigrationError('%s isn\'t partitioned, run the migration first.' % TABLE)
+    monthly = sorted(name for name in existing if name.startswith('p') and name[1:].isdigit())
+    month = get_month_start(today)
+    if monthly:
+      last = datetime.date(int(monthly[-1][1:5]), int(monthly[-1][5:7]), 1)
+      month = max(month, add_months(last, 1))
+    months = []
+    while month <= add_months(get_month_start(today), months_ahead):
+      months.append(month)
+      month = add_months(month, 1)
+    if not months:
+      return []
+    # Only p_future is rebuilt, it's empty unless partitions weren't added in time.
+    clauses = get_partition_clauses(months) + ['PARTITION p_future VALUES LESS THAN MAXVALUE']
+    self._execute('ALTER TABLE `%s` REORGANIZE PARTITION p_future INTO (%s)' % (
+        TABLE, ', '.join(clauses)))
+    names = [get_partition_name(m) for m in months]
+    self.logger.info('Partitions added to %s: %s', TABLE, ', '.join(names))
+    return names
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('command', choices=('status', 'run', 'add-partitions'),
+      help='status: print the schema version. run: migrate collected_stats to the current schema'
+           ' version. add-partitions: create the monthly partitions of the coming months.')
+  parser.add_argument('-u', '--username', required=False, default=config.DEFAULT_USERNAME,
+      help='username used for DB operations.')
+  parser.add_argument('-p', '--password', required=False, default=config.DEFAULT_PASSWORD,
+      help='username used for DB operations.')
+  parser.add_argument('--chunk-size', required=False, default=DEFAULT_CHUNK_SIZE, type=int,
+      help='Number of rows copied per transaction.')
+  parser.add_argument('--pause', required=False, default=DEFAULT_PAUSE, type=float,
+      help='Number of seconds slept between two chunks.')
+  parser.add_argument('--months-ahead', required=False, default=DEFAULT_MONTHS_AHEAD, type=int,
+      help='Number of months ahead for which partitions are created.')
+  args = parser.parse_args()
+
+  db = storage.DB(storage.Storage.DEFAULT_DB_NAME, args.username, args.password,
+                  storage.Storage.DEFAULT_DB_HOSTNAME, global_logger)
+  migrator = Migrator(db, chunk_size=args.chunk_size, pause=args.pause)
+  try:
+    if args.command == 'status':
+      print('Schema version: %d (current: %d)' % (migrator.get_schema_version(),
+                                                  storage.SCHEMA_VERSION))
+    elif args.command == 'run':
+      migrator.run(args.months_ahead)
+      migrator.add_partitions(args.months_ahead)
+    else:
+      migrator.add_partitions(args.months_ahead)
+  except (storage.StorageError, MigrationError) as e:
+    global_logger.error('Migration failed: %s', e.msg)
+    return 1
+  finally:
+    db.Close()
+  return 0
+
+
+if __name__ == '__main__':
+  exit(main())
@@ -0,0 +1,149 @@
+import contextlib
+import datetime
+import unittest
+
+from unittest import mock
+
+import migrate
+
+from lib import storage
+
+
+class FakeDB(object):
+  """Stand-in of storage.DB keeping the rows of collected_stats tables in memory."""
+
+  def __init__(self, rows):
+    self.tables = {'collected_stats': list(rows)}
+    self.version = 1
+    self.statements = []
+
+  def ExecuteQuery(self, query, return_type='lastrowid', params=None, raise_errors=False):
+    self.statements.append(query)
+    if query == migrate.table_exists_qry:
+      return (1 if params[0] in self.tables else 0,)
+    if query == migrate.schema_version_qry:
+      return (self.version,)
+    if query == migrate.get_progress_qry:
+      return (self.tables.get('progress', 0),)
+    if query == migrate.set_progress_qry:
+      self.tables['progress'] = params[1]
+    elif query == migrate.set_schema_version_qry:
+      self.version = params[0]
+    elif query.startswith('CREATE TABLE IF NOT EXISTS `schema_version`'):
+      self.tables['schema_version'] = []
+    elif query.startswith('CREATE TABLE IF NOT EXISTS `collected_stats_v2`'):
+      self.tables['collected_stats_v2'] = []
+    elif query.startswith('SELECT MIN(collection_date)'):
+      return (min(r[7] for r in self.tables['collected_stats']),)
+    elif query.startswith('SELECT COALESCE(MAX(id), 0)'):
+      return (max(r[0] for r in self.tables['collected_stats']),)
+    elif query.startswith('ALTER TABLE') and ' RENAME TO ' in query:
+      names = query.split('`')
+      self.tables[names[3]] = self.tables.pop(names[1])
+      if names[3] == 'collected_stats':
+        # What the alerter reads as soon as the tables are swapped.
+        self.swapped_ids = [r[0] for r in self.tables[names[3]]]
+    elif query.startswith('SELECT id, ip_addr'):
+      table = query.split('`')[1]
+      # Version 1 rows end with consulted_for_alerts, which isn't selected.
+      rows = [r[:8] for r in self.tables[table] if r[0] > params[0]]
+      return rows[:params[1]]
+    return 0
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    yield FakeCursor(self)
+
+  def ExecuteMany(self, query, rows):
+    self.tables[query.split('`')[1]].extend(rows)
+    return len(rows)
+
+
+class FakeCursor(object):
+  """Cursor of a FakeDB transaction."""
+
+  def __init__(self, db):
+    self.db = db
+    self.results = None
+
+  def execute(self, query, params=None):
+    self.results = self.db.ExecuteQuery(query, 'fetchall()', params)
+
+  def executemany(self, query, rows):
+    self.db.ExecuteMany(query, rows)
+
+  def fetchall(self):
+    return self.results
+
+
+class MigrateTest(unittest.TestCase):
+  def setUp(self):
+    self.date = datetime.datetime(2017, 9, 15)
+    rows = [(i, '1.1.1.1', 'posix', '1.5', '', '300', 'empty', self.date, 1) for i in range(1, 8)]
+    self.db = FakeDB(rows)
+    self.migrator = migrate.Migrator(self.db, chunk_size=3, pause=0)
+
+  def test_rows_copied_by_chunks(self):
+    self.assertTrue(self.migrator.run(today=datetime.date(2017, 10, 3)))
+    self.assertEqual(2, self.db.version)
+    migrated = self.db.tables['collected_stats']
+    self.assertEqual(list(range(1, 8)), [r[0] for r in migrated])
+    self.assertEqual((1.5, None, 300.0), migrated[0][3:6])
+    self.assertEqual(7, len(self.db.tables['collected_stats_v1']))
+    create = [q for q in self.db.statements
+              if q.startswith('CREATE TABLE IF NOT EXISTS `collected_stats_v2`')][0]
+    self.assertIn('PARTITION p201709 VALUES LESS THAN (TO_DAYS(\'2017-10-01\'))', create)
+    self.assertIn('PARTITION p201801', create)
+    self.assertFalse(self.migrator.run())
+
+  def test_rows_inserted_during_copy_caught_up(self):
+    original = self.migrator.copy_chunk
+
+    def copy_chunk(source, target, after_id):
+      count, last_id = original(source, target, after_id)
+      # The collector keeps inserting into the table being migrated, until it's locked.
+      if after_id == 0:
+        self.db.tables['collected_stats'].append(
+            (8, '2.2.2.2', 'posix', '1', '2', '3', 'empty', self.date, 0))
+      elif count < self.migrator.chunk_size:
+        self.db.tables['collected_stats'].append(
+            (9, '2.2.2.2', 'posix', '1', '2', '3', 'empty', self.date, 0))
+      return count, last_id
+
+    with mock.patch.object(self.migrator, 'copy_chunk', side_effect=copy_chunk):
+      self.migrator.run(today=datetime.date(2017, 10, 3))
+    self.assertEqual(list(range(1, 10)), [r[0] for r in self.db.tables['collected_stats']])
+    # An alerter running right after the swap moves its watermarks to the last id it reads: every
+    # row up to it has to be there already.
+    self.assertEqual(list(range(1, 10)), self.db.swapped_ids)
+    locked = self.db.statements.index(
+        'LOCK TABLES `collected_stats` WRITE, `collected_stats_v2` WRITE')
+    self.assertEqual('UNLOCK TABLES', self.db.statements[locked + 5])
+    self.assertEqual(9, self.db.tables['progress'])
+
+  def test_interrupted_swap_resumed(self):
+    self.db.tables['collected_stats_v1'] = self.db.tables.pop('collected_stats')
+    self.db.tables['collected_stats_v2'] = list(self.db.tables['collected_stats_v1'])
+    self.assertTrue(self.migrator.run(today=datetime.date(2017, 10, 3)))
+    self.assertEqual(7, len(self.db.tables['collected_stats']))
+    self.assertNotIn('collected_stats_v2', self.db.tables)
+
+  def test_add_partitions_splits_future(self):
+    db = mock.Mock()
+    db.ExecuteQuery.side_effect = [[('p_history',), ('p201710',), ('p_future',)], 0]
+    migrator = migrate.Migrator(db)
+    names = migrator.add_partitions(months_ahead=2, today=datetime.date(2017, 10, 20))
+    self.assertEqual(['p201711', 'p201712'], names)
+    alter = db.ExecuteQuery.call_args[0][0]
+    self.assertTrue(alter.startswith('ALTER TABLE `collected_stats` REORGANIZE PARTITION p_future'))
+    self.assertIn('PARTITION p201712 VALUES LESS THAN (TO_DAYS(\'2018-01-01\'))', alter)
+
+  def test_convert_row(self):
+    row = (3, '1.1.1.1', 'posix', 'inf', '20', 'x', 'empty', None)
+    self.assertEqual((3, '1.1.1.1', 'posix', None, 20.0, None, 'empty', migrate.UNKNOWN_DATE,
+                      migrate.UNKNOWN_DATE), migrate.convert_row(row))
+    self.assertIsNone(storage.Storage.ToFloat(None))
+
+
+if __name__ == '__main__':
+  unittest.main()
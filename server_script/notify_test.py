@@ -0,0 +1,64 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from lib import metrics
+from lib import notify
+
+
+class NotifyTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'alerter.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_publish_wait(self):
+    listener = notify.Listener(self.path)
+    publisher = notify.Publisher(self.path)
+    try:
+      self.assertEqual(set(), listener.wait(0))
+      self.assertTrue(publisher.publish(['1.1.1.1', '2.2.2.2']))
+      self.assertTrue(publisher.publish(['1.1.1.1', '3.3.3.3']))
+      # Pending notifications are merged.
+      self.assertEqual({'1.1.1.1', '2.2.2.2', '3.3.3.3'}, listener.wait(1))
+      self.assertEqual(set(), listener.wait(0))
+    finally:
+      publisher.close()
+      listener.close()
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_large_notification_encode(self):
+    ip_addrs = set('10.0.%d.%d' % (i // 256, i % 256) for i in range(4000))
+    datagrams = notify.encode(ip_addrs)
+    self.assertGreater(len(datagrams), 1)
+    self.assertTrue(all(len(d) <= notify.MAX_DATAGRAM_SIZE for d in datagrams))
+    self.assertEqual(ip_addrs, set().union(*[notify.decode(d) for d in datagrams]))
+
+  def test_without_listener_publish(self):
+    publisher = notify.Publisher(self.path)
+    dropped = metrics.NOTIFICATIONS.get(result='dropped')
+    self.assertFalse(publisher.publish(['1.1.1.1']))
+    # Used as a flush listener, it never raises.
+    publisher(['1.1.1.1'])
+    self.assertEqual(dropped + 2, metrics.NOTIFICATIONS.get(result='dropped'))
+    publisher.close()
+
+  def test_stale_socket_listener(self):
+    # Socket left by a listener which was killed.
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(self.path)
+    stale.close()
+    listener = notify.Listener(self.path)
+    try:
+      with self.assertRaises(notify.NotifyError):
+        notify.Listener(self.path)
+    finally:
+      listener.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,339 @@
+"""Query the stats history: aggregates of metrics of machines over a time range.
+
+Queries are answered from the rollups (see lib/rollup.py) rather than by scanning collected_stats,
+so they don't compete with the ingestion. Aggregates are count, min, max, avg, sum and percentiles
+(p50, p95, p99.9...), per machine and metric, per step of the range with --step, and of the whole
+fleet with --fleet (percentiles of the merged sketches).
+
+With --serve the same queries are answered over HTTP (GET /query?host=...&metric=...&start=...
+&end=...&agg=...&step=...&fleet=1, JSON) by a long running process which keeps the results of the
+last queries in a LRU cache (see lib/query_cache.py): dashboards repeating the same queries only
+hit the DB when stats of their machines were stored.
+
+Ranges are rounded to the minute, the finest rollup, so relative ranges ("the last hour", the
+default) map to the same cached result for a minute.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import sys
+import urllib.parse
+
+from collections import namedtuple
+from http import server
+
+from lib import config
+from lib import query_cache
+from lib import rollup
+from lib import storage
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+global_logger = logging.getLogger(__name__)
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d')
+AGGREGATIONS = ('count', 'min', 'max', 'avg', 'sum')
+DEFAULT_AGGREGATIONS = ('count', 'avg', 'max', 'p95')
+DEFAULT_RANGE = datetime.timedelta(hours=1)
+# Host of the aggregates of the whole fleet.
+FLEET = 'fleet'
+
+# ip_addrs and metrics: lists of str, start and end: datetime.datetime, aggregations: list of str
+# (see get_aggregate), step: int number of seconds or None, fleet: boolean.
+Query = namedtuple('Query', 'ip_addrs metrics start end aggregations step fleet')
+Query.__new__.__defaults__ = (None, False)
+
+
+class QueryError(Exception):
+  """Exception raised when a query is invalid."""
+
+  def __init__(self, msg):
+    super(QueryError, self).__init__(msg)
+    self.msg = msg
+
+
+def parse_time(value):
+  """Return the datetime.datetime of value: epoch seconds or one of TIME_FORMATS (local time)."""
+  try:
+    return datetime.datetime.fromtimestamp(float(value))
+  except (OverflowError, OSError, ValueError):
+    pass
+  for time_format in TIME_FORMATS:
+    try:
+      return datetime.datetime.strptime(value, time_format)
+    except ValueError:
+      pass
+  raise QueryError('Invalid time: %s' % value)
+
+
+def parse_aggregations(value):
+  """Return the list of aggregations of value, comma separated (see get_aggregate)."""
+  aggregations = [a.strip() for a in value.split(',') if a.strip()]
+  for aggregation in aggregations:
+    if aggregation not in AGGREGATIONS and _get_quantile(aggregation) is None:
+      raise QueryError('Unknown aggregation: %s' % aggregation)
+  if not aggregations:
+    raise QueryError('No aggregation')
+  return aggregations
+
+
+def _get_quantile(aggregation):
+  """Return the quantile of a pNN aggregation (p95: 0.95), None if it isn't one."""
+  if not aggregation.startswith('p'):
+    return None
+  try:
+    q = float(aggregation[1:]) / 100
+  except ValueError:
+    return None
+  return q if 0 <= q <= 1 else None
+
+
+def get_aggregate(summary, aggregation):
+  """Return an aggregation of summary (rollup.Rollup), None if it has no value."""
+  if aggregation == 'count':
+    return summary.count
+  if not summary.count:
+    return None
+  if aggregation == 'avg':
+    return summary.mean
+  if aggregation in ('min', 'max', 'sum'):
+    return getattr(summary, aggregation)
+  return summary.quantile(_get_quantile(aggregation))
+
+
+def make_query(ip_addrs, metric_names, start=None, end=None, aggregations=None, step=None,
+               fleet=False):
+  """Return the Query of the raw parameters (str) of a request, with their defaults.
+
+  Raises:
+    QueryError: if a parameter is invalid.
+  """
+  if not ip_addrs:
+    raise QueryError('No machine')
+  if not metric_names:
+    raise QueryError('No metric')
+  for metric in metric_names:
+    if metric not in rollup.METRICS + rollup.EXTRA_METRICS:
+      raise QueryError('Unknown metric: %s' % metric)
+  end = parse_time(end) if end else datetime.datetime.now()
+  start = parse_time(start) if start else end - DEFAULT_RANGE
+  # Buckets of the rollups are minutes, results don't change within a minute.
+  start = rollup.get_bucket_start(start, rollup.MINUTE)
+  end = rollup.get_next_bucket_start(end, rollup.MINUTE)
+  if start >= end:
+    raise QueryError('Empty time range')
+  if step is not None:
+    try:
+      step = int(step)
+    except ValueError:
+      raise QueryError('Invalid step: %s' % step)
+    if step < rollup.MINUTE.seconds:
+      raise QueryError('Step has to be at least %d seconds' % rollup.MINUTE.seconds)
+  return Query(ip_addrs=sorted(set(ip_addrs)), metrics=sorted(set(metric_names)), start=start,
+               end=end, aggregations=parse_aggregations(aggregations or
+                                                        ','.join(DEFAULT_AGGREGATIONS)),
+               step=step, fleet=fleet)
+
+
+def run_query(reader, query):
+  """Answer query.
+
+  Args:
+    reader: query_cache.QueryCache, or storage.Storage to read without cache.
+    query: Query namedtuple.
+
+  Returns:
+    list of dict, a row per machine (FLEET for the whole fleet), metric and step (if any), having
+    the keys host, metric, time (start of the step, None without step) and the aggregations.
+    Ordered by host, metric and time.
+  """
+  if query.step:
+    results = reader.get_fleet_series(query.ip_addrs, query.metrics, query.start, query.end,
+                                      query.step)
+  else:
+    results = dict((key, [(None, summary)]) for key, summary in reader.get_fleet_summary(
+        query.ip_addrs, query.metrics, query.start, query.end).items())
+  if query.fleet:
+    merged = {}
+    for (_, metric), points in results.items():
+      for step_start, summary in points:
+        # Cached summaries are shared, they're merged into new ones.
+        merged.setdefault((metric, step_start), rollup.Rollup()).merge(summary)
+    results = {}
+    for (metric, step_start), summary in sorted(merged.items(), key=_get_point_key):
+      results.setdefault((FLEET, metric), []).append((step_start, summary))
+  rows = []
+  for (ip_addr, metric), points in sorted(results.items()):
+    for step_start, summary in points:
+      row = {'host': ip_addr, 'metric': metric, 'time': step_start}
+      for aggregation in query.aggregations:
+        row[aggregation] = get_aggregate(summary, aggregation)
+      rows.append(row)
+  return rows
+
+
+def _get_point_key(item):
+  (metric, step_start), _ = item
+  return metric, step_start or datetime.datetime.min
+
+
+def format_rows(rows, query):
+  """Return rows (see run_query) as text, a line per row."""
+  columns = ['host', 'metric'] + (['time'] if query.step else []) + query.aggregations
+  lines = ['\t'.join(columns)]
+  for row in rows:
+    values = []
+    for column in columns:
+      value = row[column]
+      if value is None:
+        values.append('-')
+      elif isinstance(value, float):
+        values.append('%.2f' % value)
+      else:
+        values.append(str(value))
+    lines.append('\t'.join(values))
+  return '\n'.join(lines)
+
+
+def _format_json_value(value):
+  if isinstance(value, datetime.datetime):
+    return value.isoformat()
+  raise TypeError('%r is not JSON serializable' % value)
+
+
+class QueryHandler(server.BaseHTTPRequestHandler):
+  """Answers GET /query requests, the parameters of make_query being passed in the query string:
+  host and metric (repeated, or comma separated), start, end, agg, step and fleet."""
+
+  # Set by serve()
+  cache = None
+  get_hosts = None
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    if url.path != '/query':
+      self._reply(404, {'error': 'Unknown path: %s' % url.path})
+      return
+    params = urllib.parse.parse_qs(url.query)
+
+    def get_list(name):
+      return [v for value in params.get(name, []) for v in value.split(',') if v]
+
+    def get_param(name):
+      values = params.get(name)
+      return values[-1] if values else None
+    try:
+      query = make_query(get_list('host') or self.get_hosts(), get_list('metric'),
+                         start=get_param('start'), end=get_param('end'),
+                         aggregations=get_param('agg'), step=get_param('step'),
+                         fleet=get_param('fleet') in ('1', 'true'))
+      rows = run_query(self.cache, query)
+    except QueryError as e:
+      self._reply(400, {'error': e.msg})
+      return
+    except storage.StorageError as e:
+      global_logger.error('Query %s failed: %s', self.path, e.msg)
+      self._reply(503, {'error': 'Stats couldn\'t be read'})
+      return
+    self._reply(200, {'rows': rows})
+
+  def _reply(self, status, body):
+    data = json.dumps(body, default=_format_json_value).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, log_format, *args):
+    global_logger.debug('%s - %s', self.address_string(), log_format % args)
+
+
+def serve(db, address, port, max_entries, xml_file=config.DEFAULT_XML_FILE):
+  """Answer the queries of HTTP clients until interrupted."""
+  watcher = config.ConfigWatcher(xml_file, include_alerts=False, logger=global_logger)
+  watcher.start()
+  handler = type('Handler', (QueryHandler,), {
+      'cache': query_cache.QueryCache(db, max_entries=max_entries),
+      'get_hosts': staticmethod(lambda: [m.ip for m in watcher.get_clients()])})
+  httpd = server.ThreadingHTTPServer((address, port), handler)
+  global_logger.info('Serving the stats queries on %s:%d.', address, port)
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    httpd.server_close()
+    watcher.stop()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-u', '--username', required=False, default=config.DEFAULT_USERNAME,
+      help='username used for DB operations.')
+  parser.add_argument('-p', '--password', required=False, default=config.DEFAULT_PASSWORD,
+      help='username used for DB operations.')
+  parser.add_argument('--backend', required=False, default=config.DEFAULT_STORAGE_BACKEND,
+      choices=storage.BACKENDS, help='Database the stats are read from.')
+  parser.add_argument('--sqlite-file', required=False, default=config.DEFAULT_SQLITE_FILE,
+      help='Database file of the sqlite backend.')
+  parser.add_argument('--host', required=False, action='append', default=[],
+      help='ip address of a machine (repeated or comma separated), every machine of config.xml'
+           ' if not set.')
+  parser.add_argument('--metric', required=False, action='append', default=[],
+      help='Metric (repeated or comma separated): %s.' % ', '.join(rollup.METRICS +
+                                                                rollup.EXTRA_METRICS))
+  parser.add_argument('--start', required=False, default=None,
+      help='Start of the range: epoch seconds or YYYY-MM-DD[ HH:MM[:SS]], an hour before the end'
+           ' if not set.')
+  parser.add_argument('--end', required=False, default=None,
+      help='End of the range (excluded), now if not set.')
+  parser.add_argument('--agg', required=False, default=','.join(DEFAULT_AGGREGATIONS),
+      help='Comma separated aggregations: %s and percentiles (p50, p99.9...).' %
+           ', '.join(AGGREGATIONS))
+  parser.add_argument('--step', required=False, default=None, type=int,
+      help='Aggregate per step of this number of seconds rather than over the whole range.')
+  parser.add_argument('--fleet', required=False, action='store_true',
+      help='Aggregate the machines together.')
+  parser.add_argument('--serve', required=False, action='store_true',
+      help='Answer the queries over HTTP (GET /query) instead, see --port.')
+  parser.add_argument('--bind', required=False, default=config.DEFAULT_QUERY_ADDRESS,
+      help='Address the HTTP server listens on.')
+  parser.add_argument('--port', required=False, default=config.DEFAULT_QUERY_PORT, type=int,
+      help='Port the HTTP server listens on.')
+  parser.add_argument('--cache-size', required=False, default=query_cache.DEFAULT_MAX_ENTRIES,
+      type=int, help='Maximum number of query results cached by the HTTP server.')
+  args = parser.parse_args()
+
+  try:
+    db = storage.open_storage(args.backend, args.username, args.password,
+                              sqlite_file=args.sqlite_file, pool_size=config.DEFAULT_DB_POOL_SIZE)
+  except storage.StorageError as e:
+    global_logger.error('Stats can\'t be read: %s', e.msg)
+    return 1
+  try:
+    if args.serve:
+      serve(db, args.bind, args.port, args.cache_size)
+      return 0
+    ip_addrs = [v for value in args.host for v in value.split(',') if v]
+    if not ip_addrs:
+      ip_addrs = [m.ip for m in config.get_clients_details(include_alerts=False)]
+    query = make_query(ip_addrs, [v for value in args.metric for v in value.split(',') if v],
+                       start=args.start, end=args.end, aggregations=args.agg, step=args.step,
+                       fleet=args.fleet)
+    print(format_rows(run_query(db, query), query))
+  except QueryError as e:
+    parser.error(e.msg)
+  except storage.StorageError as e:
+    global_logger.error('Query failed: %s', e.msg)
+    return 1
+  finally:
+    db.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
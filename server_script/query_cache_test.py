@@ -0,0 +1,75 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from lib import query_cache
+from lib import storage
+
+
+class QueryCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db = storage.open_storage(storage.SQLITE,
+                                   sqlite_file=os.path.join(self.tmp_dir, 'fleet_health.db'))
+    self.start = datetime.datetime(2017, 1, 2)
+    self.end = self.start + datetime.timedelta(days=1)
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def store(self, db, ip_addr, cpu_usage):
+    db.store_machine_stats(ip_addr, ['posix', str(cpu_usage), '1', '1', ''], self.start)
+
+  def test_invalidated_by_stored_stats(self):
+    self.store(self.db, '1.1.1.1', 10)
+    cache = query_cache.QueryCache(self.db, check_interval=0)
+    with mock.patch.object(self.db, 'get_fleet_summary',
+                           wraps=self.db.get_fleet_summary) as mock_read:
+      first = cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+      self.assertIs(first, cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start,
+                                                   self.end))
+      self.assertEqual(1, mock_read.call_count)
+      # Stored through the same Storage: the flush listener drops the result.
+      self.store(self.db, '1.1.1.1', 30)
+      summary = cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+      self.assertEqual(20.0, summary[('1.1.1.1', 'cpu_usage')].mean)
+      self.assertEqual(2, mock_read.call_count)
+
+      # Stored by another process (the collector): found by the check of the stored ids.
+      other = storage.open_storage(storage.SQLITE,
+                                   sqlite_file=os.path.join(self.tmp_dir, 'fleet_health.db'))
+      self.store(other, '2.2.2.2', 50)
+      cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+      self.assertEqual(2, mock_read.call_count)
+      self.store(other, '1.1.1.1', 50)
+      other.close()
+      summary = cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+      self.assertEqual(3, summary[('1.1.1.1', 'cpu_usage')].count)
+      self.assertEqual(3, mock_read.call_count)
+
+  def test_least_recently_used_dropped(self):
+    cache = query_cache.QueryCache(self.db, max_entries=2)
+    for ip_addr in ('1.1.1.1', '2.2.2.2', '1.1.1.1', '3.3.3.3'):
+      cache.get_fleet_series([ip_addr], ['cpu_usage'], self.start, self.end, 3600)
+    self.assertEqual(2, len(cache))
+    with mock.patch.object(self.db, 'get_fleet_series', return_value={}) as mock_read:
+      cache.get_fleet_series(['1.1.1.1'], ['cpu_usage'], self.start, self.end, 3600)
+      self.assertFalse(mock_read.called)
+      cache.get_fleet_series(['2.2.2.2'], ['cpu_usage'], self.start, self.end, 3600)
+      self.assertTrue(mock_read.called)
+
+  def test_expired_results(self):
+    cache = query_cache.QueryCache(self.db, max_age=0)
+    with mock.patch.object(self.db, 'get_fleet_summary', return_value={}) as mock_read:
+      cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+      cache.get_fleet_summary(['1.1.1.1'], ['cpu_usage'], self.start, self.end)
+    self.assertEqual(2, mock_read.call_count)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+import datetime
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from http import server
+
+import query
+
+from lib import query_cache
+from lib import storage
+
+
+class QueryTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db = storage.open_storage(storage.SQLITE,
+                                   sqlite_file=os.path.join(self.tmp_dir, 'fleet_health.db'))
+    self.start = datetime.datetime(2017, 1, 2)
+    for i, (ip_addr, cpu_usage) in enumerate((('1.1.1.1', 10), ('1.1.1.1', 30), ('2.2.2.2', 50),
+                                              ('2.2.2.2', 70))):
+      self.db.buffer_machine_stats(ip_addr, ['posix', str(cpu_usage), '1', '1', ''],
+                                   self.start + datetime.timedelta(hours=i))
+    self.db.flush()
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_make_query(self):
+    q = query.make_query(['2.2.2.2', '1.1.1.1'], ['cpu_usage'], start='2017-01-02 10:00:30',
+                         end='2017-01-02 11:00:30', aggregations='avg,p99.9', step='60')
+    self.assertEqual((['1.1.1.1', '2.2.2.2'], datetime.datetime(2017, 1, 2, 10),
+                      datetime.datetime(2017, 1, 2, 11, 1), ['avg', 'p99.9'], 60),
+                     (q.ip_addrs, q.start, q.end, q.aggregations, q.step))
+    for kwargs in ({'metric_names': ['unknown']}, {'aggregations': 'median'},
+                   {'start': 'yesterday'}, {'step': '10'},
+                   {'start': '2017-01-02', 'end': '2017-01-01'}):
+      params = {'ip_addrs': ['1.1.1.1'], 'metric_names': ['cpu_usage']}
+      params.update(kwargs)
+      with self.assertRaises(query.QueryError):
+        query.make_query(**params)
+
+  def test_run_query(self):
+    q = query.make_query(['1.1.1.1', '2.2.2.2'], ['cpu_usage'], start='2017-01-02',
+                         end='2017-01-03', aggregations='count,avg,max')
+    self.assertEqual([{'host': '1.1.1.1', 'metric': 'cpu_usage', 'time': None, 'count': 2,
+                       'avg': 20.0, 'max': 30.0},
+                      {'host': '2.2.2.2', 'metric': 'cpu_usage', 'time': None, 'count': 2,
+                       'avg': 60.0, 'max': 70.0}], query.run_query(self.db, q))
+    q = q._replace(step=7200, fleet=True)
+    rows = query.run_query(query_cache.QueryCache(self.db), q)
+    self.assertEqual([(self.start, 2, 20.0), (self.start + datetime.timedelta(hours=2), 2, 60.0)],
+                     [(r['time'], r['count'], r['avg']) for r in rows])
+    self.assertEqual({query.FLEET}, set(r['host'] for r in rows))
+
+  def test_serve_query(self):
+    handler = type('Handler', (query.QueryHandler,), {
+        'cache': query_cache.QueryCache(self.db),
+        'get_hosts': staticmethod(lambda: ['1.1.1.1', '2.2.2.2'])})
+    httpd = server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+      connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+      connection.request('GET', '/query?metric=cpu_usage&start=2017-01-02&end=2017-01-03'
+                                '&agg=max&fleet=1')
+      response = connection.getresponse()
+      self.assertEqual(200, response.status)
+      self.assertEqual([{'host': query.FLEET, 'metric': 'cpu_usage', 'time': None, 'max': 70.0}],
+                       json.loads(response.read().decode('utf-8'))['rows'])
+      connection.request('GET', '/query?metric=unknown')
+      response = connection.getresponse()
+      self.assertEqual(400, response.status)
+      response.read()
+      connection.close()
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+      thread.join()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,255 @@
+"""Retention of collected_stats: old records are moved to compressed columnar archives.
+
+Records collected more than --max-age days ago are exported to the archive of their machine and
+month (see lib/archive.py) then deleted from collected_stats, so the table the collector and the
+alerter work on stays small. Machines are handled one at a time: their records are read by chunks
+of ids (ranges of idx_ip_addr_id) and each month is archived, synced to disk, then deleted by
+chunks of ids, each chunk being a short transaction followed by a pause which leaves room to the
+collector and alerter queries. An interrupted run is resumed by the next one, records which were
+archived but not deleted yet are skipped by the archive.
+
+Records are scanned by id and collection_date is the insertion time: the scan of a machine stops
+at its first record within --max-age. On MySQL, the monthly partitions (see migrate.py) left empty
+are then dropped, which gives their space back right away. SQLite reuses the pages of the deleted
+records for the new ones.
+
+`python3 retention.py read --host <ip>` prints records read from the archives only, without any
+DB, and lib/archive.py reads the columns of the archives as numpy arrays for offline analysis.
+"""
+
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+import migrate
+import query
+
+from lib import archive
+from lib import config
+from lib import storage
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+global_logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+# Seconds slept between two chunks, leaves room to the collector and alerter queries.
+DEFAULT_PAUSE = 0.1
+
+get_hosts_qry = '''SELECT DISTINCT ip_addr FROM collected_stats'''
+# Columns of archive.COLUMNS, a range of idx_ip_addr_id.
+select_chunk_qry = '''SELECT id, os, cpu_usage, mem_usage, uptime, event_logs, sampled_at,
+  collection_date, extra_metrics FROM collected_stats WHERE ip_addr = %s AND id > %s
+  ORDER BY id LIMIT %s'''
+delete_chunk_qry = '''DELETE FROM collected_stats WHERE id IN (%s)'''
+# Formatted with the partition name.
+partition_has_rows_qry = '''SELECT 1 FROM collected_stats PARTITION (%s) LIMIT 1'''
+
+
+class Retention(object):
+  """Archive and delete the old records of collected_stats."""
+
+  def __init__(self, db, archive_dir=config.DEFAULT_ARCHIVE_DIR,
+               max_age=config.DEFAULT_RETENTION_DAYS, chunk_size=DEFAULT_CHUNK_SIZE,
+               pause=DEFAULT_PAUSE, partitioned=False, logger=None):
+    """Create a Retention.
+
+    Args:
+      db: storage.DB instance.
+      archive_dir: str, directory of the archives.
+      max_age: float, number of days records are kept in collected_stats.
+      chunk_size: int, number of records read or deleted per query.
+      pause: float, number of seconds slept between two chunks.
+      partitioned: bool, drop the monthly partitions left empty (MySQL, see migrate.py).
+    """
+    self.db = db
+    self.archive_dir = archive_dir
+    self.max_age = max_age
+    self.chunk_size = chunk_size
+    self.pause = pause
+    self.partitioned = partitioned
+    self.logger = logger or global_logger
+
+  def _execute(self, query, return_type='rowcount', params=None):
+    return self.db.ExecuteQuery(query, return_type, params, raise_errors=True)
+
+  def run(self, now=None):
+    """Archive and delete the records collected before max_age days ago.
+
+    Returns:
+      int, number of deleted records.
+    """
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=self.max_age)
+    deleted = 0
+    for ip_addr in sorted(row[0] for row in self._execute(get_hosts_qry, 'fetchall()') or []):
+      deleted += self.purge_host(ip_addr, cutoff)
+    self.logger.info('%d record(s) collected before %s archived to %s and deleted.', deleted,
+                     cutoff, self.archive_dir)
+    if self.partitioned:
+      self.drop_partitions(cutoff)
+    return deleted
+
+  def purge_host(self, ip_addr, cutoff):
+    """Archive and delete the records of ip_addr collected before cutoff.
+
+    Returns:
+      int, number of deleted records.
+    """
+    deleted = 0
+    month, month_rows = None, []
+    after_id = 0
+    while True:
+      rows = self._execute(select_chunk_qry, 'fetchall()', (ip_addr, after_id, self.chunk_size))
+      rows = list(rows or [])
+      done = len(rows) < self.chunk_size
+      for row in rows:
+        collection_date = row[7]
+        if collection_date >= cutoff:
+          done = True
+          break
+        row_month = migrate.get_month_start(collection_date)
+        if row_month != month and month_rows:
+          deleted += self.purge_month(ip_addr, month, month_rows)
+          month_rows = []
+        month = row_month
+        month_rows.append(row)
+      if done:
+        break
+      after_id = rows[-1][0]
+      time.sleep(self.pause)
+    if month_rows:
+      deleted += self.purge_month(ip_addr, month, month_rows)
+    return deleted
+
+  def purge_month(self, ip_addr, month, rows):
+    """Archive rows of ip_addr collected during month, then delete them by chunks.
+
+    Returns:
+      int, number of deleted records.
+    """
+    added = archive.store_rows(self.archive_dir, ip_addr, month, rows)
+    self.logger.info('%d record(s) of %s archived to %s.', added, ip_addr,
+                     archive.get_path(self.archive_dir, ip_addr, month))
+    deleted = 0
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), self.chunk_size):
+      chunk = ids[i:i + self.chunk_size]
+      deleted += self._execute(delete_chunk_qry % ', '.join(['%s'] * len(chunk)),
+                               params=tuple(chunk)) or 0
+      time.sleep(self.pause)
+    return deleted
+
+  def drop_partitions(self, cutoff):
+    """Drop the partitions of collected_stats of the months before cutoff which are empty.
+
+    Returns:
+      list of str, names of the dropped partitions.
+    """
+    existing = [row[0] for row in self._execute(migrate.partitions_qry, 'fetchall()',
+                                                (migrate.TABLE,)) or []]
+    cutoff_month = migrate.get_month_start(cutoff)
+    dropped = []
+    for name in sorted(existing):
+      if name == 'p_history':
+        expired = True
+      elif name.startswith('p') and name[1:].isdigit():
+        expired = migrate.add_months(datetime.date(int(name[1:5]), int(name[5:7]), 1),
+                                     1) <= cutoff_month
+      else:
+        expired = False
+      # A partition holding rows (which didn't expire yet, or the scan stopped before) is kept.
+      if expired and not self._execute(partition_has_rows_qry % name, 'fetchall()'):
+        dropped.append(name)
+    if dropped:
+      self._execute('ALTER TABLE `%s` DROP PARTITION %s' % (migrate.TABLE, ', '.join(dropped)))
+      self.logger.info('Partitions dropped from %s: %s', migrate.TABLE, ', '.join(dropped))
+    return dropped
+
+
+def format_history(columns, names):
+  """Return the tab separated lines of the archived columns (see archive.read_history)."""
+  lines = ['\t'.join(names)]
+  for i in range(len(columns[names[0]]) if names else 0):
+    values = []
+    for name in names:
+      value = columns[name][i]
+      if archive.COLUMN_KINDS[name] == archive.TIME:
+        value = '' if value != value else str(value.astype('datetime64[s]')).replace('T', ' ')
+      elif value is None or value != value:
+        value = ''
+      values.append(str(value))
+    lines.append('\t'.join(values))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('command', choices=('run', 'read'),
+      help='run: archive and delete the records older than --max-age. read: print the archived'
+           ' records of --host.')
+  parser.add_argument('-u', '--username', required=False, default=config.DEFAULT_USERNAME,
+      help='username used for DB operations.')
+  parser.add_argument('-p', '--password', required=False, default=config.DEFAULT_PASSWORD,
+      help='username used for DB operations.')
+  parser.add_argument('--backend', required=False, default=config.DEFAULT_STORAGE_BACKEND,
+      choices=storage.BACKENDS, help='Database the stats are stored in.')
+  parser.add_argument('--sqlite-file', required=False, default=config.DEFAULT_SQLITE_FILE,
+      help='Database file of the sqlite backend.')
+  parser.add_argument('--archive-dir', required=False, default=config.DEFAULT_ARCHIVE_DIR,
+      help='Directory of the archives.')
+  parser.add_argument('--max-age', required=False, default=config.DEFAULT_RETENTION_DAYS,
+      type=float, help='Number of days records are kept in collected_stats.')
+  parser.add_argument('--chunk-size', required=False, default=DEFAULT_CHUNK_SIZE, type=int,
+      help='Number of records read or deleted per query.')
+  parser.add_argument('--pause', required=False, default=DEFAULT_PAUSE, type=float,
+      help='Number of seconds slept between two chunks.')
+  parser.add_argument('--host', required=False, default=None,
+      help='ip address of the machine whose archived records are read.')
+  parser.add_argument('--column', required=False, action='append', default=[],
+      help='Column read (repeated or comma separated): %s, all if not set.' %
+           ', '.join(archive.COLUMN_NAMES))
+  parser.add_argument('--start', required=False, default=None,
+      help='Start of the range read: epoch seconds or YYYY-MM-DD[ HH:MM[:SS]].')
+  parser.add_argument('--end', required=False, default=None,
+      help='End of the range read (excluded).')
+  args = parser.parse_args()
+
+  if args.command == 'read':
+    if not args.host:
+      parser.error('--host is required to read the archives.')
+    names = [v for value in args.column for v in value.split(',') if v] or list(
+        archive.COLUMN_NAMES)
+    try:
+      start = query.parse_time(args.start) if args.start else None
+      end = query.parse_time(args.end) if args.end else None
+      columns = archive.read_history(args.archive_dir, args.host, names, start, end)
+    except query.QueryError as e:
+      parser.error(e.msg)
+    except archive.ArchiveError as e:
+      global_logger.error('Archives can\'t be read: %s', e.msg)
+      return 1
+    print(format_history(columns, names))
+    return 0
+
+  try:
+    db = storage.open_storage(args.backend, args.username, args.password,
+                              sqlite_file=args.sqlite_file, rollups=False)
+  except storage.StorageError as e:
+    global_logger.error('Stats can\'t be read: %s', e.msg)
+    return 1
+  retention = Retention(db.db, args.archive_dir, args.max_age, chunk_size=args.chunk_size,
+                        pause=args.pause, partitioned=args.backend == storage.MYSQL)
+  try:
+    retention.run()
+  except (storage.StorageError, archive.ArchiveError, OSError) as e:
+    global_logger.error('Retention failed: %s', getattr(e, 'msg', e))
+    return 1
+  finally:
+    db.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,105 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+import retention
+
+from lib import archive
+from lib import storage
+
+
+class RetentionTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.archive_dir = os.path.join(self.tmp_dir, 'archive')
+    self.db = storage.open_storage(storage.SQLITE,
+                                   sqlite_file=os.path.join(self.tmp_dir, 'fleet_health.db'))
+    self.now = datetime.datetime(2017, 6, 1)
+    self.retention = retention.Retention(self.db.db, self.archive_dir, max_age=90, chunk_size=2,
+                                         pause=0)
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def insert(self, ip_addr, dates):
+    self.db.db.ExecuteMany(storage.Storage.insert_qry, [
+        (ip_addr, 'posix', float(i), 20.0, 300.0, 'log %d' % i, None, date, None)
+        for i, date in enumerate(dates)])
+
+  def get_stored(self):
+    return self.db.db.ExecuteQuery('SELECT ip_addr, collection_date FROM collected_stats '
+                                   'ORDER BY id', 'fetchall()')
+
+  def test_old_records_archived_and_deleted(self):
+    old = [datetime.datetime(2017, 1, 31, 23), datetime.datetime(2017, 2, 1),
+           datetime.datetime(2017, 2, 2), datetime.datetime(2017, 2, 3)]
+    recent = [datetime.datetime(2017, 5, 1)]
+    self.insert('1.1.1.1', old + recent)
+    self.insert('2.2.2.2', old[:1] + recent)
+
+    self.assertEqual(5, self.retention.run(now=self.now))
+    self.assertEqual([('1.1.1.1', recent[0]), ('2.2.2.2', recent[0])], self.get_stored())
+    self.assertEqual([datetime.date(2017, 1, 1), datetime.date(2017, 2, 1)],
+                     archive.get_months(self.archive_dir, '1.1.1.1'))
+    history = archive.read_history(self.archive_dir, '1.1.1.1',
+                                   ['collection_date', 'cpu_usage', 'event_logs'])
+    self.assertEqual(old, history['collection_date'].tolist())
+    self.assertEqual([0.0, 1.0, 2.0, 3.0], history['cpu_usage'].tolist())
+    self.assertEqual('log 3', history['event_logs'][3])
+    self.assertEqual(1, len(archive.read_history(self.archive_dir, '2.2.2.2', ['id'])['id']))
+    self.assertEqual(0, self.retention.run(now=self.now))
+
+  def test_interrupted_run_resumed(self):
+    dates = [datetime.datetime(2017, 1, 2, hour) for hour in range(5)]
+    self.insert('1.1.1.1', dates)
+    execute = self.retention._execute
+
+    def failing_delete(query, return_type='rowcount', params=None):
+      if query.startswith('DELETE') and params[0] > 2:
+        raise storage.StorageError('DB failure')
+      return execute(query, return_type, params)
+
+    with mock.patch.object(self.retention, '_execute', side_effect=failing_delete):
+      self.assertRaises(storage.StorageError, self.retention.run, now=self.now)
+    self.assertEqual(3, len(self.get_stored()))
+
+    # The records archived but not deleted by the interrupted run aren't archived twice.
+    self.assertEqual(3, self.retention.run(now=self.now))
+    self.assertEqual([], self.get_stored())
+    history = archive.read_history(self.archive_dir, '1.1.1.1', ['id', 'collection_date'])
+    self.assertEqual([1, 2, 3, 4, 5], history['id'].tolist())
+    self.assertEqual(dates, history['collection_date'].tolist())
+
+  def test_drop_partitions(self):
+    partitions = [('p_history',), ('p201701',), ('p201702',), ('p201703',), ('p_future',)]
+    db = mock.Mock()
+    db.ExecuteQuery.side_effect = lambda query, *args, **kwargs: (
+        partitions if 'information_schema' in query else
+        [(1,)] if 'p201702' in query else [])
+    dropped = retention.Retention(db, self.archive_dir, pause=0).drop_partitions(
+        datetime.datetime(2017, 3, 15))
+    self.assertEqual(['p201701', 'p_history'], dropped)
+    db.ExecuteQuery.assert_called_with(
+        'ALTER TABLE `collected_stats` DROP PARTITION p201701, p_history', 'rowcount', None,
+        raise_errors=True)
+
+  def test_format_history(self):
+    history = archive.read_history(self.archive_dir, '1.1.1.1', ['id'])
+    self.assertEqual('id', retention.format_history(history, ['id']))
+    archive.store_rows(self.archive_dir, '1.1.1.1', self.now, [
+        (1, 'posix', None, 20.0, 300.0, 'log', None, self.now, None)])
+    history = archive.read_history(self.archive_dir, '1.1.1.1',
+                                   ['collection_date', 'cpu_usage', 'mem_usage', 'sampled_at'])
+    self.assertEqual('collection_date\tcpu_usage\tmem_usage\tsampled_at\n'
+                     '2017-06-01 00:00:00\t\t20.0\t',
+                     retention.format_history(history, ['collection_date', 'cpu_usage',
+                                                        'mem_usage', 'sampled_at']))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,65 @@
+import datetime
+import unittest
+
+from lib import rollup
+from lib import sketch
+
+
+class SketchTest(unittest.TestCase):
+  def test_quantiles_within_relative_accuracy(self):
+    quantile_sketch = sketch.QuantileSketch()
+    for i in range(1, 10001):
+      quantile_sketch.add(i / 100.0)
+    for q, expected in ((0.5, 50.0), (0.95, 95.0), (0.99, 99.0)):
+      self.assertAlmostEqual(expected, quantile_sketch.quantile(q), delta=expected * 0.011)
+
+  def test_merged_serialized_sketches(self):
+    first, second = sketch.QuantileSketch(), sketch.QuantileSketch()
+    for value in (0, 1, 2):
+      first.add(value)
+    second.add(100, count=3)
+    merged = sketch.QuantileSketch.from_bytes(first.to_bytes()).merge(
+        sketch.QuantileSketch.from_bytes(second.to_bytes()))
+    self.assertEqual(6, merged.count)
+    self.assertEqual(0.0, merged.quantile(0))
+    self.assertAlmostEqual(100, merged.quantile(1), delta=1)
+    with self.assertRaises(sketch.SketchError):
+      sketch.QuantileSketch.from_bytes(first.to_bytes()[:-1])
+
+  def test_bounded_buckets(self):
+    quantile_sketch = sketch.QuantileSketch(max_buckets=10)
+    for i in range(1, 1000):
+      quantile_sketch.add(i)
+    self.assertEqual(10, len(quantile_sketch.buckets))
+    self.assertEqual(999, quantile_sketch.count)
+    self.assertAlmostEqual(990, quantile_sketch.quantile(0.99), delta=10)
+
+
+class RollupTest(unittest.TestCase):
+  def test_aggregate_all_resolutions(self):
+    date = datetime.datetime(2017, 3, 4, 5, 6, 7)
+    rollups = rollup.aggregate([('1.1.1.1', date, {'cpu_usage': 10.0, 'mem_usage': None}),
+                                ('1.1.1.1', date, {'cpu_usage': 30.0})])
+    self.assertEqual(3, len(rollups))
+    hour = rollups[(rollup.HOUR, '1.1.1.1', 'cpu_usage', datetime.datetime(2017, 3, 4, 5))]
+    self.assertEqual((2, 10.0, 30.0, 20.0), (hour.count, hour.min, hour.max, hour.mean))
+
+  def test_plan_ranges_coarsest_buckets(self):
+    start = datetime.datetime(2017, 3, 1, 22, 30, 15)
+    end = datetime.datetime(2017, 3, 8, 1, 10)
+    plan = [(r.name, s, e) for r, s, e in rollup.plan_ranges(start, end)]
+    self.assertEqual([
+        ('minute', datetime.datetime(2017, 3, 1, 22, 30), datetime.datetime(2017, 3, 1, 23)),
+        ('hour', datetime.datetime(2017, 3, 1, 23), datetime.datetime(2017, 3, 2)),
+        ('day', datetime.datetime(2017, 3, 2), datetime.datetime(2017, 3, 8)),
+        ('hour', datetime.datetime(2017, 3, 8), datetime.datetime(2017, 3, 8, 1)),
+        ('minute', datetime.datetime(2017, 3, 8, 1), end)], plan)
+
+  def test_series_resolution(self):
+    self.assertEqual(rollup.MINUTE, rollup.get_series_resolution(300))
+    self.assertEqual(rollup.HOUR, rollup.get_series_resolution(6 * 3600))
+    self.assertEqual(rollup.DAY, rollup.get_series_resolution(7 * 86400))
+
+
+if __name__ == '__main__':
+  unittest.main()
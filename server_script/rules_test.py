@@ -0,0 +1,128 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from lib import baselines
+from lib import config
+from lib import rules
+from lib import storage
+
+
+def get_stat(id, ip_addr, cpu_usage, mem_usage=1.0, uptime=1.0):
+  return storage.MachineStats(id=id, ip_addr=ip_addr, cpu_usage=cpu_usage, mem_usage=mem_usage,
+                              uptime=uptime, event_logs='', collection_date=None)
+
+
+class CompiledRulesTest(unittest.TestCase):
+  def setUp(self):
+    self.clients = [
+        config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                      alerts=[config.Alert(type='cpu', limit='50%'),
+                              config.Alert(type='memory', limit='80%')]),
+        config.Client(ip='2.2.2.2', port='22', username='u', password='p', mail='m@m.m',
+                      alerts=[config.Alert(type='uptime', limit='1000'),
+                              config.Alert(type='disk', limit='1'),
+                              config.Alert(type='cpu', limit='n/a')])]
+    self.rules = rules.CompiledRules(self.clients)
+
+  def test_batch_evaluated_at_once(self):
+    stats = [get_stat(1, '1.1.1.1', 10.0),
+             get_stat(2, '1.1.1.1', '60', mem_usage='90'),
+             get_stat(3, '2.2.2.2', 99.0, uptime=500.0),
+             get_stat(4, '2.2.2.2', 99.0, uptime=1000.0),
+             get_stat(5, '3.3.3.3', 100.0),
+             get_stat(6, '1.1.1.1', None, mem_usage=None)]
+    violations = self.rules.evaluate(stats)
+    self.assertEqual([1, 3], list(violations.get_rows()))
+    self.assertEqual([rules.Violation('cpu', 50.0, 60.0), rules.Violation('memory', 80.0, 90.0)],
+                     violations.get(1))
+    self.assertEqual([rules.Violation('uptime', 1000.0, 1000.0)], violations.get(3))
+    self.assertEqual([3], list(violations.get_rows(2, 4)))
+    self.assertEqual([], violations.get(4))
+
+  def test_empty_batch(self):
+    violations = rules.CompiledRules([]).evaluate([])
+    self.assertEqual([], list(violations.get_rows()))
+
+  def test_operators(self):
+    client = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                           alerts=[config.Alert(type='memory', limit='5%', op='<'),
+                                   config.Alert(type='cpu', limit='50', op='!=')])
+    violations = rules.CompiledRules([client]).evaluate([get_stat(1, '1.1.1.1', 50.0, 4.0),
+                                                         get_stat(2, '1.1.1.1', 50.0, 5.0)])
+    self.assertEqual([0], list(violations.get_rows()))
+
+
+  def test_anomaly_rules(self):
+    client = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                           alerts=[config.Alert(type='cpu', limit=None, sigma='3'),
+                                   config.Alert(type='memory', limit=None, op='<', sigma='2'),
+                                   # Invalid: uptime has no baseline, sigma and a limit.
+                                   config.Alert(type='uptime', limit=None, sigma='3'),
+                                   config.Alert(type='cpu', limit='50', sigma='3')])
+    compiled = rules.CompiledRules([client, self.clients[0]])
+    self.assertEqual(2, len(compiled.anomalies[0]))
+    history = [get_stat(i, '1.1.1.1', 10.0 + i % 2, mem_usage=50.0 + i % 3) for i in range(1, 41)]
+    b = baselines.Baselines(warmup=30)
+    b.advance(history, {'1.1.1.1': 40})
+    stats = [get_stat(41, '1.1.1.1', 11.0, mem_usage=51.0),
+             get_stat(42, '1.1.1.1', 40.0, mem_usage=20.0),
+             get_stat(43, '1.1.1.1', 0.0, mem_usage=90.0),
+             get_stat(44, '9.9.9.9', 99.0)]
+    violations = compiled.evaluate(stats, b)
+    self.assertEqual([1], list(violations.get_rows()))
+    self.assertEqual(['cpu', 'memory'], [v.type for v in violations.get(1)])
+    self.assertEqual([40.0, 20.0], [v.value for v in violations.get(1)])
+    # The limit is the bound of the baseline which was crossed.
+    cpu_limit, mem_limit = [v.limit for v in violations.get(1)]
+    self.assertTrue(10.5 < cpu_limit < 20.0 and 40.0 < mem_limit < 51.0)
+    # Without baselines, only the plain rules are evaluated.
+    self.assertEqual([], list(compiled.evaluate(stats).get_rows()))
+
+
+class StatefulRulesTest(unittest.TestCase):
+  def get_raised(self, alert, samples):
+    client = config.Client(ip='1.1.1.1', port='22', username='u', password='p', mail='m@m.m',
+                           alerts=[alert])
+    compiled = rules.CompiledRules([client])
+    self.assertTrue(compiled.has_stateful_rules('1.1.1.1'))
+    state = rules.HostState()
+    raised = []
+    for i, (minute, cpu_usage) in enumerate(samples):
+      stat = get_stat(i, '1.1.1.1', cpu_usage)._replace(
+          sampled_at=datetime.datetime(2017, 1, 1, 0, minute))
+      raised.append([v.value for v in compiled.advance(state, stat)])
+    return raised
+
+  def test_sustained_samples_with_hysteresis(self):
+    alert = config.Alert(type='cpu', limit='90%', for_samples=3, clear='70%')
+    raised = self.get_raised(alert, [(0, 95), (1, 99), (2, 50), (3, 95), (4, 96), (5, 97),
+                                     (6, 98), (7, 80), (8, 95), (9, 60), (10, 91), (11, 92),
+                                     (12, 93)])
+    # A spike doesn't raise anything, a sustained high cpu raises a single alert until it's
+    # cleared (below 70%).
+    self.assertEqual([[], [], [], [], [], [97.0], [], [], [], [], [], [], [93.0]], raised)
+
+  def test_sustained_minutes(self):
+    alert = config.Alert(type='cpu', limit='90', for_minutes=5)
+    raised = self.get_raised(alert, [(0, 95), (3, 95), (5, 95), (6, 95)])
+    self.assertEqual([[], [], [95.0], []], raised)
+
+  def test_rate_of_change(self):
+    alert = config.Alert(type='cpu', limit='20', rate=True)
+    raised = self.get_raised(alert, [(0, 10), (2, 30), (3, 60)])
+    # +10/minute then +30/minute
+    self.assertEqual([[], [], [30.0]], raised)
+
+  def test_state_persisted(self):
+    state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+    store = rules.RuleStateStore(state_file)
+    store.get('1.1.1.1').get_rule('cpu')[:] = [2, 10.0, False]
+    store.save()
+    self.assertEqual([2, 10.0, False],
+                     rules.RuleStateStore(state_file).get('1.1.1.1').get_rule('cpu'))
+
+
+if __name__ == '__main__':
+  unittest.main()
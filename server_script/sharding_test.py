@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import config
+from lib import sharding
+from lib import storage
+
+
+class FakeLeaseStorage(object):
+  """In memory node_leases and host_leases tables, shared by several nodes, with a fake clock."""
+
+  def __init__(self):
+    self.now = 0
+    # {(role, node_id): expires_at}
+    self.node_leases = {}
+    # {(role, ip_addr): [owner, expires_at]}
+    self.host_leases = {}
+
+  def heartbeat_node(self, role, node_id, ttl):
+    self.node_leases[(role, node_id)] = self.now + ttl
+    return sorted(n for (r, n), expires in self.node_leases.items()
+                  if r == role and expires > self.now)
+
+  def leave_node(self, role, node_id):
+    self.node_leases.pop((role, node_id), None)
+    self.release_hosts(role, node_id)
+
+  def claim_hosts(self, role, owner, ip_addrs, ttl):
+    claimed = []
+    for ip_addr in sorted(set(ip_addrs)):
+      lease = self.host_leases.setdefault((role, ip_addr), ['', 0])
+      if lease[0] == owner or lease[1] <= self.now:
+        self.host_leases[(role, ip_addr)] = [owner, self.now + ttl]
+        claimed.append(ip_addr)
+    return claimed
+
+  def release_hosts(self, role, owner, keep=()):
+    released = []
+    for (r, ip_addr), lease in sorted(self.host_leases.items()):
+      if r == role and lease[0] == owner and lease[1] > self.now and ip_addr not in keep:
+        self.host_leases[(r, ip_addr)] = ['', self.now - 1]
+        released.append(ip_addr)
+    return released
+
+
+def get_fleet(size):
+  return [config.Client(ip='10.0.%d.%d' % (i // 256, i % 256), port='22', username='u',
+                        password='p', mail='m', alerts=[]) for i in range(size)]
+
+
+class NodePathTest(unittest.TestCase):
+  def test_get_node_path(self):
+    self.assertEqual('metrics.node-1.prom', sharding.get_node_path('metrics.prom', 'node-1'))
+    self.assertEqual('metrics.prom', sharding.get_node_path('metrics.prom', None))
+    self.assertEqual('', sharding.get_node_path('', 'node-1'))
+
+
+class HashRingTest(unittest.TestCase):
+  def test_consistent_get_node(self):
+    ips = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(2000)]
+    ring = sharding.HashRing(['a', 'b', 'c'])
+    owners = dict((ip, ring.get_node(ip)) for ip in ips)
+    counts = dict((n, list(owners.values()).count(n)) for n in 'abc')
+    for count in counts.values():
+      self.assertGreater(count, 2000 / 3 * 0.6)
+
+    # Only the machines of the removed node move.
+    ring = sharding.HashRing(['a', 'c'])
+    for ip in ips:
+      if owners[ip] != 'b':
+        self.assertEqual(owners[ip], ring.get_node(ip))
+    self.assertIsNone(sharding.HashRing([]).get_node('10.0.0.1'))
+
+
+class ShardTest(unittest.TestCase):
+  def setUp(self):
+    self.db = FakeLeaseStorage()
+    self.fleet = get_fleet(300)
+    self.ttl = 60
+
+  def get_shard(self, node_id, role=sharding.COLLECTOR):
+    return sharding.Shard(self.db, role, node_id, ttl=self.ttl)
+
+  def run_cycle(self, shards):
+    """Return {node_id: set of ips} as assigned by a cycle of each node, in order."""
+    return dict((s.node_id, set(m.ip for m in s.assign(self.fleet))) for s in shards)
+
+  def assertPartition(self, assigned):
+    ips = [ip for node_ips in assigned.values() for ip in node_ips]
+    self.assertEqual(len(ips), len(set(ips)))
+    self.assertEqual(set(m.ip for m in self.fleet), set(ips))
+
+  def test_split_assign(self):
+    shards = [self.get_shard(n) for n in ('node-1', 'node-2', 'node-3')]
+    # The first cycle of the first node happens before the others joined.
+    first = self.run_cycle(shards)
+    self.assertEqual(300, len(first['node-1']))
+    ips = [ip for node_ips in first.values() for ip in node_ips]
+    self.assertEqual(len(ips), len(set(ips)))
+
+    # node-1 releases the machines of the others which claim them on their next cycle.
+    self.db.now += 10
+    self.run_cycle(shards)
+    self.db.now += 10
+    assigned = self.run_cycle(shards)
+    self.assertPartition(assigned)
+    for node_ips in assigned.values():
+      self.assertGreater(len(node_ips), 50)
+
+    # Alerters share the same machines independently.
+    alerter = self.get_shard('node-1', role=sharding.ALERTER)
+    self.assertEqual(300, len(alerter.assign(self.fleet)))
+
+  def test_expired_node_assign(self):
+    shards = [self.get_shard(n) for n in ('node-1', 'node-2', 'node-3')]
+    for _ in range(3):
+      assigned = self.run_cycle(shards)
+      self.db.now += 10
+    self.assertPartition(assigned)
+
+    # node-3 stops, its machines are only taken over once its leases expired.
+    self.db.now += 10
+    survivors = self.run_cycle(shards[:2])
+    self.assertEqual(assigned['node-1'], survivors['node-1'])
+    self.assertEqual(assigned['node-2'], survivors['node-2'])
+
+    self.db.now += self.ttl
+    self.run_cycle(shards[:2])
+    survivors = self.run_cycle(shards[:2])
+    self.assertPartition(survivors)
+    self.assertTrue(assigned['node-1'] <= survivors['node-1'])
+
+  def test_leave(self):
+    shards = [self.get_shard(n) for n in ('node-1', 'node-2')]
+    for _ in range(3):
+      assigned = self.run_cycle(shards)
+      self.db.now += 10
+    shards[1].leave()
+    # Leases of a node which left are released right away.
+    self.assertEqual(300, len(self.run_cycle(shards[:1])['node-1']))
+
+
+def run_node(path, node_id, rounds, barrier, results, leave):
+  """Run rounds cycles of a collector node on the SQLite file path, in a child process."""
+  db = storage.open_storage(storage.SQLITE, sqlite_file=path)
+  try:
+    shard = sharding.Shard(db, sharding.COLLECTOR, node_id, ttl=60)
+    fleet = get_fleet(200)
+    for i in range(rounds):
+      barrier.wait()
+      results.put((i, node_id, sorted(m.ip for m in shard.assign(fleet))))
+      # Every node is done with the round before the next one starts.
+      barrier.wait()
+    if leave:
+      shard.leave()
+  finally:
+    db.close()
+
+
+class MultiProcessShardTest(unittest.TestCase):
+  """Nodes are separate processes sharing the leases of a SQLite database."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'fleet_health.db')
+    storage.open_storage(storage.SQLITE, sqlite_file=self.path).close()
+    self.context = multiprocessing.get_context('spawn')
+    self.fleet = set(m.ip for m in get_fleet(200))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def run_nodes(self, node_ids, rounds, leaving=()):
+    """Return [{node_id: set of ips}] claimed by the nodes in each round."""
+    barrier = self.context.Barrier(len(node_ids))
+    results = self.context.Queue()
+    processes = [self.context.Process(target=run_node, args=(
+        self.path, node_id, rounds, barrier, results, node_id in leaving)) for node_id in node_ids]
+    for process in processes:
+      process.start()
+    claimed = [{} for _ in range(rounds)]
+    for _ in range(rounds * len(node_ids)):
+      i, node_id, ips = results.get(timeout=60)
+      claimed[i][node_id] = set(ips)
+    for process in processes:
+      process.join(60)
+      self.assertEqual(0, process.exitcode)
+    return claimed
+
+  def assertDisjoint(self, claimed):
+    ips = [ip for node_ips in claimed.values() for ip in node_ips]
+    self.assertEqual(len(ips), len(set(ips)))
+
+  def test_nodes_share_the_fleet(self):
+    rounds = self.run_nodes(['node-1', 'node-2', 'node-3'], 3, leaving=['node-3'])
+    for claimed in rounds:
+      self.assertDisjoint(claimed)
+    self.assertEqual(self.fleet, set.union(*rounds[-1].values()))
+    for node_ips in rounds[-1].values():
+      self.assertGreater(len(node_ips), 30)
+
+    # node-3 left, its machines are reassigned to the remaining nodes right away.
+    survivors = self.run_nodes(['node-1', 'node-2'], 2)
+    for claimed in survivors:
+      self.assertDisjoint(claimed)
+    self.assertEqual(self.fleet, set.union(*survivors[-1].values()))
+    self.assertTrue(rounds[-1]['node-1'] <= survivors[-1]['node-1'])
+    self.assertTrue(rounds[-1]['node-2'] <= survivors[-1]['node-2'])
+
+
+if __name__ == '__main__':
+  unittest.main()
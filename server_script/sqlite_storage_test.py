@@ -0,0 +1,175 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from lib import config
+from lib import sharding
+from lib import sqlite_storage
+from lib import storage
+
+
+def mock_failure(ip_addrs):
+  raise ValueError('listener failure')
+
+
+class SQLiteStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'fleet_health.db')
+    self.db = storage.open_storage(storage.SQLITE, sqlite_file=self.path, pool_size=4)
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_store_machine_stats(self):
+    date = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    first = self.db.store_machine_stats('1.1.1.1', ['posix', '10', '20', '30', "it's"], date)
+    self.db.store_machine_stats('1.1.1.1', ['posix', 'n/a', '40', '30', ''], date)
+    stats = self.db.get_fleet_backlog(['1.1.1.1'])
+    self.assertEqual([first, first + 1], [s.id for s in stats])
+    self.assertEqual((10.0, 20.0, 30.0, "it's", date),
+                     (stats[0].cpu_usage, stats[0].mem_usage, stats[0].uptime,
+                      stats[0].event_logs, stats[0].sampled_at))
+    self.assertIsNone(stats[1].cpu_usage)
+    self.assertIsInstance(stats[0].collection_date, datetime.datetime)
+
+  def test_flush_updates_rollups(self):
+    start = datetime.datetime(2017, 1, 2)
+    for i in range(3):
+      self.db.buffer_machine_stats('1.1.1.1', ['posix', str(10 * (i + 1)), '1', '1', ''],
+                                   start + datetime.timedelta(hours=i))
+    self.assertEqual(3, self.db.flush())
+    # A second flush merges its values into the stored rollups.
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '40', '1', '1', ''],
+                                 start + datetime.timedelta(minutes=30))
+    self.db.flush()
+
+    summary = self.db.get_metric_summary('1.1.1.1', 'cpu_usage', start,
+                                         start + datetime.timedelta(days=1))
+    self.assertEqual((4, 10.0, 40.0, 25.0), (summary.count, summary.min, summary.max,
+                                              summary.mean))
+    series = self.db.get_metric_series('1.1.1.1', 'cpu_usage', start,
+                                       start + datetime.timedelta(hours=3), 3600)
+    self.assertEqual([(start, 2), (start + datetime.timedelta(hours=1), 1),
+                      (start + datetime.timedelta(hours=2), 1)],
+                     [(s, r.count) for s, r in series])
+
+  def test_fleet_summary_and_series(self):
+    start = datetime.datetime(2017, 1, 2)
+    for ip_addr, hours, cpu_usage in (('1.1.1.1', 0, 10), ('1.1.1.1', 1, 30), ('2.2.2.2', 0, 50)):
+      self.db.buffer_machine_stats(ip_addr, ['posix', str(cpu_usage), '40', '1', ''],
+                                   start + datetime.timedelta(hours=hours))
+    self.db.flush()
+    end = start + datetime.timedelta(days=1)
+    summaries = self.db.get_fleet_summary(['1.1.1.1', '2.2.2.2', '3.3.3.3'],
+                                          ['cpu_usage', 'mem_usage'], start, end)
+    self.assertEqual(sorted([('1.1.1.1', 'cpu_usage'), ('1.1.1.1', 'mem_usage'),
+                             ('2.2.2.2', 'cpu_usage'), ('2.2.2.2', 'mem_usage')]),
+                     sorted(summaries))
+    self.assertEqual((2, 20.0), (summaries[('1.1.1.1', 'cpu_usage')].count,
+                                 summaries[('1.1.1.1', 'cpu_usage')].mean))
+    series = self.db.get_fleet_series(['1.1.1.1', '2.2.2.2'], ['cpu_usage'], start, end, 3600)
+    self.assertEqual([(start, 10.0), (start + datetime.timedelta(hours=1), 30.0)],
+                     [(s, r.mean) for s, r in series[('1.1.1.1', 'cpu_usage')]])
+    with self.assertRaises(storage.StorageError):
+      self.db.get_fleet_summary(['1.1.1.1'], ['unknown'], start, end)
+
+  def test_extra_metrics_rolled_up(self):
+    start = datetime.datetime(2017, 1, 2)
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', '', 'load1=0.50;procs=a:1:2'],
+                                 start)
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', '', 'load1=1.50;disk_pct=x'],
+                                 start)
+    self.db.flush()
+    summary = self.db.get_metric_summary('1.1.1.1', 'load1', start,
+                                         start + datetime.timedelta(days=1))
+    self.assertEqual((2, 1.0), (summary.count, summary.mean))
+    self.assertEqual(0, self.db.get_metric_summary('1.1.1.1', 'disk_pct', start,
+                                                   start + datetime.timedelta(days=1)).count)
+    self.assertEqual({'load1': '0.50', 'procs': 'a:1:2'}, storage.parse_extra_metrics(
+        self.db.db.ExecuteQuery('SELECT extra_metrics FROM collected_stats ORDER BY id',
+                                'fetchone()')[0]))
+
+  def test_added_columns_of_older_database(self):
+    self.db.close()
+    path = os.path.join(self.tmp_dir, 'old.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE collected_stats (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'ip_addr VARCHAR(45) NOT NULL, os VARCHAR(45), cpu_usage REAL, '
+                       'mem_usage REAL, uptime REAL, event_logs TEXT, sampled_at DATETIME, '
+                       'collection_date DATETIME NOT NULL, consulted_for_alerts INTEGER NOT NULL '
+                       'DEFAULT 0)')
+    connection.close()
+    self.db = storage.open_storage(storage.SQLITE, sqlite_file=path)
+    self.db.store_machine_stats('1.1.1.1', ['posix', '1', '2', '3', '', 'load1=0.50'])
+
+  def test_fleet_backlog_after_watermarks(self):
+    for ip_addr in ('1.1.1.1', '2.2.2.2', '1.1.1.1'):
+      self.db.buffer_machine_stats(ip_addr, ['posix', '1', '2', '3', ''])
+    self.db.flush()
+    backlog = self.db.get_fleet_backlog(['1.1.1.1', '2.2.2.2'])
+    self.assertEqual(['1.1.1.1', '1.1.1.1', '2.2.2.2'], [s.ip_addr for s in backlog])
+
+    self.db.advance_watermarks({'1.1.1.1': backlog[1].id})
+    # Watermarks never move backward.
+    self.db.advance_watermarks({'1.1.1.1': backlog[0].id})
+    self.assertEqual({'1.1.1.1': backlog[1].id}, self.db.get_watermarks(['1.1.1.1', '2.2.2.2']))
+    self.assertEqual(['2.2.2.2'],
+                     [s.ip_addr for s in self.db.get_fleet_backlog(['1.1.1.1', '2.2.2.2'])])
+
+  def test_flush_listener(self):
+    stored = []
+    self.db.add_flush_listener(stored.append)
+    self.db.add_flush_listener(mock_failure)
+    date = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    self.db.buffer_machine_stats('2.2.2.2', ['posix', '1', '1', '1', ''], date)
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '1', '1', ''], date)
+    self.db.buffer_machine_stats('2.2.2.2', ['posix', '1', '1', '1', ''], date)
+    self.assertEqual([], stored)
+    self.assertEqual(3, self.db.flush())
+    self.db.store_machine_stats('3.3.3.3', ['posix', '1', '1', '1', ''], date)
+    # A failing listener doesn't fail the flush nor the other listeners.
+    self.assertEqual([['1.1.1.1', '2.2.2.2'], ['3.3.3.3']], stored)
+
+  def test_concurrent_flushes(self):
+    def store(ip_addr):
+      db = sqlite_storage.SQLiteStorage(self.path, max_batch=10)
+      try:
+        for i in range(50):
+          db.buffer_machine_stats(ip_addr, ['posix', str(i), '1', '1', ''])
+      finally:
+        db.close()
+    threads = [threading.Thread(target=store, args=('10.0.0.%d' % i,)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(200, len(self.db.get_fleet_backlog(['10.0.0.%d' % i for i in range(4)])))
+
+  def test_shared_fleet_leases(self):
+    fleet = [config.Client(ip='10.0.0.%d' % i, port='22', username='u', password='p', mail='m',
+                           alerts=[]) for i in range(50)]
+    other = sqlite_storage.SQLiteStorage(self.path)
+    self.addCleanup(other.close)
+    shards = [sharding.Shard(self.db, sharding.ALERTER, 'node-1'),
+              sharding.Shard(other, sharding.ALERTER, 'node-2')]
+    for _ in range(2):
+      assigned = [set(m.ip for m in s.assign(fleet)) for s in shards]
+    self.assertFalse(assigned[0] & assigned[1])
+    self.assertEqual(50, len(assigned[0] | assigned[1]))
+
+    shards[1].leave()
+    self.assertEqual(50, len(shards[0].assign(fleet)))
+
+  def test_unknown_backend(self):
+    with self.assertRaises(storage.StorageError):
+      storage.open_storage('oracle')
+
+
+if __name__ == '__main__':
+  unittest.main()
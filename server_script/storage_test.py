@@ -0,0 +1,163 @@
+import datetime
+import re
+import unittest
+
+from unittest import mock
+
+import pymysql
+
+from lib import rollup
+from lib import storage
+
+
+class StorageTest(unittest.TestCase):
+  def setUp(self):
+    patcher = mock.patch('pymysql.connect')
+    self.mock_connect = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.connection = self.mock_connect.return_value
+    self.cursor = self.connection.cursor.return_value
+    self.db = storage.Storage(None, None, max_batch=3, max_delay=60)
+
+  def test_parameterized_store_machine_stats(self):
+    self.cursor.lastrowid = 12
+    date = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    record_id = self.db.store_machine_stats('1.2.3.4', ['posix', '1', '2', '3', "it's"], date)
+    self.assertEqual(12, record_id)
+    query, params = self.cursor.execute.call_args_list[0][0]
+    self.assertNotIn('1.2.3.4', query)
+    self.assertEqual(('1.2.3.4', 'posix', 1.0, 2.0, 3.0, "it's", date), params[:7])
+
+  def test_invalid_metrics_stored_as_null(self):
+    self.db.store_machine_stats('1.2.3.4', ['posix', '', 'nan', 'n/a', 'empty'])
+    params = self.cursor.execute.call_args_list[0][0][1]
+    self.assertEqual((None, None, None), params[2:5])
+    # The sample time is unknown, the collection date is always set
+    self.assertIsNone(params[6])
+    self.assertIsNotNone(params[7])
+
+  def test_buffered_stats_flushed_by_batch(self):
+    self.assertEqual(0, self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty']))
+    self.assertEqual(0, self.db.buffer_machine_stats('1.1.1.2', ['posix', '1', '2', '3', 'empty']))
+    self.assertFalse(self.cursor.executemany.called)
+    self.assertEqual(3, self.db.buffer_machine_stats('1.1.1.3', ['posix', '1', '2', '3', 'empty']))
+    query, rows = self.cursor.executemany.call_args_list[0][0]
+    self.assertEqual(storage.Storage.insert_qry, query)
+    self.assertEqual(3, len(rows))
+    self.connection.commit.assert_called_once_with()
+    self.assertEqual(0, self.db.pending_count())
+
+  def test_buffered_stats_flushed_after_delay(self):
+    self.db.max_delay = 0
+    self.assertEqual(1, self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty']))
+
+  def test_failed_flush_keeps_stats(self):
+    self.cursor.executemany.side_effect = pymysql.OperationalError('gone away')
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty'])
+    with self.assertRaises(storage.LogStatsError):
+      self.db.flush()
+    self.connection.rollback.assert_called_once_with()
+    self.assertEqual(1, self.db.pending_count())
+
+    self.cursor.executemany.side_effect = None
+    self.assertEqual(1, self.db.flush())
+
+  def test_failed_flush_drops_stats_with_callback(self):
+    stored = []
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty'],
+                                 on_stored=lambda: stored.append(1))
+    self.assertEqual(1, self.db.flush())
+    self.assertEqual([1], stored)
+    self.cursor.executemany.side_effect = pymysql.OperationalError('gone away')
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty'],
+                                 on_stored=lambda: stored.append(2))
+    self.db.buffer_machine_stats('1.1.1.2', ['posix', '1', '2', '3', 'empty'])
+    with self.assertRaises(storage.LogStatsError):
+      self.db.flush()
+    # The caller sends the first record again, the second one is kept for the next flush.
+    self.assertEqual([1], stored)
+    self.assertEqual(1, self.db.pending_count())
+
+  def test_fleet_backlog_after_watermarks(self):
+    self.cursor.fetchall.side_effect = [
+        [('1.1.1.1', 10)],
+        [(11, '1.1.1.1', '1', '2', '3', 'empty', None), (3, '2.2.2.2', '4', '5', '6', 'empty', None)]]
+    backlog = self.db.get_fleet_backlog(['2.2.2.2', '1.1.1.1'])
+    self.assertEqual([11, 3], [s.id for s in backlog])
+    # Single backlog query for the whole fleet, machines without watermark start from 0
+    query, params = self.cursor.execute.call_args[0]
+    self.assertEqual(2, query.count('(ip_addr = %s AND id > %s)'))
+    self.assertEqual(('1.1.1.1', 10, '2.2.2.2', 0), params)
+
+  def test_advance_watermarks(self):
+    self.db.advance_watermarks({'2.2.2.2': 5, '1.1.1.1': 7})
+    self.cursor.executemany.assert_called_once_with(storage.Storage.advance_watermark_qry,
+                                                    [('1.1.1.1', 7), ('2.2.2.2', 5)])
+
+  def test_flush_merges_stored_rollups(self):
+    date = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    stored = rollup.Rollup().add(10.0)
+    self.cursor.fetchall.return_value = [
+        ('1.1.1.1', 'cpu_usage', datetime.datetime(2017, 1, 2, 3, 4)) + stored.to_row()]
+    self.db.buffer_machine_stats('1.1.1.1', ['posix', '30', '2', '3', 'empty'], date)
+    self.db.flush()
+    upserts = dict((call[0][0].split()[2].split('(')[0], call[0][1])
+                   for call in self.cursor.executemany.call_args_list[1:])
+    self.assertEqual(['stats_rollup_day', 'stats_rollup_hour', 'stats_rollup_minute'],
+                     sorted(upserts))
+    minute_rows = dict((row[1], row) for row in upserts['stats_rollup_minute'])
+    # The stored rollup of the minute was merged with the new value
+    self.assertEqual(('1.1.1.1', 'cpu_usage', datetime.datetime(2017, 1, 2, 3, 4), 2, 10.0, 30.0,
+                      40.0), minute_rows['cpu_usage'][:7])
+    self.assertEqual(1, minute_rows['mem_usage'][3])
+    # Both the insert and the rollups were committed at once
+    self.connection.commit.assert_called_once_with()
+
+  def test_metric_summary_reads_coarsest_rollups(self):
+    rollups = {'stats_rollup_day': rollup.Rollup().add(20.0).add(40.0),
+               'stats_rollup_minute': rollup.Rollup().add(90.0)}
+    tables = []
+
+    def fetchall():
+      table = re.search(r'FROM (\w+)', self.cursor.execute.call_args[0][0]).group(1)
+      tables.append(table)
+      return [(None,) + rollups[table].to_row()] if table in rollups else []
+
+    self.cursor.fetchall.side_effect = fetchall
+    summary = self.db.get_metric_summary('1.1.1.1', 'cpu_usage',
+                                         datetime.datetime(2017, 1, 1, 23, 59),
+                                         datetime.datetime(2017, 1, 3))
+    self.assertEqual((3, 20.0, 90.0, 50.0),
+                     (summary.count, summary.min, summary.max, summary.mean))
+    # The last minute of the first day then 1 day bucket instead of ~1.5k minute buckets
+    self.assertEqual(['stats_rollup_minute', 'stats_rollup_day'], tables)
+
+  def test_claim_hosts_in_one_transaction(self):
+    self.cursor.fetchall.return_value = [('1.1.1.1',), ('3.3.3.3',)]
+    claimed = self.db.claim_hosts('alerter', 'node-1', ['2.2.2.2', '1.1.1.1'], 60)
+    # 3.3.3.3 is still leased by node-1 but wasn't asked for.
+    self.assertEqual(['1.1.1.1'], claimed)
+    self.cursor.executemany.assert_called_once_with(
+        storage.Storage.create_host_leases_qry,
+        [('alerter', '1.1.1.1'), ('alerter', '2.2.2.2')])
+    claim_qry, params = self.cursor.execute.call_args_list[0][0]
+    self.assertIn('IN (%s, %s)', claim_qry)
+    self.assertEqual(('node-1', 60, 'alerter', '1.1.1.1', '2.2.2.2', 'node-1'), params)
+    self.assertEqual(1, self.mock_connect.return_value.commit.call_count)
+
+  def test_connection_reused(self):
+    self.db.store_machine_stats('1.1.1.1', ['posix', '1', '2', '3', 'empty'])
+    self.db.get_watermarks(['1.1.1.1'])
+    self.assertEqual(1, self.mock_connect.call_count)
+
+  def test_unavailable_db(self):
+    self.mock_connect.side_effect = pymysql.OperationalError('Can\'t connect')
+    with self.assertRaises(storage.StorageUnavailableError):
+      self.db.get_watermarks(['1.1.1.1'])
+    # The failed attempt didn't leak its pool slot
+    self.mock_connect.side_effect = None
+    self.assertEqual({}, self.db.get_watermarks(['1.1.1.1']))
+
+
+if __name__ == '__main__':
+  unittest.main()
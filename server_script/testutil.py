@@ -0,0 +1,14 @@
+"""Helpers shared by the tests."""
+
+import importlib.util
+import os
+
+
+def load_local_collector():
+  """Import client_script/local_collector.py which isn't part of any package."""
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client_script',
+                      'local_collector.py')
+  spec = importlib.util.spec_from_file_location('local_collector', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
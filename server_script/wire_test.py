@@ -0,0 +1,66 @@
+import struct
+import unittest
+
+import testutil
+
+from lib import wire
+
+
+class WireTest(unittest.TestCase):
+  def setUp(self):
+    self.record = wire.Record(sampled_at=1500000000.5, os='posix', cpu_usage=12.5, mem_usage=40.0,
+                              uptime=3600.0, event_logs='empty',
+                              metrics={'load1': 0.5, 'disk_pct': 71.25},
+                              labels={'procs': 'sshd:22:0.1|cron:1:0.0'})
+
+  def test_round_trip(self):
+    batch = wire.decode_batch(wire.encode_batch([self.record, wire.Record()],
+                                                meta={'host': 'a'}))
+    self.assertEqual(wire.WIRE_VERSION, batch.version)
+    self.assertEqual({'host': 'a'}, batch.meta)
+    self.assertEqual(self.record, batch.records[0])
+    self.assertEqual(wire.Record(metrics={}, labels={}), batch.records[1])
+
+  def test_compressed(self):
+    records = [self.record] * 100
+    data = wire.encode_batch(records)
+    self.assertTrue(data[4] & wire.FLAG_COMPRESSED)
+    self.assertLess(len(data), len(wire.encode_batch(records, compress=False)))
+    self.assertEqual(records, wire.decode_batch(data).records)
+
+  def test_unknown_fields_and_sections(self):
+    # A newer client sending a field and a section this side doesn't know about
+    fields = wire.FIELDS + (('I', 'new_field'),)
+    data = bytearray(wire.encode_batch([self.record._replace(metrics=None, labels=None)],
+                                       fields=fields, compress=False))
+    body_offset = (wire.HEADER.size + sum(wire.FIELD.size + len(name) for _, name in fields) +
+                   wire.SECTION.size)
+    sections_offset = body_offset + struct.calcsize('<dffd')
+    struct.pack_into('<H', data, sections_offset, 3)
+    data += wire.SECTION.pack(99, 3) + b'new'
+    record = wire.decode_batch(bytes(data)).records[0]
+    self.assertEqual(self.record._replace(metrics={}, labels={}), record)
+
+  def test_missing_values(self):
+    record = wire.decode_batch(wire.encode_batch([wire.Record(cpu_usage=float('nan'))])).records[0]
+    self.assertIsNone(record.cpu_usage)
+    self.assertEqual('', wire.format_extra_metrics(record))
+
+  def test_invalid_batch(self):
+    data = wire.encode_batch([self.record])
+    for invalid in (data[:-1], data[:8], b'posix,1,2,3,empty', b'FHW\xff' + data[4:]):
+      with self.assertRaises(wire.WireError):
+        wire.decode_batch(invalid)
+
+  def test_local_collector_encoding(self):
+    local_collector = testutil.load_local_collector()
+    client_wire = local_collector.get_wire()
+    data = client_wire.encode_batch([client_wire.Record(**self.record._asdict())] * 20)
+    self.assertEqual(wire.encode_batch([self.record] * 20), data)
+    self.assertEqual(['posix', 12.5, 40.0, 3600.0, 'empty',
+                      'disk_pct=71.25;load1=0.50;procs=sshd:22:0.1|cron:1:0.0'],
+                     wire.get_stats_fields(wire.decode_batch(data).records[0]))
+
+
+if __name__ == '__main__':
+  unittest.main()
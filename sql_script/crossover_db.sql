@@ -23,17 +23,144 @@ DROP TABLE IF EXISTS `collected_stats`;
 /*!40101 SET @saved_cs_client     = @@character_set_client */;
 /*!40101 SET character_set_client = utf8 */;
 CREATE TABLE `collected_stats` (
-  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
   `ip_addr` varchar(45) NOT NULL,
   `os` varchar(45) DEFAULT NULL,
-  `cpu_usage` varchar(45) DEFAULT NULL,
-  `mem_usage` varchar(45) DEFAULT NULL,
-  `uptime` varchar(45) DEFAULT NULL,
+  `cpu_usage` float DEFAULT NULL COMMENT 'Percentage.',
+  `mem_usage` float DEFAULT NULL COMMENT 'Percentage.',
+  `uptime` double DEFAULT NULL COMMENT 'Seconds.',
   `event_logs` longtext,
-  `collection_date` datetime DEFAULT CURRENT_TIMESTAMP,
-  `consulted_for_alerts` tinyint(1) DEFAULT '0' COMMENT 'This field is used to indicate whether the spcific record was consulted (and potentially generated an alert) or not. THe alerter modle uses this field in order to trigger alerts.',
-  PRIMARY KEY (`id`)
-) ENGINE=InnoDB AUTO_INCREMENT=14 DEFAULT CHARSET=latin1;
+  `sampled_at` datetime DEFAULT NULL COMMENT 'Time of the measure on the client.',
+  `collection_date` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Time at which the record was stored, partitioning key.',
+  `extra_metrics` text COMMENT 'Other metrics reported by the client: key=value;key=value (load, disk, network, top processes...).',
+  PRIMARY KEY (`id`,`collection_date`),
+  KEY `idx_ip_addr_id` (`ip_addr`,`id`),
+  KEY `idx_ip_addr_date` (`ip_addr`,`collection_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1
+/*!50100 PARTITION BY RANGE (TO_DAYS(`collection_date`))
+(PARTITION p_history VALUES LESS THAN (TO_DAYS('2017-10-01')),
+ PARTITION p_future VALUES LESS THAN MAXVALUE) */;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `alert_watermarks`
+--
+
+DROP TABLE IF EXISTS `alert_watermarks`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `alert_watermarks` (
+  `ip_addr` varchar(45) NOT NULL,
+  `last_id` bigint(20) NOT NULL DEFAULT '0' COMMENT 'Id of the last collected_stats record of the machine which was treated by the alerter. Records with a greater id are the alerter backlog.',
+  `updated_at` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`ip_addr`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stats_rollup_minute`
+--
+
+DROP TABLE IF EXISTS `stats_rollup_minute`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stats_rollup_minute` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stats_rollup_hour`
+--
+
+DROP TABLE IF EXISTS `stats_rollup_hour`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stats_rollup_hour` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stats_rollup_day`
+--
+
+DROP TABLE IF EXISTS `stats_rollup_day`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stats_rollup_day` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `node_leases`
+--
+
+DROP TABLE IF EXISTS `node_leases`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `node_leases` (
+  `role` varchar(16) NOT NULL,
+  `node_id` varchar(64) NOT NULL,
+  `expires_at` datetime NOT NULL,
+  PRIMARY KEY (`role`,`node_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `host_leases`
+--
+
+DROP TABLE IF EXISTS `host_leases`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `host_leases` (
+  `role` varchar(16) NOT NULL,
+  `ip_addr` varchar(45) NOT NULL,
+  `owner` varchar(64) NOT NULL COMMENT 'node_id of the node working on the machine, empty if none.',
+  `expires_at` datetime NOT NULL,
+  PRIMARY KEY (`role`,`ip_addr`),
+  KEY `idx_owner` (`role`,`owner`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `schema_version`
+--
+
+DROP TABLE IF EXISTS `schema_version`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `schema_version` (
+  `version` int(11) NOT NULL,
+  `applied_at` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
 
+INSERT INTO `schema_version` (`version`) VALUES (2);
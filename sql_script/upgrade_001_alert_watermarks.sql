@@ -0,0 +1,19 @@
+-- Upgrade of an existing crossover_db to the per-machine alerter watermarks.
+--
+-- The alerter no longer flags every treated record (consulted_for_alerts), it keeps the id of the
+-- last treated record of each machine in alert_watermarks. Watermarks are initialized right before
+-- the first record which was never consulted, so nothing is alerted twice nor skipped.
+
+ALTER TABLE `collected_stats` ADD KEY `idx_ip_addr_id` (`ip_addr`,`id`);
+
+CREATE TABLE IF NOT EXISTS `alert_watermarks` (
+  `ip_addr` varchar(45) NOT NULL,
+  `last_id` int(11) NOT NULL DEFAULT '0' COMMENT 'Id of the last collected_stats record of the machine which was treated by the alerter. Records with a greater id are the alerter backlog.',
+  `updated_at` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`ip_addr`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+INSERT INTO `alert_watermarks` (`ip_addr`, `last_id`)
+  SELECT `ip_addr`, COALESCE(MIN(CASE WHEN `consulted_for_alerts` = 0 THEN `id` END) - 1, MAX(`id`))
+  FROM `collected_stats` GROUP BY `ip_addr`
+  ON DUPLICATE KEY UPDATE `last_id` = VALUES(`last_id`);
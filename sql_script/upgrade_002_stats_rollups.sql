@@ -0,0 +1,40 @@
+-- Upgrade of an existing crossover_db to the minute/hour/day rollups of the collected stats.
+--
+-- Rollups are maintained by the collector as it stores stats, they only cover the stats collected
+-- after the upgrade.
+
+CREATE TABLE IF NOT EXISTS `stats_rollup_minute` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE IF NOT EXISTS `stats_rollup_hour` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE IF NOT EXISTS `stats_rollup_day` (
+  `ip_addr` varchar(45) NOT NULL,
+  `metric` varchar(16) NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `count` int(11) NOT NULL,
+  `min_value` double NOT NULL,
+  `max_value` double NOT NULL,
+  `sum_value` double NOT NULL,
+  `sketch` blob NOT NULL COMMENT 'Quantile sketch of the values, see server_script/lib/sketch.py.',
+  PRIMARY KEY (`ip_addr`,`metric`,`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -0,0 +1,20 @@
+-- Upgrade of an existing crossover_db to collectors and alerters sharing the fleet (--node-id).
+--
+-- Nodes renew their lease in node_leases on every cycle and only work on the machines they
+-- hold a lease on in host_leases, see server_script/lib/sharding.py.
+
+CREATE TABLE IF NOT EXISTS `node_leases` (
+  `role` varchar(16) NOT NULL,
+  `node_id` varchar(64) NOT NULL,
+  `expires_at` datetime NOT NULL,
+  PRIMARY KEY (`role`,`node_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE IF NOT EXISTS `host_leases` (
+  `role` varchar(16) NOT NULL,
+  `ip_addr` varchar(45) NOT NULL,
+  `owner` varchar(64) NOT NULL COMMENT 'node_id of the node working on the machine, empty if none.',
+  `expires_at` datetime NOT NULL,
+  PRIMARY KEY (`role`,`ip_addr`),
+  KEY `idx_owner` (`role`,`owner`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
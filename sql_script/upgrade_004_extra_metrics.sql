@@ -0,0 +1,9 @@
+-- Upgrade of an existing crossover_db to the extra metrics reported by the clients (load, disk,
+-- network, swap, top processes...).
+--
+-- To be applied once collected_stats is at schema version 2 (see server_script/migrate.py), a
+-- table migrated from now on already has the column. The collector has to be upgraded after
+-- this script.
+
+ALTER TABLE `collected_stats` ADD COLUMN `extra_metrics` text
+  COMMENT 'Other metrics reported by the client: key=value;key=value (load, disk, network, top processes...).';
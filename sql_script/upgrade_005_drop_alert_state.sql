@@ -0,0 +1,9 @@
+-- Upgrade of an existing crossover_db dropping the per-record alert processing state.
+--
+-- The alerter reads its backlog through alert_watermarks (idx_ip_addr_id), nothing reads
+-- consulted_for_alerts anymore and idx_alert_state only slowed the inserts down. To be applied once
+-- collected_stats is at schema version 2 (see server_script/migrate.py) and after
+-- upgrade_001_alert_watermarks.sql, which initializes the watermarks from consulted_for_alerts. A
+-- table migrated from now on has neither of them, this script doesn't apply to it.
+
+ALTER TABLE `collected_stats` DROP KEY `idx_alert_state`, DROP COLUMN `consulted_for_alerts`;